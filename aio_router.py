@@ -0,0 +1,174 @@
+import asyncio
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from topic_router import Handler, SubscriptionTrie
+
+class Message:
+    """The parts of a paho MQTTMessage the handlers use."""
+
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+class PublishInfo:
+    """Stands in for paho's MQTTMessageInfo for messages published from a plugin thread."""
+
+    def __init__(self, future):
+        self._future = future
+
+    def is_published(self) -> bool:
+        return self._future.done() and self._future.exception() is None
+
+    def wait_for_publish(self, timeout: Optional[float] = None) -> None:
+        # Raises if the publish failed, like paho does when the client is disconnected
+        self._future.result(timeout)
+
+class AsyncTopicRouter:
+    """The TopicRouter interface on an asyncio MQTT client (aiomqtt), for the asyncio runtime.
+
+    Create it inside the running event loop. Coroutine handlers run as tasks
+    on the loop and publish with ``await client.apublish(...)``. Existing
+    plugins' blocking handlers run on a fixed pool of ``plugin_threads``
+    threads and get this router as their ``client``: its publish() is
+    thread-safe and returns an object with wait_for_publish(), like paho.
+    At most ``max_concurrency`` handlers run at once; beyond that the
+    message loop waits, pushing back on the broker connection.
+
+    subscribe/unsubscribe/publish/start/stop may be called from any thread,
+    so PluginManager and plugins use it exactly like a TopicRouter.
+    """
+
+    # MqttListenerPlugin.subscribe checks this before accepting coroutine handlers
+    is_async = True
+
+    def __init__(self, broker: str, port: int = 1883, client_id: str = "", keepalive: int = 60,
+                 plugin_threads: int = 8, max_concurrency: int = 1000, reconnect_delay: float = 1.0):
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id
+        self.keepalive = keepalive
+        self.reconnect_delay = reconnect_delay
+        self.trie = SubscriptionTrie()
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(plugin_threads, thread_name_prefix="plugin")
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._client = None
+        self._task = None
+        self._tasks = set()
+
+    def _on_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _schedule(self, coro):
+        """Run coro on the loop from any thread; returns a concurrent.futures.Future."""
+        if self._on_loop():
+            task = self.loop.create_task(coro)
+            self._tasks.add(task)
+            task.add_done_callback(self._forget)
+            return _TaskFuture(task)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def subscribe(self, topic_filter: str, handler: Handler) -> None:
+        if self.trie.add(topic_filter, handler) and self._client is not None:
+            self._schedule(self._client.subscribe(topic_filter))
+
+    def unsubscribe(self, topic_filter: str, handler: Handler) -> None:
+        if self.trie.remove(topic_filter, handler) and self._client is not None:
+            self._schedule(self._client.unsubscribe(topic_filter))
+
+    def publish(self, topic: str, payload: Any = None, qos: int = 0, retain: bool = False) -> PublishInfo:
+        return PublishInfo(self._schedule(self.apublish(topic, payload, qos, retain)))
+
+    async def apublish(self, topic: str, payload: Any = None, qos: int = 0, retain: bool = False) -> None:
+        if self._client is None:
+            raise ConnectionError("MQTT client is not connected")
+        await self._client.publish(topic, payload, qos=qos, retain=retain)
+
+    def start(self) -> "AsyncTopicRouter":
+        """Start the connection task (from any thread); it reconnects until stop()."""
+        if self._task is None:
+            if self._on_loop():
+                self._task = self.loop.create_task(self.run())
+            else:
+                self._task = asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+            logging.info("Shared async MQTT connection to %s:%d started", self.broker, self.port)
+        return self
+
+    def stop(self) -> None:
+        if self._task is not None:
+            if self._on_loop():
+                self._task.cancel()
+            else:
+                self.loop.call_soon_threadsafe(self._task.cancel)
+            self._task = None
+        self.executor.shutdown(wait=False)
+
+    async def run(self) -> None:
+        import aiomqtt
+        while True:
+            try:
+                async with aiomqtt.Client(self.broker, self.port, identifier=self.client_id or None,
+                                          keepalive=self.keepalive) as client:
+                    self._client = client
+                    filters = self.trie.filters()
+                    if filters:
+                        await client.subscribe([(f, 0) for f in filters])
+                    logging.info("Shared async MQTT connection subscribed to %d topic filters", len(filters))
+                    async for message in client.messages:
+                        await self.dispatch(Message(message.topic.value, message.payload, message.qos,
+                                                    message.retain))
+            except aiomqtt.MqttError as e:
+                logging.warning("Shared async MQTT connection lost (%s); reconnecting", e)
+            finally:
+                self._client = None
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def dispatch(self, msg: Message) -> None:
+        """Start every handler matching msg.topic; waits only while max_concurrency handlers run."""
+        for handler in self.trie.match(msg.topic):
+            await self._slots.acquire()
+            if inspect.iscoroutinefunction(handler):
+                task = self.loop.create_task(handler(self, None, msg))
+            else:
+                task = self.loop.run_in_executor(self.executor, handler, self, None, msg)
+            self._tasks.add(task)
+            task.add_done_callback(lambda t, topic=msg.topic: self._done(t, topic))
+
+    def _forget(self, task) -> None:
+        # Nobody may wait on a fire-and-forget publish: retrieve its outcome here
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.debug("Publish failed: %s", task.exception())
+
+    def _done(self, task, topic) -> None:
+        self._tasks.discard(task)
+        self._slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Handler for %s failed", topic, exc_info=task.exception())
+
+class _TaskFuture:
+    """PublishInfo's view of a task scheduled from the loop thread itself (never waited on there)."""
+
+    def __init__(self, task):
+        self._task = task
+
+    def done(self) -> bool:
+        return self._task.done()
+
+    def exception(self):
+        return self._task.exception()
+
+    def result(self, timeout=None):
+        if not self._task.done():
+            raise RuntimeError("cannot wait for a publish on the event loop thread")
+        return self._task.result()
@@ -0,0 +1,71 @@
+"""Memory held per buffered VIN by the correlation buffer, measured with tracemalloc.
+
+Every VIN has its vin and location parts buffered and is still waiting for
+giro, the common case while a fleet is reporting. The slotted PartialRecord
+buffer is compared with the legacy layout (one dict per record holding the
+decoded JSON payload dict of each part).
+
+    python benchmarks/bench_buffer_memory.py --vins 1000000
+"""
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from correlator import Correlator
+
+
+def payloads(vins):
+    ts = time.time()
+    for i in range(vins):
+        vin = f"VIN{i:08d}"
+        yield ("vin", json.dumps({"vin": vin, "ts": ts}).encode())
+        yield ("location", json.dumps({"vin": vin, "ts": ts, "latitude": 45.5 + i * 1e-6,
+                                       "longitude": -73.6}).encode())
+
+
+def fill_slotted(vins):
+    correlator = Correlator(window=60, ttl=3600)
+    for part, raw in payloads(vins):
+        correlator.add(part, json.loads(raw))
+    return correlator
+
+
+def fill_legacy(vins):
+    buffer = {}
+    for part, raw in payloads(vins):
+        payload = json.loads(raw)
+        entry = buffer.setdefault(payload["vin"], {"vin": None, "location": None, "giro": None})
+        entry[part] = payload
+    return buffer
+
+
+def measure(fill, vins):
+    gc.collect()
+    tracemalloc.start()
+    held = fill(vins)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+    gc.collect()
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vins", type=int, default=1000000)
+    args = parser.parse_args()
+
+    for name, fill in (("slotted", fill_slotted), ("legacy", fill_legacy)):
+        current, peak = measure(fill, args.vins)
+        print(f"{name:8s} vins={args.vins}  {current / args.vins:8.1f} bytes/VIN  "
+              f"held={current / 2**20:8.1f} MiB  peak={peak / 2**20:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
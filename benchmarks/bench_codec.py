@@ -0,0 +1,76 @@
+"""Encode/decode cost and bytes on the wire for each wire codec (no services needed).
+
+Times the sensor payloads (vin, location, giro) and a 500-row RPC chunk with
+every codec / compression combination whose library is installed. Plain JSON
+is the legacy format.
+
+    python benchmarks/bench_codec.py --iterations 100000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import codec
+from codec import Codec, decode
+
+SENSOR_PAYLOADS = {
+    "vin": {"vin": "1HGCM82633A004352", "ts": 1700000000.123456},
+    "location": {"vin": "1HGCM82633A004352", "ts": 1700000000.123456, "latitude": 45.501689, "longitude": -73.567256},
+    "giro": {"vin": "1HGCM82633A004352", "ts": 1700000000.123456, "giro": 187.25},
+}
+RPC_CHUNK = {
+    "correlation_id": "9b2f0c1e-4e0b-4a8e-9d7c-3f1f6f0f2a11",
+    "seq": 0,
+    "rows": [{"vin": f"VIN{i:08d}", "latitude": 45.5 + i * 1e-5, "longitude": -73.6, "giro": float(i % 360)}
+             for i in range(500)],
+}
+
+
+def codecs_for(layout):
+    options = [("json", None)]
+    if codec.msgpack is not None:
+        options.append(("msgpack", None))
+    if layout is not None:
+        options.append(("struct", None))
+    for name in [n for n, _ in options]:
+        options.append((name, "zlib"))
+        if codec.zstandard is not None:
+            options.append((name, "zstd"))
+    return [Codec(name, compression, compress_over=0, layout=layout if name == "struct" else None)
+            for name, compression in options]
+
+
+def measure(c, payload, iterations):
+    encoded = c.encode(payload)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        c.encode(payload)
+    encode_us = (time.perf_counter() - start) / iterations * 1e6
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decode(encoded)
+    decode_us = (time.perf_counter() - start) / iterations * 1e6
+    return len(encoded), encode_us, decode_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    cases = [(name, payload, name) for name, payload in SENSOR_PAYLOADS.items()]
+    cases.append(("rpc chunk (500 rows)", RPC_CHUNK, None))
+    for name, payload, layout in cases:
+        iterations = args.iterations if layout is not None else max(args.iterations // 500, 10)
+        print(f"{name}:")
+        for c in codecs_for(layout):
+            size, encode_us, decode_us = measure(c, payload, iterations)
+            label = c.name + (f"+{c.compression}" if c.compression else "")
+            print(f"  {label:14s} {size:7d} B   encode {encode_us:9.2f} us   decode {decode_us:9.2f} us")
+
+
+if __name__ == "__main__":
+    main()
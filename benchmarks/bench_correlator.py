@@ -0,0 +1,82 @@
+"""Join throughput of the VIN-keyed correlator with many concurrently reporting VINs.
+
+Every VIN sends its vin/location/giro parts in shuffled order, interleaved with
+all other VINs. The legacy join (attach location/giro to list(buffer)[-1]) is
+timed on a smaller sample since it is O(live VINs) per message.
+
+    python benchmarks/bench_correlator.py --vins 100000
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from correlator import Correlator
+
+
+def workload(vins, seed=1):
+    rng = random.Random(seed)
+    now = time.time()
+    messages = []
+    for i in range(vins):
+        vin = f"VIN{i:08d}"
+        ts = now + rng.random()
+        messages.append(("vin", {"vin": vin, "ts": ts}))
+        messages.append(("location", {"vin": vin, "ts": ts, "latitude": 45.0, "longitude": -73.0}))
+        messages.append(("giro", {"vin": vin, "ts": ts, "giro": 90.0}))
+    rng.shuffle(messages)
+    return messages
+
+
+def run_correlator(messages):
+    correlator = Correlator(window=60)
+    completed = 0
+    start = time.perf_counter()
+    for part, payload in messages:
+        vin = correlator.add(part, payload)
+        if vin is not None and correlator.pop_complete(vin) is not None:
+            completed += 1
+    return completed, time.perf_counter() - start
+
+
+def run_legacy(messages):
+    buffer = {}
+    completed = 0
+    start = time.perf_counter()
+    for part, payload in messages:
+        if part == "vin":
+            vin = payload["vin"]
+        elif buffer:
+            vin = list(buffer.keys())[-1]
+        else:
+            continue
+        entry = buffer.setdefault(vin, {"vin": None, "location": None, "giro": None})
+        entry[part] = payload
+        if entry["vin"] and entry["location"] and entry["giro"]:
+            completed += 1
+            del buffer[vin]
+    return completed, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--vins", type=int, default=100000)
+    parser.add_argument("--legacy-vins", type=int, default=5000)
+    args = parser.parse_args()
+
+    messages = workload(args.vins)
+    completed, elapsed = run_correlator(messages)
+    print(f"correlator: vins={args.vins} msgs={len(messages)} "
+          f"{len(messages) / elapsed:12.0f} msgs/s  complete={completed}/{args.vins}")
+
+    messages = workload(args.legacy_vins)
+    completed, elapsed = run_legacy(messages)
+    print(f"legacy:     vins={args.legacy_vins} msgs={len(messages)} "
+          f"{len(messages) / elapsed:12.0f} msgs/s  complete={completed}/{args.legacy_vins}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Writes-per-second of the twin storage layer: connect-per-call vs pooled.
+
+Needs a reachable PostgreSQL, e.g. the compose `db` service:
+
+    python benchmarks/bench_db_pool.py --host localhost --port 5431 --writes 2000 --threads 4
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import psycopg2
+import db
+
+
+def legacy_write(vin, lat, lon, giro):
+    """The pre-pool write path: one connection per INSERT."""
+    conn = psycopg2.connect(host=db.DB_HOST, dbname=db.DB_NAME, user=db.DB_USER, password=db.DB_PASS)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO vehicle_data (vin, latitude, longitude, giro) VALUES (%s, %s, %s, %s)",
+                (vin, lat, lon, giro))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def run(write, writes, threads):
+    per_thread = writes // threads
+
+    def worker(n):
+        for i in range(per_thread):
+            write(f"BENCH{n:04d}", 45.0 + i * 1e-6, -73.0, float(i % 360))
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=db.DB_HOST)
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--dbname", default=db.DB_NAME)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    # libpq picks the port up from the environment for both code paths
+    os.environ["PGPORT"] = args.port
+    db.DB_HOST = args.host
+    db.DB_NAME = args.dbname
+    db.POOL_MIN_CONN = db.POOL_MAX_CONN = max(args.threads, 1)
+    db.init_db()
+
+    before = run(legacy_write, args.writes, args.threads)
+    after = run(db.write_vehicle_data, args.writes, args.threads)
+    db.close_pool()
+
+    print(f"writes={args.writes} threads={args.threads}")
+    print(f"connect-per-call: {before:10.1f} writes/s")
+    print(f"pooled+prepared:  {after:10.1f} writes/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
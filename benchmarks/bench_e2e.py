@@ -0,0 +1,258 @@
+"""End-to-end latency and throughput: producer -> vehicle twin -> DB -> trigger -> fleet twin -> fleet DB.
+
+Needs the broker, both databases and both twins running, e.g. the compose
+stack without the producers:
+
+    docker compose up -d mqtt-broker fdt-broker db db_fleet vehicle_digital_twin fleet_digital_twin
+    python benchmarks/bench_e2e.py --broker localhost --db-port 5431 --fleet-db-port 5433 \\
+        --rates 500,1000,2000,4000,8000 --duration 20
+
+For each offered rate (messages/s, three messages per vehicle report), the
+harness publishes timestamped vin/location/giro reports under VINs unique to
+the run. It waits for the twin to drain, then reads the results back from
+vehicle_data:
+
+- publish-to-commit latency p50/p95/p99/max. This is ingest_time - event_time,
+  where ingest_time is the start of the batch's write transaction;
+- committed rows and sustained msgs/s over the phase.
+
+It then sends --fleet-samples trigger requests for VINs of the phase and
+measures trigger-to-fleet-commit latency from the fleet database. The
+saturation point is the highest offered rate that was sustained: at least 95%
+of the offered rate, and p99 within --slo-ms.
+
+Results are written as JSON (--output). Pass --compare with an earlier result
+file to print the change per rate.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import paho.mqtt.client as mqtt
+import psycopg2
+from codec import TopicCodecs
+
+TOPIC_VIN = "vehicles/vin"
+TOPIC_LOCATION = "vehicles/location"
+TOPIC_GIRO = "vehicles/giro"
+TRIGGER_TOPIC = "vehicles/request"
+MESSAGES_PER_REPORT = 3
+
+LATENCY_SQL = """
+    SELECT count(*),
+           percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY lag),
+           max(lag),
+           EXTRACT(EPOCH FROM max(ingest_time))::float8
+    FROM (
+        SELECT ingest_time, EXTRACT(EPOCH FROM ingest_time - event_time) * 1000 AS lag
+        FROM vehicle_data
+        WHERE vin LIKE %s AND event_time >= to_timestamp(%s)
+    ) phase
+"""
+
+
+def connect_db(host, port, dbname):
+    return psycopg2.connect(host=host, port=port, dbname=dbname, user="user", password="pass")
+
+
+def publish_phase(clients, codecs, prefix, rate, duration, vins):
+    """Publish reports at rate msgs/s for duration seconds; returns (reports, elapsed)."""
+    interval = MESSAGES_PER_REPORT / rate
+    reports = 0
+    start = time.perf_counter()
+    next_at = start
+    while True:
+        now = time.perf_counter()
+        if now - start >= duration:
+            break
+        if now < next_at:
+            time.sleep(min(next_at - now, 0.001))
+            continue
+        # Catch up in bursts when behind rather than silently lowering the rate
+        while next_at <= now:
+            vin = f"{prefix}{reports % vins:08d}"
+            ts = time.time()
+            client = clients[reports % len(clients)]
+            client.publish(TOPIC_VIN, codecs.encode(TOPIC_VIN, {"vin": vin, "ts": ts}))
+            client.publish(TOPIC_LOCATION, codecs.encode(TOPIC_LOCATION, {
+                "vin": vin, "ts": ts, "latitude": 45.5 + random.random() * 0.1, "longitude": -73.6}))
+            client.publish(TOPIC_GIRO, codecs.encode(TOPIC_GIRO, {"vin": vin, "ts": ts, "giro": float(reports % 360)}))
+            reports += 1
+            next_at += interval
+    return reports, time.perf_counter() - start
+
+
+def wait_for_commits(conn, prefix, since, expected, settle, timeout):
+    """Poll vehicle_data until expected rows are in, or the count stops growing for settle seconds."""
+    deadline = time.monotonic() + timeout
+    last_count, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) FROM vehicle_data WHERE vin LIKE %s AND event_time >= to_timestamp(%s)",
+                    (prefix + "%", since))
+        count = cur.fetchone()[0]
+        cur.close()
+        conn.commit()
+        if count >= expected:
+            return count
+        if count != last_count:
+            last_count, last_change = count, time.monotonic()
+        elif time.monotonic() - last_change >= settle:
+            return count
+        time.sleep(0.2)
+    return last_count
+
+
+def fleet_latency(client, fleet_conn, vins, timeout):
+    """Trigger a replay of each VIN and time until its rows are committed in the fleet DB."""
+    latencies = []
+    for vin in vins:
+        cur = fleet_conn.cursor()
+        cur.execute("SELECT count(*) FROM vehicle_data WHERE vin = %s", (vin,))
+        before = cur.fetchone()[0]
+        fleet_conn.commit()
+        sent = time.time()
+        client.publish(TRIGGER_TOPIC, json.dumps({"vin": vin}))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            cur.execute("SELECT count(*), EXTRACT(EPOCH FROM max(ingest_time))::float8 FROM vehicle_data WHERE vin = %s",
+                        (vin,))
+            count, last_ingest = cur.fetchone()
+            fleet_conn.commit()
+            if count > before:
+                latencies.append((last_ingest - sent) * 1000)
+                break
+            time.sleep(0.05)
+        cur.close()
+    return latencies
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(result, baseline_path):
+    baseline = {p["offered_rate"]: p for p in json.loads(Path(baseline_path).read_text())["phases"]}
+    print(f"\ncompared with {baseline_path}:")
+    for phase in result["phases"]:
+        old = baseline.get(phase["offered_rate"])
+        if old is None or not old["latency_ms"]["p99"] or not phase["latency_ms"]["p99"]:
+            continue
+        print(f"  {phase['offered_rate']:>8.0f} msg/s  achieved {old['achieved_rate']:9.0f} -> {phase['achieved_rate']:9.0f}"
+              f"  p99 {old['latency_ms']['p99']:8.1f} -> {phase['latency_ms']['p99']:8.1f} ms")
+    print(f"  saturation {json.loads(Path(baseline_path).read_text())['saturation_rate']} -> {result['saturation_rate']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--broker-port", type=int, default=1883)
+    parser.add_argument("--connections", type=int, default=2)
+    parser.add_argument("--db-host", default="localhost")
+    parser.add_argument("--db-port", default="5431")
+    parser.add_argument("--db-name", default="vehicles")
+    parser.add_argument("--fleet-db-host", default="localhost")
+    parser.add_argument("--fleet-db-port", default="5433")
+    parser.add_argument("--fleet-db-name", default="fleet")
+    parser.add_argument("--rates", default="500,1000,2000,4000", help="comma-separated offered msgs/s")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per rate")
+    parser.add_argument("--vins", type=int, default=10000, help="distinct VINs per phase")
+    parser.add_argument("--settle", type=float, default=5.0)
+    parser.add_argument("--slo-ms", type=float, default=1000.0, help="p99 bound for a rate to count as sustained")
+    parser.add_argument("--fleet-samples", type=int, default=5)
+    parser.add_argument("--output", default=None, help="result JSON (default benchmarks/results/e2e-<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier result JSON to compare against")
+    args = parser.parse_args()
+
+    run_id = random.randrange(10 ** 4)
+    codecs = TopicCodecs.from_env()
+    clients = []
+    for i in range(max(args.connections, 1)):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"bench-e2e-{run_id}-{i}")
+        client.connect(args.broker, args.broker_port, 60)
+        client.loop_start()
+        clients.append(client)
+    conn = connect_db(args.db_host, args.db_port, args.db_name)
+    fleet_conn = connect_db(args.fleet_db_host, args.fleet_db_port, args.fleet_db_name)
+
+    result = {
+        "run_id": run_id,
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "wire_codecs": os.environ.get("WIRE_CODECS"),
+        "phases": [],
+        "saturation_rate": None,
+    }
+    try:
+        for phase_no, rate in enumerate(float(r) for r in args.rates.split(",")):
+            # 17-character VINs unique to this run and phase
+            prefix = f"E2E{run_id:04d}{phase_no:02d}"
+            since = time.time() - 1
+            reports, elapsed = publish_phase(clients, codecs, prefix, rate, args.duration, args.vins)
+            committed = wait_for_commits(conn, prefix, since, reports, args.settle, timeout=args.duration * 5)
+
+            cur = conn.cursor()
+            cur.execute(LATENCY_SQL, (prefix + "%", since))
+            _, percentiles, worst, last_commit = cur.fetchone()
+            p50, p95, p99 = percentiles or (None, None, None)
+            cur.close()
+            conn.commit()
+            span = (last_commit - since) if last_commit else elapsed
+            achieved = committed * MESSAGES_PER_REPORT / max(span, elapsed)
+            sample_vins = [f"{prefix}{i:08d}" for i in random.sample(range(min(reports, args.vins)),
+                                                                     min(args.fleet_samples, reports, args.vins))]
+            fleet = fleet_latency(clients[0], fleet_conn, sample_vins, timeout=10.0)
+            phase = {
+                "offered_rate": rate,
+                "published_messages": reports * MESSAGES_PER_REPORT,
+                "publish_rate": reports * MESSAGES_PER_REPORT / elapsed,
+                "committed_rows": committed,
+                "achieved_rate": achieved,
+                "latency_ms": {"p50": p50, "p95": p95, "p99": p99, "max": worst},
+                "fleet_latency_ms": {"samples": len(fleet), "p50": percentile(fleet, 0.5), "max": max(fleet, default=None)},
+            }
+            phase["sustained"] = achieved >= 0.95 * rate and p99 is not None and p99 <= args.slo_ms
+            result["phases"].append(phase)
+            if phase["sustained"]:
+                result["saturation_rate"] = rate
+            print(f"offered {rate:8.0f} msg/s  achieved {achieved:8.0f}  committed {committed}/{reports}  "
+                  f"p50 {p50 or 0:7.1f}  p95 {p95 or 0:7.1f}  p99 {p99 or 0:7.1f} ms  "
+                  f"fleet p50 {phase['fleet_latency_ms']['p50'] or 0:7.1f} ms  {'ok' if phase['sustained'] else 'SATURATED'}")
+    finally:
+        for client in clients:
+            client.loop_stop()
+            client.disconnect()
+        conn.close()
+        fleet_conn.close()
+
+    output = Path(args.output) if args.output else (
+        Path(__file__).resolve().parent / "results" / f"e2e-{datetime.now():%Y%m%d-%H%M%S}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"saturation point: {result['saturation_rate']} msg/s; results written to {output}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
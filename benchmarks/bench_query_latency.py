@@ -0,0 +1,125 @@
+"""Query latency on a large synthetic vehicle_data: daily-partitioned + indexed vs the legacy flat table.
+
+Loads --rows synthetic rows spread over --days days of event time into both the
+partitioned schema created by db.init_db and an unindexed copy of the legacy
+layout (vehicle_data_flat), then times the typical per-VIN and time-range
+queries against each. Loading 50M rows takes a while and ~10 GB of disk; use
+--skip-load to re-run the queries on an already loaded database.
+
+    python benchmarks/bench_query_latency.py --host localhost --port 5431 --dbname bench --rows 50000000
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import psycopg2
+import db
+
+FLAT_TABLE = """
+    CREATE TABLE IF NOT EXISTS vehicle_data_flat (
+        id BIGSERIAL PRIMARY KEY,
+        vin TEXT,
+        latitude REAL,
+        longitude REAL,
+        giro REAL,
+        event_time TIMESTAMPTZ NOT NULL
+    )
+"""
+
+# name -> SQL with {table}; %(vin)s / %(since)s / %(until)s are bound per run
+QUERIES = {
+    "latest for one VIN": """
+        SELECT vin, latitude, longitude, giro FROM {table}
+        WHERE vin = %(vin)s ORDER BY event_time DESC LIMIT 1
+    """,
+    "one VIN, last hour": """
+        SELECT count(*) FROM {table}
+        WHERE vin = %(vin)s AND event_time >= %(until)s - interval '1 hour' AND event_time < %(until)s
+    """,
+    "one VIN, one day": """
+        SELECT count(*) FROM {table}
+        WHERE vin = %(vin)s AND event_time >= %(since)s AND event_time < %(since)s + interval '1 day'
+    """,
+    "fleet, last 5 minutes": """
+        SELECT count(*) FROM {table}
+        WHERE event_time >= %(until)s - interval '5 minutes' AND event_time < %(until)s
+    """,
+}
+
+
+def load(cur, conn, table, rows, vins, days, until, batch=1000000):
+    """Insert rows spread evenly over [until - days, until) with generate_series, batch by batch."""
+    span = days * 86400
+    for start in range(0, rows, batch):
+        stop = min(start + batch, rows)
+        cur.execute(f"""
+            INSERT INTO {table} (vin, latitude, longitude, giro, event_time)
+            SELECT 'VIN' || lpad((g %% %(vins)s)::text, 8, '0'),
+                   45 + random(), -73 - random(), (g %% 360)::real,
+                   %(until)s - make_interval(secs => (g::float8 * %(span)s / %(rows)s))
+            FROM generate_series(%(start)s, %(stop)s - 1) AS g
+        """, {"vins": vins, "until": until, "span": span, "rows": rows, "start": start, "stop": stop})
+        conn.commit()
+        print(f"  {table}: {stop}/{rows} rows", flush=True)
+    cur.execute(f"ANALYZE {table}")
+    conn.commit()
+
+
+def time_query(cur, sql, params, repeat):
+    latencies = []
+    for i in range(repeat):
+        bound = dict(params, vin=f"VIN{(i * 7919) % params['vins']:08d}")
+        start = time.perf_counter()
+        cur.execute(sql, bound)
+        cur.fetchall()
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=db.DB_HOST)
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--dbname", default=db.DB_NAME)
+    parser.add_argument("--rows", type=int, default=50000000)
+    parser.add_argument("--vins", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--skip-load", action="store_true")
+    args = parser.parse_args()
+
+    os.environ["PGPORT"] = args.port
+    db.DB_HOST = args.host
+    db.DB_NAME = args.dbname
+    db.init_db()
+
+    conn = psycopg2.connect(host=db.DB_HOST, dbname=db.DB_NAME, user=db.DB_USER, password=db.DB_PASS)
+    cur = conn.cursor()
+    until = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if not args.skip_load:
+        db.create_partitions(cur, (until - timedelta(days=args.days)).date(), args.days)
+        cur.execute(FLAT_TABLE)
+        conn.commit()
+        load(cur, conn, "vehicle_data", args.rows, args.vins, args.days, until)
+        load(cur, conn, "vehicle_data_flat", args.rows, args.vins, args.days, until)
+
+    params = {"vins": args.vins, "until": until, "since": until - timedelta(days=args.days // 2)}
+    print(f"rows={args.rows} vins={args.vins} days={args.days} repeat={args.repeat}")
+    for name, sql in QUERIES.items():
+        flat = time_query(cur, sql.format(table="vehicle_data_flat"), params, args.repeat)
+        partitioned = time_query(cur, sql.format(table="vehicle_data"), params, args.repeat)
+        print(f"{name:24s} flat p50={flat[0]:9.2f} ms p95={flat[1]:9.2f} ms   "
+              f"partitioned p50={partitioned[0]:8.2f} ms p95={partitioned[1]:8.2f} ms")
+    cur.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""RPC calls per second and call latency: connect-per-call client vs the persistent RpcClient.
+
+The legacy client is the one rpc_producer used before RpcClient: a new MQTT
+connection and response subscription per call, then polling a shared dict
+every 100 ms. RpcClient keeps one connection and resolves futures from the
+message callback. Needs an MQTT broker; by default an in-process echo
+responder answers every request (measures the client and broker only), pass
+--server twin to call a running vehicle twin's RPC server instead
+("method": "latest", served from memory).
+
+    python benchmarks/bench_rpc_client.py --broker localhost --calls 2000 --concurrency 1,16,256
+"""
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "rpc_producer"))
+
+import paho.mqtt.client as mqtt
+from codec import TopicCodecs
+from rpc_client import RPC_REQUEST_TOPIC, RPC_RESPONSE_TOPIC_PREFIX, RpcClient
+
+codecs = TopicCodecs()
+
+
+def legacy_call(broker, port, params, method, timeout, responses):
+    """The pre-RpcClient call_rpc: connect, subscribe, publish, poll every 100 ms, disconnect."""
+    correlation_id = str(uuid.uuid4())
+
+    def on_response(client, userdata, msg):
+        payload = codecs.decode(msg.payload)
+        responses[payload.get("correlation_id")] = payload
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    client.on_message = on_response
+    client.connect(broker, port, 60)
+    client.subscribe(f"{RPC_RESPONSE_TOPIC_PREFIX}{correlation_id}")
+    client.loop_start()
+    request = {"correlation_id": correlation_id, "params": params, "method": method}
+    client.publish(RPC_REQUEST_TOPIC, codecs.encode(RPC_REQUEST_TOPIC, request))
+    start = time.time()
+    while correlation_id not in responses and (time.time() - start) < timeout:
+        time.sleep(0.1)
+    client.loop_stop()
+    client.disconnect()
+    if correlation_id not in responses:
+        raise TimeoutError(correlation_id)
+    return responses.pop(correlation_id)
+
+
+def start_echo_server(broker, port):
+    """Answer every request at once with an empty result, on its own connection."""
+    server = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+
+    def on_request(client, userdata, msg):
+        corr = codecs.decode(msg.payload)["correlation_id"]
+        topic = f"{RPC_RESPONSE_TOPIC_PREFIX}{corr}"
+        client.publish(topic, json.dumps({"correlation_id": corr, "result": []}))
+
+    server.on_message = on_request
+    server.connect(broker, port, 60)
+    server.subscribe(RPC_REQUEST_TOPIC)
+    server.loop_start()
+    return server
+
+
+def run_legacy(args, concurrency):
+    responses = {}
+    latencies = []
+    failures = 0
+
+    def one():
+        start = time.perf_counter()
+        legacy_call(args.broker, args.port, {"vin": args.vin}, "latest", args.timeout, responses)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for future in [pool.submit(one) for _ in range(args.calls)]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                failures += 1
+    return time.perf_counter() - start, latencies, failures
+
+
+def run_client(args, concurrency):
+    latencies = []
+    failures = 0
+    slots = threading.Semaphore(concurrency)
+    lock = threading.Lock()
+
+    def done(future, start):
+        nonlocal failures
+        with lock:
+            if future.exception() is None:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failures += 1
+        slots.release()
+
+    with RpcClient(args.broker, args.port) as rpc:
+        futures = []
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            # At most `concurrency` calls in flight
+            slots.acquire()
+            call_start = time.perf_counter()
+            future = rpc.call({"vin": args.vin}, method="latest", timeout=args.timeout)
+            future.add_done_callback(lambda f, s=call_start: done(f, s))
+            futures.append(future)
+        wait(futures)
+        elapsed = time.perf_counter() - start
+    return elapsed, latencies, failures
+
+
+def report(name, concurrency, calls, elapsed, latencies, failures):
+    if latencies:
+        q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        latency = f"p50={q[49] * 1000:8.2f}ms p95={q[94] * 1000:8.2f}ms p99={q[98] * 1000:8.2f}ms"
+    else:
+        latency = "no successful calls"
+    print(f"{name:9s} concurrency={concurrency:4d} {calls / elapsed:10.0f} calls/s  {latency}  failed={failures}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broker", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--legacy-calls", type=int, default=200, help="calls for the (slow) legacy client")
+    parser.add_argument("--concurrency", default="1,16,256", help="comma-separated in-flight call counts")
+    parser.add_argument("--server", choices=("echo", "twin"), default="echo")
+    parser.add_argument("--vin", default="VIN00000001")
+    parser.add_argument("--timeout", type=float, default=10)
+    args = parser.parse_args()
+
+    server = start_echo_server(args.broker, args.port) if args.server == "echo" else None
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            legacy_args = argparse.Namespace(**dict(vars(args), calls=args.legacy_calls))
+            report("legacy", concurrency, args.legacy_calls, *run_legacy(legacy_args, concurrency))
+            report("RpcClient", concurrency, args.calls, *run_client(args, concurrency))
+    finally:
+        if server is not None:
+            server.loop_stop()
+            server.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Join throughput of the sharded vehicle twin from 1 to 8 worker processes.
+
+Synthetic vin/location/giro JSON messages are fed to a ShardSupervisor in
+dispatch mode: raw payloads go to the workers round-robin in batches, and
+every worker decodes its share, forwards parts to the VIN's owning worker
+and joins them. Rows are counted, not written (--write discard, no services
+needed). Pass --write db to include the batched vehicle_data writes, with
+DB_HOST/PGPORT pointing at a database.
+
+    python benchmarks/bench_sharding.py --workers 1,2,4,8 --vins 200000
+
+Scaling is bounded by the machine's cores: expect near-linear speedup only
+while workers <= cores - 1 (the feeding process needs one).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from sharding import ShardSupervisor
+
+
+def workload(vins):
+    """Pre-encoded (topic, payload) messages: three parts per VIN, reports of different VINs interleaved."""
+    now = time.time()
+    messages = []
+    for i in range(vins):
+        vin = f"VIN{i:08d}"
+        ts = now + i * 1e-6
+        messages.append(("vehicles/vin", json.dumps({"vin": vin, "ts": ts}).encode()))
+        messages.append(("vehicles/location", json.dumps(
+            {"vin": vin, "ts": ts, "latitude": 45.0, "longitude": -73.0}).encode()))
+        messages.append(("vehicles/giro", json.dumps({"vin": vin, "ts": ts, "giro": 90.0}).encode()))
+    return messages
+
+
+def run(workers, messages, expected, write, timeout):
+    shards = ShardSupervisor(workers, config={
+        "mode": "dispatch",
+        "write": write,
+        "report_rows": False,
+        "window": 3600,
+        "ttl": 3600,
+        "max_entries": None,
+        "stats_interval": 0.05,
+        "forward_batch": 1024,
+    }).start()
+    try:
+        # Let the workers come up so process start-up is not timed
+        deadline = time.monotonic() + timeout
+        while len(shards.worker_stats) < workers and time.monotonic() < deadline:
+            time.sleep(0.01)
+        start = time.perf_counter()
+        for topic, payload in messages:
+            shards.dispatch(topic, payload)
+        while shards.merged() < expected and time.monotonic() < deadline:
+            time.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        return shards.merged(), elapsed, sum(s["forwarded"] for s in shards.worker_stats.values())
+    finally:
+        shards.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4,8", help="comma-separated worker counts")
+    parser.add_argument("--vins", type=int, default=200000)
+    parser.add_argument("--write", choices=("discard", "db"), default="discard")
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    messages = workload(args.vins)
+    print(f"cores={os.cpu_count()} vins={args.vins} msgs={len(messages)} write={args.write}")
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(",")]:
+        merged, elapsed, forwarded = run(workers, messages, args.vins, args.write, args.timeout)
+        rate = len(messages) / elapsed
+        baseline = baseline or rate
+        print(f"workers={workers:2d} {rate:12.0f} msgs/s  speedup={rate / baseline:5.2f}x  "
+              f"merged={merged}/{args.vins}  forwarded={forwarded / len(messages):.0%}")
+
+
+if __name__ == "__main__":
+    main()
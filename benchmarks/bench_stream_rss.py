@@ -0,0 +1,42 @@
+"""Peak RSS of reading vehicle_data: fetchall() list vs server-side cursor stream.
+
+Run each mode in its own process so the peaks do not mask each other:
+
+    python benchmarks/bench_stream_rss.py --host localhost --port 5431 --mode list
+    python benchmarks/bench_stream_rss.py --host localhost --port 5431 --mode stream
+"""
+import argparse
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=db.DB_HOST)
+    parser.add_argument("--port", default="5432")
+    parser.add_argument("--mode", choices=("list", "stream"), default="stream")
+    parser.add_argument("--itersize", type=int, default=db.CURSOR_ITERSIZE)
+    args = parser.parse_args()
+
+    os.environ["PGPORT"] = args.port
+    db.DB_HOST = args.host
+
+    start = time.perf_counter()
+    rows = db.read_all_vehicle_data() if args.mode == "list" else db.iter_vehicle_data(itersize=args.itersize)
+    count = sum(1 for _ in rows)
+    elapsed = time.perf_counter() - start
+    db.close_pool()
+
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"mode={args.mode} rows={count} elapsed={elapsed:.2f}s peak_rss={peak_mb:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
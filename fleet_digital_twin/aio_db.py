@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+
+import asyncpg
+
+import db
+from db import (CURSOR_ITERSIZE, DB_HOST, DB_NAME, DB_PASS, DB_USER, RECONNECT_ATTEMPTS, RECONNECT_BACKOFF,
+                ROLLUP_COLUMNS, ROLLUP_MERGE)
+
+# The asyncio runtime's storage layer: the hot statements of db.py on an
+# asyncpg pool. Schema creation and partition maintenance stay in db.py; they
+# run rarely and off the event loop. Metrics are recorded under the same
+# names (db_operation_seconds etc.) as the threaded runtime, and writes bump
+# db's data version like db.py's own.
+
+# One connection serves many concurrent coroutines in turn, so the pool can
+# stay small for a large number of in-flight requests
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 10
+
+# Batches travel as one array per column and are expanded server side by
+# unnest(): one statement and one round trip whatever the batch size
+INSERT_VEHICLE_DATA = """
+    INSERT INTO vehicle_data (vin, latitude, longitude, giro, event_time)
+    SELECT r.vin, r.latitude, r.longitude, r.giro, COALESCE(to_timestamp(r.event_time), now())
+    FROM unnest($1::text[], $2::real[], $3::real[], $4::real[], $5::float8[])
+        AS r(vin, latitude, longitude, giro, event_time)
+"""
+
+INSERT_UNIQUE_VEHICLE_DATA = """
+    WITH batch AS (
+        SELECT * FROM unnest($1::text[], $2::text[], $3::real[], $4::real[], $5::real[], $6::float8[])
+            AS r(record_key, vin, latitude, longitude, giro, event_time)
+    ),
+    fresh AS (
+        INSERT INTO vehicle_data_keys (record_key)
+        SELECT DISTINCT record_key FROM batch
+        ON CONFLICT DO NOTHING
+        RETURNING record_key
+    )
+    INSERT INTO vehicle_data (vin, latitude, longitude, giro, event_time)
+    SELECT DISTINCT ON (b.record_key) b.vin, b.latitude, b.longitude, b.giro,
+           COALESCE(to_timestamp(b.event_time), now())
+    FROM batch b JOIN fresh USING (record_key)
+"""
+
+ROLLUP_TYPES = ("text", "float8", "int8", "int8", "float8", "real", "real", "real", "real", "real", "real", "float8")
+
+_pool = None
+
+
+async def open_pool(min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE):
+    global _pool
+    if _pool is None:
+        _pool = await asyncpg.create_pool(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS,
+                                          min_size=min_size, max_size=max_size)
+    return _pool
+
+
+async def close_pool():
+    """Close every pooled connection (used on shutdown)."""
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def _columns(rows, count):
+    """Transpose rows into ``count`` per-column lists for unnest()."""
+    return [list(column) for column in zip(*rows)] if rows else [[] for _ in range(count)]
+
+
+def _inserted(status):
+    # asyncpg returns the command tag, e.g. "INSERT 0 42"
+    return int(status.rsplit(" ", 1)[-1])
+
+
+async def _run(work, op="query", idempotent=False):
+    """Await work(conn) on a pooled connection, retrying on connection failures like db._run.
+
+    As in db._run, a failure once work has started is only retried if ``idempotent``
+    and raises db.WriteInDoubt otherwise.
+    """
+    pool = await open_pool()
+    start = time.perf_counter()
+    for attempt in range(RECONNECT_ATTEMPTS + 1):
+        started = False
+        try:
+            acquire_start = time.perf_counter()
+            async with pool.acquire() as conn:
+                db.DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - acquire_start)
+                started = True
+                result = await work(conn)
+            db.DB_OPERATION_SECONDS.labels(op=op).observe(time.perf_counter() - start)
+            return result
+        except (OSError, asyncpg.PostgresConnectionError, asyncpg.InterfaceError) as e:
+            if started and not idempotent:
+                db.DB_ERRORS.labels(op=op).inc()
+                raise db.WriteInDoubt(f"{op}: {e}") from e
+            if attempt == RECONNECT_ATTEMPTS:
+                db.DB_ERRORS.labels(op=op).inc()
+                raise
+            db.DB_RECONNECTS.inc()
+            logging.warning("DB connection failed (%s); reconnecting (attempt %d)", e, attempt + 1)
+            await asyncio.sleep(RECONNECT_BACKOFF * (attempt + 1))
+        except Exception:
+            db.DB_ERRORS.labels(op=op).inc()
+            raise
+
+
+async def upsert_rollups(conn, table, aggregates):
+    """Merge ROLLUP_COLUMNS-shaped aggregate rows (bucket as epoch seconds) into table."""
+    if not aggregates:
+        return
+    params = ", ".join(f"${i + 1}::{t}[]" for i, t in enumerate(ROLLUP_TYPES))
+    select = ", ".join("to_timestamp(r.bucket)" if c == "bucket" else f"r.{c}" for c in ROLLUP_COLUMNS)
+    await conn.execute(
+        f"INSERT INTO {table} AS t ({', '.join(ROLLUP_COLUMNS)}) "
+        f"SELECT {select} FROM unnest({params}) AS r({', '.join(ROLLUP_COLUMNS)}) {ROLLUP_MERGE}",
+        *_columns(aggregates, len(ROLLUP_COLUMNS))
+    )
+
+
+async def write_vehicle_data_batch(rows, rollups=None):
+    """db.write_vehicle_data_batch on the async pool: one INSERT and the rollups in one transaction."""
+    if not rows:
+        return
+    async def work(conn):
+        async with conn.transaction():
+            await conn.execute(INSERT_VEHICLE_DATA, *_columns(rows, 5))
+            for table, aggregates in (rollups or {}).items():
+                await upsert_rollups(conn, table, aggregates)
+    try:
+        await _run(work, "write_batch")
+    finally:
+        db.bump_data_version()
+    db.DB_ROWS_WRITTEN.inc(len(rows))
+
+
+async def write_unique_vehicle_data_batch(rows):
+    """db.write_unique_vehicle_data_batch on the async pool; returns the number of rows inserted."""
+    if not rows:
+        return 0
+    async def work(conn):
+        return _inserted(await conn.execute(INSERT_UNIQUE_VEHICLE_DATA, *_columns(rows, 6)))
+    try:
+        inserted = await _run(work, "write_unique_batch", idempotent=True)
+    finally:
+        db.bump_data_version()
+    db.DB_ROWS_WRITTEN.inc(inserted)
+    return inserted
+
+
+async def _stream(sql, params, prefetch):
+    pool = await open_pool()
+    async with pool.acquire() as conn:
+        # asyncpg cursors only exist inside a transaction
+        async with conn.transaction():
+            async for row in conn.cursor(sql, *params, prefetch=prefetch or CURSOR_ITERSIZE):
+                yield tuple(row)
+
+
+async def iter_vehicle_data(vin=None, since=None, until=None, prefetch=None):
+    """Async counterpart of db.iter_vehicle_data: (vin, lat, lon, giro) rows from a server-side cursor."""
+    conditions = []
+    params = []
+    if vin:
+        params.append(vin)
+        conditions.append(f"vin = ${len(params)}")
+    if since is not None:
+        params.append(since)
+        conditions.append(f"event_time >= to_timestamp(${len(params)})")
+    if until is not None:
+        params.append(until)
+        conditions.append(f"event_time < to_timestamp(${len(params)})")
+    sql = "SELECT vin, latitude, longitude, giro FROM vehicle_data"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    async for row in _stream(sql, params, prefetch):
+        yield row
+
+
+async def iter_latest_vehicle_data(prefetch=None):
+    """Async counterpart of db.iter_latest_vehicle_data."""
+    sql = """
+        SELECT DISTINCT ON (vin) vin, latitude, longitude, giro, EXTRACT(EPOCH FROM event_time)::float8
+        FROM vehicle_data
+        ORDER BY vin, event_time DESC, id DESC
+    """
+    async for row in _stream(sql, [], prefetch):
+        yield row
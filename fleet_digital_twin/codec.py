@@ -0,0 +1,231 @@
+"""Wire codecs for MQTT payloads: JSON, MessagePack and fixed-layout struct.
+
+Plain JSON is sent as-is, so existing publishers and subscribers keep working.
+Every other encoding starts with one header byte in 0x80-0x8F, a range no
+JSON text can start with:
+
+    0x80 | compression << 2 | codec
+
+codec is 1 (json, only when compressed), 2 (msgpack) or 3 (struct), and
+compression is 0 (none), 1 (zlib) or 2 (zstd). A struct payload carries one
+more byte, the layout id. ``decode()`` reads the header, so subscribers accept
+any codec without configuration. Publishers pick theirs per topic through
+TopicCodecs, configured from the WIRE_CODECS environment variable, e.g.
+
+    WIRE_CODECS='{"vehicles/#": {"codec": "struct"},
+                  "rpc/response/#": {"codec": "msgpack", "compression": "zlib"}}'
+
+Topics with no matching entry use JSON.
+"""
+import json
+import logging
+import math
+import os
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = {"json": 1, "msgpack": 2, "struct": 3}
+COMPRESSIONS = {None: 0, "zlib": 1, "zstd": 2}
+HEADER = 0x80
+# Payloads shorter than this are never compressed: the frame would only grow
+DEFAULT_COMPRESS_OVER = 1024
+
+# name -> (id, struct format, fields). VINs are exactly 17 ASCII bytes; every
+# other field is a float64 and None travels as NaN. A message that does not fit
+# its layout (another VIN length, a missing VIN, fields the layout lacks such as
+# a replayed row's id and source) is sent as JSON instead.
+LAYOUTS = {
+    "vin": (1, "<17sd", ("vin", "ts")),
+    "location": (2, "<17sddd", ("vin", "ts", "latitude", "longitude")),
+    "giro": (3, "<17sdd", ("vin", "ts", "giro")),
+    "data": (4, "<17sdddd", ("vin", "ts", "latitude", "longitude", "giro")),
+}
+_LAYOUTS_BY_ID = {layout_id: (struct.Struct(fmt), fields) for layout_id, fmt, fields in LAYOUTS.values()}
+
+_CODEC_NAMES = {v: k for k, v in CODECS.items()}
+_COMPRESSION_NAMES = {v: k for k, v in COMPRESSIONS.items()}
+
+
+class Codec:
+    """Encoder for one topic's payloads."""
+
+    def __init__(self, codec="json", compression=None, compress_over=DEFAULT_COMPRESS_OVER, layout=None):
+        if codec not in CODECS:
+            raise ValueError(f"unknown codec {codec!r}, expected one of {tuple(CODECS)}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"unknown compression {compression!r}, expected one of {tuple(COMPRESSIONS)}")
+        if codec == "msgpack" and msgpack is None:
+            raise ValueError("msgpack codec requested but msgpack is not installed")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requested but zstandard is not installed")
+        if codec == "struct" and layout not in LAYOUTS:
+            raise ValueError(f"struct codec needs a layout, one of {tuple(LAYOUTS)}")
+        self.name = codec
+        self.compression = compression
+        self.compress_over = compress_over
+        self.layout = layout
+        if codec == "struct":
+            layout_id, fmt, fields = LAYOUTS[layout]
+            self._struct = struct.Struct(fmt)
+            self._layout_id = layout_id
+            self._fields = fields
+
+    def encode(self, obj):
+        name = self.name
+        if name == "json":
+            body = json.dumps(obj).encode()
+        elif name == "msgpack":
+            body = msgpack.packb(obj, use_bin_type=True)
+        else:
+            try:
+                body = bytes((self._layout_id,)) + self._pack(obj)
+            except ValueError as e:
+                # decode() reads the header, so subscribers take the JSON form as well
+                logging.debug("Not packing into the %s layout (%s); sending JSON", self.layout, e)
+                name = "json"
+                body = json.dumps(obj).encode()
+        compression = self.compression if len(body) >= self.compress_over else None
+        if compression is None:
+            if name == "json":
+                return body
+            return bytes((HEADER | CODECS[name],)) + body
+        if compression == "zlib":
+            body = zlib.compress(body)
+        else:
+            body = zstandard.ZstdCompressor().compress(body)
+        return bytes((HEADER | COMPRESSIONS[compression] << 2 | CODECS[name],)) + body
+
+    def _pack(self, obj):
+        """The layout's fields of obj packed; ValueError if obj does not fit the layout."""
+        extra = [field for field, value in obj.items() if field not in self._fields and value is not None]
+        if extra:
+            raise ValueError(f"fields not in the layout: {', '.join(sorted(extra))}")
+        values = []
+        for field in self._fields:
+            value = obj.get(field)
+            if field == "vin":
+                if not isinstance(value, str):
+                    raise ValueError(f"vin must be a string, not {value!r}")
+                value = value.encode()
+                if len(value) != 17:
+                    raise ValueError(f"vin must be 17 bytes, not {len(value)}")
+                values.append(value)
+            elif value is None:
+                values.append(math.nan)
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{field} must be a number, not {value!r}")
+            else:
+                values.append(float(value))
+        return self._struct.pack(*values)
+
+
+def decode(data):
+    """Decode a payload produced by any Codec (or plain JSON from a legacy publisher)."""
+    if isinstance(data, str) or not data or not HEADER <= data[0] < HEADER + 0x10:
+        return json.loads(data)
+    header = data[0]
+    codec = _CODEC_NAMES.get(header & 0x3)
+    compression = _COMPRESSION_NAMES.get((header >> 2) & 0x3, "unknown")
+    if codec is None or compression == "unknown":
+        raise ValueError(f"unknown payload header 0x{header:02x}")
+    body = memoryview(data)[1:]
+    if compression == "zlib":
+        body = zlib.decompress(body)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd payload but zstandard is not installed")
+        body = zstandard.ZstdDecompressor().decompress(bytes(body))
+    if codec == "json":
+        return json.loads(bytes(body))
+    if codec == "msgpack":
+        if msgpack is None:
+            raise ValueError("msgpack payload but msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    layout = _LAYOUTS_BY_ID.get(body[0])
+    if layout is None:
+        raise ValueError(f"unknown struct layout {body[0]}")
+    packer, fields = layout
+    values = packer.unpack_from(body, 1)
+    obj = {}
+    for field, value in zip(fields, values):
+        if field == "vin":
+            obj[field] = value.rstrip(b"\0").decode() or None
+        else:
+            obj[field] = None if math.isnan(value) else value
+    return obj
+
+
+def _topic_matches(pattern, topic):
+    """MQTT filter match with + (one level) and # (all remaining levels)."""
+    pattern_levels = pattern.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(pattern_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(pattern_levels) == len(topic_levels)
+
+
+class TopicCodecs:
+    """Per-topic codec selection.
+
+    ``config`` maps MQTT topic filters to Codec options. The most specific
+    matching filter wins (exact topics before wildcards, longer filters before
+    shorter). A struct entry without a layout uses the topic's last level
+    ("vehicles/location" -> "location"), or JSON if there is no such layout.
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(config or {})
+        for pattern, options in self.config.items():
+            # Fail fast on bad options instead of on the first publish
+            if options.get("codec") != "struct":
+                Codec(**options)
+        self._by_topic = {}
+        self._json = Codec()
+
+    @classmethod
+    def from_env(cls, var="WIRE_CODECS"):
+        raw = os.environ.get(var)
+        if not raw:
+            return cls()
+        config = json.loads(raw)
+        logging.info("Wire codecs: %s", config)
+        return cls(config)
+
+    def for_topic(self, topic):
+        codec = self._by_topic.get(topic)
+        if codec is None:
+            matches = [p for p in self.config if _topic_matches(p, topic)]
+            if not matches:
+                codec = self._json
+            else:
+                pattern = max(matches, key=lambda p: ("+" not in p and "#" not in p, len(p)))
+                options = dict(self.config[pattern])
+                if options.get("codec") == "struct" and "layout" not in options:
+                    options["layout"] = topic.rsplit("/", 1)[-1]
+                    if options["layout"] not in LAYOUTS:
+                        # e.g. "vehicles/#" also covers vehicles/request, which has no layout
+                        logging.warning("No struct layout for %s; sending JSON", topic)
+                        options = {}
+                codec = Codec(**options)
+            self._by_topic[topic] = codec
+        return codec
+
+    def encode(self, topic, obj):
+        return self.for_topic(topic).encode(obj)
+
+    @staticmethod
+    def decode(data):
+        return decode(data)
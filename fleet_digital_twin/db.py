@@ -1,65 +1,700 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
 import psycopg2
+from psycopg2 import extras
+from psycopg2 import pool as pg_pool
 
-DB_HOST = "db_fleet"
-DB_NAME = "fleet"
-DB_USER = "user"
-DB_PASS = "pass"
+from metrics import REGISTRY
 
-def init_db():
-    conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+# Overridable so the twin can run outside compose; libpq also honours PGPORT
+DB_HOST = os.environ.get("DB_HOST", "db_fleet")
+DB_NAME = os.environ.get("DB_NAME", "fleet")
+DB_USER = os.environ.get("DB_USER", "user")
+DB_PASS = os.environ.get("DB_PASS", "pass")
+
+# Connection pool shared by the ingest loop and the plugin threads.
+# Connections above POOL_MIN_CONN are closed when handed back, so size
+# POOL_MIN_CONN for the steady-state number of DB-using threads. A thread
+# asking for a connection while POOL_MAX_CONN are out waits up to
+# POOL_WAIT_TIMEOUT seconds for one; size_pool() raises the limit to the
+# number of DB-using threads the twin is configured to run.
+POOL_MIN_CONN = 4
+POOL_MAX_CONN = int(os.environ.get("DB_POOL_MAX_CONN", 8))
+POOL_WAIT_TIMEOUT = 30.0
+# Pooled connections idle for longer than this are pinged before reuse
+HEALTH_CHECK_INTERVAL = 30
+# How many times a statement is retried on a fresh connection after a failure
+RECONNECT_ATTEMPTS = 2
+RECONNECT_BACKOFF = 0.5
+# Rows fetched per round trip by the streaming (server-side cursor) reads
+CURSOR_ITERSIZE = 2000
+# vehicle_data is range-partitioned by event_time into one table per UTC day.
+# Partitions are created PARTITION_PRECREATE_DAYS ahead so rows never land in
+# the default partition, and dropped whole once older than RETENTION_DAYS.
+PARTITION_PRECREATE_DAYS = 3
+RETENTION_DAYS = 30
+PARTITION_PREFIX = "vehicle_data_p"
+
+# Hot statements, prepared once per pooled connection
+PREPARED_STATEMENTS = {
+    "insert_vehicle_data": """
+        INSERT INTO vehicle_data (vin, latitude, longitude, giro, event_time)
+        VALUES ($1, $2, $3, $4, COALESCE(to_timestamp($5::double precision), now()))
+    """,
+    "select_last_vehicle_data": """
+        SELECT vin, latitude, longitude, giro
+        FROM vehicle_data
+        ORDER BY id DESC
+        LIMIT 1
+    """,
+    "select_last_vehicle_data_by_vin": """
+        SELECT vin, latitude, longitude, giro
+        FROM vehicle_data
+        WHERE vin = $1
+        ORDER BY event_time DESC, id DESC
+        LIMIT 1
+    """,
+}
+
+DB_OPERATION_SECONDS = REGISTRY.histogram(
+    "db_operation_seconds", "Duration of DB operations, including reconnect retries", ("op",))
+DB_ERRORS = REGISTRY.counter("db_errors_total", "DB operations that failed after all retries", ("op",))
+DB_RECONNECTS = REGISTRY.counter("db_reconnects_total", "Statements retried on a fresh connection")
+DB_POOL_WAIT_SECONDS = REGISTRY.histogram("db_pool_wait_seconds", "Time to check out a healthy pooled connection")
+DB_ROWS_WRITTEN = REGISTRY.counter("db_rows_written_total", "vehicle_data rows committed")
+
+# Data version of this process's database: bumped after every write that can
+# change what a read returns (rows, rollups, dropped partitions). A result
+# computed under version v is current while data_version() == v; readers take
+# the version before they query, so a write racing the query invalidates it.
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+
+def data_version():
+    return _data_version
+
+
+def bump_data_version():
+    """Invalidate results read so far; called once a write is done, or failed (it may have committed)."""
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+
+
+
+class WriteInDoubt(Exception):
+    """A non-idempotent write lost its connection after it was sent: it may or may not have committed."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# One slot per connection the pool may hand out: getconn() fails at once when
+# the pool is exhausted, so callers queue here instead
+_pool_slots = None
+# id(conn) -> (conn, monotonic time it was last handed back). Holding the
+# connection keeps its id from being reused while the entry exists.
+_conn_state = {}
+
+
+def size_pool(threads):
+    """Allow at least ``threads`` pooled connections; call before the pool is first used."""
+    global POOL_MAX_CONN
+    with _pool_lock:
+        if _pool is not None:
+            logging.warning("DB pool already open with %d connections; not resized to %d", POOL_MAX_CONN, threads)
+            return
+        POOL_MAX_CONN = max(POOL_MAX_CONN, threads, POOL_MIN_CONN)
+
+
+def _get_pool():
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_slots = threading.BoundedSemaphore(POOL_MAX_CONN)
+                _pool = pg_pool.ThreadedConnectionPool(
+                    POOL_MIN_CONN, POOL_MAX_CONN,
+                    host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS
+                )
+    return _pool
+
+
+def close_pool():
+    """Close every pooled connection (used on shutdown)."""
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_slots = None
+        _conn_state.clear()
+
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    state = _conn_state.get(id(conn))
+    if state is not None and time.monotonic() - state[1] < HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _prepare(conn):
+    state = _conn_state.get(id(conn))
+    if state is not None and state[0] is conn:
+        return
     cur = conn.cursor()
+    for name, sql in PREPARED_STATEMENTS.items():
+        cur.execute(f"PREPARE {name} AS {sql}")
+    cur.close()
+    conn.commit()
+
+
+def _release(pool, conn):
+    pool.putconn(conn)
+    if conn.closed:
+        _conn_state.pop(id(conn), None)
+    else:
+        _conn_state[id(conn)] = (conn, time.monotonic())
+
+
+def _discard(pool, conn):
+    _conn_state.pop(id(conn), None)
+    try:
+        pool.putconn(conn, close=True)
+    except Exception:
+        logging.exception("Failed to discard broken DB connection")
+
+
+@contextmanager
+def get_connection():
+    """Borrow a healthy pooled connection; it is returned (or discarded if broken) on exit."""
+    start = time.perf_counter()
+    pool = _get_pool()
+    slots = _pool_slots
+    if not slots.acquire(timeout=POOL_WAIT_TIMEOUT):
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        raise pg_pool.PoolError(f"no pooled connection free within {POOL_WAIT_TIMEOUT}s")
+    try:
+        conn = pool.getconn()
+        if not _is_healthy(conn):
+            _discard(pool, conn)
+            conn = pool.getconn()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        try:
+            _prepare(conn)
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            _discard(pool, conn)
+            raise
+        except BaseException:
+            # Includes GeneratorExit from abandoned streaming reads
+            if not conn.closed:
+                conn.rollback()
+            _release(pool, conn)
+            raise
+        else:
+            _release(pool, conn)
+    finally:
+        slots.release()
+
+
+def _run(work, op="query", idempotent=False):
+    """Run work(conn) on a pooled connection, reconnecting on connection failures.
+
+    A failure while checking out the connection is always retried. A failure
+    once work has started is only retried if ``idempotent``: the connection
+    may have dropped after COMMIT was sent, and running a plain INSERT again
+    would store its rows twice, so WriteInDoubt is raised instead. The duration and any final failure are
+    recorded under the ``op`` label.
+    """
+    start = time.perf_counter()
+    for attempt in range(RECONNECT_ATTEMPTS + 1):
+        started = False
+        try:
+            with get_connection() as conn:
+                started = True
+                result = work(conn)
+            DB_OPERATION_SECONDS.labels(op=op).observe(time.perf_counter() - start)
+            return result
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            if started and not idempotent:
+                DB_ERRORS.labels(op=op).inc()
+                raise WriteInDoubt(f"{op}: {e}") from e
+            if attempt == RECONNECT_ATTEMPTS:
+                DB_ERRORS.labels(op=op).inc()
+                raise
+            DB_RECONNECTS.inc()
+            logging.warning("DB connection failed (%s); reconnecting (attempt %d)", e, attempt + 1)
+            time.sleep(RECONNECT_BACKOFF * (attempt + 1))
+        except Exception:
+            DB_ERRORS.labels(op=op).inc()
+            raise
+
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS vehicle_data (
+        id BIGSERIAL,
+        vin TEXT,
+        latitude REAL,
+        longitude REAL,
+        giro REAL,
+        event_time TIMESTAMPTZ NOT NULL DEFAULT now(),
+        ingest_time TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (id, event_time)
+    ) PARTITION BY RANGE (event_time);
+    CREATE TABLE IF NOT EXISTS vehicle_data_default PARTITION OF vehicle_data DEFAULT;
+    CREATE INDEX IF NOT EXISTS vehicle_data_vin_event_time_idx ON vehicle_data (vin, event_time);
+    CREATE INDEX IF NOT EXISTS vehicle_data_event_time_brin ON vehicle_data USING BRIN (event_time);
+"""
+
+
+def _relkind(cur, table):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _migrate_legacy_table(cur):
+    """Move rows of the unpartitioned, timestamp-less vehicle_data into the partitioned table."""
+    logging.info("Migrating vehicle_data to the partitioned schema")
+    cur.execute("ALTER TABLE vehicle_data RENAME TO vehicle_data_legacy")
+    cur.execute("ALTER SEQUENCE IF EXISTS vehicle_data_id_seq RENAME TO vehicle_data_legacy_id_seq")
+    cur.execute(SCHEMA)
+    create_partitions(cur, datetime.now(timezone.utc).date())
+    # Legacy rows carry no event time: they are filed under the migration time
     cur.execute("""
-        CREATE TABLE IF NOT EXISTS vehicle_data (
-            id SERIAL PRIMARY KEY,
-            vin TEXT,
-            latitude REAL,
-            longitude REAL,
-            giro REAL
-        )
+        INSERT INTO vehicle_data (vin, latitude, longitude, giro)
+        SELECT vin, latitude, longitude, giro FROM vehicle_data_legacy ORDER BY id
     """)
-    conn.commit()
-    cur.close()
-    conn.close()
+    cur.execute("DROP TABLE vehicle_data_legacy")
+
 
-def write_vehicle_data(vin, lat, lon, giro):
+def init_db():
+    # Plain connection: the table must exist before pooled connections prepare statements
     conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
     cur = conn.cursor()
-    cur.execute("INSERT INTO vehicle_data (vin, latitude, longitude, giro) VALUES (%s, %s, %s, %s)",
-                (vin, lat, lon, giro))
+    if _relkind(cur, "vehicle_data") == "r":
+        _migrate_legacy_table(cur)
+    else:
+        cur.execute(SCHEMA)
+    create_partitions(cur)
     conn.commit()
     cur.close()
     conn.close()
 
-def read_all_vehicle_data():
+
+def _partition_name(day):
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def create_partitions(cur, first_day=None, days=PARTITION_PRECREATE_DAYS):
+    """Create the daily partitions from first_day (default: today, UTC) through days ahead."""
+    first_day = first_day or datetime.now(timezone.utc).date()
+    for offset in range(days + 1):
+        day = first_day + timedelta(days=offset)
+        # Fails if the default partition already holds rows of that day (far
+        # future event times); skip the day rather than abort the transaction
+        cur.execute("SAVEPOINT create_partition")
+        try:
+            cur.execute(
+                f"CREATE TABLE IF NOT EXISTS {_partition_name(day)} PARTITION OF vehicle_data "
+                f"FOR VALUES FROM ('{day.isoformat()} 00:00:00+00') TO ('{(day + timedelta(days=1)).isoformat()} 00:00:00+00')"
+            )
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT create_partition")
+            logging.warning("Could not create partition for %s: %s", day, e)
+        cur.execute("RELEASE SAVEPOINT create_partition")
+
+
+def drop_expired_partitions(cur, retention_days=RETENTION_DAYS, today=None):
+    """Drop daily partitions entirely older than retention_days; returns the dropped names."""
+    cutoff = (today or datetime.now(timezone.utc).date()) - timedelta(days=retention_days)
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'vehicle_data'::regclass
+    """)
+    dropped = []
+    for (name,) in cur.fetchall():
+        if not name.startswith(PARTITION_PREFIX):
+            continue
+        try:
+            day = datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d").date()
+        except ValueError:
+            continue
+        if day < cutoff:
+            cur.execute(f"DROP TABLE IF EXISTS {name}")
+            dropped.append(name)
+    # Only late rows older than any daily partition end up in the default
+    # partition, so this DELETE stays small
+    cur.execute("DELETE FROM vehicle_data_default WHERE event_time < %s",
+                (f"{cutoff.isoformat()} 00:00:00+00",))
+    return sorted(dropped)
+
+
+def maintain_partitions(retention_days=RETENTION_DAYS):
+    """Retention job: pre-create upcoming partitions and drop expired ones (no DELETEs)."""
+    def work(conn):
+        cur = conn.cursor()
+        create_partitions(cur)
+        dropped = drop_expired_partitions(cur, retention_days)
+        conn.commit()
+        cur.close()
+        return dropped
+    dropped = _run(work, "maintain_partitions", idempotent=True)
+    if dropped:
+        bump_data_version()
+        logging.info("Dropped %d expired vehicle_data partitions: %s", len(dropped), ", ".join(dropped))
+    return dropped
+
+
+# Per-VIN aggregates of vehicle_data over fixed time buckets, one table per tier
+ROLLUP_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        vin TEXT NOT NULL,
+        bucket TIMESTAMPTZ NOT NULL,
+        samples BIGINT NOT NULL,
+        giro_count BIGINT NOT NULL,
+        giro_sum DOUBLE PRECISION NOT NULL,
+        giro_min REAL,
+        giro_max REAL,
+        lat_min REAL,
+        lat_max REAL,
+        lon_min REAL,
+        lon_max REAL,
+        distance_m DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (vin, bucket)
+    );
+    CREATE INDEX IF NOT EXISTS {table}_bucket_idx ON {table} (bucket);
+"""
+
+ROLLUP_COLUMNS = ("vin", "bucket", "samples", "giro_count", "giro_sum", "giro_min", "giro_max",
+                  "lat_min", "lat_max", "lon_min", "lon_max", "distance_m")
+# How an aggregate row is merged into an existing bucket (shared with aio_db)
+ROLLUP_MERGE = """
+    ON CONFLICT (vin, bucket) DO UPDATE SET
+        samples = t.samples + EXCLUDED.samples,
+        giro_count = t.giro_count + EXCLUDED.giro_count,
+        giro_sum = t.giro_sum + EXCLUDED.giro_sum,
+        giro_min = LEAST(t.giro_min, EXCLUDED.giro_min),
+        giro_max = GREATEST(t.giro_max, EXCLUDED.giro_max),
+        lat_min = LEAST(t.lat_min, EXCLUDED.lat_min),
+        lat_max = GREATEST(t.lat_max, EXCLUDED.lat_max),
+        lon_min = LEAST(t.lon_min, EXCLUDED.lon_min),
+        lon_max = GREATEST(t.lon_max, EXCLUDED.lon_max),
+        distance_m = t.distance_m + EXCLUDED.distance_m
+"""
+
+
+def init_rollups(tables):
+    """Create the rollup tables (one per tier) if they do not exist."""
     conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
     cur = conn.cursor()
-    cur.execute("SELECT vin, latitude, longitude, giro FROM vehicle_data")
-    last_row = cur.fetchone
-    rows = cur.fetchall()
+    for table in tables:
+        cur.execute(ROLLUP_SCHEMA.format(table=table))
+    conn.commit()
     cur.close()
     conn.close()
-    return rows
-
-def read_last_vehicle_data():
-    conn = psycopg2.connect(
-        host=DB_HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS
+
+
+def upsert_rollups(cur, table, aggregates):
+    """Merge ROLLUP_COLUMNS-shaped aggregate rows (bucket as epoch seconds) into table."""
+    if not aggregates:
+        return
+    extras.execute_values(
+        cur,
+        f"INSERT INTO {table} AS t ({', '.join(ROLLUP_COLUMNS)}) VALUES %s {ROLLUP_MERGE}",
+        aggregates,
+        template="(%s, to_timestamp(%s), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        page_size=len(aggregates)
     )
-    cur = conn.cursor()
 
-    cur.execute("""
-        SELECT vin, latitude, longitude, giro
-        FROM vehicle_data
-        ORDER BY id DESC
-        LIMIT 1
-    """)
 
-    row = cur.fetchone()
+def read_rollups(table, since, until, resolution, vin=None):
+    """Re-bucket table's aggregates to ``resolution`` seconds over [since, until) (epoch seconds).
+
+    Returns (vin, bucket, samples, giro_avg, giro_min, giro_max, lat_min,
+    lat_max, lon_min, lon_max, distance_m) rows ordered by vin and bucket.
+    """
+    sql = f"""
+        SELECT vin,
+               EXTRACT(EPOCH FROM date_bin(make_interval(secs => %s), bucket, TIMESTAMPTZ 'epoch'))::float8 AS b,
+               sum(samples), sum(giro_sum) / NULLIF(sum(giro_count), 0), min(giro_min), max(giro_max),
+               min(lat_min), max(lat_max), min(lon_min), max(lon_max), sum(distance_m)
+        FROM {table}
+        WHERE bucket >= to_timestamp(%s) AND bucket < to_timestamp(%s)
+    """
+    params = [resolution, since, until]
+    if vin:
+        sql += " AND vin = %s"
+        params.append(vin)
+    sql += " GROUP BY vin, b ORDER BY vin, b"
+    def work(conn):
+        cur = conn.cursor()
+        cur.execute(sql, tuple(params))
+        rows = cur.fetchall()
+        cur.close()
+        conn.commit()
+        return rows
+    return _run(work, "read_rollups", idempotent=True)
+
+
+def prune_rollups(table, older_than):
+    """Delete table's buckets that start before older_than (epoch seconds); returns the row count."""
+    def work(conn):
+        cur = conn.cursor()
+        cur.execute(f"DELETE FROM {table} WHERE bucket < to_timestamp(%s)", (older_than,))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+        return deleted
+    deleted = _run(work, "prune_rollups", idempotent=True)
+    if deleted:
+        bump_data_version()
+    return deleted
+
 
+# Keys of every row ingested idempotently (see write_unique_vehicle_data_batch).
+# Kept apart from vehicle_data: a unique index on the partitioned table would
+# have to include event_time, which rows without a time only get at insert.
+RECORD_KEYS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS vehicle_data_keys (
+        record_key TEXT PRIMARY KEY,
+        ingest_time TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS vehicle_data_keys_ingest_time_brin ON vehicle_data_keys USING BRIN (ingest_time);
+"""
+
+
+def init_record_keys():
+    """Create the record key table used by idempotent ingest if it does not exist."""
+    conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASS)
+    cur = conn.cursor()
+    cur.execute(RECORD_KEYS_SCHEMA)
+    conn.commit()
     cur.close()
     conn.close()
 
-    return row
 
+def prune_record_keys(retention_days=RETENTION_DAYS):
+    """Forget record keys ingested more than retention_days ago; returns the row count."""
+    def work(conn):
+        cur = conn.cursor()
+        cur.execute("DELETE FROM vehicle_data_keys WHERE ingest_time < now() - make_interval(days => %s)",
+                    (retention_days,))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+        return deleted
+    return _run(work, "prune_record_keys", idempotent=True)
+
+
+def write_vehicle_data(vin, lat, lon, giro, event_time=None):
+    """event_time is epoch seconds; None stamps the row with the insert time."""
+    def work(conn):
+        cur = conn.cursor()
+        cur.execute("EXECUTE insert_vehicle_data (%s, %s, %s, %s, %s)", (vin, lat, lon, giro, event_time))
+        conn.commit()
+        cur.close()
+    try:
+        _run(work, "write")
+    finally:
+        bump_data_version()
+    DB_ROWS_WRITTEN.inc()
+
+
+def write_vehicle_data_batch(rows, rollups=None):
+    """Insert many (vin, lat, lon, giro, event_time) rows with one multi-row INSERT and one COMMIT.
+
+    event_time is epoch seconds, or None to stamp the row with the insert time.
+    ``rollups`` maps rollup table -> aggregate rows (see upsert_rollups) to merge
+    in the same transaction, so raw rows and aggregates never diverge.
+    """
+    if not rows:
+        return
+    def work(conn):
+        cur = conn.cursor()
+        extras.execute_values(
+            cur,
+            "INSERT INTO vehicle_data (vin, latitude, longitude, giro, event_time) VALUES %s",
+            rows,
+            template="(%s, %s, %s, %s, COALESCE(to_timestamp(%s::double precision), now()))",
+            page_size=len(rows)
+        )
+        for table, aggregates in (rollups or {}).items():
+            upsert_rollups(cur, table, aggregates)
+        conn.commit()
+        cur.close()
+    try:
+        _run(work, "write_batch")
+    finally:
+        bump_data_version()
+    DB_ROWS_WRITTEN.inc(len(rows))
+
+
+def write_unique_vehicle_data_batch(rows):
+    """Insert (record_key, vin, lat, lon, giro, event_time) rows whose key was never ingested.
+
+    Idempotent: the keys go into vehicle_data_keys with ON CONFLICT DO NOTHING
+    and only the rows whose key was new reach vehicle_data, in the same
+    statement. Returns the number of rows inserted.
+    """
+    if not rows:
+        return 0
+    def work(conn):
+        cur = conn.cursor()
+        extras.execute_values(
+            cur,
+            """
+            WITH batch (record_key, vin, latitude, longitude, giro, event_time) AS (VALUES %s),
+            fresh AS (
+                INSERT INTO vehicle_data_keys (record_key)
+                SELECT DISTINCT record_key FROM batch
+                ON CONFLICT DO NOTHING
+                RETURNING record_key
+            )
+            INSERT INTO vehicle_data (vin, latitude, longitude, giro, event_time)
+            SELECT DISTINCT ON (b.record_key) b.vin, b.latitude, b.longitude, b.giro,
+                   COALESCE(to_timestamp(b.event_time), now())
+            FROM batch b JOIN fresh USING (record_key)
+            """,
+            rows,
+            template="(%s, %s, %s::real, %s::real, %s::real, %s::double precision)",
+            page_size=len(rows)
+        )
+        inserted = cur.rowcount
+        conn.commit()
+        cur.close()
+        return inserted
+    try:
+        inserted = _run(work, "write_unique_batch", idempotent=True)
+    finally:
+        bump_data_version()
+    DB_ROWS_WRITTEN.inc(inserted)
+    return inserted
+
+
+def iter_vehicle_data(vin=None, itersize=None, since=None, until=None):
+    """Yield (vin, lat, lon, giro) rows from a named server-side cursor.
+
+    ``since``/``until`` (epoch seconds) bound event_time, so only the matching
+    daily partitions are scanned. Only ``itersize`` rows are held in memory at
+    a time. The pooled connection stays checked out until the generator is
+    exhausted or closed.
+    """
+    conditions = []
+    params = []
+    if vin:
+        conditions.append("vin = %s")
+        params.append(vin)
+    if since is not None:
+        conditions.append("event_time >= to_timestamp(%s)")
+        params.append(since)
+    if until is not None:
+        conditions.append("event_time < to_timestamp(%s)")
+        params.append(until)
+    sql = "SELECT vin, latitude, longitude, giro FROM vehicle_data"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    with get_connection() as conn:
+        cur = conn.cursor(name=f"vehicle_data_{uuid.uuid4().hex}")
+        cur.itersize = itersize or CURSOR_ITERSIZE
+        try:
+            if params:
+                cur.execute(sql, tuple(params))
+            else:
+                cur.execute(sql)
+            for row in cur:
+                yield row
+        finally:
+            if not conn.closed:
+                cur.close()
+                conn.rollback()
+
+
+def iter_vehicle_data_since(after_id=0, vin=None, limit=None, itersize=None):
+    """Yield (id, vin, lat, lon, giro, event_time) rows with id > after_id, in id order.
+
+    For incremental sync: the largest id seen is the caller's watermark for
+    the next call. ids are assigned at insert and every row goes through the
+    twin's one writer (shard workers hand their merged rows back to it), so
+    ids commit in increasing order and no row can appear later below a
+    watermark already handed out. event_time is epoch seconds.
+    """
+    sql = ("SELECT id, vin, latitude, longitude, giro, EXTRACT(EPOCH FROM event_time)::float8 "
+           "FROM vehicle_data WHERE id > %s")
+    params = [after_id]
+    if vin:
+        sql += " AND vin = %s"
+        params.append(vin)
+    sql += " ORDER BY id"
+    if limit:
+        sql += " LIMIT %s"
+        params.append(limit)
+    with get_connection() as conn:
+        cur = conn.cursor(name=f"vehicle_data_since_{uuid.uuid4().hex}")
+        cur.itersize = itersize or CURSOR_ITERSIZE
+        try:
+            cur.execute(sql, tuple(params))
+            for row in cur:
+                yield row
+        finally:
+            if not conn.closed:
+                cur.close()
+                conn.rollback()
+
+
+def read_all_vehicle_data(vin=None):
+    return list(iter_vehicle_data(vin))
+
+
+def read_last_vehicle_data(vin=None):
+    def work(conn):
+        cur = conn.cursor()
+        if vin:
+            cur.execute("EXECUTE select_last_vehicle_data_by_vin (%s)", (vin,))
+        else:
+            cur.execute("EXECUTE select_last_vehicle_data")
+        row = cur.fetchone()
+        cur.close()
+        conn.commit()
+        return row
+    return _run(work, "read_last", idempotent=True)
+
+
+def iter_latest_vehicle_data(itersize=None):
+    """Yield the newest (vin, lat, lon, giro, event_time) row of every VIN, streamed like iter_vehicle_data.
+
+    event_time is returned as epoch seconds, matching the rows the twin writes.
+    """
+    with get_connection() as conn:
+        cur = conn.cursor(name=f"latest_vehicle_data_{uuid.uuid4().hex}")
+        cur.itersize = itersize or CURSOR_ITERSIZE
+        try:
+            cur.execute("""
+                SELECT DISTINCT ON (vin) vin, latitude, longitude, giro, EXTRACT(EPOCH FROM event_time)::float8
+                FROM vehicle_data
+                ORDER BY vin, event_time DESC, id DESC
+            """)
+            for row in cur:
+                yield row
+        finally:
+            if not conn.closed:
+                cur.close()
+                conn.rollback()
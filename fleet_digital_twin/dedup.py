@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import math
+import threading
+
+
+def record_key(source, record_id):
+    """Identity of a row sent by an incremental sync frame: the sending twin and its vehicle_data id."""
+    return f"{source}:{record_id}"
+
+
+def content_key(vin, lat, lon, giro, ts):
+    """Identity of a row that carries no id: a hash of its content.
+
+    Only for legacy publishers: the vehicle twin sends its id and source with
+    every row, full replays included. Rows without a time collide whenever
+    one vehicle reports identical readings.
+    """
+    digest = hashlib.blake2b(repr((vin, lat, lon, giro, ts)).encode(), digest_size=16).hexdigest()
+    return f"h:{digest}"
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over string keys.
+
+    ``num_hashes`` bit positions per key come from one 128-bit blake2b
+    digest (double hashing), so a lookup costs a single hash call.
+    """
+
+    def __init__(self, num_bits, num_hashes):
+        self.num_bits = max(int(num_bits), 8)
+        self.num_hashes = max(int(num_hashes), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """Size a filter for ``capacity`` keys at a false-positive rate of ``error_rate``."""
+        num_bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        return cls(num_bits, round(num_bits / capacity * math.log(2)))
+
+    @staticmethod
+    def capacity_for(num_bits, error_rate):
+        """How many keys ``num_bits`` bits hold at a false-positive rate of ``error_rate``."""
+        return max(int(-num_bits * math.log(2) ** 2 / math.log(error_rate)), 1)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+
+class RecordFilter:
+    """Bounded-memory "probably seen" set of record keys in front of the DB.
+
+    The ``max_bytes`` budget is split between two Bloom filter generations,
+    each sized for as many keys as keep it at ``error_rate``. New keys go to
+    the current generation; once it is full the older one is dropped and a
+    fresh one started, so memory stays fixed and the error rate bounded while
+    the oldest keys are forgotten (the DB still rejects their duplicates).
+
+    A false positive makes a new record look like a duplicate; ``error_rate``
+    is the chance of that per record.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, error_rate=1e-6):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.max_bytes = max_bytes
+        self.error_rate = error_rate
+        generation_bits = max(max_bytes // 2, 1) * 8
+        self.capacity = BloomFilter.capacity_for(generation_bits, error_rate)
+        self._num_hashes = round(generation_bits / self.capacity * math.log(2))
+        self._generation_bits = generation_bits
+        self._current = BloomFilter(generation_bits, self._num_hashes)
+        self._previous = None
+        self.rotations = 0
+
+    def __contains__(self, key):
+        return key in self._current or (self._previous is not None and key in self._previous)
+
+    def add(self, key):
+        if self._current.count >= self.capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self._generation_bits, self._num_hashes)
+            self.rotations += 1
+        self._current.add(key)
+
+    @property
+    def nbytes(self):
+        return self._current.nbytes + (self._previous.nbytes if self._previous is not None else 0)
+
+    @property
+    def fill(self):
+        """Keys in the current generation as a fraction of its capacity."""
+        return self._current.count / self.capacity
+
+
+class Deduplicator:
+    """Batch flush that drops duplicate rows before, and at, the DB.
+
+    ``write(rows)`` inserts (record_key, vin, lat, lon, giro, event_time) rows
+    idempotently and returns how many were new. Rows whose key the filter has
+    seen are dropped first; keys are added to the filter only once their
+    batch is committed, so a failed write does not hide the rows from a
+    later replay. Runs on the batch writer thread (``aflush`` on the event
+    loop).
+    """
+
+    def __init__(self, write, record_filter=None):
+        self._write = write
+        self.filter = record_filter
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.filter_hits = 0
+        self.db_conflicts = 0
+        self.written = 0
+
+    def __call__(self, rows):
+        keys, fresh = self._screen(rows)
+        if fresh:
+            self._record(keys, fresh, self._write(fresh))
+
+    async def aflush(self, rows):
+        """The same flush for the asyncio runtime, where ``write`` is a coroutine function."""
+        keys, fresh = self._screen(rows)
+        if fresh:
+            self._record(keys, fresh, await self._write(fresh))
+
+    def _screen(self, rows):
+        keys = set()
+        fresh = []
+        for row in rows:
+            key = row[0]
+            if key in keys or (self.filter is not None and key in self.filter):
+                continue
+            keys.add(key)
+            fresh.append(row)
+        with self._lock:
+            self.checked += len(rows)
+            self.filter_hits += len(rows) - len(fresh)
+        return keys, fresh
+
+    def _record(self, keys, fresh, inserted):
+        with self._lock:
+            self.written += inserted
+            self.db_conflicts += len(fresh) - inserted
+        if self.filter is not None:
+            for key in keys:
+                self.filter.add(key)
+        if inserted < len(fresh):
+            logging.debug("Dropped %d duplicate rows at the DB", len(fresh) - inserted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "filter_hits": self.filter_hits,
+                "db_conflicts": self.db_conflicts,
+                "written": self.written,
+            }
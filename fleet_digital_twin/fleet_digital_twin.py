@@ -1,10 +1,23 @@
+import asyncio
+import atexit
 import json
 import time
 import threading
 import logging
+import os
+import signal
+import sys
 from typing import Optional
 import paho.mqtt.client as mqtt
-from db import init_db, write_vehicle_data
+from batch_writer import BatchWriter
+from aio_runtime import RUNTIMES, AsyncBatchWriter, consume, run_periodically
+from codec import decode
+from metrics import REGISTRY, start_http_server
+from db import init_db, init_record_keys, write_unique_vehicle_data_batch, close_pool, maintain_partitions, \
+    prune_record_keys
+from dedup import Deduplicator, RecordFilter, content_key, record_key
+from pipeline import IngestPipeline, InlineIngest, StageQueue
+from sync_acks import SyncAcks
 
 try:
     from db import read_all_vehicle_data
@@ -12,40 +25,254 @@ except Exception:
     read_all_vehicle_data = None
     logging.warning("db.read_all_vehicle_data not available; trigger will be a no-op")
 
-BROKER = "mqtt-broker"
+# Overridable so the twin can run outside compose (e.g. benchmarks/bench_e2e.py)
+BROKER = os.environ.get("BROKER", "mqtt-broker")
 DATA_TOPIC = "vehicles/data"
+# Incremental sync frames from the vehicle twin's trigger listener
+BATCH_TOPIC = "vehicles/data/batch"
+# Where applied sync frames are acknowledged (the vehicle twin's trigger topic)
+TRIGGER_TOPIC = "vehicles/request"
+# Prometheus text endpoint (GET /metrics); 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+# "threads" (paho network thread, decode workers, psycopg2 pool) or "asyncio"
+# (aiomqtt and an asyncpg pool on one event loop, decoding inline)
+TWIN_RUNTIME = os.environ.get("TWIN_RUNTIME", "threads")
+if TWIN_RUNTIME not in RUNTIMES:
+    raise ValueError(f"TWIN_RUNTIME must be one of {RUNTIMES}, not {TWIN_RUNTIME!r}")
 
 init_db()
+init_record_keys()
 
 # How long partial records can live before being cleaned (optional)
 EXPIRATION_SECONDS = 30
 
+# Group commit: flush received records every WRITE_BATCH_SIZE rows or WRITE_BATCH_DELAY seconds
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_DELAY = 0.05
+WRITE_QUEUE_SIZE = 10000
+
+# Receive -> decode -> write pipeline. Overload policies: "block" (backpressure),
+# "drop_oldest", and for the write stage also "coalesce" (keep the latest row per VIN)
+DECODE_WORKERS = 2
+RECEIVE_QUEUE_SIZE = 10000
+RECEIVE_POLICY = "block"
+WRITE_POLICY = "block"
+
+# Ingest is idempotent: every row has a record key (sending twin + id; a content
+# hash for legacy publishers that send no id) that the DB accepts once. A Bloom filter of
+# DEDUP_FILTER_BYTES drops most duplicates before they reach the DB; 0 disables it
+DEDUP_FILTER_BYTES = 8 * 1024 * 1024
+DEDUP_ERROR_RATE = 1e-6
+
+# How often daily vehicle_data partitions are created ahead / dropped past retention
+PARTITION_MAINTENANCE_INTERVAL = 3600
+
 logging.basicConfig(
     level=logging.INFO,
     format="[%(threadName)s] %(levelname)s: %(message)s",
     force=True   # important when threading is used
 )
 
+def _number(payload, field):
+    value = payload.get(field)
+    if value is not None and not isinstance(value, (int, float)):
+        raise ValueError(f"{field} is not a number: {value!r}")
+    return value
+
+def _row(payload, source=None):
+    """(record_key, vin, lat, lon, giro, ts) for one reading; source names the twin that assigned its id."""
+    vin = payload.get("vin")
+    if not vin:
+        raise ValueError("missing vin")
+    # A missing ts stamps the row with the insert time
+    values = (vin, _number(payload, "latitude"), _number(payload, "longitude"), _number(payload, "giro"),
+              _number(payload, "ts"))
+    if source is not None and payload.get("id") is not None:
+        return (record_key(source, payload["id"]),) + values
+    return (content_key(*values),) + values
+
+def decode_record(topic, raw):
+    """Decode and validate one data message or sync frame into DB row(s) (runs on the decode workers)."""
+    if topic not in (DATA_TOPIC, BATCH_TOPIC):
+        return None
+    # Any wire codec: plain JSON, msgpack or struct (see codec.py)
+    payload = decode(raw)
+    logging.debug("Processing data message: %s", payload)
+    if topic == BATCH_TOPIC:
+        source = payload.get("source")
+        rows = [_row(r, source) for r in payload.get("rows", [])]
+        # Frames of a one-VIN sync, or from senders without "since", are not acknowledged
+        if source is not None and payload.get("since") is not None and payload.get("vin") is None:
+            sync_acks.frame(source, payload.get("subscriber"), payload.get("seq"), payload["since"],
+                            payload["watermark"], [row[0] for row in rows])
+        return rows
+    return _row(payload, payload.get("source"))
+
+# The MQTT client acks are published on; the asyncio runtime sets it per connection
+client = None
+
+def publish_ack(source, subscriber, watermark):
+    """Tell the sending twin that subscriber has applied its frames up to watermark."""
+    if client is None:
+        return
+    payload = json.dumps({"subscriber": subscriber, "ack": watermark})
+    if TWIN_RUNTIME == "asyncio":
+        asyncio.get_running_loop().create_task(client.publish(TRIGGER_TOPIC, payload))
+    else:
+        client.publish(TRIGGER_TOPIC, payload)
+    logging.debug("Acknowledged %s frames up to %s for %s", source, watermark, subscriber)
+
+sync_acks = SyncAcks(publish_ack)
+
+if TWIN_RUNTIME == "asyncio":
+    import aio_db
+    dedup = Deduplicator(
+        aio_db.write_unique_vehicle_data_batch,
+        RecordFilter(DEDUP_FILTER_BYTES, DEDUP_ERROR_RATE) if DEDUP_FILTER_BYTES else None
+    )
+
+    async def flush(rows):
+        await dedup.aflush(rows)
+        sync_acks.committed(row[0] for row in rows)
+
+    # Started by run_async() on the event loop; the write queue blocks when full
+    writer = AsyncBatchWriter(
+        flush,
+        max_batch=WRITE_BATCH_SIZE,
+        max_delay=WRITE_BATCH_DELAY,
+        max_queue=WRITE_QUEUE_SIZE,
+        name="db-writer"
+    )
+    pipeline = InlineIngest(decode_record, writer, name="fleet-ingest")
+else:
+    dedup = Deduplicator(
+        write_unique_vehicle_data_batch,
+        RecordFilter(DEDUP_FILTER_BYTES, DEDUP_ERROR_RATE) if DEDUP_FILTER_BYTES else None
+    )
+
+    def flush(rows):
+        dedup(rows)
+        sync_acks.committed(row[0] for row in rows)
+
+    writer = BatchWriter(
+        flush,
+        max_batch=WRITE_BATCH_SIZE,
+        max_delay=WRITE_BATCH_DELAY,
+        name="db-writer",
+        row_queue=StageQueue(WRITE_QUEUE_SIZE, WRITE_POLICY, key=lambda row: row[1])
+    )
+    pipeline = IngestPipeline(
+        decode_record,
+        writer,
+        workers=DECODE_WORKERS,
+        receive_queue_size=RECEIVE_QUEUE_SIZE,
+        receive_policy=RECEIVE_POLICY,
+        name="fleet-ingest"
+    ).start()
+# Pipeline counters are read on scrape, so the ingest path records nothing extra
+REGISTRY.counter("fleet_messages_received_total", "Messages handed to the ingest pipeline",
+                 fn=lambda: pipeline.received)
+REGISTRY.counter("fleet_records_decoded_total", "Rows decoded and queued for the DB", fn=lambda: pipeline.decoded)
+REGISTRY.counter("fleet_messages_invalid_total", "Messages dropped as undecodable or invalid",
+                 fn=lambda: pipeline.invalid)
+if TWIN_RUNTIME == "threads":
+    REGISTRY.counter("fleet_dropped_total", "Items dropped by the overload policy", ("stage",),
+                     fn=lambda: {"receive": pipeline.receive_queue.dropped,
+                                 "write": getattr(writer.row_queue, "dropped", 0)})
+    REGISTRY.counter("fleet_write_coalesced_total", "Rows replaced in the write queue by a newer row of the same VIN",
+                     fn=lambda: getattr(writer.row_queue, "coalesced", 0))
+REGISTRY.gauge("fleet_queue_depth", "Items waiting per pipeline stage", ("stage",), fn=pipeline.queue_depths)
+REGISTRY.counter("fleet_write_failed_rows_total", "Rows dropped by failed batch writes", fn=lambda: writer.rows_failed)
+REGISTRY.counter("fleet_write_retries_total", "Failed batch writes retried", fn=lambda: writer.retries)
+# Hit rate: (filter hits + DB conflicts) / checked
+REGISTRY.counter("fleet_dedup_checked_total", "Rows checked for duplicates before writing", fn=lambda: dedup.checked)
+REGISTRY.counter("fleet_dedup_filter_hits_total", "Duplicate rows dropped before the DB (filter or same batch)",
+                 fn=lambda: dedup.filter_hits)
+REGISTRY.counter("fleet_dedup_db_conflicts_total", "Duplicate rows the DB rejected on their record key",
+                 fn=lambda: dedup.db_conflicts)
+REGISTRY.gauge("fleet_sync_rows_pending", "Sync frame rows not yet committed, holding back their ack",
+               fn=lambda: len(sync_acks))
+if dedup.filter is not None:
+    REGISTRY.gauge("fleet_dedup_filter_bytes", "Memory held by the duplicate filter", fn=lambda: dedup.filter.nbytes)
+    REGISTRY.gauge("fleet_dedup_filter_fill", "Current filter generation fill (0-1)", fn=lambda: dedup.filter.fill)
+
+# atexit runs last-registered first: drain the pipeline, then close the pool
+atexit.register(close_pool)
+if TWIN_RUNTIME == "threads":
+    atexit.register(pipeline.stop)
+# docker stop sends SIGTERM; exit normally so the pipeline is drained
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+def partition_maintenance():
+    """Pre-create upcoming vehicle_data partitions and drop expired partitions and record keys."""
+    maintain_partitions()
+    prune_record_keys()
+
+def on_trigger_partition_maintenance():
+    """Periodically run partition_maintenance()."""
+    while True:
+        try:
+            partition_maintenance()
+        except Exception as e:
+            logging.exception("Partition maintenance failed: %s", e)
+        time.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+if METRICS_PORT:
+    try:
+        start_http_server(METRICS_PORT)
+    except OSError as e:
+        logging.warning("Metrics endpoint not started on port %d: %s", METRICS_PORT, e)
+
 def on_message(client, userdata, msg):
-    payload = json.loads(msg.payload.decode())
-    logging.info(f"Received on {msg.topic}: {payload}")
-
-    if msg.topic == DATA_TOPIC:
-        logging.info(f"Processing data message: {payload}")
-        vin = payload.get("vin")
-        latitude = payload.get("latitude")
-        longitude = payload.get("longitude")
-        giro = payload.get("giro")
-        # to do validation of data - select only unique entries in order to avoid duplicates
-        write_vehicle_data(vin, latitude, longitude, giro)
-
-client = mqtt.Client()
-client.on_message = on_message
-client.connect(BROKER, 1883, 60)
-# client.subscribe(TOPIC_VIN)
-# client.subscribe(TOPIC_GIRO)
-# client.subscribe(TOPIC_LOCATION)
-client.subscribe(DATA_TOPIC)
-print("fleet_digital_twin running...")
-
-client.loop_forever()
+    # Runs on the paho network thread: only hand the raw payload to the pipeline
+    pipeline.submit(msg.topic, msg.payload)
+
+async def on_message_async(mqtt_client, userdata, msg):
+    global client
+    # Acks go out on the current connection
+    client = mqtt_client
+    await pipeline.submit(msg.topic, msg.payload)
+
+async def run_async():
+    """The asyncio runtime: ingest and deduplicating writes on this event loop.
+
+    Schema set-up (above) and partition maintenance keep using db.py, off the loop.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    # docker stop sends SIGTERM: leave the loop through the shutdown below
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    await aio_db.open_pool()
+    writer.start()
+    tasks = [
+        loop.create_task(consume(BROKER, (DATA_TOPIC, BATCH_TOPIC), on_message_async)),
+        loop.create_task(run_periodically(partition_maintenance, PARTITION_MAINTENANCE_INTERVAL,
+                                          "Partition maintenance", blocking=True)),
+    ]
+    print("fleet_digital_twin running (asyncio)...")
+    try:
+        await stopping.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await writer.stop()
+        await aio_db.close_pool()
+
+if TWIN_RUNTIME == "asyncio":
+    asyncio.run(run_async())
+else:
+    threading.Thread(target=on_trigger_partition_maintenance, name="partition-maintenance", daemon=True).start()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    client.on_message = on_message
+    client.connect(BROKER, 1883, 60)
+    # client.subscribe(TOPIC_VIN)
+    # client.subscribe(TOPIC_GIRO)
+    # client.subscribe(TOPIC_LOCATION)
+    client.subscribe(DATA_TOPIC)
+    client.subscribe(BATCH_TOPIC)
+    print("fleet_digital_twin running...")
+
+    client.loop_forever()
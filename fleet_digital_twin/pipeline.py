@@ -0,0 +1,218 @@
+import logging
+import queue
+import threading
+from collections import OrderedDict, deque
+
+POLICIES = ("block", "drop_oldest", "coalesce")
+
+
+class StageQueue:
+    """Bounded queue between pipeline stages with an explicit overload policy.
+
+    - ``block``: ``put`` waits for space, pushing back on the upstream stage.
+    - ``drop_oldest``: ``put`` never waits; the oldest queued item is dropped.
+    - ``coalesce``: items are keyed by ``key(item)``; a new item replaces the
+      queued item with the same key in place, otherwise ``put`` waits for space.
+
+    Implements the subset of ``queue.Queue`` the stages use.
+    """
+
+    def __init__(self, maxsize, policy="block", key=None):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overload policy {policy!r}, expected one of {POLICIES}")
+        if policy == "coalesce" and key is None:
+            raise ValueError("coalesce policy requires a key function")
+        self.maxsize = maxsize
+        self.policy = policy
+        self._key = key
+        self._items = OrderedDict() if policy == "coalesce" else deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self.dropped = 0
+        self.coalesced = 0
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item, timeout=None):
+        with self._lock:
+            if self.policy == "coalesce":
+                k = self._key(item)
+                if k not in self._items and len(self._items) >= self.maxsize:
+                    self._wait_for_space(timeout, lambda: k in self._items)
+                if k in self._items:
+                    self.coalesced += 1
+                self._items[k] = item
+            else:
+                if len(self._items) >= self.maxsize:
+                    if self.policy == "drop_oldest":
+                        self._items.popleft()
+                        self.dropped += 1
+                    else:
+                        self._wait_for_space(timeout)
+                self._items.append(item)
+            self._not_empty.notify()
+
+    def _wait_for_space(self, timeout, or_else=lambda: False):
+        if not self._not_full.wait_for(lambda: len(self._items) < self.maxsize or or_else(), timeout):
+            raise queue.Full
+
+    def get(self, timeout=None):
+        with self._lock:
+            if not self._not_empty.wait_for(lambda: len(self._items) > 0, timeout):
+                raise queue.Empty
+            return self._pop()
+
+    def get_nowait(self):
+        with self._lock:
+            if not self._items:
+                raise queue.Empty
+            return self._pop()
+
+    def _pop(self):
+        if self.policy == "coalesce":
+            item = self._items.popitem(last=False)[1]
+        else:
+            item = self._items.popleft()
+        self._not_full.notify()
+        return item
+
+
+class IngestPipeline:
+    """Receive -> decode/validate workers -> writer.
+
+    ``submit`` is cheap enough for the paho callback: it only enqueues the raw
+    payload. ``decode(topic, payload)`` runs on the worker pool and returns the
+    row(s) to write, or None to skip the message; rows go to ``writer``, whose
+    queue carries the write-stage overload policy.
+    """
+
+    def __init__(self, decode, writer, workers=2, receive_queue_size=10000,
+                 receive_policy="block", name="ingest", report_interval=60.0):
+        if receive_policy == "coalesce":
+            raise ValueError("raw payloads have no key; coalesce is only available on the write stage")
+        self._decode = decode
+        self.writer = writer
+        self.name = name
+        self.report_interval = report_interval
+        self.receive_queue = StageQueue(receive_queue_size, receive_policy)
+        self._stopping = threading.Event()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"{name}-decode-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        self.received = 0
+        # The decode workers share these counters
+        self._counts_lock = threading.Lock()
+        self.decoded = 0
+        self.invalid = 0
+
+    def start(self):
+        self.writer.start()
+        for t in self._workers:
+            t.start()
+        if self.report_interval:
+            threading.Thread(target=self._report, name=f"{self.name}-report", daemon=True).start()
+        return self
+
+    def submit(self, topic, payload, timeout=None):
+        self.received += 1
+        self.receive_queue.put((topic, payload), timeout=timeout)
+
+    def stop(self, timeout=None):
+        """Finish decoding what was received, then drain the writer."""
+        self._stopping.set()
+        for t in self._workers:
+            if t.is_alive():
+                t.join(timeout)
+        self.writer.stop(timeout)
+
+    def queue_depths(self):
+        return {"receive": self.receive_queue.qsize(), "write": self.writer.qsize()}
+
+    def stats(self):
+        write_queue = self.writer.row_queue
+        return {
+            "depths": self.queue_depths(),
+            "received": self.received,
+            "decoded": self.decoded,
+            "invalid": self.invalid,
+            "receive_dropped": self.receive_queue.dropped,
+            "write_dropped": getattr(write_queue, "dropped", 0),
+            "write_coalesced": getattr(write_queue, "coalesced", 0),
+        }
+
+    def _work(self):
+        while True:
+            try:
+                topic, payload = self.receive_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            try:
+                rows = self._decode(topic, payload)
+            except Exception as e:
+                with self._counts_lock:
+                    self.invalid += 1
+                logging.warning("[%s] dropping invalid message on %s: %s", self.name, topic, e)
+                continue
+            if rows is None:
+                continue
+            if isinstance(rows, tuple):
+                rows = (rows,)
+            for row in rows:
+                self.writer.submit(row)
+                with self._counts_lock:
+                    self.decoded += 1
+
+    def _report(self):
+        while not self._stopping.wait(self.report_interval):
+            logging.info("[%s] %s", self.name, self.stats())
+
+
+class InlineIngest:
+    """The asyncio runtime's IngestPipeline: messages are decoded on the event loop as they arrive.
+
+    Decoding one message costs less than handing it to a worker thread, so
+    there is no receive stage; the writer (an AsyncBatchWriter) is the only
+    buffer and ``await submit(...)`` waits while it is full. Same counters
+    as IngestPipeline.
+    """
+
+    def __init__(self, decode, writer, name="ingest"):
+        self._decode = decode
+        self.writer = writer
+        self.name = name
+        self.received = 0
+        self.decoded = 0
+        self.invalid = 0
+
+    async def submit(self, topic, payload):
+        self.received += 1
+        try:
+            rows = self._decode(topic, payload)
+        except Exception as e:
+            self.invalid += 1
+            logging.warning("[%s] dropping invalid message on %s: %s", self.name, topic, e)
+            return
+        if rows is None:
+            return
+        if isinstance(rows, tuple):
+            rows = (rows,)
+        for row in rows:
+            self.writer.submit(row)
+            self.decoded += 1
+        await self.writer.wait_for_space()
+
+    def queue_depths(self):
+        return {"receive": 0, "write": self.writer.qsize()}
+
+    def stats(self):
+        return {
+            "depths": self.queue_depths(),
+            "received": self.received,
+            "decoded": self.decoded,
+            "invalid": self.invalid,
+        }
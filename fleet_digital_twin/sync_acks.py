@@ -0,0 +1,90 @@
+import threading
+
+
+class _Frame:
+    __slots__ = ("since", "watermark", "pending")
+
+    def __init__(self, since, watermark, pending):
+        self.since = since
+        self.watermark = watermark
+        self.pending = pending
+
+
+class SyncAcks:
+    """Acknowledges incremental sync frames once all of their rows are committed.
+
+    Each frame covers the sending twin's ids from ``since`` (exclusive) to
+    ``watermark``, so per (source, subscriber) stream the frames form a
+    chain. A frame is acknowledged when its rows are written and the chain
+    has reached its ``since``; ``ack(source, subscriber, watermark)`` is then
+    called with the furthest watermark reached. A frame whose rows were
+    dropped (overload policy, failed write) stalls the chain, so the sender
+    keeps the old watermark and resends those rows on the next sync.
+
+    The first frame of a sync (``seq`` 0) starts its stream's chain at its
+    ``since``: the sender begins every sync at the watermark it last had
+    acknowledged, or at one the subscriber asked for. Frames whose ``since``
+    the chain has passed are forgotten.
+    """
+
+    def __init__(self, ack):
+        self._ack = ack
+        self._lock = threading.Lock()
+        # (source, subscriber) -> watermark the chain has reached
+        self._reached = {}
+        # (source, subscriber) -> since -> frames following on it
+        self._frames = {}
+        # record key -> (stream, frame) awaiting that row
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def frame(self, source, subscriber, seq, since, watermark, keys):
+        """Track one decoded frame whose rows have the given record keys."""
+        stream = (source, subscriber)
+        with self._lock:
+            if seq == 0:
+                self._reached[stream] = since
+            frame = _Frame(since, watermark, set(keys))
+            self._frames.setdefault(stream, {}).setdefault(since, []).append(frame)
+            for key in frame.pending:
+                self._keys[key] = (stream, frame)
+            reached = self._follow(stream)
+        if reached is not None:
+            self._ack(source, subscriber, reached)
+
+    def committed(self, keys):
+        """Mark the rows with these record keys as written."""
+        streams = set()
+        with self._lock:
+            for key in keys:
+                entry = self._keys.pop(key, None)
+                if entry is not None:
+                    stream, frame = entry
+                    frame.pending.discard(key)
+                    streams.add(stream)
+            acks = [(stream, self._follow(stream)) for stream in streams]
+        for (source, subscriber), reached in acks:
+            if reached is not None:
+                self._ack(source, subscriber, reached)
+
+    def _follow(self, stream):
+        """Advance the stream's chain over completed frames; returns the new watermark or None."""
+        start = reached = self._reached.get(stream)
+        if reached is None:
+            return None
+        frames = self._frames.get(stream, {})
+        while True:
+            done = [f for f in frames.get(reached, ()) if not f.pending and f.watermark > reached]
+            if not done:
+                break
+            reached = max(f.watermark for f in done)
+        self._reached[stream] = reached
+        # Frames the chain has passed can no longer move it
+        for since in [s for s in frames if s < reached]:
+            for frame in frames.pop(since):
+                for key in frame.pending:
+                    if self._keys.get(key, (None, None))[1] is frame:
+                        del self._keys[key]
+        return reached if reached != start else None
@@ -1,10 +1,74 @@
-from typing import Any, Dict
+import inspect
+import json
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Sequence
+
+class _NoopMetric:
+    # Stands in for every metric when the context provides no registry
+    def labels(self, **labels):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return nullcontext()
+
+_NOOP_METRIC = _NoopMetric()
+
+class FrameWindow:
+    """Publish-side flow control: at most ``max_inflight`` messages handed to the client and not yet sent.
+
+    Once the window is full, publish() waits for the oldest message to leave,
+    so a large result can't queue up whole in the client's memory. Only
+    wait from a thread other than the connection's network loop (i.e. on a
+    plugin executor); 0 disables waiting.
+    """
+
+    def __init__(self, client, max_inflight=8, timeout=10.0):
+        self.client = client
+        self.max_inflight = max_inflight
+        self.timeout = timeout
+        self._pending = deque()
+
+    def publish(self, topic, payload):
+        info = self.client.publish(topic, payload)
+        if self.max_inflight <= 0:
+            return
+        self._pending.append(info)
+        if len(self._pending) >= self.max_inflight:
+            self._wait(self._pending.popleft())
+
+    def drain(self):
+        while self._pending:
+            self._wait(self._pending.popleft())
+
+    def _wait(self, info):
+        # Raises if the message can't be sent (e.g. disconnected): the caller stops there
+        info.wait_for_publish(self.timeout)
 
 class MqttListenerPlugin:
     def __init__(self, name: str, config: Dict[str, Any], context: Dict[str, Any]):
         self.name = name
         self.config = config
         self.context = context
+        # (topic filter, dispatched handler) pairs registered through subscribe()
+        self._subscriptions = []
+        self._own_clients = []
+        self._executor = None
+        # Messages submitted to the executor and not yet handled
+        self._backlog = 0
+        self._backlog_lock = threading.Lock()
 
     def validate(self) -> None:
         # Raise if required artifacts/config are missing
@@ -15,5 +79,118 @@ class MqttListenerPlugin:
         raise NotImplementedError
 
     def stop(self) -> None:
-        # Optional clean shutdown
-        pass
\ No newline at end of file
+        # Unsubscribe, then let handlers already queued on the executor finish.
+        # Subclasses that override stop() should call super().stop().
+        router = self.context.get("router")
+        for topic_filter, handler in self._subscriptions:
+            if router is not None:
+                router.unsubscribe(topic_filter, handler)
+        self._subscriptions = []
+        for client in self._own_clients:
+            client.disconnect()
+        self._own_clients = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def subscribe(self, topic_filter: str, handler: Callable[[Any, Any, Any], None]) -> None:
+        # Deliver messages matching topic_filter (+/# wildcards allowed) to
+        # handler(client, userdata, msg). Handlers share the context's router
+        # connection and run on its network thread, unless the plugin config sets
+        # "executor_workers" to run them on a thread pool of the plugin's own.
+        # "max_queued" then bounds the messages waiting for a worker; beyond it
+        # messages go to on_overload() instead of the queue.
+        # Under the asyncio runtime (router.is_async) handler may also be a
+        # coroutine function; it runs on the event loop and publishes with
+        # "await client.apublish(...)".
+        if inspect.iscoroutinefunction(handler) and not self.is_async():
+            raise TypeError(f"[{self.name}] coroutine handlers need the asyncio runtime")
+        dispatch = self._dispatcher(handler)
+        self._subscriptions.append((topic_filter, dispatch))
+        router = self.context.get("router")
+        if router is not None:
+            router.subscribe(topic_filter, dispatch)
+        else:
+            self._connect_own(topic_filter, dispatch)
+
+    def is_async(self) -> bool:
+        # True when the context's router runs on an event loop (aio_router.AsyncTopicRouter)
+        return getattr(self.context.get("router"), "is_async", False) is True
+
+    def _dispatcher(self, handler):
+        workers = int(self.config.get("executor_workers", 0))
+        if workers <= 0 or inspect.iscoroutinefunction(handler):
+            return handler
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(workers, thread_name_prefix=f"{self.name}-worker")
+
+        max_queued = self.config.get("max_queued")
+        limit = workers + int(max_queued) if max_queued is not None else None
+
+        def run(client, userdata, msg):
+            try:
+                handler(client, userdata, msg)
+            except Exception:
+                logging.exception("[%s] handler for %s failed", self.name, msg.topic)
+            finally:
+                with self._backlog_lock:
+                    self._backlog -= 1
+
+        def submit(client, userdata, msg):
+            with self._backlog_lock:
+                accepted = limit is None or self._backlog < limit
+                if accepted:
+                    self._backlog += 1
+            if not accepted:
+                self.on_overload(client, userdata, msg)
+                return
+            self._executor.submit(run, client, userdata, msg)
+        return submit
+
+    def on_overload(self, client, userdata, msg) -> None:
+        # Called on the router's thread for a message that found executor_workers
+        # busy and max_queued messages waiting; the default drops it
+        logging.warning("[%s] %d messages queued; dropping message on %s", self.name, self._backlog, msg.topic)
+
+    def _connect_own(self, topic_filter, handler):
+        # No shared router (e.g. a plugin started on its own): a dedicated connection
+        import paho.mqtt.client as mqtt
+
+        def run():
+            c = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+            c.on_message = handler
+            c.connect(self.context["broker"], 1883, 60)
+            c.subscribe(topic_filter)
+            self._own_clients.append(c)
+            logging.info("[%s] listening on %s", self.name, topic_filter)
+            c.loop_forever()
+        threading.Thread(target=run, name=f"{self.name}-mqtt", daemon=True).start()
+
+    def wire_format(self, topic: str) -> str:
+        # Codec used when publishing on topic, e.g. "json", "msgpack+zlib"; plain JSON
+        # unless the context provides wire codecs
+        codecs = self.context.get("codecs")
+        if codecs is None:
+            return "json"
+        codec = codecs.for_topic(topic)
+        return f"{codec.name}+{codec.compression}" if codec.compression else codec.name
+
+    def decode_payload(self, raw: bytes) -> Any:
+        codecs = self.context.get("codecs")
+        if codecs is not None:
+            return codecs.decode(raw)
+        return json.loads(raw.decode())
+
+    def encode_payload(self, topic: str, obj: Any):
+        codecs = self.context.get("codecs")
+        if codecs is not None:
+            return codecs.encode(topic, obj)
+        return json.dumps(obj)
+
+    def metric(self, kind: str, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        # kind is "counter", "gauge" or "histogram"; a no-op metric unless the context
+        # provides a registry (see metrics.py)
+        registry = self.context.get("metrics")
+        if registry is None:
+            return _NOOP_METRIC
+        return getattr(registry, kind)(name, documentation, tuple(labelnames))
@@ -1,29 +1,185 @@
 import json
 import importlib
 import logging
-from typing import Any, Dict, List
-
-def load_plugins(config_path: str, context: Dict[str, Any]):
-    with open(config_path) as f:
-        cfg = json.load(f)
-    logging.info("Loaded plugin configuration from %s", config_path)
-    plugins_cfg: List[Dict[str, Any]] = cfg.get("plugins", [])
-    instances = []
-
-    for p in plugins_cfg:
-        if not p.get("enabled", False):
-            continue
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+def _spec_key(p: Dict[str, Any]):
+    # What a running plugin was started from; any change means a restart
+    return (p["module"], p["class"], json.dumps(p.get("config", {}), sort_keys=True))
+
+class PluginManager:
+    """Starts the plugins of a listeners.json file and keeps them in sync with it.
+
+    Enabled plugins are imported and started on a thread pool, so a slow
+    import or start() does not hold up the others. A plugin can list the
+    names it needs running first in "depends_on"; plugins start in waves,
+    each wave in parallel. Startup time per plugin is kept in
+    ``startup_times``.
+
+    ``watch()`` polls the file and applies changes live. Plugins that were
+    added or enabled are started, removed or disabled ones are stopped
+    (stop() unsubscribes and drains the plugin's executor), and plugins
+    whose module, class or config changed are restarted. Plugins that did
+    not change keep running untouched.
+    """
+
+    def __init__(self, config_path: str, context: Dict[str, Any], router=None, max_workers: int = 4):
+        self.config_path = config_path
+        self.context = context
+        # router (a topic_router.TopicRouter) is the one broker connection the plugins
+        # subscribe through; it is connected once the first plugins have subscribed
+        self.router = router
+        if router is not None:
+            context["router"] = router
+        self.max_workers = max_workers
+        self.running: Dict[str, Any] = {}
+        self.startup_times: Dict[str, float] = {}
+        self._specs: Dict[str, Any] = {}
+        self._order: List[str] = []
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        self._watching = threading.Event()
+        metrics = context.get("metrics")
+        self._startup_gauge = (metrics.gauge("plugin_startup_seconds", "Time to import, validate and start a plugin",
+                                             ("plugin",)) if metrics is not None else None)
+
+    @property
+    def instances(self) -> List[Any]:
+        return [self.running[name] for name in self._order if name in self.running]
+
+    def _read_config(self) -> List[Dict[str, Any]]:
+        with open(self.config_path) as f:
+            cfg = json.load(f)
+        logging.info("Loaded plugin configuration from %s", self.config_path)
+        enabled = []
+        for p in cfg.get("plugins", []):
+            if p.get("enabled", False):
+                enabled.append(dict(p, name=p.get("name", p["class"])))
+        return enabled
+
+    def load(self) -> List[Any]:
+        """Start every enabled plugin, then connect the router; returns the started instances."""
+        try:
+            self._mtime = os.stat(self.config_path).st_mtime
+        except OSError:
+            self._mtime = None
+        self._apply(self._read_config())
+        if self.router is not None:
+            self.router.start()
+        return self.instances
+
+    def reload(self) -> None:
+        """Re-read the config file and apply the differences to the running plugins."""
+        try:
+            plugins_cfg = self._read_config()
+        except (OSError, ValueError, KeyError) as e:
+            logging.error("Ignoring unreadable plugin configuration %s: %s", self.config_path, e)
+            return
+        self._apply(plugins_cfg)
+
+    def watch(self, interval: float = 2.0) -> "PluginManager":
+        """Poll the config file's mtime every interval seconds and reload on change."""
+        def run():
+            while not self._watching.wait(interval):
+                try:
+                    mtime = os.stat(self.config_path).st_mtime
+                except OSError:
+                    continue
+                if mtime != self._mtime:
+                    self._mtime = mtime
+                    logging.info("Plugin configuration %s changed; reloading", self.config_path)
+                    self.reload()
+        threading.Thread(target=run, name="plugin-config-watch", daemon=True).start()
+        return self
+
+    def stop_all(self) -> None:
+        self._watching.set()
+        with self._lock:
+            for name in reversed(list(self.running)):
+                self._stop(name)
+
+    def _apply(self, plugins_cfg: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            wanted = {p["name"]: p for p in plugins_cfg}
+            changed = {name for name in self.running
+                       if name not in wanted or _spec_key(wanted[name]) != self._specs[name]}
+            # Running dependents of a restarted plugin restart with it
+            grew = True
+            while grew:
+                dependents = {name for name in self.running if name not in changed and name in wanted
+                              and changed & set(wanted[name].get("depends_on", []))}
+                changed |= dependents
+                grew = bool(dependents)
+            # Stop in reverse start order so dependents go before what they depend on
+            for name in reversed([n for n in self._order if n in changed]):
+                self._stop(name)
+            self._order = [p["name"] for p in plugins_cfg]
+            self._start_all([p for p in plugins_cfg if p["name"] not in self.running])
+
+    def _start_all(self, pending: List[Dict[str, Any]]) -> None:
+        failed = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="plugin-start") as pool:
+            while pending:
+                ready, blocked = [], []
+                for p in pending:
+                    deps = set(p.get("depends_on", []))
+                    if deps & failed or any(d not in self.running and d not in {q["name"] for q in pending}
+                                            for d in deps):
+                        logging.error("Not starting plugin %s: dependency %s is not running",
+                                      p["name"], sorted(deps - set(self.running)))
+                        failed.add(p["name"])
+                    elif deps <= set(self.running):
+                        ready.append(p)
+                    else:
+                        blocked.append(p)
+                if not ready:
+                    for p in blocked:
+                        logging.error("Not starting plugin %s: circular depends_on", p["name"])
+                        failed.add(p["name"])
+                    break
+                for p, inst in zip(ready, pool.map(self._start, ready)):
+                    if inst is None:
+                        failed.add(p["name"])
+                    else:
+                        self.running[p["name"]] = inst
+                        self._specs[p["name"]] = _spec_key(p)
+                pending = blocked
+
+    def _start(self, p: Dict[str, Any]) -> Optional[Any]:
         module_name = p["module"]
         class_name = p["class"]
-        name = p.get("name", class_name)
+        name = p["name"]
+        start = time.perf_counter()
         try:
+            # Imported here, on the pool: only enabled plugins are imported, concurrently
             mod = importlib.import_module(module_name)
             cls = getattr(mod, class_name)
-            inst = cls(name=name, config=p.get("config", {}), context=context)
+            inst = cls(name=name, config=p.get("config", {}), context=self.context)
             inst.validate()
             inst.start()
-            logging.info("Plugin started: %s (%s.%s)", name, module_name, class_name)
-            instances.append(inst)
         except Exception:
             logging.exception("Failed to start plugin %s (%s.%s)", name, module_name, class_name)
-    return instances
\ No newline at end of file
+            return None
+        elapsed = time.perf_counter() - start
+        self.startup_times[name] = elapsed
+        if self._startup_gauge is not None:
+            self._startup_gauge.labels(plugin=name).set(elapsed)
+        logging.info("Plugin started: %s (%s.%s) in %.3fs", name, module_name, class_name, elapsed)
+        return inst
+
+    def _stop(self, name: str) -> None:
+        inst = self.running.pop(name)
+        self._specs.pop(name, None)
+        start = time.perf_counter()
+        try:
+            inst.stop()
+        except Exception:
+            logging.exception("Failed to stop plugin %s", name)
+        logging.info("Plugin stopped: %s in %.3fs", name, time.perf_counter() - start)
+
+def load_plugins(config_path: str, context: Dict[str, Any], router=None):
+    return PluginManager(config_path, context, router).load()
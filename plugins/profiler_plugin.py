@@ -0,0 +1,237 @@
+import collections
+import linecache
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from listener_base import MqttListenerPlugin
+
+KINDS = ("cpu", "memory", "both")
+
+class StackSampler:
+    """Statistical CPU profiler: samples the stack of every thread every ``interval`` seconds.
+
+    Unlike cProfile it sees all threads (paho loops, the DB writer, plugin
+    threads) and costs one sys._current_frames() walk per sample instead of a
+    hook on every call, so it is safe to run against a loaded process.
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        # (file, line of def, function) -> samples where it was on top of the stack / anywhere on it
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self.thread_counts = collections.Counter()
+
+    def sample(self, skip_thread=None):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == skip_thread:
+                continue
+            self.samples += 1
+            self.thread_counts[names.get(ident, str(ident))] += 1
+            seen = set()
+            depth = 0
+            top = True
+            while frame is not None and depth < self.max_depth:
+                code = frame.f_code
+                key = (code.co_filename, code.co_firstlineno, code.co_name)
+                if top:
+                    self.self_counts[key] += 1
+                    top = False
+                if key not in seen:
+                    # Recursive frames count once per sample
+                    seen.add(key)
+                    self.total_counts[key] += 1
+                frame = frame.f_back
+                depth += 1
+
+    def run(self, stop, deadline):
+        """Sample until stop is set or time.monotonic() reaches deadline."""
+        me = threading.get_ident()
+        while not stop.is_set() and time.monotonic() < deadline:
+            self.sample(skip_thread=me)
+            stop.wait(self.interval)
+
+    def report(self, top=20):
+        def rows(counts):
+            return [
+                {"function": name, "file": filename, "line": line, "samples": n,
+                 "percent": round(100.0 * n / self.samples, 2) if self.samples else 0.0}
+                for (filename, line, name), n in counts.most_common(top)
+            ]
+        return {
+            "samples": self.samples,
+            "interval": self.interval,
+            "threads": dict(self.thread_counts.most_common()),
+            "top_self": rows(self.self_counts),
+            "top_cumulative": rows(self.total_counts),
+        }
+
+def memory_report(before, after, top=20):
+    """Top allocation sites by growth between two tracemalloc snapshots, and by size at the end."""
+    filters = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, linecache.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    )
+    before = before.filter_traces(filters)
+    after = after.filter_traces(filters)
+
+    def site(frame):
+        return f"{frame.filename}:{frame.lineno}"
+    growth = [
+        {"site": site(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff,
+         "size": stat.size, "count": stat.count}
+        for stat in after.compare_to(before, "lineno")[:top]
+    ]
+    largest = [
+        {"site": site(stat.traceback[0]), "size": stat.size, "count": stat.count}
+        for stat in after.statistics("lineno")[:top]
+    ]
+    traced, peak = tracemalloc.get_traced_memory()
+    return {"top_growth": growth, "top_size": largest, "traced_bytes": traced, "peak_bytes": peak}
+
+def format_report(report):
+    """Plain-text rendering of a profile report, as written to disk."""
+    lines = [f"profile {report['id']} ({report['kind']}) {report['started_at']} for {report['duration']:.1f}s"]
+    cpu = report.get("cpu")
+    if cpu:
+        lines.append(f"\nCPU: {cpu['samples']} samples every {cpu['interval'] * 1000:.1f} ms")
+        lines.append("threads: " + ", ".join(f"{name}={n}" for name, n in cpu["threads"].items()))
+        for title, key in (("top functions (self)", "top_self"), ("top functions (cumulative)", "top_cumulative")):
+            lines.append(f"\n{title}:")
+            for row in cpu[key]:
+                lines.append(f"  {row['percent']:6.2f}%  {row['samples']:7d}  {row['function']}  "
+                             f"{row['file']}:{row['line']}")
+    memory = report.get("memory")
+    if memory:
+        lines.append(f"\nmemory: traced {memory['traced_bytes']} bytes, peak {memory['peak_bytes']} bytes")
+        lines.append("\ntop allocation sites (growth):")
+        for row in memory["top_growth"]:
+            lines.append(f"  {row['size_diff']:+12d} B  {row['count_diff']:+8d} blocks  {row['site']}")
+        lines.append("\ntop allocation sites (size):")
+        for row in memory["top_size"]:
+            lines.append(f"  {row['size']:12d} B  {row['count']:8d} blocks  {row['site']}")
+    return "\n".join(lines) + "\n"
+
+class ProfilerPlugin(MqttListenerPlugin):
+    """Starts and stops bounded CPU / allocation profiles on request, without restarting the process.
+
+    Control messages on ``control_topic``:
+
+        {"command": "start", "kind": "cpu" | "memory" | "both", "duration": 30, "id": "abc", "top": 20}
+        {"command": "stop"}
+
+    One profile runs at a time; it ends after ``duration`` seconds (capped at
+    ``max_duration``) or on "stop". The report is written to ``output_dir``
+    and published on ``reply_topic_prefix`` + id.
+    """
+
+    def validate(self):
+        if "control_topic" not in self.config:
+            raise ValueError("control_topic is required")
+        if "reply_topic_prefix" not in self.config:
+            raise ValueError("reply_topic_prefix is required")
+
+    def start(self):
+        control_topic = self.config["control_topic"]
+        reply_prefix = self.config["reply_topic_prefix"]
+        output_dir = self.config.get("output_dir")
+        default_duration = float(self.config.get("default_duration", 30))
+        max_duration = float(self.config.get("max_duration", 300))
+        sample_interval = float(self.config.get("sample_interval", 0.005))
+        tracemalloc_frames = int(self.config.get("tracemalloc_frames", 1))
+        self._stop_profile = threading.Event()
+        self._session = None
+
+        def reply(client, corr, response):
+            topic = f"{reply_prefix}{corr}"
+            client.publish(topic, self.encode_payload(topic, dict(response, id=corr)))
+
+        def profile(client, corr, kind, duration, top):
+            started = time.time()
+            deadline = time.monotonic() + duration
+            report = {"id": corr, "kind": kind, "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+            was_tracing = tracemalloc.is_tracing()
+
+            def stop_tracing():
+                # Tracing slows every allocation: only leave it on if someone else turned it on
+                if not was_tracing and tracemalloc.is_tracing():
+                    tracemalloc.stop()
+            try:
+                before = None
+                if kind in ("memory", "both"):
+                    if not was_tracing:
+                        tracemalloc.start(tracemalloc_frames)
+                    before = tracemalloc.take_snapshot()
+                if kind in ("cpu", "both"):
+                    sampler = StackSampler(sample_interval)
+                    sampler.run(self._stop_profile, deadline)
+                    report["cpu"] = sampler.report(top)
+                else:
+                    self._stop_profile.wait(max(deadline - time.monotonic(), 0))
+                if before is not None:
+                    report["memory"] = memory_report(before, tracemalloc.take_snapshot(), top)
+                    stop_tracing()
+                report["duration"] = time.time() - started
+                if output_dir:
+                    os.makedirs(output_dir, exist_ok=True)
+                    # The id comes off the wire: keep it to a plain file name
+                    safe_id = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in corr).lstrip(".")
+                    path = os.path.join(output_dir, f"{self.name}-{safe_id}-{kind}.txt")
+                    with open(path, "w") as f:
+                        f.write(format_report(report))
+                    report["path"] = path
+                logging.info("[%s] profile %s (%s) finished after %.1fs", self.name, corr, kind, report["duration"])
+                reply(client, corr, report)
+            except Exception as e:
+                logging.exception("[%s] profile %s failed: %s", self.name, corr, e)
+                reply(client, corr, {"error": str(e)})
+            finally:
+                if kind in ("memory", "both"):
+                    stop_tracing()
+
+        def on_message(client, userdata, msg):
+            try:
+                payload = self.decode_payload(msg.payload) or {}
+            except Exception as e:
+                logging.exception("[%s] bad profiler command: %s", self.name, e)
+                return
+            command = payload.get("command", "start")
+            corr = str(payload.get("id") or int(time.time() * 1000))
+
+            if command == "stop":
+                self._stop_profile.set()
+                return
+            if command != "start":
+                reply(client, corr, {"error": f"unknown command {command!r}"})
+                return
+            kind = payload.get("kind", "cpu")
+            if kind not in KINDS:
+                reply(client, corr, {"error": f"unknown kind {kind!r}, expected one of {KINDS}"})
+                return
+            if self._session is not None and self._session.is_alive():
+                reply(client, corr, {"error": "a profile is already running"})
+                return
+            duration = min(max(float(payload.get("duration", default_duration)), 0.0), max_duration)
+            top = int(payload.get("top", 20))
+            self._stop_profile.clear()
+            self._session = threading.Thread(
+                target=profile, args=(client, corr, kind, duration, top), name=f"{self.name}-session", daemon=True
+            )
+            self._session.start()
+            logging.info("[%s] profiling %s for %.1fs (id %s)", self.name, kind, duration, corr)
+
+        self.subscribe(control_topic, on_message)
+        logging.info("[%s] Profiler listening on %s", self.name, control_topic)
+
+    def stop(self):
+        stop_profile = getattr(self, "_stop_profile", None)
+        if stop_profile is not None:
+            stop_profile.set()
+        super().stop()
@@ -1,8 +1,212 @@
+import asyncio
 import json
-import threading
 import logging
-import paho.mqtt.client as mqtt
-from listener_base import MqttListenerPlugin
+import threading
+import time
+from collections import OrderedDict
+from listener_base import FrameWindow, MqttListenerPlugin
+
+def encode_rows(rows):
+    """Yield the JSON array of row objects piece by piece, consuming rows lazily."""
+    yield "["
+    for i, r in enumerate(rows):
+        if i:
+            yield ", "
+        yield json.dumps({"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]})
+    yield "]"
+
+def _epoch_param(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"{name} must be epoch seconds")
+    return float(value)
+
+def row_filter(params):
+    """The {vin, since, until} filter of a read request; raises ValueError for any other param.
+
+    Only these reach the DB reader, so a caller cannot set reader options
+    such as ``itersize`` or ``prefetch``.
+    """
+    if not isinstance(params, dict):
+        raise ValueError("params must be an object")
+    unknown = set(params) - {"vin", "since", "until"}
+    if unknown:
+        raise ValueError(f"unknown params: {', '.join(sorted(unknown))}")
+    vin = params.get("vin")
+    if vin is not None and not isinstance(vin, str):
+        raise ValueError("vin must be a string")
+    return {"vin": vin or None, "since": _epoch_param(params, "since"), "until": _epoch_param(params, "until")}
+
+def stream_chunk_size(payload, default):
+    """Rows per message of a streamed response; raises ValueError unless a positive integer."""
+    size = payload.get("chunk_size")
+    if size is None:
+        return default
+    if isinstance(size, bool) or not isinstance(size, int) or size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+    return size
+
+def history_filter(params):
+    """The {since, until, resolution, vin} of a history request; raises ValueError for anything else.
+
+    Validated before the request is coalesced or cached, so keys only hold
+    values query_history accepts (it picks the rollup tier itself).
+    """
+    if not isinstance(params, dict):
+        raise ValueError("params must be an object")
+    unknown = set(params) - {"since", "until", "resolution", "vin"}
+    if unknown:
+        raise ValueError(f"unknown params: {', '.join(sorted(unknown))}")
+    since = _epoch_param(params, "since")
+    until = _epoch_param(params, "until")
+    if since is None or until is None:
+        raise ValueError("since and until are required")
+    if until <= since:
+        raise ValueError("until must be after since")
+    resolution = params.get("resolution")
+    if resolution is not None:
+        if isinstance(resolution, bool) or not isinstance(resolution, (int, float)) or resolution <= 0:
+            raise ValueError("resolution must be a positive number of seconds")
+        resolution = float(resolution)
+    vin = params.get("vin")
+    if vin is not None and not isinstance(vin, str):
+        raise ValueError("vin must be a string")
+    return {"since": since, "until": until, "resolution": resolution, "vin": vin or None}
+
+def read_filtered(read, filters):
+    """Call a row reader with the row_filter() filters that are set, by name (read_all_vehicle_data only takes vin)."""
+    kwargs = {}
+    if filters["vin"]:
+        kwargs["vin"] = filters["vin"]
+    if filters["since"] is not None:
+        kwargs["since"] = filters["since"]
+    if filters["until"] is not None:
+        kwargs["until"] = filters["until"]
+    return read(**kwargs)
+
+def chunk_rows(rows, size):
+    """Group rows into lists of at most size row objects, consuming rows lazily."""
+    chunk = []
+    for r in rows:
+        chunk.append({"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]})
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class SingleFlight:
+    """Coalesces identical concurrent calls ("single-flight").
+
+    The first caller for a key runs the work; callers arriving while it runs
+    only register their callback. Every callback then gets the one
+    ``(result, error)``. The key is forgotten as soon as the work finishes,
+    so a later call runs it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, work, callback):
+        """Call callback(result, error) with work()'s outcome; returns False if another caller ran it."""
+        if not self._join(key, callback):
+            return False
+        try:
+            result, error = work(), None
+        except Exception as e:
+            result, error = None, e
+        self._land(key, result, error)
+        return True
+
+    async def ado(self, key, work, callback):
+        """do() for a coroutine function ``work`` on an event loop."""
+        if not self._join(key, callback):
+            return False
+        try:
+            result, error = await work(), None
+        except Exception as e:
+            result, error = None, e
+        self._land(key, result, error)
+        return True
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._flights)
+
+    def _join(self, key, callback):
+        with self._lock:
+            callbacks = self._flights.get(key)
+            if callbacks is not None:
+                callbacks.append(callback)
+                return False
+            self._flights[key] = [callback]
+            return True
+
+    def _land(self, key, result, error):
+        with self._lock:
+            callbacks = self._flights.pop(key)
+        for callback in callbacks:
+            try:
+                callback(result, error)
+            except Exception:
+                logging.exception("Single-flight callback for %s failed", key)
+
+class ResultCache:
+    """LRU cache of encoded RPC results within a byte budget, valid for one data version.
+
+    Entries belong to the data version current when their query started. A
+    lookup or store under a newer version empties the cache, and a store
+    under an older one (a query that raced a write) is ignored, so only
+    results of unchanged data are ever served.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.version = None
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            self._advance(version)
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, version, body):
+        """Store body (bytes) read under version; returns False if it is stale or over budget."""
+        if len(body) > self.max_bytes:
+            return False
+        with self._lock:
+            self._advance(version)
+            if version != self.version:
+                return False
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._entries[key] = body
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _advance(self, version):
+        if self.version is None or version > self.version:
+            self._entries.clear()
+            self.nbytes = 0
+            self.version = version
 
 class RpcServerPlugin(MqttListenerPlugin):
     def validate(self):
@@ -10,45 +214,327 @@ class RpcServerPlugin(MqttListenerPlugin):
             raise ValueError("request_topic is required")
         if "response_topic_prefix" not in self.config:
             raise ValueError("response_topic_prefix is required")
-        if self.context.get("read_all_vehicle_data") is None:
+        if self.context.get("iter_vehicle_data") is None and self.context.get("read_all_vehicle_data") is None:
             logging.warning("read_all_vehicle_data not available; RPC will return error")
+        if int(self.config.get("max_inflight_chunks", 8)) and not int(self.config.get("executor_workers", 0)):
+            logging.warning("[%s] max_inflight_chunks needs executor_workers; streaming without flow control",
+                            self.name)
 
     def start(self):
-        broker = self.context["broker"]
         req_topic = self.config["request_topic"]
         resp_prefix = self.config["response_topic_prefix"]
-        read_all_vehicle_data = self.context.get("read_all_vehicle_data")
+        # Prefer the streaming reader so rows are never materialized as a list
+        read_rows = self.context.get("iter_vehicle_data") or self.context.get("read_all_vehicle_data")
+        # Asyncio runtime: reads stream from the async DB pool without holding a thread
+        aiter_rows = self.context.get("aiter_vehicle_data")
+        # In-memory latest row per VIN, served for "method": "latest" without a DB query
+        latest_state = self.context.get("latest_state")
+        # Rollup-tier aggregates, served for "method": "history"
+        query_history = self.context.get("query_history")
+        # Rows per message when a caller asks for a streamed ("stream": true) response
+        default_chunk_rows = int(self.config.get("chunk_rows", 500))
+        # Chunks of one stream handed to the client and not yet sent; the stream
+        # waits (and stops reading rows) beyond that. Waiting for the network loop
+        # from the network loop would deadlock, so only on executor threads.
+        max_inflight = int(self.config.get("max_inflight_chunks", 8)) if int(self.config.get("executor_workers", 0)) else 0
+        # Identical read/history requests in flight at the same time share one query
+        # and one encoded result ("coalesce": false turns this off). Handlers run
+        # concurrently on "executor_workers" threads; "max_queued" bounds the wait.
+        self.flights = SingleFlight() if self.config.get("coalesce", True) else None
+        # Encoded read/history results are cached until the next write bumps the data
+        # version, within "cache_bytes" (0 disables). Only JSON responses are cached:
+        # other codecs embed the correlation id in the encoded message.
+        data_version = self.context.get("data_version")
+        cache_bytes = int(self.config.get("cache_bytes", 32 * 1024 * 1024))
+        self.cache = ResultCache(cache_bytes) if data_version is not None and cache_bytes > 0 else None
+        # Labelled by method: latest, history, stream, read, or invalid for rejected requests
+        requests_total = self.metric("counter", "rpc_requests_total", "RPC requests served", ("plugin", "method"))
+        errors_total = self.metric("counter", "rpc_errors_total", "RPC requests answered with an error",
+                                   ("plugin", "method"))
+        service_seconds = self.metric("histogram", "rpc_service_seconds", "Time from request receipt to last publish",
+                                      ("plugin", "method"))
+        rows_total = self.metric("counter", "rpc_streamed_rows_total", "Rows published in streamed responses",
+                                 ("plugin",)).labels(plugin=self.name)
+        coalesced_total = self.metric("counter", "rpc_coalesced_total",
+                                      "RPC requests answered from an identical request's query", ("plugin", "method"))
+        cache_hits = self.metric("counter", "rpc_cache_hits_total", "RPC requests answered from the result cache",
+                                 ("plugin", "method"))
+        cache_misses = self.metric("counter", "rpc_cache_misses_total",
+                                   "Cacheable RPC requests that had to query", ("plugin", "method"))
+        cache_bytes_gauge = self.metric("gauge", "rpc_cache_bytes", "Encoded results held by the RPC result cache",
+                                        ("plugin",)).labels(plugin=self.name)
+
+        def publish_stream(client, topic, corr, filters, chunk_size):
+            """Publish the result as ordered {seq, rows} chunks followed by an end marker."""
+            seq = 0
+            count = 0
+            window = FrameWindow(client, max_inflight)
+            try:
+                rows = read_filtered(read_rows, filters)
+                for chunk in chunk_rows(rows, chunk_size):
+                    window.publish(topic, self.encode_payload(topic, {"correlation_id": corr, "seq": seq, "rows": chunk}))
+                    seq += 1
+                    count += len(chunk)
+                window.drain()
+                end = {"correlation_id": corr, "seq": seq, "end": True, "count": count}
+            except Exception as e:
+                end = {"correlation_id": corr, "seq": seq, "end": True, "error": str(e)}
+                errors_total.labels(plugin=self.name, method="stream").inc()
+            client.publish(topic, self.encode_payload(topic, end))
+            rows_total.inc(count)
+            logging.info("[%s] streamed %d rows in %d chunks to %s", self.name, count, seq, topic)
+
+        def result_body(fmt, rows):
+            """The response's "result": JSON bytes encoded as rows are read, or row objects for other codecs."""
+            if fmt == "json":
+                return "".join(encode_rows(rows)).encode()
+            return [{"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]} for r in rows]
+
+        def history_body(fmt, result):
+            return json.dumps(result).encode() if fmt == "json" else result
+
+        def result_payload(topic, corr, body):
+            """{correlation_id, result} around a result body, which callers of one query (or the cache) share."""
+            if isinstance(body, bytes):
+                return b'{"correlation_id": ' + json.dumps(corr).encode() + b', "result": ' + body + b'}'
+            return self.encode_payload(topic, {"correlation_id": corr, "result": body})
+
+        def reply_result(client, topic, corr, method, body, error):
+            if error is None:
+                client.publish(topic, result_payload(topic, corr, body))
+            else:
+                client.publish(topic, self.encode_payload(topic, {"correlation_id": corr, "error": str(error)}))
+                errors_total.labels(plugin=self.name, method=method).inc()
+
+        def reject(client, topic, corr, error):
+            client.publish(topic, self.encode_payload(topic, {"correlation_id": corr, "error": str(error)}))
+            errors_total.labels(plugin=self.name, method="invalid").inc()
+            return "invalid"
+
+        def publish_result(client, topic, corr, rows):
+            client.publish(topic, result_payload(topic, corr, result_body(self.wire_format(topic), rows)))
+
+        def flight_key(method, topic, params):
+            return method, self.wire_format(topic), json.dumps(params, sort_keys=True, default=str)
+
+        def cached(method, key):
+            """The cached body for key under the current data version, or None."""
+            if self.cache is None or key[1] != "json":
+                return None
+            body = self.cache.get(key, data_version())
+            (cache_hits if body is not None else cache_misses).labels(plugin=self.name, method=method).inc()
+            return body
+
+        def store(key, version, body):
+            if self.cache is not None and isinstance(body, bytes):
+                self.cache.put(key, version, body)
+                cache_bytes_gauge.set(self.cache.nbytes)
+
+        def run_once(method, topic, params, work, reply):
+            """reply(body, error) with work()'s body: from the cache, or shared with identical requests in flight."""
+            key = flight_key(method, topic, params)
+            body = cached(method, key)
+            if body is not None:
+                reply(body, None)
+                return
+
+            def fill():
+                # Taken before the query: a write committed meanwhile makes the result stale
+                version = data_version() if self.cache is not None else None
+                body = work()
+                store(key, version, body)
+                return body
+
+            if self.flights is None:
+                try:
+                    body = fill()
+                except Exception as e:
+                    reply(None, e)
+                else:
+                    reply(body, None)
+            elif not self.flights.do(key, fill, reply):
+                coalesced_total.labels(plugin=self.name, method=method).inc()
 
         def on_message(client, userdata, msg):
+            start = time.perf_counter()
+            method = "invalid"
+            try:
+                method = serve(client, msg)
+            finally:
+                requests_total.labels(plugin=self.name, method=method).inc()
+                service_seconds.labels(plugin=self.name, method=method).observe(time.perf_counter() - start)
+
+        def serve(client, msg):
+            """Answer one request; returns the method label it was served under."""
             try:
-                payload = json.loads(msg.payload.decode())
+                payload = self.decode_payload(msg.payload)
             except Exception as e:
                 logging.exception("[%s] bad RPC payload: %s", self.name, e)
-                return
+                return "invalid"
+            if not isinstance(payload, dict):
+                logging.error("[%s] RPC payload is not an object: %r", self.name, payload)
+                return "invalid"
             corr = payload.get("correlation_id")
-            params = payload.get("params", {}) or {}
             if not corr:
                 logging.error("[%s] missing correlation_id", self.name)
-                return
+                return "invalid"
+            params = payload.get("params")
+            if params is None:
+                params = {}
+            if not isinstance(params, dict):
+                return reject(client, f"{resp_prefix}{corr}", corr, "params must be an object")
 
-            if read_all_vehicle_data is None:
-                response = {"correlation_id": corr, "error": "DB read function not available"}
-            else:
+            if payload.get("method") == "latest" and latest_state is not None:
+                vin = params.get("vin")
+                if vin is not None and not isinstance(vin, str):
+                    return reject(client, f"{resp_prefix}{corr}", corr, "vin must be a string")
+                if vin:
+                    row = latest_state.get(vin)
+                    rows = [row] if row is not None else []
+                else:
+                    rows = latest_state.all()
+                publish_result(client, f"{resp_prefix}{corr}", corr, rows)
+                return "latest"
+
+            if payload.get("method") == "history" and query_history is not None:
+                topic = f"{resp_prefix}{corr}"
+                try:
+                    query = history_filter(params)
+                except ValueError as e:
+                    return reject(client, topic, corr, e)
+                fmt = self.wire_format(topic)
+                run_once("history", topic, query, lambda: history_body(fmt, query_history(**query)),
+                         lambda body, error: reply_result(client, topic, corr, "history", body, error))
+                return "history"
+
+            topic = f"{resp_prefix}{corr}"
+            try:
+                filters = row_filter(params)
+                chunk_size = stream_chunk_size(payload, default_chunk_rows)
+            except ValueError as e:
+                return reject(client, topic, corr, e)
+
+            if payload.get("stream") and read_rows is not None:
+                publish_stream(client, topic, corr, filters, chunk_size)
+                return "stream"
+
+            if read_rows is None:
+                client.publish(topic, self.encode_payload(topic, {"correlation_id": corr, "error": "DB read function not available"}))
+                errors_total.labels(plugin=self.name, method="read").inc()
+                return "read"
+            fmt = self.wire_format(topic)
+            run_once("read", topic, filters, lambda: result_body(fmt, read_filtered(read_rows, filters)),
+                     lambda body, error: reply_result(client, topic, corr, "read", body, error))
+            return "read"
+
+        async def apublish_stream(client, topic, corr, filters, chunk_size):
+            """publish_stream on the event loop: each chunk's publish is awaited before more rows are read."""
+            seq = 0
+            count = 0
+            chunk = []
+            try:
+                async for r in read_filtered(aiter_rows, filters):
+                    chunk.append({"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]})
+                    if len(chunk) >= chunk_size:
+                        await client.apublish(topic, self.encode_payload(
+                            topic, {"correlation_id": corr, "seq": seq, "rows": chunk}))
+                        seq += 1
+                        count += len(chunk)
+                        chunk = []
+                if chunk:
+                    await client.apublish(topic, self.encode_payload(
+                        topic, {"correlation_id": corr, "seq": seq, "rows": chunk}))
+                    seq += 1
+                    count += len(chunk)
+                end = {"correlation_id": corr, "seq": seq, "end": True, "count": count}
+            except Exception as e:
+                end = {"correlation_id": corr, "seq": seq, "end": True, "error": str(e)}
+                errors_total.labels(plugin=self.name, method="stream").inc()
+            await client.apublish(topic, self.encode_payload(topic, end))
+            rows_total.inc(count)
+            logging.info("[%s] streamed %d rows in %d chunks to %s", self.name, count, seq, topic)
+
+        async def on_message_async(client, userdata, msg):
+            start = time.perf_counter()
+            method = "invalid"
+            try:
+                method = await aserve(client, msg)
+            finally:
+                requests_total.labels(plugin=self.name, method=method).inc()
+                service_seconds.labels(plugin=self.name, method=method).observe(time.perf_counter() - start)
+
+        async def aserve(client, msg):
+            """serve() for the asyncio runtime: DB reads run on the loop, other methods on the plugin threads."""
+            try:
+                payload = self.decode_payload(msg.payload)
+            except Exception as e:
+                logging.exception("[%s] bad RPC payload: %s", self.name, e)
+                return "invalid"
+            if not isinstance(payload, dict):
+                logging.error("[%s] RPC payload is not an object: %r", self.name, payload)
+                return "invalid"
+            if payload.get("method") in ("latest", "history"):
+                return await asyncio.get_running_loop().run_in_executor(client.executor, serve, client, msg)
+            corr = payload.get("correlation_id")
+            params = payload.get("params")
+            if params is None:
+                params = {}
+            if not corr:
+                logging.error("[%s] missing correlation_id", self.name)
+                return "invalid"
+            topic = f"{resp_prefix}{corr}"
+            try:
+                filters = row_filter(params)
+                chunk_size = stream_chunk_size(payload, default_chunk_rows)
+            except ValueError as e:
+                return reject(client, topic, corr, e)
+            if payload.get("stream"):
+                await apublish_stream(client, topic, corr, filters, chunk_size)
+                return "stream"
+            fmt = self.wire_format(topic)
+            key = flight_key("read", topic, filters)
+
+            def reply(body, error):
+                reply_result(client, topic, corr, "read", body, error)
+
+            body = cached("read", key)
+            if body is not None:
+                reply(body, None)
+                return "read"
+
+            async def read():
+                version = data_version() if self.cache is not None else None
+                body = result_body(fmt, [r async for r in read_filtered(aiter_rows, filters)])
+                store(key, version, body)
+                return body
+
+            if self.flights is None:
                 try:
-                    rows = read_all_vehicle_data(**params) if params else read_all_vehicle_data()
-                    result = [{"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]} for r in rows]
-                    response = {"correlation_id": corr, "result": result}
+                    body = await read()
                 except Exception as e:
-                    response = {"correlation_id": corr, "error": str(e)}
-
-            client.publish(f"{resp_prefix}{corr}", json.dumps(response))
-
-        def run():
-            c = mqtt.Client()
-            c.on_message = on_message
-            c.connect(broker, 1883, 60)
-            c.subscribe(req_topic)
-            logging.info("[%s] RPC server listening on %s", self.name, req_topic)
-            c.loop_forever()
-        logging.info(f"Starting thread {self.name}-rpc")
-        threading.Thread(target=run, name=f"{self.name}-rpc", daemon=True).start()
\ No newline at end of file
+                    reply(None, e)
+                else:
+                    reply(body, None)
+            elif not await self.flights.ado(key, read, reply):
+                coalesced_total.labels(plugin=self.name, method="read").inc()
+            return "read"
+
+        if aiter_rows is not None and self.is_async():
+            self.subscribe(req_topic, on_message_async)
+        else:
+            self.subscribe(req_topic, on_message)
+        logging.info("[%s] RPC server listening on %s", self.name, req_topic)
+
+    def on_overload(self, client, userdata, msg):
+        # Every worker is busy and max_queued requests are waiting: answer at once
+        # rather than let the caller wait for its timeout
+        try:
+            corr = self.decode_payload(msg.payload).get("correlation_id")
+        except Exception:
+            corr = None
+        if not corr:
+            return
+        topic = f"{self.config['response_topic_prefix']}{corr}"
+        client.publish(topic, self.encode_payload(topic, {"correlation_id": corr, "error": "server busy"}))
+        self.metric("counter", "rpc_errors_total", "RPC requests answered with an error",
+                    ("plugin", "method")).labels(plugin=self.name, method="busy").inc()
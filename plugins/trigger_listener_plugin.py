@@ -1,53 +1,222 @@
 import json
-import threading
 import logging
-import paho.mqtt.client as mqtt
-from listener_base import MqttListenerPlugin
+import os
+import threading
+import time
+from listener_base import FrameWindow, MqttListenerPlugin
 
 class TriggerListenerPlugin(MqttListenerPlugin):
+    """Replays vehicle_data when a trigger arrives on ``trigger_topic``.
+
+    ``sync_mode`` "full" publishes every row as its own message on
+    ``data_topic``, carrying its vehicle_data ``id`` and the ``source`` twin
+    so subscribers key it like a synced row. "incremental" sends only rows newer than the
+    subscriber's high-watermark (the largest vehicle_data id it has
+    acknowledged), packed into frames of ``frame_rows`` rows on
+    ``batch_topic``:
+
+        {"source": ..., "subscriber": ..., "seq": 0, "since": 1000, "watermark": 1234, "rows": [...], "end": true}
+
+    ``since`` is the watermark the frame's rows follow on, so a subscriber
+    can acknowledge frames in order. Sending a frame does not move the
+    watermark: the subscriber publishes {"subscriber": ..., "ack": <watermark>}
+    on ``trigger_topic`` once it has applied the frames up to it. Frames of a
+    sync restricted to one {"vin": ...} carry that vin and are not meant to
+    be acknowledged.
+
+    The trigger names its subscriber ({"subscriber": "fleet"}, default
+    "default") and may carry its own high-watermark as {"since": <watermark>},
+    which replaces the remembered one, e.g. 0 for a full resync.
+    {"mode": "full"} forces a full replay. Watermarks are kept in memory and,
+    if ``watermark_file`` is set, persisted there across restarts.
+    """
+
     def validate(self):
         for k in ("trigger_topic", "data_topic"):
             if k not in self.config:
                 raise ValueError(f"{k} is required")
-        if self.context.get("read_all_vehicle_data") is None:
+        if self.config.get("sync_mode", "full") not in ("full", "incremental"):
+            raise ValueError("sync_mode must be full or incremental")
+        if self.context.get("iter_vehicle_data") is None and self.context.get("read_all_vehicle_data") is None:
             logging.warning("read_all_vehicle_data not available; trigger will be no-op")
+        if int(self.config.get("max_inflight_frames", 8)) and not int(self.config.get("executor_workers", 0)):
+            logging.warning("[%s] max_inflight_frames needs executor_workers; publishing without flow control",
+                            self.name)
 
     def start(self):
-        broker = self.context["broker"]
         trigger_topic = self.config["trigger_topic"]
         data_topic = self.config["data_topic"]
-        read_all_vehicle_data = self.context.get("read_all_vehicle_data")
+        batch_topic = self.config.get("batch_topic", f"{data_topic}/batch")
+        sync_mode = self.config.get("sync_mode", "full")
+        source_id = self.config.get("source_id", self.name)
+        frame_rows = max(int(self.config.get("frame_rows", 500)), 1)
+        # Waiting for the network loop from the network loop would deadlock
+        max_inflight = int(self.config.get("max_inflight_frames", 8)) if int(self.config.get("executor_workers", 0)) else 0
+        watermark_file = self.config.get("watermark_file")
+        # Prefer the streaming reader so rows are published as they are fetched
+        read_rows = self.context.get("iter_vehicle_data") or self.context.get("read_all_vehicle_data")
+        read_since = self.context.get("iter_vehicle_data_since")
+        self._watermarks = self._load_watermarks(watermark_file)
+        self._watermarks_lock = threading.Lock()
+        requests_total = self.metric("counter", "trigger_requests_total", "Trigger requests received",
+                                     ("plugin",)).labels(plugin=self.name)
+        errors_total = self.metric("counter", "trigger_errors_total", "Trigger requests that failed",
+                                   ("plugin",)).labels(plugin=self.name)
+        published_total = self.metric("counter", "trigger_records_published_total", "Records replayed to the data topic",
+                                      ("plugin",)).labels(plugin=self.name)
+        frames_total = self.metric("counter", "trigger_frames_published_total", "Incremental sync frames published",
+                                   ("plugin",)).labels(plugin=self.name)
+        service_seconds = self.metric("histogram", "trigger_service_seconds", "Time to read and publish one replay",
+                                      ("plugin",)).labels(plugin=self.name)
 
         def on_message(client, userdata, msg):
-            payload_raw = None
             try:
-                payload_raw = msg.payload.decode()
-                payload = json.loads(payload_raw) if payload_raw else {}
+                payload = self.decode_payload(msg.payload) or {}
             except Exception:
                 payload = {}
+            if not isinstance(payload, dict):
+                logging.error("[%s] trigger payload is not an object: %r", self.name, payload)
+                errors_total.inc()
+                return
+            # Subscribers acknowledge sync frames on the trigger topic too
+            if "ack" in payload:
+                acknowledge(payload.get("subscriber") or "default", payload["ack"])
+                return
+            start = time.perf_counter()
+            requests_total.inc()
+            try:
+                serve(client, payload)
+            finally:
+                service_seconds.observe(time.perf_counter() - start)
+
+        def serve(client, payload):
             vin_filter = payload.get("vin")
 
-            if read_all_vehicle_data is None:
+            mode = payload.get("mode", sync_mode)
+            if mode == "incremental" and read_since is not None:
+                sync(client, payload.get("subscriber") or "default", payload.get("since"), vin_filter)
+                return
+
+            if read_since is None and read_rows is None:
                 logging.error("[%s] No DB read available", self.name)
+                errors_total.inc()
+                return
+
+            published = 0
+            try:
+                if read_since is not None:
+                    rows = read_since(0, vin_filter) if vin_filter else read_since(0)
+                    messages = ({"source": source_id, "id": r[0], "vin": r[1], "latitude": r[2], "longitude": r[3],
+                                 "giro": r[4], "ts": r[5]} for r in rows)
+                else:
+                    # Readers without ids: subscribers fall back to keying rows on their content
+                    rows = read_rows(vin_filter) if vin_filter else read_rows()
+                    messages = ({"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]} for r in rows)
+                for msg_out in messages:
+                    client.publish(data_topic, self.encode_payload(data_topic, msg_out))
+                    published += 1
+            except Exception as e:
+                logging.exception("[%s] DB read failed after %d records: %s", self.name, published, e)
+                errors_total.inc()
                 return
+            finally:
+                published_total.inc(published)
+            logging.info("[%s] Published %d records to %s", self.name, published, data_topic)
+
+        def acknowledge(subscriber, ack):
+            """Move the subscriber's watermark up to the frames it has applied."""
+            try:
+                watermark = int(ack)
+            except (TypeError, ValueError):
+                logging.error("[%s] invalid ack %r from %s", self.name, ack, subscriber)
+                errors_total.inc()
+                return
+            with self._watermarks_lock:
+                if watermark <= self._watermarks.get(subscriber, 0):
+                    return
+                self._watermarks[subscriber] = watermark
+            self._save_watermarks(watermark_file)
+
+        def sync(client, subscriber, since, vin_filter):
+            """Send the rows above the subscriber's watermark as frames; only its acks advance the watermark."""
+            if since is not None:
+                try:
+                    since = int(since)
+                except (TypeError, ValueError):
+                    logging.error("[%s] invalid since %r from %s", self.name, since, subscriber)
+                    errors_total.inc()
+                    return
+                # The subscriber's own high-watermark is authoritative, also when it went back
+                if not vin_filter:
+                    with self._watermarks_lock:
+                        self._watermarks[subscriber] = since
+                    self._save_watermarks(watermark_file)
+            with self._watermarks_lock:
+                watermark = since if since is not None else self._watermarks.get(subscriber, 0)
+            window = FrameWindow(client, max_inflight)
+            published = 0
+            seq = 0
+            frame = []
+
+            def send(rows, end):
+                nonlocal seq, watermark
+                out = {"source": source_id, "subscriber": subscriber, "seq": seq, "since": watermark,
+                       "watermark": rows[-1]["id"] if rows else watermark, "rows": rows}
+                if vin_filter:
+                    out["vin"] = vin_filter
+                if end:
+                    out["end"] = True
+                window.publish(batch_topic, self.encode_payload(batch_topic, out))
+                frames_total.inc()
+                seq += 1
+                watermark = out["watermark"]
 
             try:
-                rows = read_all_vehicle_data(vin_filter) if vin_filter else read_all_vehicle_data()
+                rows = read_since(watermark, vin_filter) if vin_filter else read_since(watermark)
+                for r in rows:
+                    frame.append({"id": r[0], "vin": r[1], "latitude": r[2], "longitude": r[3], "giro": r[4],
+                                  "ts": r[5]})
+                    if len(frame) >= frame_rows:
+                        send(frame, end=False)
+                        published += len(frame)
+                        frame = []
+                if frame or seq:
+                    send(frame, end=True)
+                    published += len(frame)
+                window.drain()
             except Exception as e:
-                logging.exception("[%s] DB read failed: %s", self.name, e)
+                logging.exception("[%s] incremental sync for %s failed after %d records: %s",
+                                  self.name, subscriber, published, e)
+                errors_total.inc()
                 return
+            finally:
+                published_total.inc(published)
+            if published:
+                logging.info("[%s] Synced %d records in %d frames to %s (up to %d, awaiting ack)",
+                             self.name, published, seq, subscriber, watermark)
 
-            for r in rows:
-                msg_out = {"vin": r[0], "latitude": r[1], "longitude": r[2], "giro": r[3]}
-                client.publish(data_topic, json.dumps(msg_out))
-            logging.info("[%s] Published %d records to %s", self.name, len(rows), data_topic)
+        self.subscribe(trigger_topic, on_message)
+        logging.info("[%s] Trigger listener on %s (%s sync)", self.name, trigger_topic, sync_mode)
 
-        def run():
-            c = mqtt.Client()
-            c.on_message = on_message
-            c.connect(broker, 1883, 60)
-            c.subscribe(trigger_topic)
-            logging.info("[%s] Trigger listener on %s", self.name, trigger_topic)
-            c.loop_forever()
+    def _load_watermarks(self, path):
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                return {k: int(v) for k, v in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            logging.warning("[%s] ignoring unreadable watermark file %s: %s", self.name, path, e)
+            return {}
 
-        threading.Thread(target=run, name=f"{self.name}-trigger", daemon=True).start()
\ No newline at end of file
+    def _save_watermarks(self, path):
+        if not path:
+            return
+        with self._watermarks_lock:
+            data = dict(self._watermarks)
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.warning("[%s] could not save watermarks to %s: %s", self.name, path, e)
@@ -2,20 +2,25 @@ import json
 import time
 import random
 import paho.mqtt.client as mqtt
+from codec import TopicCodecs
 
 BROKER = "mqtt-broker"
 TOPIC = "vehicles/vin"
 
-client = mqtt.Client()
+# Per-topic wire codec (WIRE_CODECS), JSON by default
+codecs = TopicCodecs.from_env()
+
+client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
 client.connect(BROKER, 1883, 60)
 client.loop_start()
 
 while True:
     message = {
         "vin": f"VIN{123456}",
+        "ts": time.time()
     }
 
-    client.publish(TOPIC, json.dumps(message))
+    client.publish(TOPIC, codecs.encode(TOPIC, message))
     print(f"{json.dumps(message)}")
     
     time.sleep(5)
\ No newline at end of file
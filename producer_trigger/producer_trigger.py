@@ -2,20 +2,27 @@ import json
 import time
 import random
 import paho.mqtt.client as mqtt
+from codec import TopicCodecs
 
 BROKER = "mqtt-broker"
 TOPIC = "vehicles/request"
+SUBSCRIBER = "fleet_digital_twin"
 
-client = mqtt.Client()
+# Per-topic wire codec (WIRE_CODECS), JSON by default
+codecs = TopicCodecs.from_env()
+
+client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
 client.connect(BROKER, 1883, 60)
 client.loop_start()
 
 while True:
+    # The twin only sends rows above the watermark this subscriber last acknowledged
     message = {
         "trigger": "VIN_REQUEST",
+        "subscriber": SUBSCRIBER,
     }
 
-    client.publish(TOPIC, json.dumps(message))
+    client.publish(TOPIC, codecs.encode(TOPIC, message))
     print(f"{json.dumps(message)}")
     
     time.sleep(5)
\ No newline at end of file
@@ -0,0 +1,254 @@
+"""Persistent, multiplexed client for the twin's MQTT RPC server.
+
+One RpcClient holds one broker connection and one wildcard subscription for
+all of its responses, so a call costs one publish and one message:
+
+    with RpcClient(BROKER) as rpc:
+        future = rpc.call({"vin": "VIN123"}, method="latest")
+        rows = future.result()["result"]
+
+Every call gets a correlation id under the client's own response prefix
+(``<client id>/<uuid>``), so the server answers on
+``rpc/response/<client id>/<uuid>`` and the subscription
+``rpc/response/<client id>/+`` covers every call of this client and no
+other. ``call`` returns a concurrent.futures.Future, ``acall`` an awaitable;
+both are resolved from the paho callback. Any number of calls can be in
+flight; each has its own timeout, after which its future fails with
+TimeoutError and its entry is dropped (a late response is discarded).
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future, InvalidStateError
+
+import paho.mqtt.client as mqtt
+from codec import TopicCodecs
+
+RPC_REQUEST_TOPIC = "rpc/request/read_all_vehicle_data"
+RPC_RESPONSE_TOPIC_PREFIX = "rpc/response/"
+DEFAULT_TIMEOUT = 5.0
+
+
+class RpcError(Exception):
+    """The server answered with {"error": ...}."""
+
+
+class _Stream:
+    """Chunks of one streaming call, handed from the paho thread to the iterating thread."""
+
+    def __init__(self):
+        self.chunks = queue.Queue()
+
+
+def _settle(waiter, result=None, error=None):
+    """Resolve a call's future (or feed its stream); a future the caller already cancelled is left alone."""
+    if isinstance(waiter, _Stream):
+        waiter.chunks.put(error if error is not None else result)
+        return
+    try:
+        if error is not None:
+            waiter.set_exception(error)
+        else:
+            waiter.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class RpcClient:
+    """One broker connection and response subscription shared by every call; safe to use from any thread."""
+
+    def __init__(self, broker, port=1883, request_topic=RPC_REQUEST_TOPIC,
+                 response_prefix=RPC_RESPONSE_TOPIC_PREFIX, client_id=None, codecs=None, keepalive=60):
+        self.broker = broker
+        self.port = port
+        self.request_topic = request_topic
+        self.client_id = client_id or f"rpc-{uuid.uuid4().hex[:12]}"
+        self.response_prefix = response_prefix
+        self.codecs = codecs or TopicCodecs.from_env()
+        self.keepalive = keepalive
+        self._pending = {}
+        self._lock = threading.Lock()
+        # (deadline, seq, correlation id) of every call; entries of finished calls are skipped
+        self._deadlines = []
+        self._seq = itertools.count()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._subscribed = threading.Event()
+        self.calls = 0
+        self.timeouts = 0
+        self.late_responses = 0
+        self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=self.client_id)
+        self._client.on_connect = self._on_connect
+        self._client.on_subscribe = self._on_subscribe
+        self._client.on_message = self._on_message
+        self._reaper = threading.Thread(target=self._expire, name="rpc-timeouts", daemon=True)
+
+    def start(self, timeout=DEFAULT_TIMEOUT):
+        """Connect and start the network thread; returns once responses can be received."""
+        self._client.connect(self.broker, self.port, self.keepalive)
+        self._client.loop_start()
+        self._reaper.start()
+        if not self._subscribed.wait(timeout):
+            self.close()
+            raise ConnectionError(f"no response subscription on {self.broker}:{self.port} after {timeout}s")
+        return self
+
+    def close(self):
+        """Fail every call still in flight with ConnectionError and disconnect."""
+        with self._lock:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+            self._wakeup.notify()
+        for waiter in pending.values():
+            _settle(waiter, error=ConnectionError("RPC client closed"))
+        self._client.loop_stop()
+        self._client.disconnect()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._pending)
+
+    def call(self, params=None, method=None, timeout=DEFAULT_TIMEOUT):
+        """Send one request; returns a Future of the response payload.
+
+        The future fails with RpcError if the server reports an error and with
+        TimeoutError if no response arrives within ``timeout`` seconds.
+        Cancelling the future forgets the call.
+        """
+        future = Future()
+        corr = self._register(future, timeout)
+        future.add_done_callback(lambda f: self._forget(corr))
+        request = {"correlation_id": corr, "params": params or {}}
+        if method:
+            request["method"] = method
+        self._publish(corr, request)
+        return future
+
+    def acall(self, params=None, method=None, timeout=DEFAULT_TIMEOUT):
+        """call() as an awaitable for asyncio code; must be called from a running event loop."""
+        return asyncio.wrap_future(self.call(params, method, timeout))
+
+    def stream(self, params=None, chunk_size=500, timeout=DEFAULT_TIMEOUT):
+        """Call in streaming mode and lazily yield result rows in query order.
+
+        ``timeout`` applies between chunks. Raises TimeoutError if no chunk
+        arrives in time and RpcError if the server reports an error.
+        """
+        stream = _Stream()
+        corr = self._register(stream, None)
+        try:
+            self._publish(corr, {"correlation_id": corr, "params": params or {}, "stream": True,
+                                 "chunk_size": chunk_size})
+            pending = {}
+            next_seq = 0
+            end = None
+            while end is None or next_seq < end["seq"]:
+                try:
+                    chunk = stream.chunks.get(timeout=timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self.timeouts += 1
+                    raise TimeoutError(f"RPC stream timeout for correlation_id={corr} at seq={next_seq}")
+                if isinstance(chunk, Exception):
+                    raise chunk
+                # Requests refused before streaming starts get a plain error reply
+                if "error" in chunk and "seq" not in chunk:
+                    raise RpcError(chunk["error"])
+                if chunk.get("end"):
+                    end = chunk
+                    continue
+                pending[chunk["seq"]] = chunk["rows"]
+                while next_seq in pending:
+                    yield from pending.pop(next_seq)
+                    next_seq += 1
+            if "error" in end:
+                raise RpcError(end["error"])
+        finally:
+            self._forget(corr)
+
+    def _register(self, waiter, timeout):
+        corr = f"{self.client_id}/{uuid.uuid4().hex}"
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("RPC client closed")
+            self._pending[corr] = waiter
+            self.calls += 1
+            if timeout is not None:
+                heapq.heappush(self._deadlines, (time.monotonic() + timeout, next(self._seq), corr))
+                # Only the earliest deadline matters to the reaper
+                if self._deadlines[0][2] == corr:
+                    self._wakeup.notify()
+        return corr
+
+    def _forget(self, corr):
+        with self._lock:
+            self._pending.pop(corr, None)
+
+    def _publish(self, corr, request):
+        try:
+            info = self._client.publish(self.request_topic, self.codecs.encode(self.request_topic, request))
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise ConnectionError(f"RPC request not sent (rc={info.rc})")
+        except Exception as e:
+            with self._lock:
+                waiter = self._pending.pop(corr, None)
+            if waiter is not None:
+                _settle(waiter, error=e)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # Also runs after an automatic reconnect: the subscription is not kept by a clean session
+        client.subscribe(f"{self.response_prefix}{self.client_id}/+")
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        self._subscribed.set()
+
+    def _on_message(self, client, userdata, msg):
+        corr = msg.topic[len(self.response_prefix):]
+        with self._lock:
+            waiter = self._pending.get(corr)
+            if isinstance(waiter, Future):
+                del self._pending[corr]
+        if waiter is None:
+            with self._lock:
+                self.late_responses += 1
+            logging.debug("Discarding response on %s: call timed out or was cancelled", msg.topic)
+            return
+        try:
+            payload = self.codecs.decode(msg.payload)
+        except Exception as e:
+            _settle(waiter, error=ValueError(f"undecodable RPC response: {e}"))
+            return
+        if isinstance(waiter, Future) and "error" in payload:
+            _settle(waiter, error=RpcError(payload["error"]))
+        else:
+            _settle(waiter, payload)
+
+    def _expire(self):
+        with self._lock:
+            while not self._closed:
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, _, corr = heapq.heappop(self._deadlines)
+                    waiter = self._pending.pop(corr, None)
+                    if waiter is not None:
+                        self.timeouts += 1
+                        # Resolve outside the lock: done callbacks take it again
+                        self._lock.release()
+                        try:
+                            _settle(waiter, error=TimeoutError(f"RPC timeout for correlation_id={corr}"))
+                        finally:
+                            self._lock.acquire()
+                        now = time.monotonic()
+                delay = self._deadlines[0][0] - now if self._deadlines else None
+                self._wakeup.wait(delay)
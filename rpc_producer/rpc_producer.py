@@ -1,65 +1,47 @@
 import json
-import uuid
 import time
-import paho.mqtt.client as mqtt
+from rpc_client import RpcClient, RpcError
 
 BROKER = "mqtt-broker"
 RPC_REQUEST_TOPIC = "rpc/request/read_all_vehicle_data"
 RPC_RESPONSE_TOPIC_PREFIX = "rpc/response/"
+# Ask the server for a chunked response and consume it lazily
+USE_STREAMING = True
+STREAM_CHUNK_ROWS = 500
 
-# Store responses by correlation_id
-responses = {}
+# One connection and one response subscription for every call (WIRE_CODECS
+# picks the request codec; responses in any codec are decoded)
+rpc = RpcClient(BROKER, request_topic=RPC_REQUEST_TOPIC, response_prefix=RPC_RESPONSE_TOPIC_PREFIX).start()
 
-def on_response(client, userdata, msg):
-    """Handle RPC responses."""
+def call_rpc(timeout=5, params=None):
+    """Call the RPC method and wait for the response; None on timeout or error."""
     try:
-        payload = json.loads(msg.payload.decode())
-        correlation_id = payload.get("correlation_id")
-        responses[correlation_id] = payload
-        print(f"RPC Response (correlation_id={correlation_id}): {payload}")
-    except Exception as e:
-        print(f"Error parsing response: {e}")
-
-def call_rpc(correlation_id, timeout=5):
-    """Call RPC method and wait for response."""
-    client = mqtt.Client()
-    client.on_message = on_response
-    client.connect(BROKER, 1883, 60)
-    
-    # Subscribe to response topic for this correlation_id
-    response_topic = f"{RPC_RESPONSE_TOPIC_PREFIX}{correlation_id}"
-    client.subscribe(response_topic)
-    client.loop_start()
-    
-    # Send RPC request
-    request = {
-        "correlation_id": correlation_id,
-        "params": {}
-    }
-    client.publish(RPC_REQUEST_TOPIC, json.dumps(request))
-    print(f"RPC Request sent (correlation_id={correlation_id}): {request}")
-    
-    # Wait for response with timeout
-    start = time.time()
-    while correlation_id not in responses and (time.time() - start) < timeout:
-        time.sleep(0.1)
-    
-    if correlation_id in responses:
-        result = responses[correlation_id]
-        client.loop_stop()
-        client.disconnect()
-        return result
-    else:
-        print(f"RPC timeout for correlation_id={correlation_id}")
-        client.loop_stop()
-        client.disconnect()
+        result = rpc.call(params, timeout=timeout).result()
+    except (TimeoutError, RpcError, ConnectionError) as e:
+        print(f"RPC failed: {e}")
         return None
+    print(f"RPC Response (correlation_id={result.get('correlation_id')}): {len(result.get('result', []))} rows")
+    return result
+
+def stream_rpc(chunk_size=STREAM_CHUNK_ROWS, timeout=5, params=None):
+    """Call the RPC method in streaming mode and lazily yield result rows (see RpcClient.stream)."""
+    return rpc.stream(params, chunk_size=chunk_size, timeout=timeout)
 
 # Example usage
 while True:
-    correlation_id = str(uuid.uuid4())
-    result = call_rpc(correlation_id, timeout=10)
-    if result:
-        print("\nFinal result:")
-        print(json.dumps(result, indent=2))
+    if USE_STREAMING:
+        try:
+            count = 0
+            for row in stream_rpc(timeout=10):
+                if count < 5:
+                    print(f"Row {count}: {row}")
+                count += 1
+            print(f"\nStreamed {count} rows")
+        except (TimeoutError, RpcError, ConnectionError) as e:
+            print(f"RPC stream failed: {e}")
+    else:
+        result = call_rpc(timeout=10)
+        if result:
+            print("\nFinal result:")
+            print(json.dumps(result, indent=2))
     time.sleep(10)
\ No newline at end of file
@@ -0,0 +1,207 @@
+"""Fleet load generator: steps thousands of vehicles at once and publishes their telemetry.
+
+Replaces the producer, producer_location and producer_giro containers. Every
+vehicle has a position, heading and speed, advanced together with NumPy each
+tick. Each report publishes the same vin / location / giro messages as the
+producers (or a single vehicles/data message with --topics data). Reports
+arrive at a configurable aggregate message rate with Poisson, bursty or
+uniform timing. They are spread over a pool of MQTT connections, and the rate
+actually achieved is logged every --report-interval seconds.
+
+    python simulator.py --vehicles 5000 --rate 20000 --arrivals poisson --connections 4
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+from codec import TopicCodecs
+
+BROKER = os.environ.get("BROKER", "mqtt-broker")
+TOPIC_VIN = "vehicles/vin"
+TOPIC_LOCATION = "vehicles/location"
+TOPIC_GIRO = "vehicles/giro"
+TOPIC_DATA = "vehicles/data"
+ARRIVALS = ("poisson", "bursty", "uniform")
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+
+class Fleet:
+    """Kinematic state of n vehicles, advanced together.
+
+    Speeds follow a bounded random walk and headings turn at a random-walk
+    yaw rate, so each vehicle drives a smooth, plausible trajectory. giro is
+    the heading in degrees [0, 360).
+    """
+
+    def __init__(self, n, seed=None, center=(45.5, -73.6), spread=0.2, max_speed=35.0):
+        self.rng = np.random.default_rng(seed)
+        self.n = n
+        self.vins = [f"SIM{i:014d}" for i in range(n)]
+        self.max_speed = max_speed
+        self.lat = center[0] + self.rng.uniform(-spread, spread, n)
+        self.lon = center[1] + self.rng.uniform(-spread, spread, n)
+        self.heading = self.rng.uniform(0.0, 360.0, n)
+        self.speed = self.rng.uniform(0.0, max_speed, n)
+        self.yaw_rate = np.zeros(n)
+
+    def step(self, dt):
+        """Advance every vehicle by dt seconds."""
+        if dt <= 0:
+            return
+        self.speed = np.clip(self.speed + self.rng.normal(0.0, 1.0, self.n) * dt, 0.0, self.max_speed)
+        self.yaw_rate = np.clip(self.yaw_rate + self.rng.normal(0.0, 2.0, self.n) * dt, -15.0, 15.0)
+        self.heading = (self.heading + self.yaw_rate * dt) % 360.0
+        rad = np.radians(self.heading)
+        distance = self.speed * dt
+        self.lat = np.clip(self.lat + distance * np.cos(rad) / METERS_PER_DEGREE, -89.9, 89.9)
+        self.lon = (self.lon + distance * np.sin(rad) / (METERS_PER_DEGREE * np.cos(np.radians(self.lat))) + 180.0) % 360.0 - 180.0
+
+
+def arrivals(rng, mode, rate, dt, burst_size=50):
+    """Number of reports due in a tick of dt seconds for an aggregate rate (reports/s)."""
+    expected = rate * dt
+    if mode == "uniform":
+        return expected
+    if mode == "poisson":
+        return int(rng.poisson(expected))
+    # Compound Poisson: bursts of burst_size reports arrive as a Poisson process
+    return int(rng.poisson(expected / burst_size)) * burst_size
+
+
+def messages(fleet, index, ts, topics):
+    """(topic, payload) messages of one report of vehicle index."""
+    vin = fleet.vins[index]
+    lat = round(float(fleet.lat[index]), 6)
+    lon = round(float(fleet.lon[index]), 6)
+    giro = round(float(fleet.heading[index]), 2)
+    if topics == "data":
+        return [(TOPIC_DATA, {"vin": vin, "ts": ts, "latitude": lat, "longitude": lon, "giro": giro})]
+    return [
+        (TOPIC_VIN, {"vin": vin, "ts": ts}),
+        (TOPIC_LOCATION, {"vin": vin, "ts": ts, "latitude": lat, "longitude": lon}),
+        (TOPIC_GIRO, {"vin": vin, "ts": ts, "giro": giro}),
+    ]
+
+
+class Simulator:
+    """Paces reports at the target rate and publishes them round-robin over a connection pool."""
+
+    def __init__(self, fleet, publishers, rate, arrivals_mode="poisson", topics="split", tick=0.01,
+                 burst_size=50, report_interval=5.0, codecs=None, clock=time.monotonic, sleep=time.sleep):
+        if arrivals_mode not in ARRIVALS:
+            raise ValueError(f"unknown arrival process {arrivals_mode!r}, expected one of {ARRIVALS}")
+        self.fleet = fleet
+        self.publishers = publishers
+        self.messages_per_report = 1 if topics == "data" else 3
+        # rate is in messages/s; arrivals are drawn per report
+        self.report_rate = rate / self.messages_per_report
+        self.rate = rate
+        self.arrivals_mode = arrivals_mode
+        self.topics = topics
+        self.tick = tick
+        self.burst_size = burst_size
+        self.report_interval = report_interval
+        self.codecs = codecs or TopicCodecs()
+        self.clock = clock
+        self.sleep = sleep
+        self.sent = 0
+        self._cursor = 0
+        self._carry = 0.0
+        self._next_publisher = 0
+
+    def publish(self, topic, payload):
+        client = self.publishers[self._next_publisher]
+        self._next_publisher = (self._next_publisher + 1) % len(self.publishers)
+        client.publish(topic, self.codecs.encode(topic, payload))
+        self.sent += 1
+
+    def run_tick(self, dt):
+        """Step the fleet by dt and publish the reports due in it; returns the reports sent."""
+        self.fleet.step(dt)
+        due = arrivals(self.fleet.rng, self.arrivals_mode, self.report_rate, dt, self.burst_size)
+        # Uniform arrivals carry the fractional report over to the next tick
+        due += self._carry
+        reports = int(due)
+        self._carry = due - reports
+        ts = time.time()
+        for _ in range(reports):
+            for topic, payload in messages(self.fleet, self._cursor, ts, self.topics):
+                self.publish(topic, payload)
+            self._cursor = (self._cursor + 1) % self.fleet.n
+        return reports
+
+    def run(self, duration=None):
+        start = last = last_report = self.clock()
+        sent_at_report = 0
+        while duration is None or last - start < duration:
+            self.sleep(max(0.0, last + self.tick - self.clock()))
+            now = self.clock()
+            self.run_tick(now - last)
+            last = now
+            if now - last_report >= self.report_interval:
+                achieved = (self.sent - sent_at_report) / (now - last_report)
+                logging.info("target %.0f msg/s, achieved %.0f msg/s (%d sent, %s arrivals, %d connections)",
+                             self.rate, achieved, self.sent, self.arrivals_mode, len(self.publishers))
+                last_report = now
+                sent_at_report = self.sent
+        elapsed = self.clock() - start
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+
+def connect_pool(broker, connections):
+    clients = []
+    for i in range(connections):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"simulator-{os.getpid()}-{i}")
+        client.connect(broker, 1883, 60)
+        client.loop_start()
+        clients.append(client)
+    return clients
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--broker", default=BROKER)
+    parser.add_argument("--vehicles", type=int, default=int(os.environ.get("SIM_VEHICLES", 1000)))
+    parser.add_argument("--rate", type=float, default=float(os.environ.get("SIM_RATE", 600)),
+                        help="aggregate messages per second")
+    parser.add_argument("--arrivals", choices=ARRIVALS, default=os.environ.get("SIM_ARRIVALS", "poisson"))
+    parser.add_argument("--burst-size", type=int, default=50, help="reports per burst for bursty arrivals")
+    parser.add_argument("--connections", type=int, default=int(os.environ.get("SIM_CONNECTIONS", 2)))
+    parser.add_argument("--topics", choices=("split", "data"), default="split",
+                        help="split: vin/location/giro like the producers; data: one vehicles/data message")
+    parser.add_argument("--tick", type=float, default=0.01)
+    parser.add_argument("--duration", type=float, default=None)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(threadName)s] %(levelname)s: %(message)s", force=True)
+    publishers = connect_pool(args.broker, max(args.connections, 1))
+    simulator = Simulator(
+        Fleet(args.vehicles, seed=args.seed),
+        publishers,
+        args.rate,
+        arrivals_mode=args.arrivals,
+        topics=args.topics,
+        tick=args.tick,
+        burst_size=args.burst_size,
+        report_interval=args.report_interval,
+        codecs=TopicCodecs.from_env()
+    )
+    try:
+        achieved = simulator.run(args.duration)
+        logging.info("done: %d messages, %.0f msg/s achieved (target %.0f)", simulator.sent, achieved, args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for client in publishers:
+            client.loop_stop()
+            client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import sys
+import threading
+import unittest
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, Mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Mock dependencies
+sys.modules['paho'] = MagicMock()
+sys.modules['paho.mqtt'] = MagicMock()
+sys.modules['paho.mqtt.client'] = MagicMock()
+
+from aio_router import AsyncTopicRouter, Message
+from listener_base import MqttListenerPlugin
+from plugins.rpc_server_plugin import RpcServerPlugin
+
+
+async def settle(router):
+    """Wait for every handler and publish the router has started."""
+    while router._tasks:
+        await asyncio.gather(*list(router._tasks), return_exceptions=True)
+
+
+class TestAsyncTopicRouter(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.router = AsyncTopicRouter("test-broker", plugin_threads=2)
+        # Stands in for the connected aiomqtt client
+        self.router._client = Mock(publish=AsyncMock(), subscribe=AsyncMock(), unsubscribe=AsyncMock())
+
+    async def asyncTearDown(self):
+        self.router.stop()
+
+    async def test_sync_handler_runs_on_plugin_thread(self):
+        seen = []
+        self.router.subscribe("vehicles/+", lambda client, userdata, msg: seen.append(
+            (client, msg.topic, threading.current_thread().name)))
+
+        await self.router.dispatch(Message("vehicles/vin", b"{}"))
+        await settle(self.router)
+
+        self.assertEqual(len(seen), 1)
+        client, topic, thread = seen[0]
+        self.assertIs(client, self.router)
+        self.assertEqual(topic, "vehicles/vin")
+        self.assertTrue(thread.startswith("plugin"))
+
+    async def test_coroutine_handler_runs_on_loop(self):
+        seen = []
+
+        async def handler(client, userdata, msg):
+            seen.append(threading.current_thread() is threading.main_thread())
+            await client.apublish("out", msg.payload)
+
+        self.router.subscribe("in", handler)
+        await self.router.dispatch(Message("in", b"x"))
+        await settle(self.router)
+
+        self.assertEqual(seen, [True])
+        self.router._client.publish.assert_awaited_once_with("out", b"x", qos=0, retain=False)
+
+    async def test_publish_from_plugin_thread_waits_for_loop(self):
+        def handler(client, userdata, msg):
+            info = client.publish("out", b"reply")
+            info.wait_for_publish(timeout=1)
+            seen.append(info.is_published())
+
+        seen = []
+        self.router.subscribe("in", handler)
+        await self.router.dispatch(Message("in", b""))
+        await settle(self.router)
+
+        self.assertEqual(seen, [True])
+        self.router._client.publish.assert_awaited_once_with("out", b"reply", qos=0, retain=False)
+
+    async def test_publish_while_disconnected_fails(self):
+        self.router._client = None
+        errors = []
+
+        def handler(client, userdata, msg):
+            try:
+                client.publish("out", b"").wait_for_publish(timeout=1)
+            except ConnectionError as e:
+                errors.append(e)
+
+        self.router.subscribe("in", handler)
+        await self.router.dispatch(Message("in", b""))
+        await settle(self.router)
+
+        self.assertEqual(len(errors), 1)
+
+    async def test_concurrency_is_bounded(self):
+        router = AsyncTopicRouter("test-broker", max_concurrency=2)
+        release = asyncio.Event()
+        running = []
+
+        async def handler(client, userdata, msg):
+            running.append(msg.topic)
+            await release.wait()
+
+        router.subscribe("#", handler)
+        await router.dispatch(Message("a", b""))
+        await router.dispatch(Message("b", b""))
+        third = asyncio.create_task(router.dispatch(Message("c", b"")))
+        await asyncio.sleep(0.01)
+        # The third message waits for a free slot instead of starting
+        self.assertEqual(running, ["a", "b"])
+        self.assertFalse(third.done())
+
+        release.set()
+        await third
+        await settle(router)
+        self.assertEqual(running, ["a", "b", "c"])
+        router.stop()
+
+    async def test_subscribe_while_connected_subscribes_broker(self):
+        self.router.subscribe("rpc/#", lambda c, u, m: None)
+        await settle(self.router)
+        self.router._client.subscribe.assert_awaited_once_with("rpc/#")
+
+
+class _Plugin(MqttListenerPlugin):
+
+    def validate(self):
+        pass
+
+    def start(self):
+        pass
+
+
+class TestCoroutineHandlers(unittest.TestCase):
+
+    def test_coroutine_handler_rejected_without_asyncio_runtime(self):
+        async def handler(client, userdata, msg):
+            pass
+
+        plugin = _Plugin("p", {}, {"router": Mock()})
+        with self.assertRaises(TypeError):
+            plugin.subscribe("t", handler)
+
+
+class TestRpcServerAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.router = AsyncTopicRouter("test-broker", plugin_threads=2)
+        self.router._client = Mock(publish=AsyncMock(), subscribe=AsyncMock(), unsubscribe=AsyncMock())
+        self.read = Mock(side_effect=AssertionError("blocking reader used"))
+        self.queries = []
+
+        async def aiter_rows(**params):
+            self.queries.append(params)
+            for row in [("VIN1", 1.0, 2.0, 3.0), ("VIN2", 4.0, 5.0, 6.0)]:
+                yield row
+
+        self.plugin = RpcServerPlugin(
+            "rpc",
+            {"request_topic": "rpc/request", "response_topic_prefix": "rpc/response/"},
+            {"router": self.router, "iter_vehicle_data": self.read, "aiter_vehicle_data": aiter_rows}
+        )
+        self.plugin.start()
+
+    async def asyncTearDown(self):
+        self.plugin.stop()
+        self.router.stop()
+
+    async def request(self, payload):
+        await self.router.dispatch(Message("rpc/request", json.dumps(payload).encode()))
+        await settle(self.router)
+        return [(c.args[0], json.loads(c.args[1])) for c in self.router._client.publish.await_args_list]
+
+    async def test_read_served_from_async_reader(self):
+        published = await self.request({"correlation_id": "c1", "params": {"vin": "VIN1"}})
+
+        self.assertEqual(self.queries, [{"vin": "VIN1"}])
+        self.assertEqual(published[0][0], "rpc/response/c1")
+        self.assertEqual([r["vin"] for r in published[0][1]["result"]], ["VIN1", "VIN2"])
+        self.read.assert_not_called()
+
+    async def test_reader_options_in_params_rejected(self):
+        published = await self.request({"correlation_id": "c3", "stream": True, "params": {"prefetch": 10 ** 9}})
+
+        self.assertEqual(self.queries, [])
+        self.assertEqual(published, [("rpc/response/c3", {"correlation_id": "c3", "error": "unknown params: prefetch"})])
+
+    async def test_stream_served_from_async_reader(self):
+        published = await self.request({"correlation_id": "c2", "stream": True, "chunk_size": 1})
+
+        self.assertEqual([p["seq"] for _, p in published], [0, 1, 2])
+        self.assertEqual(published[-1][1], {"correlation_id": "c2", "seq": 2, "end": True, "count": 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import asyncio
+import sys
+import unittest
+from contextlib import asynccontextmanager
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+
+# Mock external dependencies before importing
+sys.modules['psycopg2'] = MagicMock()
+asyncpg = MagicMock()
+asyncpg.PostgresConnectionError = type("PostgresConnectionError", (Exception,), {})
+asyncpg.InterfaceError = type("InterfaceError", (Exception,), {})
+sys.modules['asyncpg'] = asyncpg
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import aio_db
+from aio_runtime import AsyncBatchWriter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "fleet_digital_twin"))
+from dedup import Deduplicator
+from pipeline import InlineIngest
+
+
+class TestAsyncBatchWriter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_rows_are_grouped_into_batches(self):
+        batches = []
+
+        async def flush(rows):
+            batches.append(list(rows))
+
+        writer = AsyncBatchWriter(flush, max_batch=3, max_delay=0.01).start()
+        for i in range(7):
+            writer.submit(i)
+        await writer.stop()
+
+        self.assertEqual([r for batch in batches for r in batch], list(range(7)))
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual(writer.rows_written, 7)
+        self.assertEqual(writer.qsize(), 0)
+
+    async def test_failed_flush_counts_rows(self):
+        flush = AsyncMock(side_effect=RuntimeError("db down"))
+        writer = AsyncBatchWriter(flush, max_delay=0.01, max_retries=2, retry_backoff=0).start()
+        writer.submit(1)
+        writer.submit(2)
+        with self.assertLogs(level="ERROR"):
+            await writer.stop()
+
+        self.assertEqual(flush.await_count, 3)
+        self.assertEqual(writer.rows_failed, 2)
+        self.assertEqual(writer.rows_written, 0)
+
+    async def test_failed_flush_is_retried(self):
+        flush = AsyncMock(side_effect=[RuntimeError("db down"), None])
+        writer = AsyncBatchWriter(flush, max_delay=0.01, retry_backoff=0).start()
+        writer.submit(1)
+        with self.assertLogs(level="WARNING"):
+            await writer.stop()
+
+        self.assertEqual(writer.rows_written, 1)
+        self.assertEqual(writer.rows_failed, 0)
+        self.assertEqual(writer.retries, 1)
+
+    async def test_wait_for_space_blocks_while_full(self):
+        release = asyncio.Event()
+
+        async def flush(rows):
+            await release.wait()
+
+        writer = AsyncBatchWriter(flush, max_batch=1, max_delay=0, max_queue=2).start()
+        for i in range(3):
+            writer.submit(i)
+        await asyncio.sleep(0.01)
+        # One row is being flushed, two are queued: the queue is full
+        waiting = asyncio.create_task(writer.wait_for_space())
+        await asyncio.sleep(0.01)
+        self.assertFalse(waiting.done())
+
+        release.set()
+        await asyncio.wait_for(waiting, 1)
+        await writer.stop()
+        self.assertEqual(writer.rows_written, 3)
+
+
+class TestInlineIngest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_decodes_counts_and_submits(self):
+        writer = Mock(qsize=Mock(return_value=0), wait_for_space=AsyncMock())
+
+        def decode(topic, raw):
+            if raw == b"bad":
+                raise ValueError("bad")
+            return [(1,), (2,)] if topic == "batch" else (raw,)
+
+        ingest = InlineIngest(decode, writer)
+        await ingest.submit("data", b"a")
+        await ingest.submit("batch", b"b")
+        with self.assertLogs(level="WARNING"):
+            await ingest.submit("data", b"bad")
+
+        self.assertEqual([c.args[0] for c in writer.submit.call_args_list], [(b"a",), (1,), (2,)])
+        self.assertEqual((ingest.received, ingest.decoded, ingest.invalid), (3, 3, 1))
+        self.assertEqual(writer.wait_for_space.await_count, 2)
+
+
+class TestDeduplicatorAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aflush_matches_flush(self):
+        write = AsyncMock(return_value=1)
+        dedup = Deduplicator(write)
+
+        await dedup.aflush([("k1", "VIN1"), ("k1", "VIN1"), ("k2", "VIN2")])
+
+        write.assert_awaited_once_with([("k1", "VIN1"), ("k2", "VIN2")])
+        self.assertEqual(dedup.stats(), {"checked": 3, "filter_hits": 1, "db_conflicts": 1, "written": 1})
+
+
+class TestAioDb(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.conn = MagicMock()
+        self.conn.execute = AsyncMock(return_value="INSERT 0 2")
+
+        @asynccontextmanager
+        async def transaction():
+            yield
+
+        @asynccontextmanager
+        async def acquire():
+            yield self.conn
+
+        self.conn.transaction = transaction
+        self.pool = MagicMock(acquire=acquire)
+        aio_db._pool = self.pool
+
+    async def asyncTearDown(self):
+        aio_db._pool = None
+
+    async def test_batch_is_sent_as_column_arrays(self):
+        rows = [("VIN1", 1.0, 2.0, 3.0, 100.0), ("VIN2", 4.0, 5.0, 6.0, None)]
+        await aio_db.write_vehicle_data_batch(rows)
+
+        self.conn.execute.assert_awaited_once()
+        args = self.conn.execute.await_args.args
+        self.assertIn("unnest", args[0])
+        self.assertEqual(args[1:], (["VIN1", "VIN2"], [1.0, 4.0], [2.0, 5.0], [3.0, 6.0], [100.0, None]))
+
+    async def test_rollups_written_in_same_transaction(self):
+        aggregate = ("VIN1", 60.0, 1, 1, 90.0, 1.0, 1.0, 2.0, 2.0, 3.0, 3.0, 60.0)
+        await aio_db.write_vehicle_data_batch([("VIN1", 1.0, 2.0, 3.0, 60.0)], {"vehicle_rollup_1m": [aggregate]})
+
+        self.assertEqual(self.conn.execute.await_count, 2)
+        sql = self.conn.execute.await_args_list[1].args[0]
+        self.assertIn("INSERT INTO vehicle_rollup_1m", sql)
+        self.assertIn("ON CONFLICT", sql)
+
+    async def test_unique_batch_returns_inserted_count(self):
+        rows = [("k1", "VIN1", 1.0, 2.0, 3.0, None), ("k2", "VIN2", 1.0, 2.0, 3.0, None), ("k3", "VIN3", 1.0, 2.0, 3.0, None)]
+        self.assertEqual(await aio_db.write_unique_vehicle_data_batch(rows), 2)
+        self.assertIn("vehicle_data_keys", self.conn.execute.await_args.args[0])
+
+    async def test_connection_errors_are_retried(self):
+        self.conn.execute = AsyncMock(side_effect=[OSError("reset"), "INSERT 0 1"])
+        with patch.object(aio_db, "RECONNECT_BACKOFF", 0), self.assertLogs(level="WARNING"):
+            await aio_db.write_unique_vehicle_data_batch([("k1", "VIN1", 1.0, 2.0, 3.0, None)])
+        self.assertEqual(self.conn.execute.await_count, 2)
+
+    async def test_plain_insert_not_retried_once_sent(self):
+        # The batch may have committed before the connection dropped
+        self.conn.execute = AsyncMock(side_effect=[OSError("reset"), "INSERT 0 1"])
+        with patch.object(aio_db, "RECONNECT_BACKOFF", 0), self.assertRaises(aio_db.db.WriteInDoubt):
+            await aio_db.write_vehicle_data_batch([("VIN1", 1.0, 2.0, 3.0, None)])
+        self.assertEqual(self.conn.execute.await_count, 1)
+
+    async def test_iter_vehicle_data_filters_with_placeholders(self):
+        queries = []
+
+        class Cursor:
+            def __init__(self, sql, *params, prefetch):
+                queries.append((sql, params))
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                raise StopAsyncIteration
+
+        self.conn.cursor = Cursor
+        rows = [r async for r in aio_db.iter_vehicle_data(vin="VIN1", since=10.0)]
+
+        self.assertEqual(rows, [])
+        sql, params = queries[0]
+        self.assertIn("vin = $1", sql)
+        self.assertIn("to_timestamp($2)", sql)
+        self.assertEqual(params, ("VIN1", 10.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+from unittest.mock import Mock
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from batch_writer import BatchWriter
+
+
+class TestBatchWriter(unittest.TestCase):
+    
+    def setUp(self):
+        """Collect flushed batches instead of writing to a DB."""
+        self.batches = []
+        self.flushed = threading.Event()
+        
+        def flush(rows):
+            self.batches.append(list(rows))
+            self.flushed.set()
+        
+        self.flush = flush
+    
+    def test_flush_on_size(self):
+        """Test a full batch is flushed as one call."""
+        writer = BatchWriter(self.flush, max_batch=3, max_delay=10)
+        for i in range(3):
+            writer.submit(("VIN", i))
+        writer.start()
+        
+        self.assertTrue(self.flushed.wait(2))
+        writer.stop()
+        self.assertEqual(self.batches[0], [("VIN", 0), ("VIN", 1), ("VIN", 2)])
+    
+    def test_flush_on_time(self):
+        """Test a partial batch is flushed once max_delay elapses."""
+        writer = BatchWriter(self.flush, max_batch=500, max_delay=0.01).start()
+        writer.submit(("VIN", 1))
+        
+        self.assertTrue(self.flushed.wait(2))
+        writer.stop()
+        self.assertEqual(self.batches, [[("VIN", 1)]])
+    
+    def test_stop_drains_queue(self):
+        """Test rows still queued at shutdown are written."""
+        writer = BatchWriter(self.flush, max_batch=2, max_delay=10)
+        for i in range(5):
+            writer.submit(i)
+        writer.start()
+        writer.stop(timeout=2)
+        
+        self.assertEqual(sum(self.batches, []), [0, 1, 2, 3, 4])
+        self.assertEqual(writer.stats()["rows_written"], 5)
+    
+    def test_flush_failure_is_counted(self):
+        """Test a flush failing past its retries is logged and counted without killing the writer."""
+        flush = Mock(side_effect=[RuntimeError("db down"), RuntimeError("db down"), None])
+        writer = BatchWriter(flush, max_batch=1, max_delay=0, max_retries=1, retry_backoff=0).start()
+        writer.submit(1)
+        writer.submit(2)
+        writer.stop(timeout=2)
+        
+        stats = writer.stats()
+        self.assertEqual(stats["rows_failed"], 1)
+        self.assertEqual(stats["rows_written"], 1)
+        self.assertEqual(stats["retries"], 1)
+    
+    def test_failed_batch_is_retried_in_order(self):
+        """Test a batch that fails during a short outage is written again before later rows."""
+        flush = Mock(side_effect=[RuntimeError("db down"), RuntimeError("db down"), None, None])
+        writer = BatchWriter(flush, max_batch=1, max_delay=0, retry_backoff=0).start()
+        writer.submit(1)
+        writer.submit(2)
+        writer.stop(timeout=2)
+        
+        self.assertEqual([c[0][0] for c in flush.call_args_list], [[1], [1], [1], [2]])
+        stats = writer.stats()
+        self.assertEqual(stats["rows_failed"], 0)
+        self.assertEqual(stats["rows_written"], 2)
+        self.assertEqual(stats["retries"], 2)
+    
+    def test_non_retryable_failure_is_not_retried(self):
+        """Test errors rejected by retryable fail the batch at once."""
+        flush = Mock(side_effect=ValueError("may have committed"))
+        writer = BatchWriter(flush, max_batch=1, max_delay=0, retry_backoff=0,
+                             retryable=lambda e: not isinstance(e, ValueError)).start()
+        writer.submit(1)
+        writer.stop(timeout=2)
+        
+        flush.assert_called_once()
+        self.assertEqual(writer.stats()["rows_failed"], 1)
+    
+    def test_stats_report_latency(self):
+        """Test flush latency is recorded."""
+        def slow_flush(rows):
+            time.sleep(0.01)
+        writer = BatchWriter(slow_flush, max_batch=1).start()
+        writer.submit(1)
+        writer.stop(timeout=2)
+        
+        stats = writer.stats()
+        self.assertEqual(stats["flushes"], 1)
+        self.assertGreaterEqual(stats["max_flush_latency"], 0.01)
+        self.assertGreaterEqual(stats["avg_flush_latency"], 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
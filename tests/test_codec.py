@@ -0,0 +1,104 @@
+import unittest
+import sys
+import json
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+import codec
+from codec import Codec, TopicCodecs, decode
+
+
+class TestCodec(unittest.TestCase):
+    
+    def setUp(self):
+        self.location = {"vin": "1HGCM82633A004352", "ts": 1700000000.5, "latitude": 45.5, "longitude": -73.6}
+    
+    def test_plain_json_is_unchanged(self):
+        """Test the JSON codec emits exactly what legacy publishers sent."""
+        self.assertEqual(Codec().encode(self.location), json.dumps(self.location).encode())
+        self.assertEqual(decode(json.dumps(self.location).encode()), self.location)
+    
+    def test_struct_round_trip(self):
+        """Test the fixed layout round-trips values and carries None as NaN."""
+        payload = dict(self.location, longitude=None)
+        data = Codec("struct", layout="location").encode(payload)
+        
+        self.assertEqual(len(data), 2 + 17 + 3 * 8)
+        self.assertEqual(decode(data), payload)
+    
+    def test_struct_refuses_vins_it_cannot_carry(self):
+        """Test VINs other than 17 bytes, missing VINs and extra fields are not packed."""
+        c = Codec("struct", layout="location")
+        for payload in (dict(self.location, vin="VIN123456789012345678"), dict(self.location, vin="VIN1"),
+                        dict(self.location, vin=None), {"ts": 1.0, "latitude": 1.0},
+                        dict(self.location, latitude="45.5")):
+            with self.assertRaises(ValueError):
+                c._pack(payload)
+    
+    def test_struct_falls_back_to_json(self):
+        """Test a payload that does not fit its layout is sent, and decoded, as JSON."""
+        replayed = {"source": "vdt", "id": 7, "vin": "VIN123456", "latitude": 1.0, "longitude": 2.0,
+                    "giro": 3.0, "ts": 4.0}
+        data = Codec("struct", layout="data").encode(replayed)
+        
+        self.assertEqual(data, json.dumps(replayed).encode())
+        self.assertEqual(decode(data), replayed)
+        compressed = Codec("struct", compression="zlib", compress_over=0, layout="data").encode(replayed)
+        self.assertEqual(compressed[0], 0x80 | 1 << 2 | 1)
+        self.assertEqual(decode(compressed), replayed)
+    
+    def test_zlib_only_above_threshold(self):
+        """Test small payloads skip compression and large ones are compressed."""
+        c = Codec("json", compression="zlib", compress_over=100)
+        small = c.encode({"a": 1})
+        large = c.encode({"rows": [self.location] * 50})
+        
+        self.assertEqual(small, b'{"a": 1}')
+        self.assertEqual(large[0], 0x80 | 1 << 2 | 1)
+        self.assertLess(len(large), len(json.dumps({"rows": [self.location] * 50})))
+        self.assertEqual(decode(large)["rows"][0], self.location)
+    
+    @unittest.skipIf(codec.msgpack is None, "msgpack not installed")
+    def test_msgpack_round_trip(self):
+        """Test MessagePack payloads are framed and decoded."""
+        data = Codec("msgpack").encode(self.location)
+        
+        self.assertEqual(data[0], 0x82)
+        self.assertEqual(decode(data), self.location)
+    
+    def test_invalid_options_rejected(self):
+        """Test unknown codecs and layout-less struct codecs fail fast."""
+        with self.assertRaises(ValueError):
+            Codec("yaml")
+        with self.assertRaises(ValueError):
+            Codec("struct")
+        with self.assertRaises(ValueError):
+            decode(b"\x8f\x00")
+
+
+class TestTopicCodecs(unittest.TestCase):
+    
+    def test_selection_by_topic_filter(self):
+        """Test the most specific filter wins and struct layouts follow the topic."""
+        codecs = TopicCodecs({
+            "vehicles/#": {"codec": "struct"},
+            "vehicles/request": {"codec": "json", "compression": "zlib"},
+        })
+        
+        self.assertEqual(codecs.for_topic("vehicles/giro").layout, "giro")
+        self.assertEqual(codecs.for_topic("vehicles/request").compression, "zlib")
+        self.assertEqual(codecs.for_topic("rpc/response/abc").name, "json")
+        # No struct layout for this topic: JSON instead
+        self.assertEqual(codecs.for_topic("vehicles/other").name, "json")
+    
+    def test_encode_decode_by_topic(self):
+        """Test a subscriber decodes whatever codec the publisher picked."""
+        codecs = TopicCodecs({"vehicles/+": {"codec": "struct"}})
+        payload = {"vin": "SIM00000000000001", "ts": 1.0, "giro": 90.0}
+        
+        self.assertEqual(codecs.decode(codecs.encode("vehicles/giro", payload)), payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
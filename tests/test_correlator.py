@@ -0,0 +1,103 @@
+import unittest
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from correlator import Correlator
+
+
+class TestCorrelator(unittest.TestCase):
+    
+    def setUp(self):
+        """Use a controllable clock."""
+        self.now = 1000.0
+        self.correlator = Correlator(window=10, clock=lambda: self.now)
+    
+    def add_all(self, vin, ts=None):
+        for part, payload in (("vin", {}), ("location", {"latitude": 1.0, "longitude": 2.0}), ("giro", {"giro": 3.0})):
+            payload = dict(payload, vin=vin)
+            if ts is not None:
+                payload["ts"] = ts
+            self.correlator.add(part, payload)
+    
+    def test_complete_record(self):
+        """Test a record is complete once every required part arrived."""
+        self.add_all("VIN1")
+        record = self.correlator.pop_complete("VIN1")
+        
+        self.assertEqual(record.row(), ("VIN1", 1.0, 2.0, 3.0, self.now))
+        self.assertNotIn("VIN1", self.correlator.partials)
+        self.assertEqual(self.correlator.stats["completed"], 1)
+    
+    def test_incomplete_record_stays_buffered(self):
+        """Test pop_complete leaves partial records alone."""
+        self.correlator.add("location", {"vin": "VIN1", "latitude": 1.0, "longitude": 2.0})
+        
+        self.assertIsNone(self.correlator.pop_complete("VIN1"))
+        self.assertIn("VIN1", self.correlator.partials)
+    
+    def test_configurable_required_parts(self):
+        """Test completeness follows the configured required parts."""
+        correlator = Correlator(required=("location", "giro"), clock=lambda: self.now)
+        correlator.add("location", {"vin": "VIN1", "latitude": 1.0, "longitude": 2.0})
+        correlator.add("giro", {"vin": "VIN1", "giro": 3.0})
+        
+        self.assertIsNotNone(correlator.pop_complete("VIN1"))
+    
+    def test_row_event_time_is_location_ts(self):
+        """Test the written event time is the location's own timestamp."""
+        self.correlator.add("vin", {"vin": "VIN1", "ts": 995.0})
+        self.correlator.add("location", {"vin": "VIN1", "ts": 998.0, "latitude": 1.0, "longitude": 2.0})
+        self.correlator.add("giro", {"vin": "VIN1", "ts": 999.0, "giro": 3.0})
+        
+        self.assertEqual(self.correlator.pop_complete("VIN1").row()[4], 998.0)
+    
+    def test_record_has_no_instance_dict(self):
+        """Test buffered records are slotted rather than dict-backed."""
+        self.correlator.add("giro", {"vin": "VIN1", "giro": 3.0, "extra": "ignored"})
+        record = self.correlator.partials["VIN1"]
+        
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertTrue(record.has("giro"))
+        self.assertFalse(record.has("vin"))
+    
+    def test_unknown_required_part_rejected(self):
+        """Test unknown parts in the completeness rule are rejected."""
+        with self.assertRaises(ValueError):
+            Correlator(required=("vin", "speed"))
+    
+    def test_legacy_parts_use_last_announced_vin(self):
+        """Test parts without a VIN go to the last VIN seen on the vin topic."""
+        self.assertIsNone(self.correlator.add("giro", {"giro": 3.0}))
+        self.assertEqual(self.correlator.stats["unattributed"], 1)
+        
+        self.correlator.add("vin", {"vin": "VIN1"})
+        self.assertEqual(self.correlator.add("giro", {"giro": 3.0}), "VIN1")
+    
+    def test_out_of_order_part_keeps_newest(self):
+        """Test an older duplicate part does not overwrite a newer one."""
+        self.correlator.add("giro", {"vin": "VIN1", "giro": 2.0, "ts": 1005.0})
+        self.correlator.add("giro", {"vin": "VIN1", "giro": 1.0, "ts": 1003.0})
+        self.correlator.add("giro", {"vin": "VIN1", "giro": 3.0, "ts": 1006.0})
+        
+        self.assertEqual(self.correlator.partials["VIN1"].giro, 3.0)
+        self.assertEqual(self.correlator.stats["late"], 1)
+        self.assertEqual(self.correlator.stats["replaced"], 1)
+    
+    def test_part_outside_window(self):
+        """Test stale records are superseded and late parts dropped."""
+        self.correlator.add("location", {"vin": "VIN1", "latitude": 1.0, "longitude": 2.0, "ts": 1000.0})
+        self.correlator.add("giro", {"vin": "VIN1", "giro": 3.0, "ts": 1020.0})
+        
+        record = self.correlator.partials["VIN1"]
+        self.assertFalse(record.has("location"))
+        self.assertIsNone(record.latitude)
+        self.assertEqual(self.correlator.stats["superseded"], 1)
+        
+        self.assertIsNone(self.correlator.add("location", {"vin": "VIN1", "latitude": 0, "longitude": 0, "ts": 1005.0}))
+        self.assertEqual(self.correlator.stats["late"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from unittest.mock import Mock
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "fleet_digital_twin"))
+
+from dedup import BloomFilter, Deduplicator, RecordFilter, content_key, record_key
+
+
+class TestBloomFilter(unittest.TestCase):
+    
+    def test_no_false_negatives(self):
+        """Test every added key is reported as seen."""
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        keys = [record_key("vdt", i) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+    
+    def test_false_positive_rate_near_target(self):
+        """Test a filter filled to capacity stays close to its error rate."""
+        bloom = BloomFilter.for_capacity(2000, 0.01)
+        for i in range(2000):
+            bloom.add(record_key("vdt", i))
+        false_positives = sum(record_key("other", i) in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+
+
+class TestRecordFilter(unittest.TestCase):
+    
+    def test_memory_stays_within_budget(self):
+        """Test generations rotate instead of growing past max_bytes."""
+        record_filter = RecordFilter(max_bytes=1024, error_rate=0.01)
+        for i in range(record_filter.capacity * 5):
+            record_filter.add(record_key("vdt", i))
+        self.assertGreaterEqual(record_filter.rotations, 4)
+        self.assertLessEqual(record_filter.nbytes, 1024)
+    
+    def test_recent_keys_survive_one_rotation(self):
+        """Test keys of the previous generation are still seen after a rotation."""
+        record_filter = RecordFilter(max_bytes=1024, error_rate=0.01)
+        keys = [record_key("vdt", i) for i in range(record_filter.capacity + 10)]
+        for key in keys:
+            record_filter.add(key)
+        self.assertEqual(record_filter.rotations, 1)
+        self.assertTrue(all(key in record_filter for key in keys))
+
+
+class TestDeduplicator(unittest.TestCase):
+    
+    def row(self, key, vin="VIN1"):
+        return (key, vin, 1.0, 2.0, 3.0, 100.0)
+    
+    def test_drops_seen_keys_before_the_db(self):
+        """Test a replayed batch never reaches the DB once its keys are committed."""
+        write = Mock(side_effect=lambda rows: len(rows))
+        dedup = Deduplicator(write, RecordFilter(max_bytes=4096))
+        batch = [self.row("vdt:1"), self.row("vdt:2"), self.row("vdt:2")]
+        dedup(batch)
+        dedup(batch)
+        
+        write.assert_called_once_with([self.row("vdt:1"), self.row("vdt:2")])
+        self.assertEqual(dedup.stats(), {"checked": 6, "filter_hits": 4, "db_conflicts": 0, "written": 2})
+    
+    def test_counts_duplicates_rejected_by_the_db(self):
+        """Test rows the filter lets through but the DB already holds are counted as conflicts."""
+        dedup = Deduplicator(Mock(return_value=1))
+        dedup([self.row("vdt:1"), self.row("vdt:2")])
+        self.assertEqual(dedup.db_conflicts, 1)
+        self.assertEqual(dedup.written, 1)
+    
+    def test_failed_write_does_not_mark_keys_seen(self):
+        """Test keys of a batch that failed to commit are retried on replay."""
+        write = Mock(side_effect=[RuntimeError("db down"), 1])
+        dedup = Deduplicator(write, RecordFilter(max_bytes=4096))
+        with self.assertRaises(RuntimeError):
+            dedup([self.row("vdt:1")])
+        dedup([self.row("vdt:1")])
+        self.assertEqual(write.call_count, 2)
+    
+    def test_content_key_is_stable(self):
+        """Test rows without an id get the same key for the same content only."""
+        self.assertEqual(content_key("VIN1", 1.0, 2.0, 3.0, 100.0), content_key("VIN1", 1.0, 2.0, 3.0, 100.0))
+        self.assertNotEqual(content_key("VIN1", 1.0, 2.0, 3.0, 100.0), content_key("VIN1", 1.0, 2.0, 3.0, 101.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from correlator import Correlator
+from expiry import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    
+    def test_timers_fire_when_due(self):
+        """Test timers are handed back once their deadline tick has passed."""
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.schedule("a", 2.0)
+        wheel.schedule("b", 5.0)
+        
+        self.assertEqual(list(wheel.advance(1.5)), [])
+        self.assertEqual([k for k, _ in wheel.advance(3.0)], ["a"])
+        self.assertEqual([k for k, _ in wheel.advance(5.0)], ["b"])
+        self.assertEqual(len(wheel), 0)
+    
+    def test_timers_beyond_one_revolution(self):
+        """Test timers longer than the wheel span wait for their own revolution."""
+        wheel = TimerWheel(tick=1.0, slots=4, now=0.0)
+        wheel.schedule("far", 10.0)
+        
+        self.assertEqual(list(wheel.advance(6.0)), [])
+        self.assertEqual([k for k, _ in wheel.advance(10.0)], ["far"])
+    
+    def test_long_pause_visits_every_bucket_once(self):
+        """Test advancing far ahead expires everything that is due."""
+        wheel = TimerWheel(tick=1.0, slots=4, now=0.0)
+        for i in range(4):
+            wheel.schedule(i, i + 1.0)
+        
+        self.assertEqual(sorted(k for k, _ in wheel.advance(100.0)), [0, 1, 2, 3])
+    
+    def test_cancel_and_reschedule_keep_one_timer_per_key(self):
+        """Test cancelled timers leave their bucket and a rescheduled key moves its timer."""
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.schedule("a", 2.0)
+        wheel.schedule("a", 4.0)
+        wheel.schedule("b", 2.0)
+        self.assertEqual(len(wheel), 2)
+        
+        self.assertTrue(wheel.cancel("b"))
+        self.assertFalse(wheel.cancel("b"))
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(list(wheel.advance(3.0)), [])
+        self.assertEqual(list(wheel.advance(4.0)), [("a", 4)])
+        self.assertEqual(sum(len(bucket) for bucket in wheel._wheel), 0)
+    
+    def test_pop_earliest(self):
+        """Test pop_earliest returns the timer due next."""
+        wheel = TimerWheel(tick=1.0, slots=8, now=0.0)
+        wheel.schedule("late", 6.0)
+        wheel.schedule("soon", 2.0)
+        
+        self.assertEqual(wheel.pop_earliest()[0], "soon")
+        self.assertEqual(wheel.pop_earliest()[0], "late")
+        self.assertIsNone(wheel.pop_earliest())
+
+
+class TestCorrelatorExpiry(unittest.TestCase):
+    
+    def setUp(self):
+        """Use a controllable monotonic clock."""
+        self.now = 0.0
+        self.clock = lambda: self.now
+    
+    def test_partial_records_expire_after_ttl(self):
+        """Test incomplete records are dropped once their TTL elapsed."""
+        correlator = Correlator(ttl=10, clock=self.clock, monotonic=self.clock)
+        correlator.add("location", {"vin": "VIN1", "latitude": 1.0, "longitude": 2.0})
+        self.now = 5.0
+        correlator.add("location", {"vin": "VIN2", "latitude": 1.0, "longitude": 2.0})
+        
+        self.assertEqual(correlator.expire(11.0), ["VIN1"])
+        self.assertEqual(list(correlator.partials), ["VIN2"])
+        self.assertEqual(correlator.stats["expired"], 1)
+    
+    def test_completed_record_timer_is_ignored(self):
+        """Test a record re-opened after completion is not expired by the old timer."""
+        correlator = Correlator(required=("location",), ttl=10, clock=self.clock, monotonic=self.clock)
+        correlator.add("location", {"vin": "VIN1", "latitude": 1.0, "longitude": 2.0})
+        correlator.pop_complete("VIN1")
+        self.now = 5.0
+        correlator.add("giro", {"vin": "VIN1", "giro": 1.0})
+        
+        self.assertEqual(correlator.expire(11.0), [])
+        self.assertIn("VIN1", correlator.partials)
+    
+    def test_completed_and_superseded_records_leave_the_wheel(self):
+        """Test the wheel holds timers of buffered records only, however many complete within a TTL."""
+        correlator = Correlator(required=("location",), window=1, ttl=10, clock=self.clock, monotonic=self.clock)
+        for i in range(100):
+            correlator.add("location", {"vin": "VIN%d" % i, "latitude": 1.0, "longitude": 2.0})
+            correlator.pop_complete("VIN%d" % i)
+        correlator.add("giro", {"vin": "VIN1", "giro": 1.0, "ts": 0.0})
+        correlator.add("giro", {"vin": "VIN1", "giro": 1.0, "ts": 5.0})
+        
+        self.assertEqual(correlator.stats["superseded"], 1)
+        self.assertEqual(len(correlator._wheel), len(correlator.partials))
+        self.assertEqual(len(correlator._wheel), 1)
+    
+    def test_cap_evicts_oldest(self):
+        """Test the entry cap evicts the record closest to expiry."""
+        correlator = Correlator(ttl=10, max_entries=2, clock=self.clock, monotonic=self.clock)
+        for i, vin in enumerate(("VIN1", "VIN2", "VIN3")):
+            self.now = float(i)
+            correlator.add("giro", {"vin": vin, "giro": 1.0})
+        
+        self.assertEqual(sorted(correlator.partials), ["VIN2", "VIN3"])
+        self.assertEqual(correlator.stats["evicted"], 1)
+    
+    def test_cap_rejects_new_parts(self):
+        """Test the reject policy drops parts for new VINs when full."""
+        correlator = Correlator(ttl=10, max_entries=1, eviction="reject", clock=self.clock, monotonic=self.clock)
+        correlator.add("giro", {"vin": "VIN1", "giro": 1.0})
+        
+        self.assertIsNone(correlator.add("giro", {"vin": "VIN2", "giro": 1.0}))
+        self.assertEqual(list(correlator.partials), ["VIN1"])
+        self.assertEqual(correlator.stats["rejected"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+from unittest.mock import Mock
+import queue
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "fleet_digital_twin"))
+
+from pipeline import IngestPipeline, StageQueue
+
+
+class TestStageQueue(unittest.TestCase):
+    
+    def test_block_policy_times_out_when_full(self):
+        """Test block policy pushes back instead of dropping."""
+        q = StageQueue(2, "block")
+        q.put(1)
+        q.put(2)
+        with self.assertRaises(queue.Full):
+            q.put(3, timeout=0.01)
+        self.assertEqual([q.get_nowait(), q.get_nowait()], [1, 2])
+    
+    def test_drop_oldest_policy(self):
+        """Test drop_oldest keeps the newest items and counts drops."""
+        q = StageQueue(2, "drop_oldest")
+        for i in range(4):
+            q.put(i)
+        self.assertEqual(q.dropped, 2)
+        self.assertEqual([q.get_nowait(), q.get_nowait()], [2, 3])
+    
+    def test_coalesce_policy_keeps_latest_per_key(self):
+        """Test coalesce replaces queued rows for the same VIN in place."""
+        q = StageQueue(10, "coalesce", key=lambda row: row[0])
+        q.put(("VIN1", 1))
+        q.put(("VIN2", 1))
+        q.put(("VIN1", 2))
+        self.assertEqual(q.qsize(), 2)
+        self.assertEqual(q.coalesced, 1)
+        self.assertEqual([q.get_nowait(), q.get_nowait()], [("VIN1", 2), ("VIN2", 1)])
+    
+    def test_coalesce_requires_key(self):
+        """Test coalesce without a key function is rejected."""
+        with self.assertRaises(ValueError):
+            StageQueue(10, "coalesce")
+    
+    def test_get_times_out_when_empty(self):
+        """Test get raises queue.Empty after the timeout."""
+        with self.assertRaises(queue.Empty):
+            StageQueue(1).get(timeout=0.01)
+
+
+class FakeWriter:
+    """Minimal BatchWriter stand-in recording submitted rows."""
+    
+    def __init__(self):
+        self.row_queue = StageQueue(100)
+        self.rows = []
+        self.start = Mock()
+        self.stop = Mock()
+    
+    def submit(self, row):
+        self.rows.append(row)
+    
+    def qsize(self):
+        return 0
+
+
+class TestIngestPipeline(unittest.TestCase):
+    
+    def test_decoded_rows_reach_writer(self):
+        """Test raw payloads are decoded off the receive thread and written."""
+        writer = FakeWriter()
+        done = threading.Event()
+        
+        def decode(topic, payload):
+            if payload == b"last":
+                done.set()
+            return (topic, payload)
+        
+        pipeline = IngestPipeline(decode, writer, workers=1, report_interval=0).start()
+        pipeline.submit("vehicles/data", b"first")
+        pipeline.submit("vehicles/data", b"last")
+        self.assertTrue(done.wait(2))
+        pipeline.stop(timeout=2)
+        
+        self.assertEqual(writer.rows, [("vehicles/data", b"first"), ("vehicles/data", b"last")])
+        writer.stop.assert_called_once()
+    
+    def test_invalid_messages_are_counted(self):
+        """Test decode errors do not stop the workers."""
+        writer = FakeWriter()
+        
+        def decode(topic, payload):
+            if payload == b"bad":
+                raise ValueError("bad payload")
+            return (payload,)
+        
+        pipeline = IngestPipeline(decode, writer, workers=2, report_interval=0).start()
+        pipeline.submit("t", b"bad")
+        pipeline.submit("t", b"good")
+        pipeline.stop(timeout=2)
+        
+        self.assertEqual(pipeline.stats()["invalid"], 1)
+        self.assertEqual(writer.rows, [(b"good",)])
+    
+    def test_counters_add_up_across_workers(self):
+        """Test concurrent decode workers do not lose counter updates."""
+        writer = FakeWriter()
+        
+        def decode(topic, payload):
+            if payload % 3 == 0:
+                raise ValueError("bad payload")
+            return [(payload,), (payload,)]
+        
+        pipeline = IngestPipeline(decode, writer, workers=4, receive_queue_size=2000,
+                                  report_interval=0).start()
+        for i in range(1500):
+            pipeline.submit("t", i)
+        pipeline.stop(timeout=5)
+        
+        stats = pipeline.stats()
+        self.assertEqual(stats["invalid"], 500)
+        self.assertEqual(stats["decoded"], 2000)
+        self.assertEqual(len(writer.rows), 2000)
+    
+    def test_queue_depths_exposed(self):
+        """Test per-stage queue depths are reported."""
+        writer = FakeWriter()
+        pipeline = IngestPipeline(Mock(), writer, workers=1, report_interval=0)
+        pipeline.submit("t", b"x")
+        
+        self.assertEqual(pipeline.queue_depths(), {"receive": 1, "write": 0})
+    
+    def test_receive_stage_rejects_coalesce(self):
+        """Test coalesce is refused on the keyless receive stage."""
+        with self.assertRaises(ValueError):
+            IngestPipeline(Mock(), FakeWriter(), receive_policy="coalesce")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import unittest
-from unittest.mock import Mock, patch, MagicMock, mock_open
+from unittest.mock import Mock, patch, MagicMock
+import os
 import sys
+import tempfile
 from pathlib import Path
 import json
 
@@ -40,9 +42,12 @@ class TestIntegration(unittest.TestCase):
         
         context = {"broker": "test-broker"}
         
-        with patch('builtins.open', mock_open()):
-            with patch('json.load', return_value=config):
-                instances = load_plugins("test.json", context)
+        # A real file: the import_module patch is importlib's own, which
+        # patch() would also use to resolve a "builtins.open" target
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(config, f)
+        self.addCleanup(os.remove, f.name)
+        instances = load_plugins(f.name, context)
         
         self.assertEqual(len(instances), 1)
         mock_plugin_instance.validate.assert_called_once()
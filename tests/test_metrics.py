@@ -0,0 +1,115 @@
+import unittest
+import sys
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from metrics import Registry, start_http_server
+from listener_base import MqttListenerPlugin
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_with_labels(self):
+        """Test labelled counters keep one value per label combination."""
+        counter = self.registry.counter("msgs_total", "Messages", ("topic",))
+        counter.labels(topic="a").inc()
+        counter.labels(topic="a").inc(2)
+        counter.labels(topic="b").inc()
+
+        text = self.registry.render()
+        self.assertIn("# TYPE msgs_total counter", text)
+        self.assertIn('msgs_total{topic="a"} 3', text)
+        self.assertIn('msgs_total{topic="b"} 1', text)
+
+    def test_registering_twice_returns_same_metric(self):
+        """Test a name registered again returns the existing metric, and a kind clash raises."""
+        first = self.registry.counter("x_total", "X")
+        self.assertIs(self.registry.counter("x_total", "X"), first)
+        with self.assertRaises(ValueError):
+            self.registry.gauge("x_total", "X")
+
+    def test_callback_gauge_read_on_render(self):
+        """Test fn= metrics are evaluated at scrape time, including labelled ones."""
+        buffer = [1, 2]
+        self.registry.gauge("buffered", "Buffered", fn=lambda: len(buffer))
+        self.registry.gauge("depth", "Depth", ("stage",), fn=lambda: {"receive": 4, "write": 0})
+        buffer.append(3)
+
+        text = self.registry.render()
+        self.assertIn("buffered 3", text)
+        self.assertIn('depth{stage="receive"} 4', text)
+        self.assertIn('depth{stage="write"} 0', text)
+
+    def test_callback_replaced_on_reregistration(self):
+        """Test re-registering a callback metric collects from the new callback."""
+        self.registry.gauge("g", "G", fn=lambda: 1)
+        self.registry.gauge("g", "G", fn=lambda: 2)
+        self.assertIn("g 2", self.registry.render())
+
+    def test_histogram_buckets_are_cumulative(self):
+        """Test histogram buckets, sum and count in exposition format."""
+        hist = self.registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            hist.observe(value)
+
+        text = self.registry.render()
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn("latency_seconds_sum 6.05", text)
+        self.assertIn("latency_seconds_count 4", text)
+
+    def test_histogram_time_context(self):
+        """Test time() observes the duration of the block."""
+        hist = self.registry.histogram("op_seconds", "Op")
+        with hist.time():
+            pass
+        self.assertEqual(hist.count, 1)
+
+    def test_label_values_are_escaped(self):
+        """Test quotes and backslashes in label values are escaped."""
+        self.registry.counter("c_total", "C", ("topic",)).labels(topic='a"b\\c').inc()
+        self.assertIn('c_total{topic="a\\"b\\\\c"} 1', self.registry.render())
+
+    def test_failing_callback_does_not_break_scrape(self):
+        """Test a raising callback drops only its own metric."""
+        self.registry.gauge("broken", "Broken", fn=lambda: 1 / 0)
+        self.registry.counter("ok_total", "Ok").inc()
+        with self.assertLogs(level="ERROR"):
+            text = self.registry.render()
+        self.assertIn("ok_total 1", text)
+        self.assertNotIn("broken", text)
+
+    def test_http_endpoint(self):
+        """Test /metrics serves the registry in Prometheus text format."""
+        self.registry.counter("served_total", "Served").inc()
+        server = start_http_server(0, self.registry, host="127.0.0.1")
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as response:
+                self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+                self.assertIn("served_total 1", response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_plugin_metric_without_registry_is_noop(self):
+        """Test plugins can record metrics whether or not the context provides a registry."""
+        plugin = MqttListenerPlugin("p", {}, {})
+        metric = plugin.metric("histogram", "p_seconds", "P", ("plugin",))
+        metric.labels(plugin="p").observe(0.1)
+        with metric.time():
+            pass
+
+        plugin = MqttListenerPlugin("p", {}, {"metrics": self.registry})
+        plugin.metric("counter", "p_total", "P", ("plugin",)).labels(plugin="p").inc()
+        self.assertIn('p_total{plugin="p"} 1', self.registry.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,45 @@
 import unittest
-from unittest.mock import Mock, patch, mock_open, MagicMock
+from unittest.mock import Mock, patch
 import json
+import os
 import sys
+import tempfile
+import threading
+import time
+import types
 from pathlib import Path
 
 # Add parent directory to path
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
-from plugin_manager import load_plugins
+from plugin_manager import load_plugins, PluginManager
+
+
+class FakePlugin:
+    """Records lifecycle calls; config["start_delay"] makes start() slow."""
+    events = []
+    lock = threading.Lock()
+
+    def __init__(self, name, config, context):
+        self.name = name
+        self.config = config
+
+    def validate(self):
+        if self.config.get("invalid"):
+            raise ValueError("invalid config")
+
+    def start(self):
+        with FakePlugin.lock:
+            FakePlugin.events.append(("start", self.name, time.monotonic()))
+        time.sleep(self.config.get("start_delay", 0))
+
+    def stop(self):
+        with FakePlugin.lock:
+            FakePlugin.events.append(("stop", self.name, time.monotonic()))
+
+
+sys.modules['fake_plugins'] = types.ModuleType('fake_plugins')
+sys.modules['fake_plugins'].FakePlugin = FakePlugin
 
 
 class TestPluginManager(unittest.TestCase):
@@ -40,12 +72,23 @@ class TestPluginManager(unittest.TestCase):
             "read_all_vehicle_data": Mock()
         }
     
-    @patch('builtins.open', new_callable=mock_open)
+    def write_config(self, config):
+        """Write config to a temporary listeners file and return its path.
+
+        A real file rather than a patched open(): patching
+        plugin_manager.importlib.import_module replaces importlib.import_module
+        itself, which patch() then uses to resolve "builtins.open".
+        """
+        fd, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f)
+        self.addCleanup(os.remove, path)
+        return path
+    
     @patch('plugin_manager.importlib.import_module')
-    def test_load_plugins_success(self, mock_import, mock_file):
+    def test_load_plugins_success(self, mock_import):
         """Test successful plugin loading."""
-        # Mock file read
-        mock_file.return_value.read.return_value = json.dumps(self.test_config)
+        path = self.write_config(self.test_config)
         
         # Mock plugin class
         mock_plugin_instance = Mock()
@@ -55,33 +98,28 @@ class TestPluginManager(unittest.TestCase):
         mock_import.return_value = mock_module
         
         # Load plugins
-        with patch('json.load', return_value=self.test_config):
-            instances = load_plugins("test_config.json", self.context)
+        instances = load_plugins(path, self.context)
         
         # Assertions
         self.assertEqual(len(instances), 1)
+        mock_import.assert_called_once_with("plugins.rpc_server_plugin")
         mock_plugin_instance.validate.assert_called_once()
         mock_plugin_instance.start.assert_called_once()
     
     def test_load_plugins_empty_config(self):
         """Test loading with empty plugin list."""
-        empty_config = {"plugins": []}
-        
-        with patch('builtins.open', mock_open()):
-            with patch('json.load', return_value=empty_config):
-                instances = load_plugins("empty_config.json", self.context)
+        instances = load_plugins(self.write_config({"plugins": []}), self.context)
         
         self.assertEqual(len(instances), 0)
     
+    # import_module is patched last: patch() resolves "plugin_manager" through it
+    @patch('plugin_manager.importlib.import_module')
     @patch('plugin_manager.logging')
-    @patch('importlib.import_module')
-    def test_load_plugins_handles_exception(self, mock_import, mock_logging):
+    def test_load_plugins_handles_exception(self, mock_logging, mock_import):
         """Test plugin loading handles exceptions gracefully."""
         mock_import.side_effect = ImportError("Module not found")
         
-        with patch('builtins.open', mock_open()):
-            with patch('json.load', return_value=self.test_config):
-                instances = load_plugins("test_config.json", self.context)
+        instances = load_plugins(self.write_config(self.test_config), self.context)
         
         # Should return empty list when plugin fails to load
         self.assertEqual(len(instances), 0)
@@ -90,12 +128,119 @@ class TestPluginManager(unittest.TestCase):
     @patch('plugin_manager.importlib.import_module')
     def test_load_plugins_skips_disabled(self, mock_import):
         """Test that disabled plugins are skipped."""
-        with patch('builtins.open', mock_open()):
-            with patch('json.load', return_value=self.test_config):
-                instances = load_plugins("test_config.json", self.context)
+        instances = load_plugins(self.write_config(self.test_config), self.context)
         
-        # Only one plugin is enabled
+        # Only one plugin is enabled, and the disabled one is never imported
         self.assertEqual(len(instances), 1)
+        mock_import.assert_called_once_with("plugins.rpc_server_plugin")
+
+
+class TestPluginManagerReload(unittest.TestCase):
+
+    def setUp(self):
+        FakePlugin.events = []
+        fd, self.path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def write(self, *plugins):
+        with open(self.path, "w") as f:
+            json.dump({"plugins": [dict({"module": "fake_plugins", "class": "FakePlugin", "enabled": True}, **p)
+                                   for p in plugins]}, f)
+
+    def names(self, kind):
+        return [name for event, name, _ in FakePlugin.events if event == kind]
+
+    def test_plugins_start_in_parallel_and_report_startup_time(self):
+        """Test independent plugins start concurrently and their startup times are recorded."""
+        self.write({"name": "a", "config": {"start_delay": 0.2}}, {"name": "b", "config": {"start_delay": 0.2}})
+        manager = PluginManager(self.path, {})
+        start = time.monotonic()
+        instances = manager.load()
+
+        self.assertLess(time.monotonic() - start, 0.35)
+        self.assertEqual([i.name for i in instances], ["a", "b"])
+        self.assertGreaterEqual(manager.startup_times["a"], 0.2)
+
+    def test_depends_on_orders_startup(self):
+        """Test a plugin starts only after the plugins it depends on."""
+        self.write({"name": "dependent", "depends_on": ["base"]}, {"name": "base", "config": {"start_delay": 0.1}})
+        PluginManager(self.path, {}).load()
+        self.assertEqual(self.names("start"), ["base", "dependent"])
+
+    def test_missing_dependency_is_not_started(self):
+        """Test a plugin whose dependency is absent or failed is skipped."""
+        self.write({"name": "a", "depends_on": ["nope"]}, {"name": "b", "config": {"invalid": True}},
+                   {"name": "c", "depends_on": ["b"]})
+        with self.assertLogs(level="ERROR"):
+            instances = PluginManager(self.path, {}).load()
+        self.assertEqual(instances, [])
+
+    def test_reload_applies_only_the_diff(self):
+        """Test reload starts added, stops removed and restarts reconfigured plugins only."""
+        self.write({"name": "keep"}, {"name": "change", "config": {"x": 1}}, {"name": "remove"})
+        manager = PluginManager(self.path, {})
+        manager.load()
+        keep = manager.running["keep"]
+        FakePlugin.events = []
+
+        self.write({"name": "keep"}, {"name": "change", "config": {"x": 2}}, {"name": "add"})
+        manager.reload()
+
+        self.assertEqual(sorted(self.names("stop")), ["change", "remove"])
+        self.assertEqual(sorted(self.names("start")), ["add", "change"])
+        self.assertIs(manager.running["keep"], keep)
+        self.assertEqual(manager.running["change"].config, {"x": 2})
+        self.assertEqual([i.name for i in manager.instances], ["keep", "change", "add"])
+
+    def test_reload_restarts_dependents(self):
+        """Test a reconfigured plugin's running dependents restart with it."""
+        self.write({"name": "base", "config": {"x": 1}}, {"name": "dependent", "depends_on": ["base"]})
+        manager = PluginManager(self.path, {})
+        manager.load()
+        FakePlugin.events = []
+
+        self.write({"name": "base", "config": {"x": 2}}, {"name": "dependent", "depends_on": ["base"]})
+        manager.reload()
+        self.assertEqual(self.names("stop"), ["dependent", "base"])
+        self.assertEqual(self.names("start"), ["base", "dependent"])
+
+    def test_invalid_config_keeps_running_plugins(self):
+        """Test an unparsable config is ignored on reload."""
+        self.write({"name": "a"})
+        manager = PluginManager(self.path, {})
+        manager.load()
+        with open(self.path, "w") as f:
+            f.write("{not json")
+        with self.assertLogs(level="ERROR"):
+            manager.reload()
+        self.assertIn("a", manager.running)
+        self.assertEqual(self.names("stop"), [])
+
+    def test_watch_reloads_on_change(self):
+        """Test the watcher picks up a modified config file."""
+        self.write({"name": "a"})
+        manager = PluginManager(self.path, {})
+        manager.load()
+        manager.watch(interval=0.05)
+        self.addCleanup(manager.stop_all)
+        self.write({"name": "a"}, {"name": "b"})
+        os.utime(self.path, (time.time() + 5, time.time() + 5))
+
+        deadline = time.monotonic() + 2
+        while "b" not in manager.running and time.monotonic() < deadline:
+            time.sleep(0.02)
+        self.assertIn("b", manager.running)
+
+    def test_router_started_after_plugins(self):
+        """Test the shared router connects once the initial plugins have started."""
+        self.write({"name": "a"})
+        router = Mock()
+        router.start.side_effect = lambda: self.assertEqual(self.names("start"), ["a"])
+        context = {}
+        PluginManager(self.path, context, router=router).load()
+        router.start.assert_called_once()
+        self.assertIs(context["router"], router)
 
 
 if __name__ == '__main__':
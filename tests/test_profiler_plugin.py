@@ -0,0 +1,165 @@
+import unittest
+from unittest.mock import Mock, patch, MagicMock
+import sys
+import json
+import tempfile
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Mock dependencies
+sys.modules['paho'] = MagicMock()
+sys.modules['paho.mqtt'] = MagicMock()
+sys.modules['paho.mqtt.client'] = MagicMock()
+
+from plugins.profiler_plugin import ProfilerPlugin, StackSampler, format_report
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(i * i for i in range(1000))
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def test_samples_other_threads(self):
+        """Test a busy thread shows up in the cumulative top functions."""
+        stop = threading.Event()
+        worker = threading.Thread(target=busy_loop, args=(stop,), name="busy", daemon=True)
+        worker.start()
+        try:
+            sampler = StackSampler(interval=0.001)
+            sampler.run(threading.Event(), time.monotonic() + 0.2)
+        finally:
+            stop.set()
+            worker.join()
+
+        report = sampler.report(top=50)
+        self.assertGreater(report["samples"], 0)
+        self.assertIn("busy", report["threads"])
+        self.assertIn("busy_loop", [row["function"] for row in report["top_cumulative"]])
+
+    def test_stop_event_ends_run(self):
+        """Test run() returns as soon as the stop event is set."""
+        stop = threading.Event()
+        stop.set()
+        start = time.monotonic()
+        StackSampler().run(stop, time.monotonic() + 10)
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class TestProfilerPlugin(unittest.TestCase):
+
+    def setUp(self):
+        """Set up test fixtures."""
+        self.output_dir = tempfile.mkdtemp()
+        self.config = {
+            "control_topic": "control/profile/test",
+            "reply_topic_prefix": "control/profile/reply/",
+            "output_dir": self.output_dir,
+            "max_duration": 5,
+            "sample_interval": 0.001,
+        }
+        self.context = {"broker": "test-broker"}
+        self.plugin = ProfilerPlugin("profiler", self.config, self.context)
+
+    def test_validate_missing_control_topic(self):
+        """Test validation fails without control_topic."""
+        with self.assertRaises(ValueError) as cm:
+            ProfilerPlugin("p", {"reply_topic_prefix": "r/"}, self.context).validate()
+        self.assertIn("control_topic", str(cm.exception))
+
+    def start_handler(self, plugin):
+        """Start the plugin on a mock shared router and return a client and the routed handler."""
+        router = Mock()
+        plugin.context = dict(plugin.context, router=router)
+        plugin.start()
+        return Mock(), router.subscribe.call_args[0][1]
+
+    def command(self, payload):
+        msg = Mock()
+        msg.payload.decode.return_value = json.dumps(payload)
+        return msg
+
+    def wait_for_reply(self, client, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not client.publish.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        topic, payload = client.publish.call_args[0]
+        return topic, json.loads(payload)
+
+    def test_cpu_profile_published_and_written(self):
+        """Test a bounded CPU profile is published on the reply topic and written to disk."""
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.command({"command": "start", "kind": "cpu", "duration": 0.1, "id": "p1"}))
+
+        topic, report = self.wait_for_reply(client)
+        self.assertEqual(topic, "control/profile/reply/p1")
+        self.assertEqual(report["id"], "p1")
+        self.assertGreater(report["cpu"]["samples"], 0)
+        self.assertTrue(report["cpu"]["top_self"])
+        self.assertTrue(Path(report["path"]).read_text().startswith("profile p1 (cpu)"))
+
+    def test_memory_profile_reports_allocation_sites(self):
+        """Test a memory profile reports allocation sites and stops tracemalloc afterwards."""
+        was_tracing = tracemalloc.is_tracing()
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.command({"kind": "memory", "duration": 0.05, "id": "m1"}))
+
+        _, report = self.wait_for_reply(client)
+        self.assertIn("top_growth", report["memory"])
+        self.assertIn("top_size", report["memory"])
+        self.assertNotIn("cpu", report)
+        self.plugin._session.join(1)
+        self.assertEqual(tracemalloc.is_tracing(), was_tracing)
+
+    def test_stop_ends_profile_early(self):
+        """Test a stop command ends a running profile before its duration."""
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.command({"kind": "cpu", "duration": 5, "id": "s1"}))
+        on_message(client, None, self.command({"command": "stop"}))
+
+        _, report = self.wait_for_reply(client, timeout=2)
+        self.assertLess(report["duration"], 2)
+
+    def test_second_profile_rejected_while_running(self):
+        """Test only one profile runs at a time."""
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.command({"kind": "cpu", "duration": 5, "id": "a"}))
+        on_message(client, None, self.command({"kind": "cpu", "duration": 5, "id": "b"}))
+
+        topic, payload = client.publish.call_args[0]
+        self.assertEqual(topic, "control/profile/reply/b")
+        self.assertIn("already running", json.loads(payload)["error"])
+        self.plugin.stop()
+        self.plugin._session.join(2)
+
+    def test_unknown_kind_rejected(self):
+        """Test an unknown profile kind is answered with an error."""
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.command({"kind": "gpu", "id": "x"}))
+
+        payload = json.loads(client.publish.call_args[0][1])
+        self.assertIn("unknown kind", payload["error"])
+
+    def test_format_report(self):
+        """Test the text report lists CPU and memory sections."""
+        report = {
+            "id": "r", "kind": "both", "started_at": "now", "duration": 1.0,
+            "cpu": {"samples": 1, "interval": 0.005, "threads": {"main": 1},
+                    "top_self": [{"function": "f", "file": "x.py", "line": 1, "samples": 1, "percent": 100.0}],
+                    "top_cumulative": []},
+            "memory": {"traced_bytes": 10, "peak_bytes": 20,
+                       "top_growth": [{"site": "x.py:2", "size_diff": 5, "count_diff": 1}],
+                       "top_size": [{"site": "x.py:2", "size": 10, "count": 1}]},
+        }
+        text = format_report(report)
+        self.assertIn("100.00%", text)
+        self.assertIn("x.py:2", text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+# Mock psycopg2 before importing db (imported by rollups)
+sys.modules['psycopg2'] = MagicMock()
+
+import rollups
+from batch_writer import BatchWriter
+from rollups import RollupAggregator, choose_tier, haversine, table_name
+
+
+class TestRollupAggregator(unittest.TestCase):
+    
+    def setUp(self):
+        self.aggregator = RollupAggregator(clock=lambda: 7200.0)
+    
+    def by_key(self, aggregates, tier):
+        return {(r[0], r[1]): r[2:] for r in aggregates[table_name(tier)]}
+    
+    def test_buckets_per_tier(self):
+        """Test rows are folded into the bucket of each tier they fall in."""
+        aggregates = self.aggregator.aggregate([
+            ("VIN1", 45.0, -73.0, 10.0, 3600.0),
+            ("VIN1", 45.1, -73.2, 30.0, 3630.0),
+            ("VIN1", 45.2, -73.1, 20.0, 3700.0),
+            ("VIN2", 46.0, -74.0, 90.0, 3610.0),
+        ])
+        
+        minutes = self.by_key(aggregates, "1m")
+        self.assertEqual(set(minutes), {("VIN1", 3600), ("VIN1", 3660), ("VIN2", 3600)})
+        samples, giro_count, giro_sum, giro_min, giro_max, lat_min, lat_max, lon_min, lon_max, _ = minutes[("VIN1", 3600)]
+        self.assertEqual((samples, giro_count, giro_sum, giro_min, giro_max), (2, 2, 40.0, 10.0, 30.0))
+        self.assertEqual((lat_min, lat_max, lon_min, lon_max), (45.0, 45.1, -73.2, -73.0))
+        
+        hours = self.by_key(aggregates, "1h")
+        self.assertEqual(hours[("VIN1", 3600)][:3], (3, 3, 60.0))
+        self.assertEqual(set(self.by_key(aggregates, "1d")), {("VIN1", 0), ("VIN2", 0)})
+    
+    def test_distance_follows_event_time_across_batches(self):
+        """Test legs are summed in event-time order, including the leg from the previous batch."""
+        first = self.aggregator.aggregate([("VIN1", 45.0, -73.0, 0.0, 100.0)])
+        self.aggregator.commit()
+        self.assertEqual(self.by_key(first, "1d")[("VIN1", 0)][-1], 0.0)
+        
+        second = self.aggregator.aggregate([
+            ("VIN1", 45.2, -73.0, 0.0, 300.0),
+            ("VIN1", 45.1, -73.0, 0.0, 200.0),
+        ])
+        
+        expected = haversine(45.0, -73.0, 45.1, -73.0) + haversine(45.1, -73.0, 45.2, -73.0)
+        self.assertAlmostEqual(self.by_key(second, "1d")[("VIN1", 0)][-1], expected)
+    
+    def test_late_row_adds_no_distance(self):
+        """Test a row older than the VIN's last position is counted but travels nowhere."""
+        self.aggregator.aggregate([("VIN1", 45.0, -73.0, 0.0, 500.0)])
+        self.aggregator.commit()
+        late = self.aggregator.aggregate([("VIN1", 46.0, -73.0, 0.0, 400.0)])
+        
+        row = self.by_key(late, "1d")[("VIN1", 0)]
+        self.assertEqual((row[0], row[-1]), (1, 0.0))
+    
+    def test_retried_batch_keeps_its_distance(self):
+        """Test a flush retried after a failed write measures its legs from the last written position."""
+        self.aggregator.aggregate([("VIN1", 45.0, -73.0, 0.0, 100.0)])
+        self.aggregator.commit()
+        writes = []
+        
+        def write(rows, aggregates):
+            writes.append(self.by_key(aggregates, "1d")[("VIN1", 0)][-1])
+            if len(writes) == 1:
+                raise RuntimeError("connection lost")
+        
+        def flush(rows):
+            write(rows, self.aggregator.aggregate(rows))
+            self.aggregator.commit()
+        
+        writer = BatchWriter(flush, retry_backoff=0)
+        with self.assertLogs(level="WARNING"):
+            writer._write([("VIN1", 45.1, -73.0, 0.0, 200.0)])
+        
+        expected = haversine(45.0, -73.0, 45.1, -73.0)
+        self.assertEqual(len(writes), 2)
+        self.assertAlmostEqual(writes[1], expected)
+        self.assertEqual(writer.retries, 1)
+    
+    def test_dropped_batch_leaves_positions_unchanged(self):
+        """Test a batch that was never written does not move the VIN's last position."""
+        self.aggregator.aggregate([("VIN1", 45.0, -73.0, 0.0, 100.0)])
+        self.aggregator.commit()
+        self.aggregator.aggregate([("VIN1", 45.1, -73.0, 0.0, 200.0)])
+        retry = self.aggregator.aggregate([("VIN1", 45.2, -73.0, 0.0, 300.0)])
+        
+        expected = haversine(45.0, -73.0, 45.2, -73.0)
+        self.assertAlmostEqual(self.by_key(retry, "1d")[("VIN1", 0)][-1], expected)
+    
+    def test_missing_event_time_uses_clock(self):
+        """Test rows without event time are bucketed at the current time."""
+        aggregates = self.aggregator.aggregate([("VIN1", None, None, 5.0)])
+        
+        self.assertEqual(list(self.by_key(aggregates, "1h")), [("VIN1", 7200)])
+
+
+class TestTierRouting(unittest.TestCase):
+    
+    def test_coarsest_aligned_tier(self):
+        """Test queries use the coarsest tier whose buckets answer them exactly."""
+        day = 86400
+        self.assertEqual(choose_tier(0, 30 * day, day), ("1d", day))
+        self.assertEqual(choose_tier(0, 30 * day, 3600), ("1h", 3600))
+        self.assertEqual(choose_tier(1800, 30 * day, 3600), ("1m", 60))
+        self.assertEqual(choose_tier(0, 3600), ("1h", 3600))
+        self.assertIsNone(choose_tier(30, 3600))
+    
+    @patch('rollups.db.read_rollups', return_value=[])
+    def test_query_history_skips_pruned_tiers(self, mock_read):
+        """Test a range older than the 1m retention is served from hourly buckets."""
+        now = 100 * 86400
+        rollups.query_history(now - 30 * 86400 + 90, now, 3600, now=now)
+        
+        table, since, until, resolution, vin = mock_read.call_args[0]
+        self.assertEqual(table, "vehicle_rollup_1h")
+        self.assertEqual((since % 3600, until, resolution), (0, now, 3600))
+    
+    @patch('rollups.db.read_rollups', return_value=[])
+    def test_query_history_widens_unaligned_bounds(self, mock_read):
+        """Test bounds that are not whole minutes are widened to the enclosing minutes."""
+        now = 100 * 86400
+        rollups.query_history(now - 125, now - 5, now=now)
+        
+        table, since, until, resolution, vin = mock_read.call_args[0]
+        self.assertEqual((table, since, until, resolution), ("vehicle_rollup_1m", now - 180, now, 180))
+
+
+if __name__ == '__main__':
+    unittest.main()
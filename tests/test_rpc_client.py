@@ -0,0 +1,150 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+import unittest
+from concurrent.futures import CancelledError
+from pathlib import Path
+from unittest.mock import MagicMock, Mock
+
+# Mock dependencies
+sys.modules['paho'] = MagicMock()
+sys.modules['paho.mqtt'] = MagicMock()
+sys.modules['paho.mqtt.client'] = MagicMock()
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "rpc_producer"))
+
+import rpc_client
+from rpc_client import RpcClient, RpcError
+
+
+def response(topic, payload):
+    return Mock(topic=topic, payload=json.dumps(payload).encode())
+
+
+class TestRpcClient(unittest.TestCase):
+
+    def setUp(self):
+        rpc_client.mqtt.Client.reset_mock()
+        self.rpc = RpcClient("test-broker", client_id="c1")
+        self.mqtt = self.rpc._client
+        self.mqtt.publish.return_value.rc = rpc_client.mqtt.MQTT_ERR_SUCCESS
+        # The broker acknowledges the response subscription once connected
+        self.mqtt.loop_start.side_effect = lambda: (self.rpc._on_connect(self.mqtt, None, {}, 0),
+                                                    self.rpc._on_subscribe(self.mqtt, None, 1, (0,)))
+        self.rpc.start()
+
+    def tearDown(self):
+        self.rpc.close()
+
+    def requests(self):
+        return [json.loads(c.args[1]) for c in self.mqtt.publish.call_args_list]
+
+    def reply(self, payload):
+        self.rpc._on_message(self.mqtt, None, response(f"rpc/response/{payload['correlation_id']}", payload))
+
+    def test_one_wildcard_subscription_for_all_calls(self):
+        self.rpc.call()
+        self.rpc.call()
+        self.mqtt.subscribe.assert_called_once_with("rpc/response/c1/+")
+        self.mqtt.connect.assert_called_once()
+
+    def test_concurrent_calls_resolved_by_correlation_id(self):
+        futures = [self.rpc.call({"vin": f"VIN{i}"}, method="latest") for i in range(3)]
+        requests = self.requests()
+        self.assertEqual(len({r["correlation_id"] for r in requests}), 3)
+        self.assertTrue(all(r["correlation_id"].startswith("c1/") for r in requests))
+        self.assertEqual(requests[0]["method"], "latest")
+
+        # Responses arrive out of order
+        for request in reversed(requests):
+            self.reply({"correlation_id": request["correlation_id"], "result": [request["params"]["vin"]]})
+
+        self.assertEqual([f.result(timeout=1)["result"] for f in futures], [["VIN0"], ["VIN1"], ["VIN2"]])
+        self.assertEqual(self.rpc.in_flight(), 0)
+
+    def test_server_error_fails_future(self):
+        future = self.rpc.call()
+        self.reply({"correlation_id": self.requests()[0]["correlation_id"], "error": "db down"})
+        with self.assertRaises(RpcError):
+            future.result(timeout=1)
+
+    def test_timeout_fails_future_and_drops_call(self):
+        slow = self.rpc.call(timeout=5)
+        fast = self.rpc.call(timeout=0.05)
+        with self.assertRaises(TimeoutError):
+            fast.result(timeout=1)
+        self.assertEqual(self.rpc.in_flight(), 1)
+        self.assertFalse(slow.done())
+
+        # A response after the timeout is discarded
+        self.reply({"correlation_id": self.requests()[1]["correlation_id"], "result": []})
+        self.assertEqual(self.rpc.late_responses, 1)
+        self.assertEqual(self.rpc.timeouts, 1)
+
+    def test_cancelled_call_is_forgotten(self):
+        future = self.rpc.call()
+        self.assertTrue(future.cancel())
+        self.assertEqual(self.rpc.in_flight(), 0)
+        self.reply({"correlation_id": self.requests()[0]["correlation_id"], "result": []})
+        with self.assertRaises(CancelledError):
+            future.result()
+
+    def test_failed_publish_fails_future(self):
+        self.mqtt.publish.return_value.rc = 4
+        future = self.rpc.call()
+        with self.assertRaises(ConnectionError):
+            future.result(timeout=1)
+        self.assertEqual(self.rpc.in_flight(), 0)
+
+    def test_close_fails_calls_in_flight(self):
+        future = self.rpc.call()
+        self.rpc.close()
+        with self.assertRaises(ConnectionError):
+            future.result(timeout=1)
+        with self.assertRaises(ConnectionError):
+            self.rpc.call()
+
+    def test_acall_awaitable(self):
+        async def main():
+            task = self.rpc.acall({"vin": "VIN1"})
+            self.reply({"correlation_id": self.requests()[0]["correlation_id"], "result": [1]})
+            return await task
+
+        self.assertEqual(asyncio.run(main())["result"], [1])
+
+    def test_stream_yields_rows_in_seq_order(self):
+        def serve():
+            # Wait for the request, then send chunks out of order
+            while not self.mqtt.publish.call_args_list:
+                time.sleep(0.001)
+            corr = self.requests()[0]["correlation_id"]
+            self.reply({"correlation_id": corr, "seq": 1, "rows": [3, 4]})
+            self.reply({"correlation_id": corr, "seq": 0, "rows": [1, 2]})
+            self.reply({"correlation_id": corr, "seq": 2, "end": True, "count": 4})
+
+        threading.Thread(target=serve).start()
+        self.assertEqual(list(self.rpc.stream(chunk_size=2, timeout=1)), [1, 2, 3, 4])
+        self.assertTrue(self.requests()[0]["stream"])
+        self.assertEqual(self.rpc.in_flight(), 0)
+
+    def test_stream_timeout(self):
+        with self.assertRaises(TimeoutError):
+            list(self.rpc.stream(timeout=0.05))
+        self.assertEqual(self.rpc.in_flight(), 0)
+
+    def test_stream_refused_raises_rpc_error(self):
+        def serve():
+            while not self.mqtt.publish.call_args_list:
+                time.sleep(0.001)
+            self.reply({"correlation_id": self.requests()[0]["correlation_id"], "error": "server busy"})
+
+        threading.Thread(target=serve).start()
+        with self.assertRaisesRegex(RpcError, "server busy"):
+            list(self.rpc.stream(timeout=1))
+        self.assertEqual(self.rpc.in_flight(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
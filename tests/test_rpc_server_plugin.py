@@ -3,6 +3,7 @@ from unittest.mock import Mock, patch, MagicMock
 import sys
 from pathlib import Path
 import json
+import threading
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
@@ -11,7 +12,12 @@ sys.modules['paho'] = MagicMock()
 sys.modules['paho.mqtt'] = MagicMock()
 sys.modules['paho.mqtt.client'] = MagicMock()
 
-from plugins.rpc_server_plugin import RpcServerPlugin
+from plugins.rpc_server_plugin import ResultCache, RpcServerPlugin, SingleFlight
+
+# Wire codecs ship with the twin; appended so the root plugins stay first on the path
+sys.path.append(str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+from codec import TopicCodecs, decode
+from metrics import Registry
 
 
 class TestRpcServerPlugin(unittest.TestCase):
@@ -58,8 +64,8 @@ class TestRpcServerPlugin(unittest.TestCase):
             plugin.validate()
         self.assertIn("response_topic_prefix", str(cm.exception))
     
-    @patch('plugins.rpc_server_plugin.threading.Thread')
-    @patch('plugins.rpc_server_plugin.mqtt.Client')
+    @patch('listener_base.threading.Thread')
+    @patch('paho.mqtt.client.Client')
     def test_start(self, mock_mqtt_client, mock_thread):
         """Test plugin start."""
         mock_client_instance = Mock()
@@ -73,6 +79,366 @@ class TestRpcServerPlugin(unittest.TestCase):
         mock_thread.assert_called_once()
         mock_thread_instance.start.assert_called_once()
     
+    def test_start_subscribes_through_shared_router(self):
+        """Test the plugin subscribes on the context's shared connection instead of opening its own."""
+        router = Mock()
+        self.plugin.context = dict(self.context, router=router)
+        with patch('listener_base.threading.Thread') as mock_thread:
+            self.plugin.start()
+        
+        mock_thread.assert_not_called()
+        router.subscribe.assert_called_once()
+        self.assertEqual(router.subscribe.call_args[0][0], "rpc/request/test")
+        
+        self.plugin.stop()
+        router.unsubscribe.assert_called_once_with("rpc/request/test", router.subscribe.call_args[0][1])
+    
+    def start_handler(self, plugin):
+        """Start the plugin on a mock shared router and return a client and the routed handler."""
+        router = Mock()
+        plugin.context = dict(plugin.context, router=router)
+        plugin.start()
+        return Mock(), router.subscribe.call_args[0][1]
+    
+    def rpc_message(self, payload):
+        msg = Mock()
+        msg.payload.decode.return_value = json.dumps(payload)
+        return msg
+    
+    def test_rpc_response_from_iterator(self):
+        """Test the RPC result is encoded straight from iter_vehicle_data."""
+        context = dict(self.context, iter_vehicle_data=Mock(return_value=iter([
+            ("VIN1", 1.0, 2.0, 3.0), ("VIN2", 4.0, 5.0, 6.0)
+        ])))
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        on_message(client, None, self.rpc_message({"correlation_id": "abc", "params": {}}))
+        
+        topic, payload = client.publish.call_args[0]
+        self.assertEqual(topic, "rpc/response/abc")
+        self.assertEqual(json.loads(payload), {
+            "correlation_id": "abc",
+            "result": [
+                {"vin": "VIN1", "latitude": 1.0, "longitude": 2.0, "giro": 3.0},
+                {"vin": "VIN2", "latitude": 4.0, "longitude": 5.0, "giro": 6.0},
+            ]
+        })
+        self.context["read_all_vehicle_data"].assert_not_called()
+    
+    def test_rpc_stream_mode_publishes_chunks(self):
+        """Test stream requests are answered with ordered chunks and an end marker."""
+        rows = [("VIN%d" % i, float(i), float(i), float(i)) for i in range(5)]
+        context = dict(self.context, iter_vehicle_data=Mock(return_value=iter(rows)))
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        on_message(client, None, self.rpc_message({"correlation_id": "abc", "stream": True, "chunk_size": 2}))
+        
+        messages = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        self.assertEqual([m["seq"] for m in messages], [0, 1, 2, 3])
+        self.assertEqual([len(m.get("rows", [])) for m in messages], [2, 2, 1, 0])
+        self.assertEqual(messages[-1], {"correlation_id": "abc", "seq": 3, "end": True, "count": 5})
+        self.assertEqual(messages[0]["rows"][0]["vin"], "VIN0")
+    
+    def test_rpc_stream_waits_for_chunks_in_flight(self):
+        """Test a stream stops reading rows while max_inflight_chunks chunks are still unsent."""
+        events = []
+
+        def rows():
+            for i in range(3):
+                events.append(("read", i))
+                yield ("VIN%d" % i, float(i), float(i), float(i))
+
+        def publish(topic, payload):
+            seq = json.loads(payload)["seq"]
+            events.append(("publish", seq))
+            return Mock(wait_for_publish=Mock(side_effect=lambda timeout: events.append(("sent", seq))))
+
+        client = Mock()
+        client.publish.side_effect = publish
+        config = dict(self.config, executor_workers=1, max_inflight_chunks=2)
+        context = dict(self.context, iter_vehicle_data=Mock(return_value=rows()))
+        plugin = RpcServerPlugin("rpc", config, context)
+        _, on_message = self.start_handler(plugin)
+        with patch.object(plugin, "_executor") as executor:
+            # Run the handler inline instead of on the plugin's worker thread
+            executor.submit.side_effect = lambda fn, *args: fn(*args)
+            on_message(client, None, self.rpc_message({"correlation_id": "abc", "stream": True, "chunk_size": 1}))
+        plugin.stop()
+
+        self.assertEqual(events, [
+            ("read", 0), ("publish", 0), ("read", 1), ("publish", 1), ("sent", 0),
+            ("read", 2), ("publish", 2), ("sent", 1),
+            # All chunks are out before the end marker
+            ("sent", 2), ("publish", 3),
+        ])
+
+    def test_rpc_stream_mode_reports_error(self):
+        """Test a failing streamed read ends the stream with an error marker."""
+        self.context["read_all_vehicle_data"].side_effect = RuntimeError("db down")
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.rpc_message({"correlation_id": "abc", "stream": True}))
+        
+        end = json.loads(client.publish.call_args[0][1])
+        self.assertEqual(end, {"correlation_id": "abc", "seq": 0, "end": True, "error": "db down"})
+    
+    def test_rpc_latest_served_from_state_store(self):
+        """Test "latest" requests are answered from the in-memory state store."""
+        latest_state = Mock()
+        latest_state.get.return_value = ("VIN1", 1.0, 2.0, 3.0)
+        context = dict(self.context, latest_state=latest_state)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        on_message(client, None, self.rpc_message({
+            "correlation_id": "abc", "method": "latest", "params": {"vin": "VIN1"}
+        }))
+        
+        payload = json.loads(client.publish.call_args[0][1])
+        self.assertEqual(payload["result"], [{"vin": "VIN1", "latitude": 1.0, "longitude": 2.0, "giro": 3.0}])
+        latest_state.get.assert_called_once_with("VIN1")
+        self.context["read_all_vehicle_data"].assert_not_called()
+    
+    def test_rpc_response_uses_topic_codec(self):
+        """Test responses are encoded with the codec configured for the response topic."""
+        codecs = TopicCodecs({"rpc/response/#": {"codec": "json", "compression": "zlib", "compress_over": 0}})
+        context = dict(self.context, codecs=codecs)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        msg = Mock()
+        msg.payload = json.dumps({"correlation_id": "abc"}).encode()
+        on_message(client, None, msg)
+        
+        payload = client.publish.call_args[0][1]
+        self.assertEqual(payload[0], 0x85)
+        self.assertEqual(decode(payload)["result"][0]["vin"], "VIN123")
+    
+    def test_rpc_read_error_is_returned(self):
+        """Test read failures are reported to the caller."""
+        self.context["read_all_vehicle_data"].side_effect = RuntimeError("db down")
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.rpc_message({"correlation_id": "abc"}))
+        
+        payload = json.loads(client.publish.call_args[0][1])
+        self.assertEqual(payload, {"correlation_id": "abc", "error": "db down"})
+    
+    def test_read_params_whitelisted(self):
+        """Test only vin/since/until reach the reader, by name, and anything else is rejected."""
+        context = dict(self.context, iter_vehicle_data=Mock(return_value=iter([])))
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        on_message(client, None, self.rpc_message({"correlation_id": "a", "params": {"vin": "VIN1", "since": 10}}))
+        context["iter_vehicle_data"].assert_called_once_with(vin="VIN1", since=10.0)
+        
+        for params, error in (({"itersize": 10 ** 9}, "unknown params: itersize"),
+                              ({"since": "yesterday"}, "since must be epoch seconds"),
+                              ({"vin": ["VIN1"]}, "vin must be a string"),
+                              ([1], "params must be an object")):
+            for stream in (False, True):
+                on_message(client, None, self.rpc_message({"correlation_id": "b", "stream": stream, "params": params}))
+                self.assertEqual(json.loads(client.publish.call_args[0][1]), {"correlation_id": "b", "error": error})
+        context["iter_vehicle_data"].assert_called_once()
+    
+    def test_malformed_requests_answered_or_dropped(self):
+        """Test non-object payloads are dropped and non-object params rejected, also for "latest"."""
+        latest_state = Mock()
+        registry = Registry()
+        context = dict(self.context, latest_state=latest_state, metrics=registry)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        for payload in (7, ["abc"], "abc"):
+            with self.assertLogs(level="ERROR"):
+                on_message(client, None, self.rpc_message(payload))
+        client.publish.assert_not_called()
+        
+        for params, error in (("VIN1", "params must be an object"), ([1], "params must be an object"),
+                              ({"vin": ["VIN1"]}, "vin must be a string")):
+            on_message(client, None, self.rpc_message({"correlation_id": "a", "method": "latest", "params": params}))
+            self.assertEqual(json.loads(client.publish.call_args[0][1]), {"correlation_id": "a", "error": error})
+        latest_state.get.assert_not_called()
+        latest_state.all.assert_not_called()
+        self.assertIn('rpc_requests_total{plugin="rpc",method="invalid"} 6', registry.render())
+    
+    def test_bad_chunk_size_rejected(self):
+        """Test a chunk_size that is not a positive integer is answered with an error instead of no reply."""
+        context = dict(self.context, iter_vehicle_data=Mock(return_value=iter([])))
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        for chunk_size in ("abc", [], 0, 2.5, True):
+            on_message(client, None, self.rpc_message({"correlation_id": "a", "stream": True, "chunk_size": chunk_size}))
+            self.assertEqual(json.loads(client.publish.call_args[0][1]),
+                             {"correlation_id": "a", "error": "chunk_size must be a positive integer"})
+        context["iter_vehicle_data"].assert_not_called()
+    
+    def test_rpc_metrics_recorded_per_method(self):
+        """Test request count, errors and service time are recorded when the context has a registry."""
+        registry = Registry()
+        self.context["read_all_vehicle_data"].side_effect = RuntimeError("db down")
+        context = dict(self.context, metrics=registry)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        on_message(client, None, self.rpc_message({"correlation_id": "abc"}))
+        on_message(client, None, self.rpc_message({"params": {}}))
+        
+        text = registry.render()
+        self.assertIn('rpc_requests_total{plugin="rpc",method="read"} 1', text)
+        self.assertIn('rpc_requests_total{plugin="rpc",method="invalid"} 1', text)
+        self.assertIn('rpc_errors_total{plugin="rpc",method="read"} 1', text)
+        self.assertIn('rpc_service_seconds_count{plugin="rpc",method="read"} 1', text)
+    
+    def test_identical_concurrent_reads_share_one_query(self):
+        """Test requests with the same params arriving during a read are answered from that read."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def read(**params):
+            started.set()
+            release.wait(2)
+            return iter([("VIN1", 1.0, 2.0, 3.0)])
+
+        registry = Registry()
+        context = dict(self.context, iter_vehicle_data=Mock(side_effect=read), metrics=registry)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        leader = threading.Thread(target=on_message, args=(
+            client, None, self.rpc_message({"correlation_id": "a", "params": {"vin": "VIN1"}})))
+        leader.start()
+        self.assertTrue(started.wait(2))
+        for corr in ("b", "c"):
+            on_message(client, None, self.rpc_message({"correlation_id": corr, "params": {"vin": "VIN1"}}))
+        # Followers return at once; nothing is published until the read finishes
+        client.publish.assert_not_called()
+        release.set()
+        leader.join(2)
+
+        responses = {c[0][0]: json.loads(c[0][1]) for c in client.publish.call_args_list}
+        self.assertEqual(sorted(responses), ["rpc/response/a", "rpc/response/b", "rpc/response/c"])
+        self.assertEqual(responses["rpc/response/c"]["correlation_id"], "c")
+        self.assertEqual(responses["rpc/response/b"]["result"], responses["rpc/response/a"]["result"])
+        context["iter_vehicle_data"].assert_called_once_with(vin="VIN1")
+        self.assertIn('rpc_coalesced_total{plugin="rpc",method="read"} 2', registry.render())
+
+        # The flight is over: the next request reads again
+        on_message(client, None, self.rpc_message({"correlation_id": "d", "params": {"vin": "VIN1"}}))
+        self.assertEqual(context["iter_vehicle_data"].call_count, 2)
+
+    def test_coalescing_can_be_disabled(self):
+        """Test "coalesce": false serves every request with its own read."""
+        config = dict(self.config, coalesce=False)
+        plugin = RpcServerPlugin("rpc", config, self.context)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.rpc_message({"correlation_id": "a"}))
+
+        self.assertIsNone(plugin.flights)
+        self.assertEqual(json.loads(client.publish.call_args[0][1])["result"][0]["vin"], "VIN123")
+
+    def test_single_flight_shares_errors_and_keys_apart(self):
+        """Test every waiter gets the leader's error and different keys run separately."""
+        flights = SingleFlight()
+        outcomes = []
+
+        def work():
+            # A caller joining while the work runs shares its outcome; another key runs on its own
+            self.assertFalse(flights.do("k", Mock(), lambda r, e: outcomes.append(("joined", r, e))))
+            self.assertTrue(flights.do("other", lambda: 1, lambda r, e: outcomes.append(("other", r, e))))
+            raise RuntimeError("boom")
+
+        self.assertTrue(flights.do("k", work, lambda r, e: outcomes.append(("leader", r, e))))
+        self.assertEqual(outcomes[0], ("other", 1, None))
+        self.assertEqual([o[0] for o in outcomes[1:]], ["leader", "joined"])
+        self.assertTrue(all(isinstance(o[2], RuntimeError) for o in outcomes[1:]))
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_overload_answers_server_busy(self):
+        """Test a request refused by the bounded executor is answered with an error at once."""
+        client = Mock()
+        self.plugin.on_overload(client, None, self.rpc_message({"correlation_id": "abc"}))
+
+        topic, payload = client.publish.call_args[0]
+        self.assertEqual(topic, "rpc/response/abc")
+        self.assertEqual(json.loads(payload), {"correlation_id": "abc", "error": "server busy"})
+
+    def test_unchanged_data_served_from_cache(self):
+        """Test repeated reads are answered from the cache until the data version moves."""
+        version = [1]
+        registry = Registry()
+        context = dict(self.context, data_version=lambda: version[0], metrics=registry)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        read = self.context["read_all_vehicle_data"]
+        
+        on_message(client, None, self.rpc_message({"correlation_id": "a"}))
+        with patch('plugins.rpc_server_plugin.encode_rows') as encode_rows:
+            on_message(client, None, self.rpc_message({"correlation_id": "b"}))
+        # Neither queried nor re-encoded
+        self.assertEqual(read.call_count, 1)
+        encode_rows.assert_not_called()
+        first, second = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        self.assertEqual(second, dict(first, correlation_id="b"))
+        
+        # A write bumps the version: the next request queries again
+        version[0] = 2
+        on_message(client, None, self.rpc_message({"correlation_id": "c"}))
+        self.assertEqual(read.call_count, 2)
+        
+        text = registry.render()
+        self.assertIn('rpc_cache_hits_total{plugin="rpc",method="read"} 1', text)
+        self.assertIn('rpc_cache_misses_total{plugin="rpc",method="read"} 2', text)
+    
+    def test_cache_keyed_by_method_and_params(self):
+        """Test different params and methods get their own cache entries."""
+        history = Mock(return_value=[{"bucket": 0, "samples": 1}])
+        context = dict(self.context, data_version=lambda: 1, query_history=history)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        for params in ({"vin": "A"}, {"vin": "B"}, {"vin": "A"}):
+            on_message(client, None, self.rpc_message({"correlation_id": "x", "params": params}))
+            on_message(client, None, self.rpc_message({"correlation_id": "y", "method": "history",
+                                                       "params": dict(params, since=0, until=3600)}))
+        
+        self.assertEqual(self.context["read_all_vehicle_data"].call_count, 2)
+        self.assertEqual(history.call_count, 2)
+        self.assertEqual(json.loads(client.publish.call_args[0][1]),
+                         {"correlation_id": "y", "result": [{"bucket": 0, "samples": 1}]})
+    
+    def test_history_params_validated_before_caching(self):
+        """Test bad history params are rejected without a query, and equal queries share one cache entry."""
+        history = Mock(return_value=[])
+        registry = Registry()
+        context = dict(self.context, data_version=lambda: 1, query_history=history, metrics=registry)
+        client, on_message = self.start_handler(RpcServerPlugin("rpc", self.config, context))
+        for params in ({"since": 0, "until": 3600, "now": 0}, {"since": 0}, {"since": "0", "until": 3600},
+                       {"since": 3600, "until": 0}, {"since": 0, "until": 3600, "resolution": -60},
+                       {"since": 0, "until": 3600, "vin": 7}):
+            on_message(client, None, self.rpc_message({"correlation_id": "x", "method": "history", "params": params}))
+        history.assert_not_called()
+        self.assertIn("unknown params: now", json.loads(client.publish.call_args_list[0][0][1])["error"])
+        
+        on_message(client, None, self.rpc_message({"correlation_id": "y", "method": "history",
+                                                   "params": {"since": 0, "until": 3600}}))
+        on_message(client, None, self.rpc_message({"correlation_id": "z", "method": "history",
+                                                   "params": {"since": 0.0, "until": 3600, "vin": ""}}))
+        history.assert_called_once_with(since=0.0, until=3600.0, resolution=None, vin=None)
+        self.assertIn('rpc_errors_total{plugin="rpc",method="invalid"} 6', registry.render())
+    
+    def test_no_cache_without_data_version(self):
+        """Test the cache stays off when nothing reports writes."""
+        client, on_message = self.start_handler(self.plugin)
+        on_message(client, None, self.rpc_message({"correlation_id": "a"}))
+        on_message(client, None, self.rpc_message({"correlation_id": "b"}))
+        
+        self.assertIsNone(self.plugin.cache)
+        self.assertEqual(self.context["read_all_vehicle_data"].call_count, 2)
+    
+    def test_result_cache_lru_byte_budget(self):
+        """Test least recently used entries are evicted to stay within the byte budget."""
+        cache = ResultCache(10)
+        self.assertTrue(cache.put("a", 1, b"aaaa"))
+        self.assertTrue(cache.put("b", 1, b"bbbb"))
+        self.assertEqual(cache.get("a", 1), b"aaaa")
+        self.assertTrue(cache.put("c", 1, b"cccc"))
+        
+        self.assertIsNone(cache.get("b", 1))
+        self.assertEqual((len(cache), cache.nbytes, cache.evictions), (2, 8, 1))
+        self.assertFalse(cache.put("big", 1, b"x" * 11))
+    
+    def test_result_cache_drops_stale_versions(self):
+        """Test a newer version empties the cache and results of older versions are not stored."""
+        cache = ResultCache(100)
+        cache.put("a", 1, b"one")
+        self.assertIsNone(cache.get("a", 2))
+        self.assertEqual(cache.nbytes, 0)
+        # A query that started before the write finishes after it
+        self.assertFalse(cache.put("a", 1, b"old"))
+        self.assertIsNone(cache.get("a", 2))
+    
     def test_validate_without_read_function(self):
         """Test validation warning when read function not available."""
         context = {"broker": "test-broker", "read_all_vehicle_data": None}
@@ -0,0 +1,174 @@
+import unittest
+import json
+import queue
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from sharding import HashRing, ShardSupervisor, ShardWorker, record_parts
+
+
+def raw(topic, payload):
+    return (topic, json.dumps(payload).encode())
+
+
+def report(vin, ts=100.0):
+    return [
+        raw("vehicles/vin", {"vin": vin, "ts": ts}),
+        raw("vehicles/location", {"vin": vin, "ts": ts, "latitude": 1.0, "longitude": 2.0}),
+        raw("vehicles/giro", {"vin": vin, "ts": ts, "giro": 3.0}),
+    ]
+
+
+class TestHashRing(unittest.TestCase):
+    
+    def test_keys_spread_over_nodes(self):
+        """Test every node gets a fair share of the VINs."""
+        ring = HashRing(range(4))
+        counts = {}
+        for i in range(20000):
+            node = ring.node_for(f"VIN{i}")
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(set(counts), {0, 1, 2, 3})
+        self.assertLess(max(counts.values()) / min(counts.values()), 2)
+    
+    def test_adding_a_node_moves_only_its_share(self):
+        """Test a join only moves VINs to the new node, about 1/N of them."""
+        before = HashRing(range(4))
+        after = HashRing(range(5))
+        vins = [f"VIN{i}" for i in range(20000)]
+        moved = [v for v in vins if before.node_for(v) != after.node_for(v)]
+        self.assertTrue(all(after.node_for(v) == 4 for v in moved))
+        self.assertLess(len(moved) / len(vins), 0.35)
+    
+    def test_remove_restores_previous_owners(self):
+        """Test removing a node gives its VINs back to the remaining nodes unchanged otherwise."""
+        ring = HashRing(range(3))
+        owners = {f"VIN{i}": ring.node_for(f"VIN{i}") for i in range(1000)}
+        ring.add(3)
+        ring.remove(3)
+        self.assertEqual(owners, {vin: ring.node_for(vin) for vin in owners})
+    
+    def test_empty_ring(self):
+        """Test an empty ring owns nothing."""
+        self.assertIsNone(HashRing().node_for("VIN1"))
+
+
+class TestShardWorker(unittest.TestCase):
+    
+    def setUp(self):
+        self.inboxes = {0: queue.Queue(), 1: queue.Queue()}
+        self.results = queue.Queue()
+        self.flushed = []
+        self.workers = [ShardWorker(i, [0, 1], self.inboxes, self.results, {"write": "discard"},
+                                    flush=self.flushed.extend) for i in (0, 1)]
+    
+    def vin_owned_by(self, worker_id):
+        return next(f"VIN{i}" for i in range(1000) if self.workers[0].owner(f"VIN{i}") == worker_id)
+    
+    def test_owned_parts_are_joined_locally(self):
+        """Test a worker joins the parts of its own VINs without forwarding."""
+        vin = self.vin_owned_by(0)
+        self.workers[0].handle_raw(report(vin))
+        self.assertEqual(self.workers[0].merged, 1)
+        self.assertEqual(self.workers[0].forwarded, 0)
+    
+    def test_other_parts_are_forwarded_to_the_owner(self):
+        """Test parts of another worker's VIN are batched to its inbox and joined there."""
+        vin = self.vin_owned_by(1)
+        self.workers[0].handle_raw(report(vin))
+        self.workers[0].flush_forwards()
+        
+        kind, parts, hops = self.inboxes[1].get_nowait()
+        self.assertEqual((kind, hops, len(parts)), ("parts", 1, 3))
+        self.workers[1].handle_parts(parts, hops)
+        self.assertEqual(self.workers[1].merged, 1)
+        self.assertEqual(self.workers[0].merged, 0)
+    
+    def test_parts_are_not_forwarded_forever(self):
+        """Test a part already forwarded MAX_HOPS times is joined where it is."""
+        vin = self.vin_owned_by(1)
+        self.workers[0].handle_parts([(p, json.loads(b)) for p, b in
+                                      [("vin", report(vin)[0][1])]], hops=2)
+        self.workers[0].flush_forwards()
+        self.assertTrue(self.inboxes[1].empty())
+        self.assertIn(vin, self.workers[0].correlator.partials)
+    
+    def test_rebalance_hands_off_partial_records(self):
+        """Test partial records of VINs that moved are re-filed on their new owner."""
+        worker = self.workers[0]
+        vin = self.vin_owned_by(0)
+        worker.handle_raw(report(vin)[:2])
+        worker.rebalance([1])
+        
+        self.assertNotIn(vin, worker.correlator.partials)
+        kind, parts, hops = self.inboxes[1].get_nowait()
+        self.workers[1].rebalance([1])
+        self.workers[1].handle_parts(parts, hops)
+        self.workers[1].handle_raw(report(vin)[2:])
+        self.assertEqual(self.workers[1].merged, 1)
+    
+    def test_parts_without_vin_are_unattributed(self):
+        """Test sharded ingest drops parts that carry no VIN."""
+        self.workers[0].handle_raw([raw("vehicles/giro", {"giro": 1.0})])
+        self.assertEqual(self.workers[0].correlator.stats["unattributed"], 1)
+    
+    def test_parent_write_hands_rows_back_without_writing(self):
+        """Test "parent" workers leave the DB write to the twin and always report their rows."""
+        worker = ShardWorker(0, [0], self.inboxes, self.results, {"write": "parent", "report_rows": False})
+        rows = [("VIN1", 1.0, 2.0, 3.0, 100.0)]
+        worker._flush(rows)
+        
+        self.assertEqual(self.results.get_nowait(), ("rows", 0, rows))
+        self.assertIsNone(worker._write)
+    
+    def test_record_parts_round_trip(self):
+        """Test a buffered record's parts rebuild the same row."""
+        vin = self.vin_owned_by(0)
+        worker = self.workers[0]
+        worker.handle_raw(report(vin)[:2])
+        record = worker.correlator.partials[vin]
+        parts = record_parts(record)
+        self.assertEqual([p for p, _ in parts], ["vin", "location"])
+        self.assertEqual(parts[1][1]["latitude"], 1.0)
+
+
+class TestShardSupervisor(unittest.TestCase):
+    
+    def test_dispatch_joins_every_vin_across_a_scale_up(self):
+        """Test forked workers join every report while a worker joins the ring."""
+        rows = []
+        lock = threading.Lock()
+        
+        def on_rows(batch):
+            with lock:
+                rows.extend(batch)
+        shards = ShardSupervisor(2, max_workers=3, on_rows=on_rows, config={
+            "mode": "dispatch", "write": "discard", "batch_delay": 0.01, "stats_interval": 0.1})
+        shards.start()
+        try:
+            for i in range(300):
+                if i == 150:
+                    shards.scale(3)
+                for topic, payload in report(f"VIN{i}"):
+                    shards.dispatch(topic, payload)
+            deadline = time.monotonic() + 10
+            while len(rows) < 300 and time.monotonic() < deadline:
+                time.sleep(0.02)
+        finally:
+            shards.stop()
+        self.assertEqual(sorted(r[0] for r in rows), sorted(f"VIN{i}" for i in range(300)))
+        self.assertEqual(shards.members, [0, 1, 2])
+        self.assertEqual(shards.rebalances, 1)
+    
+    def test_unknown_mode_rejected(self):
+        """Test an unknown shard mode fails fast."""
+        with self.assertRaises(ValueError):
+            ShardSupervisor(2, config={"mode": "broadcast"})
+
+
+if __name__ == '__main__':
+    unittest.main()
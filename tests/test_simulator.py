@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import Mock, MagicMock
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "simulator"))
+
+# Mock dependencies
+sys.modules['paho'] = MagicMock()
+sys.modules['paho.mqtt'] = MagicMock()
+sys.modules['paho.mqtt.client'] = MagicMock()
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if np is not None:
+    from simulator import Fleet, Simulator, arrivals, messages
+
+
+@unittest.skipIf(np is None, "numpy not installed")
+class TestFleet(unittest.TestCase):
+    
+    def test_step_moves_every_vehicle_within_bounds(self):
+        """Test one vectorized step advances all vehicles along their heading."""
+        fleet = Fleet(1000, seed=1)
+        lat, lon = fleet.lat.copy(), fleet.lon.copy()
+        
+        fleet.step(1.0)
+        
+        moved = np.hypot(fleet.lat - lat, fleet.lon - lon)
+        self.assertTrue(np.all(moved < 0.01))
+        self.assertGreater(np.count_nonzero(moved), 900)
+        self.assertTrue(np.all((fleet.heading >= 0) & (fleet.heading < 360)))
+        self.assertTrue(np.all((fleet.speed >= 0) & (fleet.speed <= fleet.max_speed)))
+    
+    def test_messages_match_producer_payloads(self):
+        """Test a report yields the vin/location/giro messages the producers sent."""
+        fleet = Fleet(2, seed=1)
+        
+        split = messages(fleet, 1, 10.0, "split")
+        data = messages(fleet, 1, 10.0, "data")
+        
+        self.assertEqual([t for t, _ in split], ["vehicles/vin", "vehicles/location", "vehicles/giro"])
+        self.assertEqual(set(split[1][1]), {"vin", "ts", "latitude", "longitude"})
+        self.assertEqual(data[0][1]["vin"], fleet.vins[1])
+        self.assertEqual(len(fleet.vins[1]), 17)
+
+
+@unittest.skipIf(np is None, "numpy not installed")
+class TestSimulator(unittest.TestCase):
+    
+    def test_arrival_processes_hit_the_mean_rate(self):
+        """Test Poisson and bursty arrivals average to the requested rate."""
+        rng = np.random.default_rng(1)
+        for mode in ("poisson", "bursty"):
+            total = sum(arrivals(rng, mode, 1000.0, 0.01) for _ in range(10000))
+            self.assertAlmostEqual(total / 100.0, 1000.0, delta=50.0)
+        self.assertEqual(arrivals(rng, "uniform", 1000.0, 0.01), 10.0)
+    
+    def test_publishes_round_robin_over_pool(self):
+        """Test reports are spread over all pooled connections at the target rate."""
+        publishers = [Mock(), Mock()]
+        simulator = Simulator(Fleet(10, seed=1), publishers, rate=3000, arrivals_mode="uniform")
+        
+        for _ in range(100):
+            simulator.run_tick(0.01)
+        
+        self.assertEqual(simulator.sent, 3000)
+        self.assertEqual(publishers[0].publish.call_count, 1500)
+        self.assertEqual(publishers[1].publish.call_count, 1500)
+    
+    def test_unknown_arrival_process_rejected(self):
+        """Test an unknown arrival process fails fast."""
+        with self.assertRaises(ValueError):
+            Simulator(Fleet(1), [Mock()], rate=1, arrivals_mode="gaussian")
+
+
+if __name__ == '__main__':
+    unittest.main()
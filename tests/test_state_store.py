@@ -0,0 +1,46 @@
+import unittest
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+
+from state_store import LatestStateStore
+
+
+class TestLatestStateStore(unittest.TestCase):
+    
+    def setUp(self):
+        self.now = 1000.0
+        self.store = LatestStateStore(clock=lambda: self.now)
+    
+    def test_update_replaces_state_per_vin(self):
+        """Test the newest row of each VIN wins."""
+        self.store.update(("VIN1", 1.0, 2.0, 3.0))
+        self.store.update(("VIN2", 4.0, 5.0, 6.0))
+        self.now = 1001.0
+        self.store.update(("VIN1", 7.0, 8.0, 9.0))
+        
+        self.assertEqual(self.store.get("VIN1"), ("VIN1", 7.0, 8.0, 9.0))
+        self.assertEqual(self.store.updated_at("VIN1"), 1001.0)
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(sorted(self.store.all()), [("VIN1", 7.0, 8.0, 9.0), ("VIN2", 4.0, 5.0, 6.0)])
+    
+    def test_unknown_vin(self):
+        """Test lookups of unseen VINs return None."""
+        self.assertIsNone(self.store.get("VIN1"))
+        self.assertNotIn("VIN1", self.store)
+    
+    def test_warm_does_not_overwrite_live_state(self):
+        """Test warming only fills VINs that were not updated live."""
+        self.store.update(("VIN1", 7.0, 8.0, 9.0))
+        
+        loaded = self.store.warm(iter([["VIN1", 1.0, 2.0, 3.0], ["VIN2", 4.0, 5.0, 6.0]]))
+        
+        self.assertEqual(loaded, 1)
+        self.assertEqual(self.store.get("VIN1"), ("VIN1", 7.0, 8.0, 9.0))
+        self.assertEqual(self.store.get("VIN2"), ("VIN2", 4.0, 5.0, 6.0))
+        self.assertIsNone(self.store.updated_at("VIN2"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "fleet_digital_twin"))
+
+from sync_acks import SyncAcks
+
+
+class TestSyncAcks(unittest.TestCase):
+    
+    def setUp(self):
+        """Collect the acks instead of publishing them."""
+        self.acks = []
+        self.tracker = SyncAcks(lambda source, subscriber, watermark: self.acks.append((subscriber, watermark)))
+    
+    def test_frame_acked_once_its_rows_are_committed(self):
+        """Test a frame is acknowledged only after every one of its rows was written."""
+        self.tracker.frame("vdt", "fleet", 0, 0, 2, ["vdt:1", "vdt:2"])
+        self.tracker.committed(["vdt:1"])
+        self.assertEqual(self.acks, [])
+        
+        self.tracker.committed(["vdt:2"])
+        self.assertEqual(self.acks, [("fleet", 2)])
+        self.assertEqual(len(self.tracker), 0)
+    
+    def test_acks_follow_frame_order(self):
+        """Test a later frame committed first waits for the frames before it."""
+        self.tracker.frame("vdt", "fleet", 0, 0, 2, ["vdt:1", "vdt:2"])
+        self.tracker.frame("vdt", "fleet", 1, 2, 4, ["vdt:3", "vdt:4"])
+        self.tracker.committed(["vdt:3", "vdt:4"])
+        self.assertEqual(self.acks, [])
+        
+        self.tracker.committed(["vdt:1", "vdt:2"])
+        self.assertEqual(self.acks, [("fleet", 4)])
+    
+    def test_lost_rows_hold_back_the_ack_until_resent(self):
+        """Test a frame with a dropped row stalls the chain and the resent frame releases it."""
+        self.tracker.frame("vdt", "fleet", 0, 0, 2, ["vdt:1", "vdt:2"])
+        self.tracker.frame("vdt", "fleet", 1, 2, 3, ["vdt:3"])
+        self.tracker.committed(["vdt:1", "vdt:3"])
+        self.assertEqual(self.acks, [])
+        
+        # The next sync starts again at the last acknowledged watermark
+        self.tracker.frame("vdt", "fleet", 0, 0, 3, ["vdt:1", "vdt:2", "vdt:3"])
+        self.tracker.committed(["vdt:1", "vdt:2", "vdt:3"])
+        self.assertEqual(self.acks, [("fleet", 3)])
+        self.assertEqual(len(self.tracker), 0)
+    
+    def test_streams_are_acked_separately(self):
+        """Test each subscriber's chain advances on its own frames."""
+        self.tracker.frame("vdt", "a", 0, 0, 1, ["vdt:1"])
+        self.tracker.frame("vdt", "b", 0, 5, 6, ["vdt:6"])
+        self.tracker.committed(["vdt:6"])
+        
+        self.assertEqual(self.acks, [("b", 6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
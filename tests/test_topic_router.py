@@ -0,0 +1,166 @@
+import unittest
+from unittest.mock import Mock, MagicMock
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Mock dependencies
+sys.modules['paho'] = MagicMock()
+sys.modules['paho.mqtt'] = MagicMock()
+sys.modules['paho.mqtt.client'] = MagicMock()
+
+from topic_router import SubscriptionTrie, TopicRouter
+from listener_base import MqttListenerPlugin
+
+
+def message(topic):
+    msg = Mock()
+    msg.topic = topic
+    return msg
+
+
+class TestSubscriptionTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = SubscriptionTrie()
+
+    def matches(self, topic_filter, topic):
+        trie = SubscriptionTrie()
+        handler = Mock()
+        trie.add(topic_filter, handler)
+        return handler in trie.match(topic)
+
+    def test_wildcard_matching(self):
+        """Test + and # follow MQTT filter semantics."""
+        cases = [
+            ("a/b", "a/b", True),
+            ("a/b", "a/c", False),
+            ("a/+", "a/b", True),
+            ("a/+", "a/b/c", False),
+            ("a/+/c", "a/b/c", True),
+            ("+/+", "a/b", True),
+            ("a/#", "a", True),
+            ("a/#", "a/b/c", True),
+            ("a/#", "b/c", False),
+            ("#", "a/b", True),
+            ("+", "a/b", False),
+            ("#", "$SYS/broker", False),
+            ("+/broker", "$SYS/broker", False),
+            ("$SYS/#", "$SYS/broker", True),
+        ]
+        for topic_filter, topic, expected in cases:
+            with self.subTest(topic_filter=topic_filter, topic=topic):
+                self.assertEqual(self.matches(topic_filter, topic), expected)
+
+    def test_add_and_remove_report_first_and_last_handler(self):
+        """Test add/remove return whether the filter's broker subscription must change."""
+        h1, h2 = Mock(), Mock()
+        self.assertTrue(self.trie.add("rpc/request/#", h1))
+        self.assertFalse(self.trie.add("rpc/request/#", h2))
+        self.assertFalse(self.trie.remove("rpc/request/#", h1))
+        self.assertTrue(self.trie.remove("rpc/request/#", h2))
+        self.assertEqual(self.trie.match("rpc/request/x"), [])
+        self.assertEqual(self.trie.filters(), [])
+
+    def test_filters_lists_subscribed_filters(self):
+        """Test filters() returns every filter with handlers."""
+        self.trie.add("a/b", Mock())
+        self.trie.add("a/#", Mock())
+        self.assertEqual(sorted(self.trie.filters()), ["a/#", "a/b"])
+
+
+class TestTopicRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = TopicRouter("test-broker")
+        self.router.client = Mock()
+
+    def test_dispatches_to_matching_handlers(self):
+        """Test messages go to every handler whose filter matches."""
+        rpc, trigger = Mock(), Mock()
+        self.router.subscribe("rpc/request/+", rpc)
+        self.router.subscribe("vehicles/request", trigger)
+        msg = message("rpc/request/read")
+        self.router._on_message(self.router.client, None, msg)
+
+        rpc.assert_called_once_with(self.router.client, None, msg)
+        trigger.assert_not_called()
+
+    def test_failing_handler_does_not_block_others(self):
+        """Test one handler raising does not stop dispatch to the rest."""
+        other = Mock()
+        self.router.subscribe("a/#", Mock(side_effect=RuntimeError("boom")))
+        self.router.subscribe("a/b", other)
+        with self.assertLogs(level="ERROR"):
+            self.router._on_message(self.router.client, None, message("a/b"))
+        other.assert_called_once()
+
+    def test_broker_subscriptions_are_reference_counted(self):
+        """Test the broker is subscribed once per filter and unsubscribed after the last handler."""
+        self.router._started = True
+        h1, h2 = Mock(), Mock()
+        self.router.subscribe("a/+", h1)
+        self.router.subscribe("a/+", h2)
+        self.router.client.subscribe.assert_called_once_with("a/+")
+        self.router.unsubscribe("a/+", h1)
+        self.router.client.unsubscribe.assert_not_called()
+        self.router.unsubscribe("a/+", h2)
+        self.router.client.unsubscribe.assert_called_once_with("a/+")
+
+    def test_resubscribes_on_connect(self):
+        """Test every filter is (re)subscribed in one request when the connection comes up."""
+        self.router.subscribe("a/b", Mock())
+        self.router.subscribe("c/#", Mock())
+        self.router._on_connect(self.router.client, None, {}, 0)
+        filters = self.router.client.subscribe.call_args[0][0]
+        self.assertEqual(sorted(filters), [("a/b", 0), ("c/#", 0)])
+
+
+class TestPluginExecutor(unittest.TestCase):
+
+    def test_handlers_run_on_plugin_executor(self):
+        """Test executor_workers moves a plugin's handlers off the router's network thread."""
+        router = TopicRouter("test-broker")
+        router.client = Mock()
+        plugin = MqttListenerPlugin("p", {"executor_workers": 2}, {"router": router})
+        seen = []
+        done = threading.Event()
+
+        def handler(client, userdata, msg):
+            seen.append(threading.current_thread().name)
+            done.set()
+        plugin.subscribe("a/b", handler)
+        router._on_message(router.client, None, message("a/b"))
+
+        self.assertTrue(done.wait(2))
+        self.assertTrue(seen[0].startswith("p-worker"))
+        plugin.stop()
+        self.assertEqual(router.trie.match("a/b"), [])
+
+    def test_max_queued_sends_excess_to_on_overload(self):
+        """Test messages beyond executor_workers + max_queued go to on_overload instead of the queue."""
+        router = TopicRouter("test-broker")
+        router.client = Mock()
+        plugin = MqttListenerPlugin("p", {"executor_workers": 1, "max_queued": 1}, {"router": router})
+        plugin.on_overload = Mock()
+        release = threading.Event()
+        handled = []
+
+        def handler(client, userdata, msg):
+            release.wait(2)
+            handled.append(msg.topic)
+        plugin.subscribe("a/+", handler)
+        for topic in ("a/1", "a/2", "a/3"):
+            router._on_message(router.client, None, message(topic))
+
+        plugin.on_overload.assert_called_once()
+        self.assertEqual(plugin.on_overload.call_args[0][2].topic, "a/3")
+        release.set()
+        plugin.stop()
+        self.assertEqual(handled, ["a/1", "a/2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
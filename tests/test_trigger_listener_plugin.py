@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import Mock, patch, MagicMock
 import sys
+import json
+import tempfile
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -10,7 +12,11 @@ sys.modules['paho'] = MagicMock()
 sys.modules['paho.mqtt'] = MagicMock()
 sys.modules['paho.mqtt.client'] = MagicMock()
 
-from plugins.trigger_listener_plugin import TriggerListenerPlugin
+from plugins.trigger_listener_plugin import TriggerListenerPlugin, FrameWindow
+
+# Metrics ship with the twin; appended so the root plugins stay first on the path
+sys.path.append(str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+from metrics import Registry
 
 
 class TestTriggerListenerPlugin(unittest.TestCase):
@@ -58,8 +64,8 @@ class TestTriggerListenerPlugin(unittest.TestCase):
             plugin.validate()
         self.assertIn("data_topic", str(cm.exception))
     
-    @patch('plugins.trigger_listener_plugin.threading.Thread')
-    @patch('plugins.trigger_listener_plugin.mqtt.Client')
+    @patch('listener_base.threading.Thread')
+    @patch('paho.mqtt.client.Client')
     def test_start(self, mock_mqtt_client, mock_thread):
         """Test plugin start."""
         mock_client_instance = Mock()
@@ -73,6 +79,242 @@ class TestTriggerListenerPlugin(unittest.TestCase):
         mock_thread.assert_called_once()
         mock_thread_instance.start.assert_called_once()
     
+    def test_start_subscribes_through_shared_router(self):
+        """Test the plugin subscribes on the context's shared connection instead of opening its own."""
+        router = Mock()
+        self.plugin.context = dict(self.context, router=router)
+        with patch('listener_base.threading.Thread') as mock_thread:
+            self.plugin.start()
+        
+        mock_thread.assert_not_called()
+        router.subscribe.assert_called_once()
+        self.assertEqual(router.subscribe.call_args[0][0], "vehicles/request")
+        
+        self.plugin.stop()
+        router.unsubscribe.assert_called_once_with("vehicles/request", router.subscribe.call_args[0][1])
+    
+    def start_handler(self, plugin):
+        """Start the plugin on a mock shared router and return a client and the routed handler."""
+        router = Mock()
+        plugin.context = dict(plugin.context, router=router)
+        plugin.start()
+        return Mock(), router.subscribe.call_args[0][1]
+    
+    def test_trigger_streams_rows_from_iterator(self):
+        """Test rows are consumed incrementally from iter_vehicle_data."""
+        consumed = []
+        
+        def iter_vehicle_data(vin=None):
+            for row in [("VIN1", 1.0, 2.0, 3.0), ("VIN2", 4.0, 5.0, 6.0)]:
+                consumed.append(row)
+                yield row
+        
+        context = dict(self.context, iter_vehicle_data=iter_vehicle_data)
+        client, on_message = self.start_handler(TriggerListenerPlugin("t", self.config, context))
+        msg = Mock()
+        msg.payload.decode.return_value = ""
+        on_message(client, None, msg)
+        
+        self.assertEqual(client.publish.call_count, 2)
+        self.assertEqual(len(consumed), 2)
+        self.context["read_all_vehicle_data"].assert_not_called()
+        topic, payload = client.publish.call_args[0]
+        self.assertEqual(topic, "vehicles/data")
+        self.assertEqual(json.loads(payload)["vin"], "VIN2")
+    
+    def test_trigger_passes_vin_filter(self):
+        """Test a VIN in the trigger payload filters the read."""
+        client, on_message = self.start_handler(self.plugin)
+        msg = Mock()
+        msg.payload.decode.return_value = json.dumps({"vin": "VIN123"})
+        on_message(client, None, msg)
+        
+        self.context["read_all_vehicle_data"].assert_called_once_with("VIN123")
+        client.publish.assert_called_once()
+    
+    def test_full_replay_carries_id_and_source(self):
+        """Test full mode sends each row's id, source twin and time when the id reader is available."""
+        rows = [(7, "VIN1", 1.0, 2.0, 3.0, 100.0), (8, "VIN2", 1.0, 2.0, 3.0, 100.0)]
+        reads = []
+        
+        def iter_vehicle_data_since(after_id, vin=None):
+            reads.append((after_id, vin))
+            return iter([r for r in rows if vin is None or r[1] == vin])
+        
+        context = dict(self.context, iter_vehicle_data_since=iter_vehicle_data_since)
+        config = dict(self.config, source_id="vdt")
+        client, on_message = self.start_handler(TriggerListenerPlugin("t", config, context))
+        on_message(client, None, self.trigger({}))
+        on_message(client, None, self.trigger({"vin": "VIN2"}))
+        
+        messages = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        self.assertEqual(reads, [(0, None), (0, "VIN2")])
+        self.assertEqual(messages[0], {"source": "vdt", "id": 7, "vin": "VIN1", "latitude": 1.0, "longitude": 2.0,
+                                       "giro": 3.0, "ts": 100.0})
+        self.assertEqual([m["id"] for m in messages], [7, 8, 8])
+        self.context["read_all_vehicle_data"].assert_not_called()
+    
+    def incremental_plugin(self, rows, **config):
+        """An incremental-sync plugin over rows of (id, vin, lat, lon, giro, ts); records the watermarks read."""
+        reads = []
+        
+        def iter_vehicle_data_since(after_id, vin=None):
+            reads.append(after_id)
+            return iter([r for r in rows if r[0] > after_id and (vin is None or r[1] == vin)])
+        
+        config = dict(self.config, sync_mode="incremental", source_id="vdt", frame_rows=2, **config)
+        context = dict(self.context, iter_vehicle_data_since=iter_vehicle_data_since)
+        return TriggerListenerPlugin("t", config, context), reads
+    
+    def trigger(self, payload):
+        msg = Mock()
+        msg.payload.decode.return_value = json.dumps(payload)
+        return msg
+    
+    def test_incremental_sync_sends_framed_rows(self):
+        """Test rows are packed into frames on the batch topic, the last one marked end."""
+        rows = [(i, "VIN%d" % i, 1.0, 2.0, 3.0, 100.0 + i) for i in range(1, 6)]
+        plugin, _ = self.incremental_plugin(rows)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        
+        frames = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        self.assertEqual({c[0][0] for c in client.publish.call_args_list}, {"vehicles/data/batch"})
+        self.assertEqual([len(f["rows"]) for f in frames], [2, 2, 1])
+        self.assertEqual([f["watermark"] for f in frames], [2, 4, 5])
+        self.assertTrue(frames[-1]["end"])
+        self.assertNotIn("end", frames[0])
+        self.assertEqual(frames[0]["source"], "vdt")
+        self.assertEqual(frames[0]["rows"][0], {"id": 1, "vin": "VIN1", "latitude": 1.0, "longitude": 2.0,
+                                                "giro": 3.0, "ts": 101.0})
+    
+    def test_incremental_sync_resumes_from_acknowledged_watermark(self):
+        """Test each subscriber only receives rows newer than what it acknowledged."""
+        rows = [(i, "VIN", 1.0, 2.0, 3.0, 0.0) for i in range(1, 4)]
+        plugin, reads = self.incremental_plugin(rows)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": 3}))
+        rows.append((4, "VIN", 1.0, 2.0, 3.0, 0.0))
+        client.publish.reset_mock()
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        on_message(client, None, self.trigger({"subscriber": "other"}))
+        
+        self.assertEqual(reads, [0, 3, 0])
+        frames = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        self.assertEqual([r["id"] for r in frames[0]["rows"]], [4])
+        self.assertEqual(frames[0]["subscriber"], "fleet")
+        self.assertEqual(frames[0]["since"], 3)
+    
+    def test_incremental_sync_resends_unacknowledged_rows(self):
+        """Test publishing frames alone does not move the watermark."""
+        rows = [(i, "VIN", 1.0, 2.0, 3.0, 0.0) for i in range(1, 4)]
+        plugin, reads = self.incremental_plugin(rows)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        frames = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": frames[0]["watermark"]}))
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        
+        self.assertEqual(reads, [0, 2])
+        self.assertEqual([f["since"] for f in frames], [0, 2])
+    
+    def test_acks_only_move_the_watermark_forward(self):
+        """Test a late ack for older frames does not move the watermark back."""
+        rows = [(i, "VIN", 1.0, 2.0, 3.0, 0.0) for i in range(1, 6)]
+        plugin, reads = self.incremental_plugin(rows)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": 4}))
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": 2}))
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        
+        self.assertEqual(reads, [4])
+    
+    def test_since_replaces_the_watermark(self):
+        """Test the subscriber's own high-watermark in the trigger is remembered, also going back."""
+        rows = [(i, "VIN", 1.0, 2.0, 3.0, 0.0) for i in range(1, 4)]
+        plugin, reads = self.incremental_plugin(rows)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": 3}))
+        on_message(client, None, self.trigger({"subscriber": "fleet", "since": 1}))
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        
+        self.assertEqual(reads, [1, 1])
+    
+    def test_invalid_since_and_ack_are_errors(self):
+        """Test a non-numeric since or ack is logged and counted like other failures."""
+        registry = Registry()
+        plugin, reads = self.incremental_plugin([(1, "VIN", 1.0, 2.0, 3.0, 0.0)])
+        plugin.context["metrics"] = registry
+        client, on_message = self.start_handler(plugin)
+        with self.assertLogs(level="ERROR"):
+            on_message(client, None, self.trigger({"subscriber": "fleet", "since": "latest"}))
+            on_message(client, None, self.trigger({"subscriber": "fleet", "ack": [1]}))
+        
+        self.assertEqual(reads, [])
+        client.publish.assert_not_called()
+        self.assertIn('trigger_errors_total{plugin="t"} 2', registry.render())
+    
+    def test_non_object_payload_is_dropped(self):
+        """Test a trigger that is valid JSON but not an object is logged and dropped."""
+        plugin, reads = self.incremental_plugin([(1, "VIN", 1.0, 2.0, 3.0, 0.0)])
+        client, on_message = self.start_handler(plugin)
+        for payload in (7, ["ack"], "ack"):
+            with self.assertLogs(level="ERROR"):
+                on_message(client, None, self.trigger(payload))
+        
+        self.assertEqual(reads, [])
+        client.publish.assert_not_called()
+    
+    def test_vin_filtered_sync_is_marked_and_keeps_the_watermark(self):
+        """Test frames of a one-VIN sync carry the vin and its since does not replace the watermark."""
+        rows = [(1, "A", 1.0, 2.0, 3.0, 0.0), (2, "B", 1.0, 2.0, 3.0, 0.0)]
+        plugin, reads = self.incremental_plugin(rows)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet", "vin": "B", "since": 0}))
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": 1}))
+        on_message(client, None, self.trigger({"subscriber": "fleet", "vin": "B"}))
+        
+        frames = [json.loads(c[0][1]) for c in client.publish.call_args_list]
+        self.assertEqual(frames[0]["vin"], "B")
+        self.assertEqual(reads, [0, 1])
+    
+    def test_incremental_sync_nothing_new_publishes_nothing(self):
+        """Test a trigger with no new rows sends no frames."""
+        plugin, _ = self.incremental_plugin([])
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet", "since": 7}))
+        client.publish.assert_not_called()
+    
+    def test_incremental_sync_persists_watermarks(self):
+        """Test acknowledged watermarks survive a plugin restart through watermark_file."""
+        path = str(Path(tempfile.mkdtemp()) / "watermarks.json")
+        rows = [(i, "VIN", 1.0, 2.0, 3.0, 0.0) for i in range(1, 4)]
+        plugin, _ = self.incremental_plugin(rows, watermark_file=path)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        on_message(client, None, self.trigger({"subscriber": "fleet", "ack": 3}))
+        
+        plugin, reads = self.incremental_plugin(rows, watermark_file=path)
+        client, on_message = self.start_handler(plugin)
+        on_message(client, None, self.trigger({"subscriber": "fleet"}))
+        self.assertEqual(reads, [3])
+    
+    def test_frame_window_waits_when_full(self):
+        """Test flow control waits on the oldest frame once max_inflight frames are outstanding."""
+        client = Mock()
+        infos = [Mock() for _ in range(3)]
+        client.publish.side_effect = infos
+        window = FrameWindow(client, max_inflight=2)
+        window.publish("t", b"1")
+        infos[0].wait_for_publish.assert_not_called()
+        window.publish("t", b"2")
+        infos[0].wait_for_publish.assert_called_once()
+        window.publish("t", b"3")
+        window.drain()
+        for info in infos:
+            info.wait_for_publish.assert_called_once()
+    
     def test_validate_without_read_function(self):
         """Test validation warning when read function not available."""
         context = {"broker": "test-broker", "read_all_vehicle_data": None}
@@ -3,6 +3,7 @@ from unittest.mock import Mock, patch, MagicMock
 import sys
 from pathlib import Path
 import json
+import os
 
 # Vehicle Digital Twin tests - first, mock external dependencies
 # Mock all external dependencies before importing
@@ -12,6 +13,8 @@ sys.modules['paho.mqtt.client'] = MagicMock()
 sys.modules['psycopg2'] = MagicMock()
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
+# No metrics HTTP endpoint when the twin module is imported by the tests
+os.environ["METRICS_PORT"] = "0"
 
 
 class TestVehicleDigitalTwin(unittest.TestCase):
@@ -30,42 +33,37 @@ class TestVehicleDigitalTwin(unittest.TestCase):
         ensure_buffer(self.test_vin)
         
         self.assertIn(self.test_vin, buffer)
-        self.assertIsNone(buffer[self.test_vin]["vin"])
-        self.assertIsNone(buffer[self.test_vin]["location"])
-        self.assertIsNone(buffer[self.test_vin]["giro"])
+        self.assertFalse(buffer[self.test_vin].has("vin"))
+        self.assertFalse(buffer[self.test_vin].has("location"))
+        self.assertFalse(buffer[self.test_vin].has("giro"))
     
-    @patch('vehicle_digital_twin.write_vehicle_data')
-    def test_try_merge_complete_record(self, mock_write):
+    @patch('vehicle_digital_twin.writer')
+    def test_try_merge_complete_record(self, mock_writer):
         """Test merging complete vehicle record."""
-        from vehicle_digital_twin import try_merge, buffer
+        from vehicle_digital_twin import try_merge, buffer, correlator
         
         buffer.clear()
-        buffer[self.test_vin] = {
-            "vin": {"vin": self.test_vin},
-            "location": self.test_location,
-            "giro": self.test_giro
-        }
+        correlator.add("vin", {"vin": self.test_vin})
+        correlator.add("location", dict(self.test_location, vin=self.test_vin))
+        correlator.add("giro", dict(self.test_giro, vin=self.test_vin))
         
         try_merge(self.test_vin)
         
-        mock_write.assert_called_once_with(
-            self.test_vin,
-            45.5,
-            -73.6,
-            90.0
-        )
+        mock_writer.submit.assert_called_once()
+        row = mock_writer.submit.call_args[0][0]
+        self.assertEqual(row[:4], (self.test_vin, 45.5, -73.6, 90.0))
+        self.assertIsInstance(row[4], float)
         self.assertNotIn(self.test_vin, buffer)
+        from vehicle_digital_twin import latest_state
+        self.assertEqual(latest_state.get(self.test_vin), row)
     
     def test_try_merge_incomplete_record(self):
         """Test merging incomplete record does nothing."""
-        from vehicle_digital_twin import try_merge, buffer
+        from vehicle_digital_twin import try_merge, buffer, correlator
         
         buffer.clear()
-        buffer[self.test_vin] = {
-            "vin": {"vin": self.test_vin},
-            "location": None,
-            "giro": self.test_giro
-        }
+        correlator.add("vin", {"vin": self.test_vin})
+        correlator.add("giro", dict(self.test_giro, vin=self.test_vin))
         
         try_merge(self.test_vin)
         
@@ -81,68 +79,95 @@ class TestVehicleDigitalTwin(unittest.TestCase):
         
         mock_msg = Mock()
         mock_msg.topic = TOPIC_VIN
-        mock_msg.payload.decode.return_value = json.dumps({"vin": self.test_vin})
+        mock_msg.payload = json.dumps({"vin": self.test_vin}).encode()
         
         on_message(None, None, mock_msg)
         
         # Verify buffer was populated
         self.assertIn(self.test_vin, buffer)
-        self.assertEqual(buffer[self.test_vin]["vin"], {"vin": self.test_vin})
+        self.assertTrue(buffer[self.test_vin].has("vin"))
         mock_merge.assert_called_once_with(self.test_vin)
     
     @patch('vehicle_digital_twin.try_merge')
     def test_on_message_location_topic(self, mock_merge):
         """Test handling location topic message."""
-        from vehicle_digital_twin import on_message, buffer, TOPIC_LOCATION
+        from vehicle_digital_twin import on_message, buffer, ensure_buffer, TOPIC_LOCATION
         
         buffer.clear()
-        buffer[self.test_vin] = {"vin": None, "location": None, "giro": None}
+        ensure_buffer(self.test_vin)
+        location = dict(self.test_location, vin=self.test_vin)
         
         mock_msg = Mock()
         mock_msg.topic = TOPIC_LOCATION
-        mock_msg.payload.decode.return_value = json.dumps(self.test_location)
+        mock_msg.payload = json.dumps(location).encode()
         
         on_message(None, None, mock_msg)
         
-        self.assertEqual(buffer[self.test_vin]["location"], self.test_location)
-        mock_merge.assert_called_once()
+        self.assertEqual((buffer[self.test_vin].latitude, buffer[self.test_vin].longitude), (45.5, -73.6))
+        mock_merge.assert_called_once_with(self.test_vin)
     
     @patch('vehicle_digital_twin.try_merge')
     def test_on_message_giro_topic(self, mock_merge):
         """Test handling giro topic message."""
-        from vehicle_digital_twin import on_message, buffer, TOPIC_GIRO
+        from vehicle_digital_twin import on_message, buffer, ensure_buffer, TOPIC_GIRO
         
         buffer.clear()
-        buffer[self.test_vin] = {"vin": None, "location": None, "giro": None}
+        ensure_buffer(self.test_vin)
+        giro = dict(self.test_giro, vin=self.test_vin)
         
         mock_msg = Mock()
         mock_msg.topic = TOPIC_GIRO
-        mock_msg.payload.decode.return_value = json.dumps(self.test_giro)
+        mock_msg.payload = json.dumps(giro).encode()
         
         on_message(None, None, mock_msg)
         
-        self.assertEqual(buffer[self.test_vin]["giro"], self.test_giro)
-        mock_merge.assert_called_once()
+        self.assertEqual(buffer[self.test_vin].giro, 90.0)
+        mock_merge.assert_called_once_with(self.test_vin)
+    
+    @patch('vehicle_digital_twin.writer')
+    def test_on_message_concurrent_vins_are_not_mixed(self, mock_writer):
+        """Test parts of two vehicles reporting at once are joined by VIN."""
+        from vehicle_digital_twin import on_message, buffer, TOPIC_VIN, TOPIC_LOCATION, TOPIC_GIRO
+        
+        buffer.clear()
+        messages = [
+            (TOPIC_VIN, {"vin": "VIN_A"}),
+            (TOPIC_VIN, {"vin": "VIN_B"}),
+            (TOPIC_LOCATION, {"vin": "VIN_A", "latitude": 1.0, "longitude": 2.0}),
+            (TOPIC_GIRO, {"vin": "VIN_B", "giro": 20.0}),
+            (TOPIC_LOCATION, {"vin": "VIN_B", "latitude": 3.0, "longitude": 4.0}),
+            (TOPIC_GIRO, {"vin": "VIN_A", "giro": 10.0}),
+        ]
+        for topic, payload in messages:
+            mock_msg = Mock()
+            mock_msg.topic = topic
+            mock_msg.payload = json.dumps(payload).encode()
+            on_message(None, None, mock_msg)
+        
+        written = [c[0][0][:4] for c in mock_writer.submit.call_args_list]
+        self.assertEqual(written, [("VIN_B", 3.0, 4.0, 20.0), ("VIN_A", 1.0, 2.0, 10.0)])
+        self.assertEqual(buffer, {})
     
     def test_cleanup_buffer_expired_entries(self):
         """Test cleanup of expired buffer entries."""
-        from vehicle_digital_twin import cleanup_buffer, buffer
-        from time import time
+        from vehicle_digital_twin import cleanup_buffer, ensure_buffer, buffer, correlator, EXPIRATION_SECONDS
+        from time import monotonic
         
         buffer.clear()
+        start = monotonic()
         
-        # Add expired entry
-        old_time = time() - 100
-        buffer["VIN_OLD"] = {"timestamp": old_time}
+        # Add entry that will be expired by the time of the sweep
+        with patch.object(correlator, 'monotonic', return_value=start - 100):
+            ensure_buffer("VIN_OLD")
         
         # Add recent entry
-        buffer["VIN_NEW"] = {"timestamp": time()}
+        with patch.object(correlator, 'monotonic', return_value=start):
+            ensure_buffer("VIN_NEW")
         
-        cleanup_buffer()
+        cleanup_buffer(now=start + EXPIRATION_SECONDS / 2)
         
         self.assertNotIn("VIN_OLD", buffer)
         self.assertIn("VIN_NEW", buffer)
 
-
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
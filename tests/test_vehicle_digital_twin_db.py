@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import Mock, patch, MagicMock
 import sys
+import threading
+from datetime import date
 from pathlib import Path
 
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "vehicle_digital_twin"))
@@ -13,11 +15,38 @@ import db
 
 class TestVehicleDatabase(unittest.TestCase):
     
+    def setUp(self):
+        """Give every test a fresh pool backed by a mocked connection."""
+        db.close_pool()
+        self.mock_conn = Mock()
+        self.mock_conn.closed = 0
+        self.mock_cur = Mock()
+        self.mock_conn.cursor.return_value = self.mock_cur
+        self.mock_pool = Mock()
+        self.mock_pool.getconn.return_value = self.mock_conn
+        patcher = patch('db.pg_pool.ThreadedConnectionPool', return_value=self.mock_pool)
+        self.mock_pool_cls = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(db.close_pool)
+        # psycopg2 is a MagicMock here; except clauses need real exception classes
+        class OperationalError(Exception):
+            pass
+        for name, exc in (("Error", Exception), ("OperationalError", OperationalError),
+                          ("InterfaceError", OperationalError)):
+            exc_patcher = patch.object(db.psycopg2, name, exc)
+            exc_patcher.start()
+            self.addCleanup(exc_patcher.stop)
+        self.OperationalError = OperationalError
+
+    def executed(self):
+        return [c[0][0] for c in self.mock_cur.execute.call_args_list]
+
     @patch('db.psycopg2.connect')
     def test_init_db(self, mock_connect):
         """Test database initialization."""
         mock_conn = Mock()
         mock_cur = Mock()
+        mock_cur.fetchone.return_value = None
         mock_conn.cursor.return_value = mock_cur
         mock_connect.return_value = mock_conn
         
@@ -29,67 +58,304 @@ class TestVehicleDatabase(unittest.TestCase):
             user="user",
             password="pass"
         )
-        mock_cur.execute.assert_called_once()
+        executed = [c[0][0] for c in mock_cur.execute.call_args_list]
+        self.assertIn(db.SCHEMA, executed)
+        self.assertTrue(any("PARTITION OF vehicle_data FOR VALUES" in sql for sql in executed))
+        self.assertFalse(any("vehicle_data_legacy" in sql for sql in executed))
         mock_conn.commit.assert_called_once()
         mock_cur.close.assert_called_once()
         mock_conn.close.assert_called_once()
     
     @patch('db.psycopg2.connect')
-    def test_write_vehicle_data(self, mock_connect):
-        """Test writing vehicle data."""
-        mock_conn = Mock()
+    def test_init_db_migrates_unpartitioned_table(self, mock_connect):
+        """Test an existing plain vehicle_data table is copied into the partitioned one."""
         mock_cur = Mock()
-        mock_conn.cursor.return_value = mock_cur
-        mock_connect.return_value = mock_conn
+        mock_cur.fetchone.return_value = ("r",)
+        mock_connect.return_value.cursor.return_value = mock_cur
+        
+        db.init_db()
         
+        executed = [c[0][0] for c in mock_cur.execute.call_args_list]
+        rename = executed.index("ALTER TABLE vehicle_data RENAME TO vehicle_data_legacy")
+        self.assertLess(rename, executed.index(db.SCHEMA))
+        self.assertTrue(any("FROM vehicle_data_legacy" in sql for sql in executed))
+        self.assertEqual(executed.count("DROP TABLE vehicle_data_legacy"), 1)
+    
+    def test_drop_expired_partitions(self):
+        """Test retention drops whole daily partitions past the cutoff."""
+        cur = Mock()
+        cur.fetchall.return_value = [
+            ("vehicle_data_p20260901",), ("vehicle_data_p20261001",),
+            ("vehicle_data_p20261018",), ("vehicle_data_default",)
+        ]
+        
+        dropped = db.drop_expired_partitions(cur, retention_days=30, today=date(2026, 10, 18))
+        
+        self.assertEqual(dropped, ["vehicle_data_p20260901"])
+        executed = [c[0][0] for c in cur.execute.call_args_list]
+        self.assertIn("DROP TABLE IF EXISTS vehicle_data_p20260901", executed)
+        self.assertFalse(any("DROP TABLE IF EXISTS vehicle_data_p202610" in sql for sql in executed))
+    
+    def test_create_partitions_covers_days_ahead(self):
+        """Test one daily partition is created per day through the pre-create horizon."""
+        cur = Mock()
+        
+        db.create_partitions(cur, date(2026, 12, 31), days=2)
+        
+        created = [c[0][0] for c in cur.execute.call_args_list if "CREATE TABLE" in c[0][0]]
+        self.assertEqual(len(created), 3)
+        self.assertIn("vehicle_data_p20261231", created[0])
+        self.assertIn("FROM ('2027-01-02 00:00:00+00') TO ('2027-01-03 00:00:00+00')", created[2])
+    
+    def test_write_vehicle_data(self):
+        """Test writing vehicle data."""
         db.write_vehicle_data("VIN123", 45.5, -73.6, 90.0)
         
-        mock_cur.execute.assert_called_once()
-        args = mock_cur.execute.call_args[0]
-        self.assertIn("INSERT INTO vehicle_data", args[0])
-        self.assertEqual(args[1], ("VIN123", 45.5, -73.6, 90.0))
-        mock_conn.commit.assert_called_once()
+        args = self.mock_cur.execute.call_args[0]
+        self.assertIn("EXECUTE insert_vehicle_data", args[0])
+        self.assertEqual(args[1], ("VIN123", 45.5, -73.6, 90.0, None))
+        self.mock_conn.commit.assert_called()
+        self.mock_pool.putconn.assert_called_with(self.mock_conn)
+        self.mock_conn.close.assert_not_called()
     
-    @patch('db.psycopg2.connect')
-    def test_read_all_vehicle_data(self, mock_connect):
-        """Test reading all vehicle data."""
-        mock_conn = Mock()
-        mock_cur = Mock()
-        mock_conn.cursor.return_value = mock_cur
-        mock_connect.return_value = mock_conn
+    @patch('db.extras.execute_values')
+    def test_write_batch_upserts_rollups_in_same_transaction(self, mock_execute_values):
+        """Test rollup aggregates are merged before the batch's single COMMIT."""
+        rows = [("VIN123", 45.5, -73.6, 90.0, 60.0)]
+        aggregates = [("VIN123", 60, 1, 1, 90.0, 90.0, 90.0, 45.5, 45.5, -73.6, -73.6, 0.0)]
+        
+        db.write_vehicle_data_batch(rows, {"vehicle_rollup_1m": aggregates})
+        
+        self.assertEqual(mock_execute_values.call_count, 2)
+        upsert_sql = mock_execute_values.call_args_list[1][0][1]
+        self.assertIn("INSERT INTO vehicle_rollup_1m AS t", upsert_sql)
+        self.assertIn("ON CONFLICT (vin, bucket) DO UPDATE", upsert_sql)
+        self.assertEqual(mock_execute_values.call_args_list[1][0][2], aggregates)
+        self.mock_conn.commit.assert_called()
+    
+    @patch('db.extras.execute_values')
+    def test_write_unique_batch_inserts_only_new_keys(self, mock_execute_values):
+        """Test idempotent writes gate vehicle_data on ON CONFLICT DO NOTHING over the record keys."""
+        rows = [("vdt:1", "VIN123", 45.5, -73.6, 90.0, 60.0), ("vdt:2", "VIN123", 45.6, -73.7, 91.0, 61.0)]
+        self.mock_cur.rowcount = 1
+        
+        self.assertEqual(db.write_unique_vehicle_data_batch(rows), 1)
+        
+        sql = mock_execute_values.call_args[0][1]
+        self.assertIn("INSERT INTO vehicle_data_keys", sql)
+        self.assertIn("ON CONFLICT DO NOTHING", sql)
+        self.assertIn("JOIN fresh USING (record_key)", sql)
+        self.assertEqual(mock_execute_values.call_args[0][2], rows)
+        self.mock_conn.commit.assert_called()
+    
+    @patch('db.extras.execute_values')
+    def test_writes_bump_data_version(self, mock_execute_values):
+        """Test every write, failed ones included, moves the data version on."""
+        version = db.data_version()
+        db.write_vehicle_data_batch([("VIN123", 45.5, -73.6, 90.0, 60.0)])
+        self.assertEqual(db.data_version(), version + 1)
+        
+        mock_execute_values.side_effect = RuntimeError("constraint")
+        with self.assertRaises(RuntimeError):
+            db.write_vehicle_data_batch([("VIN123", 45.5, -73.6, 90.0, 60.0)])
+        self.assertEqual(db.data_version(), version + 2)
+        
+        # Nothing written, nothing to invalidate
+        db.write_vehicle_data_batch([])
+        self.assertEqual(db.data_version(), version + 2)
+    
+    def test_pool_is_shared_and_statements_prepared_once(self):
+        """Test repeated writes reuse one pool and prepare statements once per connection."""
+        db.write_vehicle_data("VIN123", 45.5, -73.6, 90.0)
+        db.write_vehicle_data("VIN123", 45.6, -73.7, 91.0)
+        
+        self.mock_pool_cls.assert_called_once()
+        prepares = [sql for sql in self.executed() if sql.startswith("PREPARE")]
+        self.assertEqual(len(prepares), len(db.PREPARED_STATEMENTS))
+        self.assertEqual(self.mock_pool.getconn.call_count, 2)
+    
+    def test_checkout_waits_for_a_free_connection(self):
+        """Test more borrowers than POOL_MAX_CONN queue for a connection instead of failing."""
+        with patch('db.POOL_MAX_CONN', 2):
+            first = db.get_connection()
+            second = db.get_connection()
+            first.__enter__()
+            second.__enter__()
+            got = threading.Event()
+            
+            def borrow():
+                with db.get_connection():
+                    got.set()
+            
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            self.assertFalse(got.wait(0.1))
+            second.__exit__(None, None, None)
+            self.assertTrue(got.wait(2))
+            thread.join(2)
+            first.__exit__(None, None, None)
+        self.assertEqual(self.mock_pool.getconn.call_count, 3)
+    
+    def test_checkout_times_out_when_pool_stays_exhausted(self):
+        """Test a borrower gives up with PoolError after POOL_WAIT_TIMEOUT."""
+        class PoolError(Exception):
+            pass
+        with patch('db.POOL_MAX_CONN', 1), patch('db.POOL_WAIT_TIMEOUT', 0.05), \
+                patch.object(db.pg_pool, 'PoolError', PoolError):
+            held = db.get_connection()
+            held.__enter__()
+            with self.assertRaises(PoolError):
+                with db.get_connection():
+                    pass
+            held.__exit__(None, None, None)
+        self.assertEqual(self.mock_pool.getconn.call_count, 1)
+    
+    def test_size_pool_only_grows_before_first_use(self):
+        """Test size_pool raises the connection limit until the pool is opened."""
+        with patch('db.POOL_MAX_CONN', 8):
+            db.size_pool(12)
+            self.assertEqual(db.POOL_MAX_CONN, 12)
+            db.size_pool(2)
+            self.assertEqual(db.POOL_MAX_CONN, 12)
+            db.write_vehicle_data("VIN123", 45.5, -73.6, 90.0)
+            with self.assertLogs(level="WARNING"):
+                db.size_pool(20)
+            self.assertEqual(db.POOL_MAX_CONN, 12)
+        self.assertEqual(self.mock_pool_cls.call_args[0][:2], (db.POOL_MIN_CONN, 12))
+    
+    def test_reconnect_on_connection_failure(self):
+        """Test a broken connection is discarded and the statement retried."""
+        broken_conn = Mock()
+        broken_conn.closed = 0
+        broken_conn.cursor.return_value.execute.side_effect = self.OperationalError("server closed")
+        self.mock_pool.getconn.side_effect = [broken_conn, self.mock_conn]
+        
+        with patch('db.time.sleep'):
+            db.write_vehicle_data("VIN123", 45.5, -73.6, 90.0)
+        
+        self.mock_pool.putconn.assert_any_call(broken_conn, close=True)
+        self.assertIn("EXECUTE insert_vehicle_data", self.executed()[-1])
+    
+    def test_write_not_retried_after_statement_sent(self):
+        """Test a plain INSERT that failed mid-transaction is not run again (it may have committed)."""
+        self.mock_conn.commit.side_effect = [None, self.OperationalError("server closed")]
+        
+        with patch('db.time.sleep'), self.assertRaises(db.WriteInDoubt):
+            db.write_vehicle_data_batch([("VIN123", 45.5, -73.6, 90.0, None)])
+        
+        self.assertEqual(self.mock_pool.getconn.call_count, 1)
+    
+    def test_idempotent_write_retried_after_statement_sent(self):
+        """Test the key-deduplicated INSERT is retried on a fresh connection."""
+        self.mock_conn.commit.side_effect = [None, self.OperationalError("server closed"), None, None]
+        self.mock_cur.rowcount = 1
+        
+        with patch('db.time.sleep'), patch('db.extras.execute_values') as execute_values:
+            self.assertEqual(db.write_unique_vehicle_data_batch([("k1", "VIN123", 45.5, -73.6, 90.0, None)]), 1)
+        
+        self.assertEqual(execute_values.call_count, 2)
+    
+    def test_unhealthy_connection_replaced(self):
+        """Test a closed pooled connection is discarded before use."""
+        dead_conn = Mock()
+        dead_conn.closed = 1
+        self.mock_pool.getconn.side_effect = [dead_conn, self.mock_conn]
         
+        db.write_vehicle_data("VIN123", 45.5, -73.6, 90.0)
+        
+        self.mock_pool.putconn.assert_any_call(dead_conn, close=True)
+        dead_conn.cursor.assert_not_called()
+    
+    def test_read_all_vehicle_data(self):
+        """Test reading all vehicle data."""
         expected_data = [
             ("VIN123", 45.5, -73.6, 90.0),
             ("VIN456", 46.5, -74.6, 180.0)
         ]
-        mock_cur.fetchall.return_value = expected_data
+        self.mock_cur.__iter__ = Mock(return_value=iter(expected_data))
         
         result = db.read_all_vehicle_data()
         
-        mock_cur.execute.assert_called_once()
+        self.assertIn("FROM vehicle_data", self.executed()[-1])
         self.assertEqual(result, expected_data)
-        mock_cur.close.assert_called_once()
-        mock_conn.close.assert_called_once()
+        self.mock_pool.putconn.assert_called_with(self.mock_conn)
     
-    @patch('db.psycopg2.connect')
-    def test_read_last_vehicle_data(self, mock_connect):
-        """Test reading last vehicle data."""
-        mock_conn = Mock()
-        mock_cur = Mock()
-        mock_conn.cursor.return_value = mock_cur
-        mock_connect.return_value = mock_conn
+    def test_iter_vehicle_data_uses_server_side_cursor(self):
+        """Test streaming reads use a named cursor with the configured itersize."""
+        self.mock_cur = MagicMock()
+        self.mock_conn.cursor.return_value = self.mock_cur
+        self.mock_cur.__iter__.return_value = iter([("VIN123", 45.5, -73.6, 90.0)])
+        
+        rows = db.iter_vehicle_data("VIN123", itersize=50)
+        self.mock_pool.getconn.assert_not_called()
+        self.assertEqual(list(rows), [("VIN123", 45.5, -73.6, 90.0)])
+        
+        self.assertTrue(self.mock_conn.cursor.call_args.kwargs["name"].startswith("vehicle_data_"))
+        self.assertEqual(self.mock_cur.itersize, 50)
+        self.assertEqual(self.mock_cur.execute.call_args[0][1], ("VIN123",))
+        self.mock_cur.close.assert_called()
+        self.mock_pool.putconn.assert_called_with(self.mock_conn)
+    
+    def test_abandoned_stream_returns_connection(self):
+        """Test closing a partially consumed stream hands the connection back."""
+        self.mock_cur = MagicMock()
+        self.mock_conn.cursor.return_value = self.mock_cur
+        self.mock_cur.__iter__.return_value = iter([("VIN1", 1, 1, 1), ("VIN2", 2, 2, 2)])
+        
+        rows = db.iter_vehicle_data()
+        next(rows)
+        rows.close()
         
+        self.mock_cur.close.assert_called()
+        self.mock_pool.putconn.assert_called_with(self.mock_conn)
+    
+    def test_read_last_vehicle_data(self):
+        """Test reading last vehicle data."""
         expected_data = ("VIN123", 45.5, -73.6, 90.0)
-        mock_cur.fetchone.return_value = expected_data
+        self.mock_cur.fetchone.return_value = expected_data
         
         result = db.read_last_vehicle_data()
         
-        mock_cur.execute.assert_called_once()
-        args = mock_cur.execute.call_args[0][0]
-        self.assertIn("ORDER BY id DESC", args)
-        self.assertIn("LIMIT 1", args)
+        self.assertEqual(self.executed()[-1], "EXECUTE select_last_vehicle_data")
+        sql = db.PREPARED_STATEMENTS["select_last_vehicle_data"]
+        self.assertIn("ORDER BY id DESC", sql)
+        self.assertIn("LIMIT 1", sql)
         self.assertEqual(result, expected_data)
-
+    
+    def test_read_last_vehicle_data_by_vin(self):
+        """Test the per-VIN variant uses its own prepared statement."""
+        self.mock_cur.fetchone.return_value = ("VIN123", 45.5, -73.6, 90.0)
+        
+        db.read_last_vehicle_data("VIN123")
+        
+        self.mock_cur.execute.assert_called_with("EXECUTE select_last_vehicle_data_by_vin (%s)", ("VIN123",))
+        self.assertIn("WHERE vin = $1", db.PREPARED_STATEMENTS["select_last_vehicle_data_by_vin"])
+    
+    def test_iter_latest_vehicle_data(self):
+        """Test the latest row per VIN is streamed with DISTINCT ON."""
+        self.mock_cur = MagicMock()
+        self.mock_conn.cursor.return_value = self.mock_cur
+        self.mock_cur.__iter__.return_value = iter([("VIN1", 1, 1, 1), ("VIN2", 2, 2, 2)])
+        
+        self.assertEqual(len(list(db.iter_latest_vehicle_data())), 2)
+        
+        self.assertIn("DISTINCT ON (vin)", self.executed()[-1])
+        self.mock_pool.putconn.assert_called_with(self.mock_conn)
+    
+    def test_iter_vehicle_data_since_watermark(self):
+        """Test incremental reads return rows above the watermark in id order."""
+        self.mock_cur = MagicMock()
+        self.mock_conn.cursor.return_value = self.mock_cur
+        self.mock_cur.__iter__.return_value = iter([(11, "VIN1", 1, 1, 1, 100.0)])
+        
+        rows = list(db.iter_vehicle_data_since(10, "VIN1", limit=5))
+        
+        self.assertEqual(rows, [(11, "VIN1", 1, 1, 1, 100.0)])
+        sql, params = self.mock_cur.execute.call_args[0]
+        self.assertIn("id > %s", sql)
+        self.assertTrue(sql.rstrip().endswith("ORDER BY id LIMIT %s"))
+        self.assertEqual(params, (10, "VIN1", 5))
+        self.mock_pool.putconn.assert_called_with(self.mock_conn)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,161 @@
+import logging
+import threading
+from typing import Any, Callable, Dict, List
+import paho.mqtt.client as mqtt
+
+Handler = Callable[[Any, Any, Any], None]
+
+class _Node:
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.handlers: List[Handler] = []
+
+class SubscriptionTrie:
+    """MQTT topic filters -> handlers, matched level by level with + and # wildcards.
+
+    Matching walks at most two branches per topic level (the literal level and
+    "+"), plus the "#" child at each step, so its cost is independent of the
+    number of subscriptions. As the MQTT spec requires, wildcards at the first
+    level do not match topics starting with "$" (e.g. $SYS).
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.Lock()
+
+    def add(self, topic_filter: str, handler: Handler) -> bool:
+        """Register handler; returns True if topic_filter had no handlers before."""
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _Node())
+            first = not node.handlers
+            # Copy-on-write so match() can iterate without the lock
+            node.handlers = node.handlers + [handler]
+            return first
+
+    def remove(self, topic_filter: str, handler: Handler) -> bool:
+        """Unregister handler; returns True if topic_filter has no handlers left."""
+        with self._lock:
+            path = [self._root]
+            for level in topic_filter.split("/"):
+                node = path[-1].children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            node = path[-1]
+            if handler not in node.handlers:
+                return False
+            node.handlers = [h for h in node.handlers if h is not handler]
+            if node.handlers:
+                return False
+            # Prune branches left without handlers or children
+            levels = topic_filter.split("/")
+            for i in range(len(levels), 0, -1):
+                child = path[i]
+                if child.handlers or child.children:
+                    break
+                del path[i - 1].children[levels[i - 1]]
+            return True
+
+    def filters(self) -> List[str]:
+        """Every topic filter with at least one handler."""
+        found = []
+        stack = [(self._root, [])]
+        while stack:
+            node, levels = stack.pop()
+            if node.handlers and levels:
+                found.append("/".join(levels))
+            for level, child in node.children.items():
+                stack.append((child, levels + [level]))
+        return found
+
+    def match(self, topic: str) -> List[Handler]:
+        levels = topic.split("/")
+        system = topic.startswith("$")
+        matched: List[Handler] = []
+        nodes = [self._root]
+        for i, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                wildcards = not (system and i == 0)
+                if wildcards:
+                    multi = node.children.get("#")
+                    if multi is not None:
+                        matched.extend(multi.handlers)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+                if wildcards:
+                    single = node.children.get("+")
+                    if single is not None:
+                        next_nodes.append(single)
+            nodes = next_nodes
+            if not nodes:
+                return matched
+        for node in nodes:
+            matched.extend(node.handlers)
+            # "a/#" also matches "a" itself
+            multi = node.children.get("#")
+            if multi is not None:
+                matched.extend(multi.handlers)
+        return matched
+
+class TopicRouter:
+    """One broker connection shared by every plugin, dispatching messages through a SubscriptionTrie.
+
+    Handlers have the paho on_message signature, handler(client, userdata, msg),
+    and run on the connection's network thread unless the plugin wrapped them
+    for its own executor (see MqttListenerPlugin.subscribe). A failing handler
+    is logged and does not affect the others. Broker subscriptions are
+    reference-counted per filter and replayed on every (re)connect.
+    """
+
+    def __init__(self, broker: str, port: int = 1883, client_id: str = "", keepalive: int = 60):
+        self.broker = broker
+        self.port = port
+        self.keepalive = keepalive
+        self.trie = SubscriptionTrie()
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self._started = False
+
+    def subscribe(self, topic_filter: str, handler: Handler) -> None:
+        if self.trie.add(topic_filter, handler) and self._started:
+            self.client.subscribe(topic_filter)
+
+    def unsubscribe(self, topic_filter: str, handler: Handler) -> None:
+        if self.trie.remove(topic_filter, handler) and self._started:
+            self.client.unsubscribe(topic_filter)
+
+    def publish(self, topic: str, payload: Any = None, qos: int = 0, retain: bool = False):
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    def start(self) -> "TopicRouter":
+        """Connect and run the network loop on a background thread."""
+        self._started = True
+        self.client.connect(self.broker, self.port, self.keepalive)
+        self.client.loop_start()
+        logging.info("Shared MQTT connection to %s:%d started", self.broker, self.port)
+        return self
+
+    def stop(self) -> None:
+        self._started = False
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        filters = self.trie.filters()
+        if filters:
+            client.subscribe([(f, 0) for f in filters])
+        logging.info("Shared MQTT connection subscribed to %d topic filters", len(filters))
+
+    def _on_message(self, client, userdata, msg):
+        for handler in self.trie.match(msg.topic):
+            try:
+                handler(client, userdata, msg)
+            except Exception:
+                logging.exception("Handler for %s failed", msg.topic)
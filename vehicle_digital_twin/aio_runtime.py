@@ -0,0 +1,184 @@
+import asyncio
+import inspect
+import logging
+import time
+from collections import deque
+
+# Selected at startup with TWIN_RUNTIME: "threads" (paho loop threads and
+# psycopg2, the default) or "asyncio" (aiomqtt and asyncpg on one event loop)
+RUNTIMES = ("threads", "asyncio")
+
+
+class Message:
+    """The parts of a paho MQTTMessage the twins' on_message handlers use."""
+
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class AsyncBatchWriter:
+    """BatchWriter for the event loop: group commit with an async ``flush(rows)``.
+
+    ``submit`` only appends, so the synchronous merge code can call it. The
+    producer pushes back with ``await wait_for_space()`` once ``max_queue``
+    rows are waiting. Same flush rule (``max_batch`` rows or ``max_delay``
+    seconds), retry of failed flushes and stats as BatchWriter.
+    """
+
+    def __init__(self, flush, max_batch=500, max_delay=0.05, max_queue=10000,
+                 name="batch-writer", report_interval=60.0, max_retries=5, retry_backoff=0.5, retryable=None):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retryable = retryable or (lambda exc: True)
+        self.max_queue = max_queue
+        self.name = name
+        self.report_interval = report_interval
+        self._rows = deque()
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._stopping = False
+        self._task = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.retries = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def submit(self, row):
+        self._rows.append(row)
+        self._ready.set()
+
+    async def wait_for_space(self):
+        while len(self._rows) >= self.max_queue:
+            self._space.clear()
+            await self._space.wait()
+
+    def qsize(self):
+        return len(self._rows)
+
+    async def stop(self):
+        """Flush everything queued and wait for the writer task."""
+        self._stopping = True
+        self._ready.set()
+        if self._task is not None:
+            await self._task
+        logging.info("[%s] stopped: %s", self.name, self.stats())
+
+    def stats(self):
+        return {
+            "queued": len(self._rows),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "retries": self.retries,
+            "last_flush_latency": self.last_flush_latency,
+            "avg_flush_latency": self._total_flush_latency / self.flushes if self.flushes else 0.0,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        while not self._rows:
+            if self._stopping:
+                return []
+            self._ready.clear()
+            await self._ready.wait()
+        deadline = loop.time() + self.max_delay
+        while len(self._rows) < self.max_batch and not self._stopping:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        batch = [self._rows.popleft() for _ in range(min(self.max_batch, len(self._rows)))]
+        self._space.set()
+        return batch
+
+    async def _write(self, batch):
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._flush(batch)
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not self.retryable(e):
+                    logging.exception("[%s] failed to flush %d rows", self.name, len(batch))
+                    self.rows_failed += len(batch)
+                    return
+                delay = self.retry_backoff * 2 ** attempt
+                logging.warning("[%s] flush of %d rows failed (%s); retrying in %.1fs",
+                                self.name, len(batch), e, delay)
+                self.retries += 1
+                await asyncio.sleep(delay)
+        latency = time.perf_counter() - start
+        self.flushes += 1
+        self.rows_written += len(batch)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self._total_flush_latency += latency
+
+    async def _run(self):
+        next_report = time.monotonic() + self.report_interval
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                return
+            await self._write(batch)
+            if time.monotonic() >= next_report:
+                logging.info("[%s] %s", self.name, self.stats())
+                next_report = time.monotonic() + self.report_interval
+
+
+async def consume(broker, topics, on_message, port=1883, client_id="", keepalive=60, reconnect_delay=1.0):
+    """Subscribe to topics and await on_message(client, None, msg) for every message, reconnecting forever.
+
+    on_message may be a plain function or a coroutine function; messages are
+    handled one at a time, in order.
+    """
+    import aiomqtt
+    is_coroutine = inspect.iscoroutinefunction(on_message)
+    while True:
+        try:
+            async with aiomqtt.Client(broker, port, identifier=client_id or None, keepalive=keepalive) as client:
+                await client.subscribe([(topic, 0) for topic in topics])
+                logging.info("Async MQTT client subscribed to %s", ", ".join(topics))
+                async for message in client.messages:
+                    msg = Message(message.topic.value, message.payload, message.qos, message.retain)
+                    if is_coroutine:
+                        await on_message(client, None, msg)
+                    else:
+                        on_message(client, None, msg)
+        except aiomqtt.MqttError as e:
+            logging.warning("Async MQTT connection to %s lost (%s); reconnecting", broker, e)
+        await asyncio.sleep(reconnect_delay)
+
+
+async def run_periodically(work, interval, name, blocking=False):
+    """Call work() every interval seconds on the loop, or on the default executor when blocking."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if blocking:
+                await loop.run_in_executor(None, work)
+            else:
+                work()
+        except Exception as e:
+            logging.exception("%s failed: %s", name, e)
+        await asyncio.sleep(interval)
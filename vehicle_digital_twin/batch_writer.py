@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+import time
+
+
+class BatchWriter:
+    """Group-commit writer: rows are queued and flushed in batches from one thread.
+
+    A batch is flushed when it reaches ``max_batch`` rows or when its oldest
+    row has waited ``max_delay`` seconds, whichever comes first. ``submit``
+    blocks while the queue is full, which pushes back on the producer.
+
+    A failed flush is retried with the same batch up to ``max_retries``
+    times, backing off from ``retry_backoff`` seconds; meanwhile rows keep
+    queueing, so a short outage turns into backpressure instead of lost
+    rows. Errors for which ``retryable(exc)`` is false are not retried.
+    """
+
+    def __init__(self, flush, max_batch=500, max_delay=0.05, max_queue=10000,
+                 name="batch-writer", report_interval=60.0, row_queue=None,
+                 max_retries=5, retry_backoff=0.5, retryable=None):
+        self._flush = flush
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retryable = retryable or (lambda exc: True)
+        self.report_interval = report_interval
+        self.name = name
+        # Any object with put/get/get_nowait/qsize (e.g. a pipeline StageQueue)
+        self.row_queue = row_queue if row_queue is not None else queue.Queue(max_queue)
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._lock = threading.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.retries = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self._total_flush_latency = 0.0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def submit(self, row, timeout=None):
+        """Queue one row; raises queue.Full if it cannot be queued within timeout."""
+        self.row_queue.put(row, timeout=timeout)
+
+    def stop(self, timeout=None):
+        """Stop accepting time-based flushes, drain everything queued and wait for the thread."""
+        self._stopping.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        logging.info("[%s] stopped: %s", self.name, self.stats())
+
+    def qsize(self):
+        return self.row_queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self.row_queue.qsize(),
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "retries": self.retries,
+                "last_flush_latency": self.last_flush_latency,
+                "avg_flush_latency": self._total_flush_latency / self.flushes if self.flushes else 0.0,
+                "max_flush_latency": self.max_flush_latency,
+            }
+
+    def _next_batch(self):
+        try:
+            batch = [self.row_queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopping.is_set():
+                break
+            try:
+                # Short waits so stop() is noticed while a batch is filling
+                batch.append(self.row_queue.get(timeout=min(remaining, 0.1)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.row_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self._flush(batch)
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not self.retryable(e):
+                    logging.exception("[%s] failed to flush %d rows", self.name, len(batch))
+                    with self._lock:
+                        self.rows_failed += len(batch)
+                    return
+                delay = self.retry_backoff * 2 ** attempt
+                logging.warning("[%s] flush of %d rows failed (%s); retrying in %.1fs",
+                                self.name, len(batch), e, delay)
+                with self._lock:
+                    self.retries += 1
+                time.sleep(delay)
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self._total_flush_latency += latency
+
+    def _run(self):
+        next_report = time.monotonic() + self.report_interval
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            if time.monotonic() >= next_report:
+                logging.info("[%s] %s", self.name, self.stats())
+                next_report = time.monotonic() + self.report_interval
+        # Shutdown: flush whatever is still queued
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
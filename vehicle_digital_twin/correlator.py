@@ -0,0 +1,192 @@
+import time
+
+from expiry import TimerWheel
+
+PARTS = ("vin", "location", "giro")
+EVICTION_POLICIES = ("oldest", "reject")
+# Bit per part in PartialRecord.present
+PART_BITS = {"vin": 1, "location": 2, "giro": 4}
+TS_ATTRS = {"vin": "ts_vin", "location": "ts_location", "giro": "ts_giro"}
+
+
+class PartialRecord:
+    """One VIN's buffered parts as plain slots: no per-record or per-part dicts.
+
+    Only the values the DB row needs are kept from each payload; ``row()``
+    builds the (vin, latitude, longitude, giro, event_time) tuple written to
+    vehicle_data.
+    """
+
+    __slots__ = ("vin", "present", "latitude", "longitude", "giro",
+                 "opened", "expires", "ts_vin", "ts_location", "ts_giro")
+
+    def __init__(self, vin, opened, expires=None):
+        self.vin = vin
+        self.present = 0
+        self.latitude = None
+        self.longitude = None
+        self.giro = None
+        self.opened = opened
+        self.expires = expires
+        self.ts_vin = None
+        self.ts_location = None
+        self.ts_giro = None
+
+    def has(self, part):
+        return bool(self.present & PART_BITS[part])
+
+    def event_time(self):
+        """When the vehicle was at this location: the location's ts, else the record's opening time."""
+        return self.ts_location if self.ts_location is not None else self.opened
+
+    def row(self):
+        return (self.vin, self.latitude, self.longitude, self.giro, self.event_time())
+
+
+class Correlator:
+    """Streaming join of the vin/location/giro topics, keyed by VIN.
+
+    Every part is filed under its VIN with a single dict lookup. A VIN's partial
+    record stays open for ``window`` seconds of event time (the part's ``ts``,
+    or arrival time when it has none):
+
+    - a part newer than the open record's window starts a fresh record and the
+      stale one is dropped (``superseded``);
+    - a part older than the window, or older than the part already held for the
+      same slot, is dropped (``late``); a newer one replaces it (``replaced``).
+
+    A record is complete once all ``required`` parts are present. Parts that
+    carry no VIN (legacy producers) are attributed to the last VIN announced on
+    the vin topic.
+
+    Incomplete records are dropped by ``expire()`` ``ttl`` seconds (arrival
+    time) after they were created, driven by a timer wheel. At most
+    ``max_entries`` records are buffered: when full, ``eviction="oldest"``
+    evicts the record closest to expiry and ``"reject"`` drops the new part.
+    """
+
+    def __init__(self, required=PARTS, window=30.0, ttl=30.0, max_entries=None,
+                 eviction="oldest", clock=time.time, monotonic=time.monotonic, wheel_tick=1.0):
+        unknown = set(required) - set(PARTS)
+        if unknown:
+            raise ValueError(f"unknown parts {sorted(unknown)}, expected a subset of {PARTS}")
+        if eviction not in EVICTION_POLICIES:
+            raise ValueError(f"unknown eviction policy {eviction!r}, expected one of {EVICTION_POLICIES}")
+        self.required = tuple(required)
+        self._required_mask = sum(PART_BITS[part] for part in self.required)
+        self.window = window
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.clock = clock
+        self.monotonic = monotonic
+        self.partials = {}
+        self.last_vin = None
+        # Span the wheel over the whole TTL so every timer fires within one revolution
+        self._wheel = TimerWheel(wheel_tick, int(ttl / wheel_tick) + 2, now=monotonic())
+        self.stats = {"completed": 0, "late": 0, "replaced": 0, "superseded": 0, "unattributed": 0,
+                      "expired": 0, "evicted": 0, "rejected": 0}
+
+    def ensure(self, vin, ts=None):
+        """Return the open record for vin, creating an empty one if needed (None if rejected)."""
+        record = self.partials.get(vin)
+        if record is None:
+            if self.max_entries is not None and len(self.partials) >= self.max_entries:
+                if self.eviction == "reject":
+                    self.stats["rejected"] += 1
+                    return None
+                self._evict_one()
+            record = PartialRecord(vin, self.clock() if ts is None else ts)
+            record.expires = self._wheel.schedule(vin, self.monotonic() + self.ttl)
+            self.partials[vin] = record
+        return record
+
+    def remove(self, vin):
+        """Drop vin's record and its expiry timer; returns the record or None."""
+        record = self.partials.pop(vin, None)
+        if record is not None:
+            self._wheel.cancel(vin)
+        return record
+
+    def _evict_one(self):
+        while True:
+            timer = self._wheel.pop_earliest()
+            if timer is None:
+                return
+            vin, due = timer
+            record = self.partials.get(vin)
+            if record is not None and record.expires == due:
+                del self.partials[vin]
+                self.stats["evicted"] += 1
+                return
+
+    def expire(self, now=None):
+        """Drop partial records whose TTL elapsed; returns the expired VINs."""
+        expired = []
+        for vin, due in self._wheel.advance(self.monotonic() if now is None else now):
+            record = self.partials.get(vin)
+            # Records leave the wheel when they complete or are dropped, so every due timer should match
+            if record is not None and record.expires == due:
+                del self.partials[vin]
+                expired.append(vin)
+        self.stats["expired"] += len(expired)
+        return expired
+
+    def add(self, part, payload):
+        """File one part; returns the VIN it was correlated to, or None if it was dropped."""
+        vin = payload.get("vin")
+        if vin is None:
+            vin = self.last_vin
+            if vin is None:
+                self.stats["unattributed"] += 1
+                return None
+        elif part == "vin":
+            self.last_vin = vin
+
+        ts = payload.get("ts")
+        if ts is None:
+            ts = self.clock()
+
+        record = self.partials.get(vin)
+        if record is not None:
+            if ts - record.opened > self.window:
+                self.stats["superseded"] += 1
+                self.remove(vin)
+                record = None
+            elif record.opened - ts > self.window:
+                self.stats["late"] += 1
+                return None
+        if record is None:
+            record = self.ensure(vin, ts)
+            if record is None:
+                return None
+
+        ts_attr = TS_ATTRS[part]
+        held = getattr(record, ts_attr)
+        if held is not None:
+            if ts < held:
+                self.stats["late"] += 1
+                return vin
+            self.stats["replaced"] += 1
+        if part == "location":
+            record.latitude = payload.get("latitude")
+            record.longitude = payload.get("longitude")
+        elif part == "giro":
+            record.giro = payload.get("giro")
+        setattr(record, ts_attr, ts)
+        record.present |= PART_BITS[part]
+        if ts < record.opened:
+            record.opened = ts
+        return vin
+
+    def is_complete(self, record):
+        return record.present & self._required_mask == self._required_mask
+
+    def pop_complete(self, vin):
+        """Remove and return vin's record if it is complete, else None."""
+        record = self.partials.get(vin)
+        if record is None or not self.is_complete(record):
+            return None
+        self.remove(vin)
+        self.stats["completed"] += 1
+        return record
@@ -0,0 +1,78 @@
+import math
+
+
+class TimerWheel:
+    """Hashed timer wheel: O(1) schedule, amortized O(1) expiry per timer.
+
+    Time is cut into ticks of ``tick`` seconds and timers are hashed into
+    ``slots`` buckets by their deadline tick. Size the wheel so that
+    ``tick * slots`` covers the longest TTL; longer timers still work but are
+    re-examined once per revolution.
+
+    A key has at most one timer: scheduling it again moves the timer, and
+    ``cancel`` removes it through a key -> due tick index, so the wheel only
+    holds the timers of live entries.
+    """
+
+    def __init__(self, tick=1.0, slots=64, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self._wheel = [dict() for _ in range(slots)]
+        self._current = self.tick_of(now)
+        # key -> due tick of its timer, to find the bucket it sits in
+        self._due = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def tick_of(self, t):
+        return math.floor(t / self.tick)
+
+    def schedule(self, key, deadline):
+        """Arm (or move) the timer for key; returns its deadline tick."""
+        self.cancel(key)
+        due = max(math.ceil(deadline / self.tick), self._current + 1)
+        self._wheel[due % self.slots][key] = due
+        self._due[key] = due
+        return due
+
+    def cancel(self, key):
+        """Remove key's timer; returns False if it had none."""
+        due = self._due.pop(key, None)
+        if due is None:
+            return False
+        del self._wheel[due % self.slots][key]
+        return True
+
+    def advance(self, now):
+        """Yield (key, due_tick) for every timer that is due at time now."""
+        target = self.tick_of(now)
+        if target <= self._current:
+            return
+        # After a long pause every bucket is visited once rather than once per tick
+        start = max(self._current + 1, target - self.slots + 1)
+        self._current = target
+        for t in range(start, target + 1):
+            bucket = self._wheel[t % self.slots]
+            if not bucket:
+                continue
+            due = [(key, d) for key, d in bucket.items() if d <= target]
+            for key, d in due:
+                del bucket[key]
+                del self._due[key]
+                yield key, d
+
+    def pop_earliest(self):
+        """Remove and return a (key, due_tick) timer from the next bucket to fire, or None.
+
+        Exact while the wheel span covers every TTL; timers of later revolutions
+        sharing that bucket may be picked otherwise.
+        """
+        for offset in range(1, self.slots + 1):
+            bucket = self._wheel[(self._current + offset) % self.slots]
+            if bucket:
+                # popitem() is O(1); timers within one bucket share their due tick
+                key, due = bucket.popitem()
+                del self._due[key]
+                return key, due
+        return None
@@ -0,0 +1,241 @@
+"""In-process metrics (counters, gauges, histograms) served in Prometheus text format.
+
+Recording is a lock-protected add on a pre-resolved metric object, cheap
+enough to leave on in production. Hold on to the object returned by
+``counter()`` / ``histogram()`` (or by ``.labels(...)``) instead of looking it
+up per event. Values that already exist elsewhere (queue depths, buffer
+sizes, stats dicts) are exported with ``fn=`` callbacks, which are only
+evaluated on scrape; a labelled callback returns {label value: value}.
+
+    REQUESTS = REGISTRY.counter("rpc_requests_total", "RPC requests", ("method",))
+    REQUESTS.labels(method="read").inc()
+    start_http_server(9100)  # GET /metrics
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, 0.5 ms to 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._fn = fn
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, **labels):
+        """The child metric for one combination of label values (cached)."""
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Yield (suffix, label values, extra labels, value)."""
+        if self._fn is not None:
+            value = self._fn()
+            if not self.labelnames:
+                yield "", (), (), value
+                return
+            # A labelled callback returns {label value (or tuple of values): value}
+            for key, v in value.items():
+                yield "", key if isinstance(key, tuple) else (key,), (), v
+            return
+        children = list(self._children.items()) if self.labelnames else [((), self)]
+        for key, child in children:
+            yield from child._child_samples(key)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames, fn)
+        self.value = 0
+
+    def _new_child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def _child_samples(self, key):
+        yield "", key, (), self.value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), fn=None):
+        super().__init__(name, documentation, labelnames, fn)
+        self.value = 0
+
+    def _new_child(self):
+        return Gauge(self.name, self.documentation)
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _child_samples(self, key):
+        yield "", key, (), self.value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        """Observe the duration of the with-block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def _child_samples(self, key):
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            yield "_bucket", key, (("le", _format_value(bound)),), cumulative
+        yield "_sum", key, (), total
+        yield "_count", key, (), count
+
+
+class Registry:
+    """Named metrics; registering an existing name returns the existing metric."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} already registered as a {metric.kind}")
+            elif kwargs.get("fn") is not None:
+                # Re-registered callback (e.g. a restarted plugin): collect from the new one
+                metric._fn = kwargs["fn"]
+            return metric
+
+    def counter(self, name, documentation, labelnames=(), fn=None):
+        return self._register(Counter, name, documentation, labelnames, fn=fn)
+
+    def gauge(self, name, documentation, labelnames=(), fn=None):
+        return self._register(Gauge, name, documentation, labelnames, fn=fn)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        """All metrics in Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        blocks = []
+        for metric in metrics:
+            try:
+                blocks.append(metric.render())
+            except Exception:
+                logging.exception("Failed to collect metric %s", metric.name)
+        return "\n".join(blocks) + "\n"
+
+
+# Process-wide registry used by the twins, db.py and (via the plugin context) the plugins
+REGISTRY = Registry()
+
+
+def start_http_server(port, registry=REGISTRY, host="0.0.0.0"):
+    """Serve registry on http://host:port/metrics from a daemon thread; returns the server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info("Serving metrics on %s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,171 @@
+import math
+import time
+
+import db
+
+# (name, bucket seconds), finest first. Each tier is one vehicle_rollup_<name> table.
+TIERS = (("1m", 60), ("1h", 3600), ("1d", 86400))
+# Buckets older than this many days are pruned; None keeps the tier forever
+RETENTION_DAYS = {"1m": 7, "1h": 90, "1d": None}
+EARTH_RADIUS_M = 6371000.0
+
+
+def table_name(tier):
+    return f"vehicle_rollup_{tier}"
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+class RollupBucket:
+    """Running aggregate of one VIN over one time bucket."""
+
+    __slots__ = ("samples", "giro_count", "giro_sum", "giro_min", "giro_max",
+                 "lat_min", "lat_max", "lon_min", "lon_max", "distance_m")
+
+    def __init__(self):
+        self.samples = 0
+        self.giro_count = 0
+        self.giro_sum = 0.0
+        self.giro_min = None
+        self.giro_max = None
+        self.lat_min = None
+        self.lat_max = None
+        self.lon_min = None
+        self.lon_max = None
+        self.distance_m = 0.0
+
+    def add(self, lat, lon, giro, distance):
+        self.samples += 1
+        if giro is not None:
+            self.giro_count += 1
+            self.giro_sum += giro
+            self.giro_min = giro if self.giro_min is None else min(self.giro_min, giro)
+            self.giro_max = giro if self.giro_max is None else max(self.giro_max, giro)
+        if lat is not None and lon is not None:
+            self.lat_min = lat if self.lat_min is None else min(self.lat_min, lat)
+            self.lat_max = lat if self.lat_max is None else max(self.lat_max, lat)
+            self.lon_min = lon if self.lon_min is None else min(self.lon_min, lon)
+            self.lon_max = lon if self.lon_max is None else max(self.lon_max, lon)
+        self.distance_m += distance
+
+    def values(self):
+        return (self.samples, self.giro_count, self.giro_sum, self.giro_min, self.giro_max,
+                self.lat_min, self.lat_max, self.lon_min, self.lon_max, self.distance_m)
+
+
+class RollupAggregator:
+    """Folds each written batch of vehicle_data rows into per-tier bucket aggregates.
+
+    ``aggregate(rows)`` returns {rollup table: [db.ROLLUP_COLUMNS rows]} ready
+    for db.write_vehicle_data_batch, which upserts them in the same transaction
+    as the raw rows. Distance travelled is summed leg by leg in event-time
+    order; the last position of every VIN is remembered across batches, and a
+    leg is counted in the bucket of its later point. Rows older than the VIN's
+    last position add no distance.
+
+    The positions a batch moves to are only remembered once ``commit()`` is
+    called after its write succeeded: a retried batch is aggregated against
+    the same positions again, and a dropped one leaves them where they were.
+
+    Not thread-safe: call it from the single writer thread.
+    """
+
+    def __init__(self, tiers=TIERS, clock=time.time):
+        self.tiers = tuple(tiers)
+        self.clock = clock
+        self._last = {}
+        self._staged = {}
+
+    def aggregate(self, rows):
+        now = self.clock()
+        staged = self._staged = {}
+        timed = [(row[0], row[4] if len(row) > 4 and row[4] is not None else now, row) for row in rows]
+        timed.sort(key=lambda item: (item[0], item[1]))
+        buckets = {name: {} for name, _ in self.tiers}
+        for vin, t, row in timed:
+            lat, lon, giro = row[1], row[2], row[3]
+            distance = 0.0
+            if lat is not None and lon is not None:
+                last = staged.get(vin) or self._last.get(vin)
+                if last is None or t >= last[0]:
+                    if last is not None:
+                        distance = haversine(last[1], last[2], lat, lon)
+                    staged[vin] = (t, lat, lon)
+            for name, seconds in self.tiers:
+                key = (vin, int(t // seconds) * seconds)
+                bucket = buckets[name].get(key)
+                if bucket is None:
+                    bucket = buckets[name][key] = RollupBucket()
+                bucket.add(lat, lon, giro, distance)
+        return {
+            table_name(name): [key + bucket.values() for key, bucket in tier.items()]
+            for name, tier in buckets.items()
+        }
+
+    def commit(self):
+        """Remember the positions of the last aggregated batch, once it is written."""
+        self._last.update(self._staged)
+        self._staged = {}
+
+
+def choose_tier(since, until, resolution=None, tiers=TIERS):
+    """Coarsest tier that answers [since, until) at ``resolution`` seconds exactly.
+
+    A tier qualifies when its bucket size divides the resolution (default: the
+    whole range as one bucket) and both bounds fall on its bucket edges.
+    Returns (name, seconds), or None when not even the finest tier aligns.
+    """
+    resolution = resolution or (until - since)
+    for name, seconds in reversed(tiers):
+        if resolution % seconds == 0 and since % seconds == 0 and until % seconds == 0:
+            return name, seconds
+    return None
+
+
+def query_history(since, until, resolution=None, vin=None, now=None):
+    """Aggregates per VIN over [since, until) (epoch seconds) in buckets of ``resolution`` seconds.
+
+    Served from the coarsest rollup tier that answers the query and still
+    retains ``since``, so the cost is O(buckets) rather than O(raw rows).
+    Bounds and resolution that do not fall on that tier's bucket edges are
+    widened to the enclosing buckets of the finest usable tier.
+    """
+    now = time.time() if now is None else now
+    tiers = [(name, seconds) for name, seconds in TIERS
+             if RETENTION_DAYS.get(name) is None or since >= now - RETENTION_DAYS[name] * 86400]
+    tier = choose_tier(since, until, resolution, tiers)
+    if tier is None:
+        seconds = tiers[0][1]
+        since = since // seconds * seconds
+        until = -(-until // seconds) * seconds
+        resolution = max(-(-(resolution or (until - since)) // seconds) * seconds, seconds)
+        tier = choose_tier(since, until, resolution, tiers)
+    name, _ = tier
+    rows = db.read_rollups(table_name(name), since, until, resolution or (until - since), vin)
+    return [
+        {"vin": r[0], "bucket": r[1], "samples": r[2], "giro_avg": r[3], "giro_min": r[4], "giro_max": r[5],
+         "lat_min": r[6], "lat_max": r[7], "lon_min": r[8], "lon_max": r[9], "distance_m": r[10]}
+        for r in rows
+    ]
+
+
+def init_rollups():
+    db.init_rollups([table_name(name) for name, _ in TIERS])
+
+
+def prune(now=None):
+    """Drop buckets past each tier's retention; returns {tier: deleted rows}."""
+    now = time.time() if now is None else now
+    deleted = {}
+    for name, _ in TIERS:
+        days = RETENTION_DAYS.get(name)
+        if days is not None:
+            deleted[name] = db.prune_rollups(table_name(name), now - days * 86400)
+    return deleted
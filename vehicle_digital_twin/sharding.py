@@ -0,0 +1,510 @@
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from batch_writer import BatchWriter
+from codec import decode
+from correlator import Correlator
+
+TOPIC_PARTS = {"vehicles/vin": "vin", "vehicles/location": "location", "vehicles/giro": "giro"}
+MODES = ("shared", "dispatch")
+# A part is forwarded at most this many times while workers disagree on the ring
+MAX_HOPS = 2
+
+DEFAULT_CONFIG = {
+    # "shared": every worker subscribes through an MQTT shared subscription;
+    # "dispatch": the twin's own client hands raw messages to the workers
+    "mode": "shared",
+    "broker": "mqtt-broker",
+    "share_group": "vehicle-twin",
+    "required": ("vin", "location", "giro"),
+    "window": 10,
+    "ttl": 30,
+    "max_entries": 100000,
+    "eviction": "oldest",
+    "wheel_tick": 1,
+    "batch_size": 500,
+    "batch_delay": 0.05,
+    "queue_size": 10000,
+    # "db" writes merged rows (and rollups) to vehicle_data; "parent" only sends
+    # them back to the twin, whose own writer stores them; "discard" only counts them
+    "write": "db",
+    # Send committed rows back to the twin (for its latest-state store); always on with "parent"
+    "report_rows": True,
+    # Messages or parts batched per inter-process send, and the longest a batch waits
+    "forward_batch": 256,
+    "forward_delay": 0.005,
+    "stats_interval": 5.0,
+}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of VINs onto worker ids.
+
+    Every worker owns ``replicas`` points on a 64-bit ring; a VIN belongs to
+    the first point at or after its own hash. Adding or removing a worker
+    only moves the VINs of the points it gains or loses, about 1/N of them.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.nodes = set()
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in range(self.replicas):
+            point = _hash(f"{node}#{i}")
+            # On the (unlikely) collision the first owner keeps the point
+            if point not in self._owners:
+                self._owners[point] = node
+                bisect.insort(self._points, point)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._points = [p for p in self._points if self._owners[p] != node]
+        self._owners = {p: self._owners[p] for p in self._points}
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[self._points[i]]
+
+
+def record_parts(record):
+    """Rebuild the part payloads buffered in a PartialRecord, to re-file them on another worker."""
+    parts = []
+    if record.ts_vin is not None:
+        parts.append(("vin", {"vin": record.vin, "ts": record.ts_vin}))
+    if record.ts_location is not None:
+        parts.append(("location", {"vin": record.vin, "ts": record.ts_location,
+                                   "latitude": record.latitude, "longitude": record.longitude}))
+    if record.ts_giro is not None:
+        parts.append(("giro", {"vin": record.vin, "ts": record.ts_giro, "giro": record.giro}))
+    return parts
+
+
+class ShardWorker:
+    """One worker process' share of the vin/location/giro join.
+
+    Raw messages arrive from the MQTT shared subscription or the dispatcher,
+    in no particular VIN order. Each is decoded and its VIN looked up on the
+    ring: parts of VINs owned here are correlated locally, the rest are
+    forwarded, decoded and in batches, to the owning worker's inbox. So every
+    VIN is joined by exactly one worker and the correlator needs no changes.
+
+    Inbox messages:
+
+    - ``("raw", [(topic, payload), ...])``
+    - ``("parts", [(part, payload), ...], hops)``: forwarded by another worker
+    - ``("members", [ids])``: new ring; partial records of VINs that moved
+      are handed to their new owner. A worker missing from the list hands
+      off everything and exits.
+    - ``("stop",)``: drain the writer and exit
+    """
+
+    def __init__(self, worker_id, members, inboxes, results, config, flush=None):
+        self.id = worker_id
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.inboxes = inboxes
+        self.results = results
+        self.ring = HashRing(members)
+        self._owners = {}
+        self._outbox = {}
+        self._lock = threading.Lock()
+        self.correlator = Correlator(
+            required=self.config["required"],
+            window=self.config["window"],
+            ttl=self.config["ttl"],
+            max_entries=self.config["max_entries"],
+            eviction=self.config["eviction"],
+            wheel_tick=self.config["wheel_tick"]
+        )
+        self.writer = BatchWriter(
+            flush or self._flush,
+            max_batch=self.config["batch_size"],
+            max_delay=self.config["batch_delay"],
+            max_queue=self.config["queue_size"],
+            name=f"shard-{worker_id}-writer"
+        )
+        self._write = None
+        self.received = 0
+        self.forwarded = 0
+        self.merged = 0
+        self.invalid = 0
+        self.handed_off = 0
+        self.rebalances = 0
+
+    def _flush(self, rows):
+        if self.config["write"] == "db":
+            if self._write is None:
+                # Imported here so a "discard" worker needs no database driver
+                import rollups
+                from db import write_vehicle_data_batch
+                aggregator = rollups.RollupAggregator()
+
+                def write(batch):
+                    write_vehicle_data_batch(batch, aggregator.aggregate(batch))
+                    aggregator.commit()
+                self._write = write
+            self._write(rows)
+        if self.config["report_rows"] or self.config["write"] == "parent":
+            self.results.put(("rows", self.id, rows))
+
+    def owner(self, vin):
+        owner = self._owners.get(vin)
+        if owner is None:
+            owner = self._owners[vin] = self.ring.node_for(vin)
+        return owner
+
+    def handle_raw(self, messages):
+        """Decode raw messages and file or forward each part; thread-safe."""
+        with self._lock:
+            for topic, payload in messages:
+                self.received += 1
+                part = TOPIC_PARTS.get(topic)
+                if part is None:
+                    continue
+                try:
+                    payload = decode(payload)
+                except Exception as e:
+                    self.invalid += 1
+                    logging.debug("[shard-%s] could not decode payload on %s: %s", self.id, topic, e)
+                    continue
+                self._route(part, payload, 0)
+
+    def handle_parts(self, parts, hops):
+        with self._lock:
+            for part, payload in parts:
+                self._route(part, payload, hops)
+
+    def _route(self, part, payload, hops):
+        vin = payload.get("vin")
+        if vin is None:
+            # "last VIN announced" attribution needs one global message order
+            self.correlator.stats["unattributed"] += 1
+            return
+        owner = self.owner(vin)
+        if owner != self.id and owner is not None and hops < MAX_HOPS:
+            self._forward(owner, [(part, payload)], hops + 1)
+            return
+        if self.correlator.add(part, payload) is not None:
+            record = self.correlator.pop_complete(vin)
+            if record is not None:
+                self.writer.submit(record.row())
+                self.merged += 1
+
+    def _forward(self, owner, parts, hops):
+        batch = self._outbox.setdefault((owner, hops), [])
+        batch.extend(parts)
+        self.forwarded += len(parts)
+        if len(batch) >= self.config["forward_batch"]:
+            self.inboxes[owner].put(("parts", batch, hops))
+            del self._outbox[(owner, hops)]
+
+    def flush_forwards(self):
+        with self._lock:
+            outbox, self._outbox = self._outbox, {}
+        for (owner, hops), batch in outbox.items():
+            self.inboxes[owner].put(("parts", batch, hops))
+
+    def rebalance(self, members):
+        """Adopt a new ring and hand partial records of VINs that moved to their new owner."""
+        with self._lock:
+            self.ring = HashRing(members)
+            self._owners = {}
+            self.rebalances += 1
+            moved = [vin for vin in self.correlator.partials if self.owner(vin) != self.id]
+            for vin in moved:
+                record = self.correlator.remove(vin)
+                owner = self.owner(vin)
+                if owner is not None:
+                    self._forward(owner, record_parts(record), 1)
+                    self.handed_off += 1
+        self.flush_forwards()
+        logging.info("[shard-%s] ring now %s; handed off %d partial records", self.id, sorted(members), len(moved))
+
+    def expire(self):
+        with self._lock:
+            return self.correlator.expire()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "received": self.received,
+                "forwarded": self.forwarded,
+                "merged": self.merged,
+                "invalid": self.invalid,
+                "handed_off": self.handed_off,
+                "rebalances": self.rebalances,
+                "buffered": len(self.correlator.partials),
+                "write_queue": self.writer.qsize(),
+                "rows_failed": self.writer.rows_failed,
+                "correlator": dict(self.correlator.stats),
+            }
+
+    def _subscribe(self):
+        import paho.mqtt.client as mqtt
+        group = self.config["share_group"]
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"{group}-{self.id}-{os.getpid()}")
+        client.on_connect = lambda c, userdata, flags, rc: c.subscribe(
+            [(f"$share/{group}/{topic}", 0) for topic in TOPIC_PARTS])
+        client.on_message = lambda c, userdata, msg: self.handle_raw([(msg.topic, msg.payload)])
+        client.connect(self.config["broker"], 1883, 60)
+        client.loop_start()
+        return client
+
+    def run(self):
+        """Serve the inbox until stopped; the worker process' main loop."""
+        self.writer.start()
+        client = self._subscribe() if self.config["mode"] == "shared" else None
+        inbox = self.inboxes[self.id]
+        next_expiry = next_stats = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = inbox.get(timeout=self.config["forward_delay"])
+                except queue.Empty:
+                    item = None
+                if item is not None:
+                    kind = item[0]
+                    if kind == "raw":
+                        self.handle_raw(item[1])
+                    elif kind == "parts":
+                        self.handle_parts(item[1], item[2])
+                    elif kind == "members":
+                        self.rebalance(item[1])
+                        if self.id not in item[1]:
+                            return
+                    elif kind == "stop":
+                        return
+                self.flush_forwards()
+                now = time.monotonic()
+                if now >= next_expiry:
+                    self.expire()
+                    next_expiry = now + self.config["wheel_tick"]
+                if now >= next_stats:
+                    self.results.put(("stats", self.id, self.stats()))
+                    next_stats = now + self.config["stats_interval"]
+        finally:
+            if client is not None:
+                client.disconnect()
+                client.loop_stop()
+            self.flush_forwards()
+            self.writer.stop()
+            self.results.put(("stats", self.id, self.stats()))
+
+
+def run_worker(worker_id, members, inboxes, results, config):
+    logging.basicConfig(level=logging.INFO, format=f"[shard-{worker_id}:%(threadName)s] %(levelname)s: %(message)s",
+                        force=True)
+    ShardWorker(worker_id, members, inboxes, results, config).run()
+
+
+def run_launcher(inboxes, results, commands, config):
+    """Fork workers on request and report the ones that exit.
+
+    Forked from the twin before it starts any thread or DB pool, so every
+    worker is forked from a clean single-threaded process, also when it is
+    started later to scale up or replace a dead one.
+    """
+    ctx = multiprocessing.get_context("fork")
+    parent = os.getppid()
+    procs = {}
+    while True:
+        try:
+            command = commands.get(timeout=0.5)
+        except queue.Empty:
+            command = None
+        for worker_id, proc in list(procs.items()):
+            if not proc.is_alive():
+                proc.join()
+                del procs[worker_id]
+                results.put(("exited", worker_id, proc.exitcode))
+        if command is None:
+            if os.getppid() != parent:
+                # The twin is gone; take the workers down with us
+                command = ("stop", 5.0)
+            else:
+                continue
+        if command[0] == "spawn":
+            worker_id, members = command[1], command[2]
+            proc = ctx.Process(target=run_worker, args=(worker_id, members, inboxes, results, config),
+                               name=f"shard-{worker_id}", daemon=True)
+            proc.start()
+            procs[worker_id] = proc
+        elif command[0] == "stop":
+            deadline = time.monotonic() + command[1]
+            for proc in procs.values():
+                proc.join(max(deadline - time.monotonic(), 0))
+                if proc.is_alive():
+                    proc.terminate()
+            return
+
+
+class ShardSupervisor:
+    """Scale-out of the vin/location/giro join over worker processes.
+
+    ``workers`` processes each correlate the VINs the consistent-hash ring
+    gives them (see ShardWorker); ``max_workers`` inbox slots are allocated
+    up front, since a queue can only reach a process when it is forked.
+    Messages come in through an MQTT shared subscription ("shared" mode) or
+    through ``dispatch()`` ("dispatch" mode), which hands raw payloads to
+    the workers round-robin in batches without decoding them.
+
+    ``scale(n)`` adds or removes workers; a worker that dies is removed from
+    the ring and, with ``restart``, started again in its slot. Every change
+    is broadcast to the workers, which hand partial records of moved VINs
+    to their new owner. Rows the workers merge are passed to ``on_rows``,
+    once written when the workers write them themselves (``write="db"``);
+    with ``write="parent"`` writing them is up to ``on_rows``.
+
+    ``start()`` forks the launcher process: call it before the process
+    starts threads or opens DB connections.
+    """
+
+    def __init__(self, workers, max_workers=None, config=None, on_rows=None, restart=True):
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        if self.config["mode"] not in MODES:
+            raise ValueError(f"unknown shard mode {self.config['mode']!r}, expected one of {MODES}")
+        self.workers = workers
+        self.max_workers = max(max_workers or workers, workers)
+        self.on_rows = on_rows
+        self.restart = restart
+        self.members = []
+        self.worker_stats = {}
+        self.rebalances = 0
+        self._ctx = multiprocessing.get_context("fork")
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._pending = []
+        self._next = 0
+        self._launcher = None
+        self._collector = None
+
+    def start(self):
+        ctx = self._ctx
+        self.inboxes = {i: ctx.Queue() for i in range(self.max_workers)}
+        self.results = ctx.Queue()
+        self._commands = ctx.Queue()
+        # Not a daemon: daemonic processes may not start children
+        self._launcher = ctx.Process(target=run_launcher,
+                                     args=(self.inboxes, self.results, self._commands, self.config),
+                                     name="shard-launcher")
+        self._launcher.start()
+        self.scale(self.workers)
+        self._collector = threading.Thread(target=self._collect, name="shard-results", daemon=True)
+        self._collector.start()
+        if self.config["mode"] == "dispatch":
+            threading.Thread(target=self._flush_loop, name="shard-dispatch", daemon=True).start()
+        return self
+
+    def scale(self, workers):
+        """Grow or shrink to ``workers`` processes (at most max_workers)."""
+        workers = max(1, min(workers, self.max_workers))
+        with self._lock:
+            members = list(range(workers))
+            added = [i for i in members if i not in self.members]
+            removed = [i for i in self.members if i not in members]
+            self.workers = workers
+            self._set_members(members, notify=removed)
+            for i in added:
+                self._commands.put(("spawn", i, members))
+
+    def _set_members(self, members, notify=()):
+        """Adopt a new ring: current members learn it, and so do the removed ones in ``notify``."""
+        if self.members:
+            self.rebalances += 1
+        for i in sorted(set(self.members) & set(members) | set(notify)):
+            self.inboxes[i].put(("members", members))
+        self.members = members
+        logging.info("Shard ring: workers %s", members)
+
+    def dispatch(self, topic, payload):
+        """Queue one raw message for the workers ("dispatch" mode); safe from the paho thread."""
+        with self._lock:
+            self._pending.append((topic, payload))
+            if len(self._pending) >= self.config["forward_batch"]:
+                self._send_pending()
+
+    def _send_pending(self):
+        if not self._pending or not self.members:
+            return
+        worker = self.members[self._next % len(self.members)]
+        self._next += 1
+        self.inboxes[worker].put(("raw", self._pending))
+        self._pending = []
+
+    def _flush_loop(self):
+        while not self._stopping.wait(self.config["forward_delay"]):
+            with self._lock:
+                self._send_pending()
+
+    def _collect(self):
+        while True:
+            try:
+                kind, worker_id, data = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            if kind == "rows":
+                if self.on_rows is not None:
+                    try:
+                        self.on_rows(data)
+                    except Exception:
+                        logging.exception("Shard row callback failed")
+            elif kind == "stats":
+                self.worker_stats[worker_id] = data
+            elif kind == "exited":
+                self._worker_exited(worker_id, data)
+
+    def _worker_exited(self, worker_id, exitcode):
+        with self._lock:
+            if self._stopping.is_set() or worker_id not in self.members:
+                return
+            logging.error("Shard worker %s exited with code %s", worker_id, exitcode)
+            if self.restart:
+                # The ring is unchanged: its slot, and whatever is queued in its
+                # inbox, goes to a fresh worker. Its partial records are lost.
+                self._commands.put(("spawn", worker_id, self.members))
+            else:
+                self._set_members([i for i in self.members if i != worker_id])
+
+    def merged(self):
+        return sum(s["merged"] for s in self.worker_stats.values())
+
+    def stop(self, timeout=10.0):
+        """Send the pending batch, let every worker drain its writer, and wait for them."""
+        if self._launcher is None or self._stopping.is_set():
+            return
+        with self._lock:
+            self._send_pending()
+            self._stopping.set()
+            for i in self.members:
+                self.inboxes[i].put(("stop",))
+        self._commands.put(("stop", timeout))
+        self._launcher.join(timeout + 1)
+        if self._launcher.is_alive():
+            self._launcher.terminate()
+        # Hand the rows the workers drained on exit to on_rows before returning
+        self._collector.join(timeout)
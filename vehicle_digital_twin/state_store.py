@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+class LatestStateStore:
+    """Latest (vin, latitude, longitude, giro, event_time) row per VIN, kept in memory.
+
+    The merge path calls ``update()`` for every record it queues for the DB
+    (write-through), so lookups never touch PostgreSQL. Rows are immutable
+    tuples replaced whole, so readers on other threads see either the old or
+    the new state of a VIN, never a mix.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._rows = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, vin):
+        return vin in self._rows
+
+    def update(self, row):
+        """Record row as the current state of its VIN."""
+        vin = row[0]
+        with self._lock:
+            self._rows[vin] = row
+            self._updated[vin] = self.clock()
+
+    def warm(self, rows):
+        """Seed the store from vehicle_data rows, e.g. the DB's latest row per VIN.
+
+        VINs already updated live are left alone since their state is newer.
+        Returns the number of VINs loaded.
+        """
+        loaded = 0
+        for row in rows:
+            with self._lock:
+                if row[0] not in self._rows:
+                    self._rows[row[0]] = tuple(row)
+                    self._updated[row[0]] = None
+                    loaded += 1
+        return loaded
+
+    def get(self, vin):
+        """The latest row of vin, or None if it was never seen."""
+        return self._rows.get(vin)
+
+    def updated_at(self, vin):
+        """When vin was last updated live (clock time), or None if only warmed or unknown."""
+        return self._updated.get(vin)
+
+    def all(self):
+        """Snapshot of the latest row of every VIN."""
+        with self._lock:
+            return list(self._rows.values())
@@ -1,37 +1,130 @@
+import asyncio
+import atexit
 import json
 import time
 import threading
 import logging
+import os
+import signal
 import sys
 from pathlib import Path
 import paho.mqtt.client as mqtt
-from db import init_db, write_vehicle_data
-from time import time
+from batch_writer import BatchWriter
+from aio_runtime import RUNTIMES, AsyncBatchWriter, consume, run_periodically
+from codec import TopicCodecs
+from metrics import REGISTRY, start_http_server
+from correlator import Correlator
+from state_store import LatestStateStore
+from sharding import ShardSupervisor
+import rollups
+from db import init_db, size_pool, write_vehicle_data_batch, close_pool, iter_latest_vehicle_data, maintain_partitions, \
+    data_version, WriteInDoubt
 
 # add project root to sys.path for plugin imports
 # ROOT = Path(__file__).resolve().parent.parent
 # sys.path.insert(0, str(ROOT))
 
-from plugin_manager import load_plugins
+from plugin_manager import PluginManager
+from topic_router import TopicRouter
+from aio_router import AsyncTopicRouter
 
 try:
-    from db import read_all_vehicle_data
+    from db import read_all_vehicle_data, iter_vehicle_data, iter_vehicle_data_since
 except Exception:
     read_all_vehicle_data = None
+    iter_vehicle_data = None
+    iter_vehicle_data_since = None
     logging.warning("db.read_all_vehicle_data not available; trigger will be a no-op")
 
-BROKER = "mqtt-broker"
+# Overridable so the twin can run outside compose (e.g. benchmarks/bench_e2e.py)
+BROKER = os.environ.get("BROKER", "mqtt-broker")
 TOPIC_VIN = "vehicles/vin"
 TOPIC_GIRO = "vehicles/giro"
 TOPIC_LOCATION = "vehicles/location"
 
+# Prometheus text endpoint (GET /metrics); 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+# Per-topic wire codecs for publishing (WIRE_CODECS); incoming payloads in any codec are decoded
+codecs = TopicCodecs.from_env()
+
+# Scale-out: SHARD_WORKERS > 0 moves decoding and the vin/location/giro join to
+# that many worker processes, each joining the VINs a consistent-hash ring gives
+# it. Merged rows come back to this process's one DB writer, so vehicle_data ids
+# still commit in increasing order (incremental sync relies on it). SHARD_MODE "shared" has the workers consume through an MQTT shared
+# subscription; "dispatch" keeps one client here that hands them raw messages.
+# Workers can be added up to SHARD_MAX_WORKERS (context["shards"].scale(n)).
+SHARD_WORKERS = int(os.environ.get("SHARD_WORKERS", 0))
+SHARD_MAX_WORKERS = int(os.environ.get("SHARD_MAX_WORKERS", SHARD_WORKERS))
+SHARD_MODE = os.environ.get("SHARD_MODE", "shared")
+
+# Runtime: "threads" (paho network thread, psycopg2 pool) or "asyncio" (aiomqtt
+# and an asyncpg pool on one event loop). Under asyncio the plugins share an
+# AsyncTopicRouter: coroutine handlers run on the loop, blocking handlers on a
+# fixed pool of PLUGIN_THREADS threads, at most PLUGIN_MAX_CONCURRENCY at once.
+TWIN_RUNTIME = os.environ.get("TWIN_RUNTIME", "threads")
+PLUGIN_THREADS = int(os.environ.get("PLUGIN_THREADS", 8))
+PLUGIN_MAX_CONCURRENCY = int(os.environ.get("PLUGIN_MAX_CONCURRENCY", 1000))
+if TWIN_RUNTIME not in RUNTIMES:
+    raise ValueError(f"TWIN_RUNTIME must be one of {RUNTIMES}, not {TWIN_RUNTIME!r}")
+if TWIN_RUNTIME == "asyncio" and SHARD_WORKERS:
+    raise ValueError("SHARD_WORKERS requires TWIN_RUNTIME=threads")
+
+def plugin_db_threads(path):
+    """Threads the enabled plugins in listeners.json can use the DB from: their executor_workers, else one."""
+    try:
+        with open(path) as f:
+            plugins = json.load(f).get("plugins", [])
+    except (OSError, ValueError) as e:
+        logging.warning("Could not read %s to size the DB pool: %s", path, e)
+        return 0
+    return sum(max(int(p.get("config", {}).get("executor_workers", 0)), 1) for p in plugins if p.get("enabled", True))
+
+# One pooled connection per thread that can hold one at a time: the batch writer,
+# partition maintenance, start-up reads and the plugins (whose blocking handlers
+# share PLUGIN_THREADS under asyncio). Plugins enabled later by a live reload are
+# not counted.
+config_path = Path(__file__).parent / "listeners.json"
+size_pool(3 + (PLUGIN_THREADS if TWIN_RUNTIME == "asyncio" else plugin_db_threads(config_path)))
 init_db()
-
-# Temporary storage for partial data
-buffer = {}
+rollups.init_rollups()
 
 # How long partial records can live before being cleaned (optional)
 EXPIRATION_SECONDS = 30
+# How often expired partial records are swept
+EXPIRY_INTERVAL = 1
+# Hard cap on buffered partial records; "oldest" evicts the record closest to
+# expiry when full, "reject" drops the incoming part instead
+MAX_BUFFERED_RECORDS = 100000
+EVICTION_POLICY = "oldest"
+
+# Streaming join of the three topics, keyed by VIN. A record is written once all
+# REQUIRED_PARTS arrived within CORRELATION_WINDOW seconds of event time.
+REQUIRED_PARTS = ("vin", "location", "giro")
+CORRELATION_WINDOW = 10
+TOPIC_PARTS = {TOPIC_VIN: "vin", TOPIC_LOCATION: "location", TOPIC_GIRO: "giro"}
+
+correlator = Correlator(
+    required=REQUIRED_PARTS,
+    window=CORRELATION_WINDOW,
+    ttl=EXPIRATION_SECONDS,
+    max_entries=MAX_BUFFERED_RECORDS,
+    eviction=EVICTION_POLICY,
+    wheel_tick=EXPIRY_INTERVAL
+)
+# Temporary storage for partial data (VIN -> partial record)
+buffer = correlator.partials
+# Serializes the paho thread and the cleanup thread on the buffer
+buffer_lock = threading.Lock()
+
+# Group commit: flush merged records every WRITE_BATCH_SIZE rows or WRITE_BATCH_DELAY seconds
+WRITE_BATCH_SIZE = 500
+WRITE_BATCH_DELAY = 0.05
+WRITE_QUEUE_SIZE = 10000
+# How often listeners.json is checked for changes
+PLUGIN_RELOAD_INTERVAL = 2
+# How often daily vehicle_data partitions are created ahead / dropped past retention
+PARTITION_MAINTENANCE_INTERVAL = 3600
 
 logging.basicConfig(
     level=logging.INFO,
@@ -39,93 +132,172 @@ logging.basicConfig(
     force=True
 )
 
-context = {"broker": BROKER, "read_all_vehicle_data": read_all_vehicle_data}
-# Load plugins using absolute path
-config_path = Path(__file__).parent / "listeners.json"
-plugins = load_plugins(str(config_path), context)
-
-def merge_and_store(vin):
-    """If all parts exist for this VIN, merge and write to DB."""
-    record = buffer.get(vin)
-
-    if not record:
-        return  # nothing to merge
-    
-    required_fields = ["location", "giro", "vin"]
-    
-    if all(key in record for key in required_fields):
-        # Merge everything
-        final = {
-            **record["vin"],
-            **record["location"],
-            **record["giro"]
-        }
-
-        print(f"Final merged record for {vin}: {final}")
-
-        # Write to DB
-        write_vehicle_data(final["vin"], final["latitude"], final["longitude"], final["giro"])
-
-        # Remove from buffer
-        del buffer[vin]
+# Latest merged state per VIN, updated write-through from try_merge (or from the
+# rows the shard workers merge) and warmed from the DB below so lookups are
+# served from memory after a restart
+latest_state = LatestStateStore()
+
+RECORDS_MERGED = REGISTRY.counter("twin_records_merged_total", "Complete records queued for the DB")
+
+# Per-VIN 1m/1h/1d aggregates, upserted with every written batch
+rollup_aggregator = rollups.RollupAggregator()
+
+def flush_batch(rows):
+    write_vehicle_data_batch(rows, rollup_aggregator.aggregate(rows))
+    rollup_aggregator.commit()
+
+def flush_retryable(exc):
+    # A batch that may already have committed is not written again: its rows would be stored twice
+    return not isinstance(exc, WriteInDoubt)
+
+# Under asyncio, run_async() creates an AsyncBatchWriter on the event loop instead.
+# Started below, once the shard launcher is forked
+writer = None
+if TWIN_RUNTIME == "threads":
+    writer = BatchWriter(
+        flush_batch,
+        max_batch=WRITE_BATCH_SIZE,
+        max_delay=WRITE_BATCH_DELAY,
+        max_queue=WRITE_QUEUE_SIZE,
+        name="db-writer",
+        retryable=flush_retryable
+    )
+
+def on_shard_rows(rows):
+    for row in rows:
+        writer.submit(row)
+        latest_state.update(row)
+    RECORDS_MERGED.inc(len(rows))
+
+shards = None
+if SHARD_WORKERS:
+    # Forks the worker launcher: must run before any thread or pooled DB connection exists
+    shards = ShardSupervisor(
+        SHARD_WORKERS,
+        max_workers=SHARD_MAX_WORKERS,
+        config={
+            "mode": SHARD_MODE,
+            "broker": BROKER,
+            "required": REQUIRED_PARTS,
+            "window": CORRELATION_WINDOW,
+            "ttl": EXPIRATION_SECONDS,
+            "max_entries": MAX_BUFFERED_RECORDS // SHARD_WORKERS,
+            "eviction": EVICTION_POLICY,
+            "wheel_tick": EXPIRY_INTERVAL,
+            "batch_size": WRITE_BATCH_SIZE,
+            "batch_delay": WRITE_BATCH_DELAY,
+            "queue_size": WRITE_QUEUE_SIZE,
+            # One writer for every row: see SHARD_WORKERS above
+            "write": "parent",
+        },
+        on_rows=on_shard_rows
+    ).start()
+
+if writer is not None:
+    writer.start()
+MESSAGES_RECEIVED = REGISTRY.counter("twin_messages_received_total", "MQTT messages received", ("topic",))
+MESSAGE_SECONDS = REGISTRY.histogram("twin_message_seconds", "Time to decode and correlate one message")
+DECODE_ERRORS = REGISTRY.counter("twin_decode_errors_total", "Payloads that could not be decoded")
+REGISTRY.gauge("twin_buffered_records", "Partial records waiting in the merge buffer", fn=lambda: len(buffer))
+REGISTRY.counter("twin_correlator_events_total", "Correlator outcomes", ("event",), fn=lambda: dict(correlator.stats))
+REGISTRY.gauge("twin_write_queue_rows", "Merged rows waiting for the DB writer", fn=lambda: writer.qsize() if writer is not None else 0)
+REGISTRY.counter("twin_write_failed_rows_total", "Rows dropped by failed batch writes", fn=lambda: writer.rows_failed if writer is not None else 0)
+REGISTRY.counter("twin_write_retries_total", "Failed batch writes retried", fn=lambda: writer.retries if writer is not None else 0)
+REGISTRY.gauge("twin_latest_state_vins", "VINs held in the latest-state store", fn=lambda: len(latest_state))
+if shards is not None:
+    def _shard_stat(key):
+        return lambda: {str(worker): stats[key] for worker, stats in shards.worker_stats.items()}
+    REGISTRY.gauge("twin_shard_workers", "Worker processes in the shard ring", fn=lambda: len(shards.members))
+    REGISTRY.counter("twin_shard_rebalances_total", "Shard ring membership changes", fn=lambda: shards.rebalances)
+    REGISTRY.counter("twin_shard_messages_total", "Messages received per shard worker", ("worker",),
+                     fn=_shard_stat("received"))
+    REGISTRY.counter("twin_shard_forwarded_total", "Parts forwarded to the VIN's owning worker", ("worker",),
+                     fn=_shard_stat("forwarded"))
+    REGISTRY.gauge("twin_shard_buffered_records", "Partial records buffered per shard worker", ("worker",),
+                   fn=_shard_stat("buffered"))
+# Resolved once so the hot path does not look up label children
+_received_by_topic = {topic: MESSAGES_RECEIVED.labels(topic=topic) for topic in TOPIC_PARTS}
+
+# atexit runs last-registered first: drain the writer (and the shard workers), then close the pool
+atexit.register(close_pool)
+if writer is not None:
+    atexit.register(writer.stop)
+if shards is not None:
+    atexit.register(shards.stop)
+# docker stop sends SIGTERM; exit normally so the writer is drained
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+if TWIN_RUNTIME == "threads":
+    try:
+        logging.info("Warmed latest state for %d VINs", latest_state.warm(iter_latest_vehicle_data()))
+    except Exception as e:
+        logging.warning("Could not warm latest state from DB: %s", e)
+
+context = {
+    "broker": BROKER,
+    "read_all_vehicle_data": read_all_vehicle_data,
+    "iter_vehicle_data": iter_vehicle_data,
+    "iter_vehicle_data_since": iter_vehicle_data_since,
+    "latest_state": latest_state,
+    "query_history": rollups.query_history,
+    # Bumped by every write; the RPC server's result cache is keyed on it
+    "data_version": data_version,
+    "codecs": codecs,
+    "metrics": REGISTRY,
+    "shards": shards,
+}
+# Load plugins from listeners.json (config_path, above)
+plugin_manager = None
+if TWIN_RUNTIME == "threads":
+    # All plugins share one broker connection, separate from the ingest client below
+    plugin_router = TopicRouter(BROKER, client_id=f"vehicle-twin-plugins-{os.getpid()}")
+    plugin_manager = PluginManager(str(config_path), context, router=plugin_router)
+    plugins = plugin_manager.load()
+    # Edits to listeners.json are applied live: only changed plugins are restarted
+    plugin_manager.watch(PLUGIN_RELOAD_INTERVAL)
+    # Registered after the writer, so plugins are drained first on exit
+    atexit.register(plugin_manager.stop_all)
 
 def ensure_buffer(vin):
-    if vin not in buffer:
-        buffer[vin] = {"vin": None, "location": None, "giro": None}
+    correlator.ensure(vin)
 
 
 def try_merge(vin):
-    entry = buffer.get(vin)
-    if not entry:
-        return
+    entry = correlator.pop_complete(vin)
+    if entry is not None:
+        # (vin, latitude, longitude, giro, event_time), ready for the batched DB write
+        row = entry.row()
+        logging.debug("Merged complete record: %s", row)
+        writer.submit(row)
+        latest_state.update(row)
+        RECORDS_MERGED.inc()
 
-    if entry["vin"] and entry["location"] and entry["giro"]:
-        merged = {
-            **entry["vin"],
-            **entry["location"],
-            **entry["giro"]
-        }
-        print("Merged complete record:", merged)
-
-        # Write to DB (adjust fields as needed)
-        write_vehicle_data(
-            merged["vin"],
-            merged["latitude"],
-            merged["longitude"],
-            merged["giro"]
-        )
+def on_message(client, userdata, msg):
+    start = time.perf_counter()
+    received = _received_by_topic.get(msg.topic)
+    if received is None:
+        received = MESSAGES_RECEIVED.labels(topic=msg.topic)
+    received.inc()
+    try:
+        payload = codecs.decode(msg.payload)
+    except Exception as e:
+        DECODE_ERRORS.inc()
+        logging.warning("Could not decode payload on %s: %s", msg.topic, e)
+        return
+    # DEBUG, not INFO: formatting every message was a measurable share of ingest time
+    logging.debug("Received on %s: %s", msg.topic, payload)
 
-        # Remove to start fresh
-        del buffer[vin]
+    part = TOPIC_PARTS.get(msg.topic)
+    if part is None:
+        return
 
-def on_message(client, userdata, msg):
-    payload = json.loads(msg.payload.decode())
-    logging.info(f"Received on {msg.topic}: {payload}")
-
-    vin = None
-    if msg.topic == TOPIC_VIN:
-        vin = payload["vin"]
-        ensure_buffer(vin)
-        buffer[vin]["vin"] = payload
-
-    elif msg.topic == TOPIC_LOCATION:
-        if not buffer:
-            print("WARNING: location received but no VIN known yet")
-            return
-        vin = list(buffer.keys())[-1]
-        ensure_buffer(vin)
-        buffer[vin]["location"] = payload
-
-    elif msg.topic == TOPIC_GIRO:
-        if not buffer:
-            print("WARNING: status received but no VIN known yet")
-            return
-        vin = list(buffer.keys())[-1]
-        ensure_buffer(vin)
-        buffer[vin]["giro"] = payload
-
-    if vin:
-        try_merge(vin)
+    with buffer_lock:
+        vin = correlator.add(part, payload)
+        if vin is None:
+            print(f"WARNING: {part} received but could not be correlated to a VIN")
+        else:
+            try_merge(vin)
+    MESSAGE_SECONDS.observe(time.perf_counter() - start)
 
 def prepare_data():
     print("Preparing data")
@@ -134,28 +306,124 @@ def on_trigger_cleanup():
     """Periodically clean up expired buffer entries."""
     while True:
         cleanup_buffer()
-        time.sleep(EXPIRATION_SECONDS)
+        time.sleep(EXPIRY_INTERVAL)
 
-def cleanup_buffer():
+def cleanup_buffer(now=None):
     """Remove expired entries from the buffer."""
-    current_time = time()
-    to_delete = []
-    for vin, record in buffer.items():
-        if "timestamp" in record:
-            if current_time - record["timestamp"] > EXPIRATION_SECONDS:
-                to_delete.append(vin)
-    for vin in to_delete:
-        print(f"Cleaning up expired record for VIN: {vin}")
-        del buffer[vin]
-
-client = mqtt.Client()
-client.on_message = on_message
-client.connect(BROKER, 1883, 60)
-client.subscribe(TOPIC_VIN)
-client.subscribe(TOPIC_GIRO)
-client.subscribe(TOPIC_LOCATION)
-# client.subscribe(DATA_TOPIC)
-print("Consumer running...")
+    with buffer_lock:
+        expired = correlator.expire(now)
+    if expired:
+        logging.info(
+            "Cleaned up %d expired records (expired=%d evicted=%d buffered=%d)",
+            len(expired), correlator.stats["expired"], correlator.stats["evicted"], len(buffer)
+        )
+
+def partition_maintenance():
+    """Pre-create upcoming vehicle_data partitions and drop expired partitions and rollups."""
+    maintain_partitions()
+    rollups.prune()
+
+def on_trigger_partition_maintenance():
+    """Periodically run partition_maintenance()."""
+    while True:
+        try:
+            partition_maintenance()
+        except Exception as e:
+            logging.exception("Partition maintenance failed: %s", e)
+        time.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+if METRICS_PORT:
+    try:
+        start_http_server(METRICS_PORT)
+    except OSError as e:
+        logging.warning("Metrics endpoint not started on port %d: %s", METRICS_PORT, e)
+
+async def run_async():
+    """The asyncio runtime: ingest, batched DB writes and plugin I/O on this event loop.
+
+    Schema set-up (above) and partition maintenance keep using db.py, off the loop.
+    """
+    global writer, plugin_manager
+    import aio_db
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    # docker stop sends SIGTERM: leave the loop through the shutdown below
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    await aio_db.open_pool()
+
+    async def flush_batch_async(rows):
+        await aio_db.write_vehicle_data_batch(rows, rollup_aggregator.aggregate(rows))
+        rollup_aggregator.commit()
+
+    writer = AsyncBatchWriter(
+        flush_batch_async,
+        max_batch=WRITE_BATCH_SIZE,
+        max_delay=WRITE_BATCH_DELAY,
+        max_queue=WRITE_QUEUE_SIZE,
+        name="db-writer",
+        retryable=flush_retryable
+    ).start()
+    try:
+        loaded = 0
+        async for row in aio_db.iter_latest_vehicle_data():
+            loaded += latest_state.warm((row,))
+        logging.info("Warmed latest state for %d VINs", loaded)
+    except Exception as e:
+        logging.warning("Could not warm latest state from DB: %s", e)
+
+    context["aiter_vehicle_data"] = aio_db.iter_vehicle_data
+    plugin_router = AsyncTopicRouter(
+        BROKER,
+        client_id=f"vehicle-twin-plugins-{os.getpid()}",
+        plugin_threads=PLUGIN_THREADS,
+        max_concurrency=PLUGIN_MAX_CONCURRENCY
+    )
+    plugin_manager = PluginManager(str(config_path), context, router=plugin_router)
+    # Plugin start() may block: keep it off the loop
+    await loop.run_in_executor(None, plugin_manager.load)
+    plugin_manager.watch(PLUGIN_RELOAD_INTERVAL)
+
+    async def on_message_async(client, userdata, msg):
+        on_message(client, userdata, msg)
+        # Stop reading from the broker while the writer is full
+        await writer.wait_for_space()
+
+    tasks = [
+        loop.create_task(consume(BROKER, (TOPIC_VIN, TOPIC_GIRO, TOPIC_LOCATION), on_message_async)),
+        loop.create_task(run_periodically(cleanup_buffer, EXPIRY_INTERVAL, "Buffer cleanup")),
+        loop.create_task(run_periodically(partition_maintenance, PARTITION_MAINTENANCE_INTERVAL,
+                                          "Partition maintenance", blocking=True)),
+    ]
+    print("Consumer running (asyncio)...")
+    try:
+        await stopping.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await loop.run_in_executor(None, plugin_manager.stop_all)
+        plugin_router.stop()
+        await writer.stop()
+        await aio_db.close_pool()
+
+if TWIN_RUNTIME == "threads":
+    threading.Thread(target=on_trigger_cleanup, name="buffer-cleanup", daemon=True).start()
+    threading.Thread(target=on_trigger_partition_maintenance, name="partition-maintenance", daemon=True).start()
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1)
+    if shards is None:
+        client.on_message = on_message
+    else:
+        # Dispatch mode: the paho thread only batches raw payloads for the workers
+        client.on_message = lambda c, userdata, msg: shards.dispatch(msg.topic, msg.payload)
+    if shards is None or SHARD_MODE == "dispatch":
+        client.connect(BROKER, 1883, 60)
+        client.subscribe(TOPIC_VIN)
+        client.subscribe(TOPIC_GIRO)
+        client.subscribe(TOPIC_LOCATION)
+    # client.subscribe(DATA_TOPIC)
+    print("Consumer running...")
 
 # def trigger_on_message(client: mqtt.Client, userdata, msg):
 #     """Handle trigger requests: read DB and publish data."""
@@ -263,4 +531,11 @@ print("Consumer running...")
 # start RPC server thread
 # threading.Thread(target=rpc_server, name="rpc-server", daemon=True).start()
 
-client.loop_forever()
+if TWIN_RUNTIME == "asyncio":
+    asyncio.run(run_async())
+elif shards is not None and SHARD_MODE == "shared":
+    # The workers consume through the shared subscription; keep the plugins and metrics up
+    while True:
+        time.sleep(3600)
+else:
+    client.loop_forever()